@@ -0,0 +1,127 @@
+# bench_bulk_writer.py
+"""
+Benchmark the COPY-based bulk writer against row-by-row inserts.
+
+Builds synthetic 100-item notas (through the real XML parser and a JSON round
+trip, exactly as the worker receives them), loads them once with the previous
+row-by-row strategy (one fetchval per item, one execute per tax row) and once
+with bulk_writer.write_notas_batch, and prints rows/sec for each. Benchmark
+rows are deleted afterwards.
+
+Requires a database with the load_service tables (see DATABASE_URL in db_utils).
+
+Usage:
+    python bench_bulk_writer.py [--notas 200] [--items 100] [--batch 50]
+"""
+import argparse
+import asyncio
+import json
+import time
+
+import asyncpg
+
+from bench_xml_parser import build_nfe
+from bulk_writer import (
+    NOTA_COLUMNS, ITEM_COLUMNS, IMPOSTOS_NOTA_COLUMNS, IMPOSTOS_ITEM_COLUMNS,
+    build_staging_records, write_notas_batch
+)
+from db_utils import DATABASE_URL, ensure_tables_exist
+from partitions import ensure_partitions
+from xml_parser import parse_nfe_xml
+
+CHAVE_PREFIX = "99"  # no real chave de acesso starts with UF code 99
+
+
+def build_notas(count: int, item_count: int, offset: int) -> list:
+    """Synthetic notas with distinct chaves, shaped like a decoded queue message"""
+    template = json.dumps(parse_nfe_xml(build_nfe(item_count)), default=str)
+    original = json.loads(template)[0]['chave_acesso']
+    notas = []
+    for n in range(offset, offset + count):
+        chave = f"{CHAVE_PREFIX}{n:042d}"
+        notas.append(tuple(json.loads(template.replace(original, chave))))
+    return notas
+
+
+def _placeholders(count: int, start: int = 1) -> str:
+    return ', '.join(f'${i}' for i in range(start, start + count))
+
+
+async def write_row_by_row(conn: asyncpg.Connection, notas: list):
+    """The previous strategy: one statement per row, item ids fetched one by one"""
+    insert_nota = (f"INSERT INTO notasfiscais ({', '.join(NOTA_COLUMNS)}) VALUES ({_placeholders(len(NOTA_COLUMNS))}) "
+                   "ON CONFLICT (chave_acesso, data_emissao) DO NOTHING")
+    insert_impostos_nota = (f"INSERT INTO impostos_nota_fiscal ({', '.join(IMPOSTOS_NOTA_COLUMNS)}) "
+                            f"VALUES ({_placeholders(len(IMPOSTOS_NOTA_COLUMNS))}) ON CONFLICT (chave_acesso_nf) DO NOTHING")
+    insert_item = (f"INSERT INTO itens_nota ({', '.join(ITEM_COLUMNS)}) VALUES ({_placeholders(len(ITEM_COLUMNS))}) "
+                   "RETURNING id_item_nf")
+    insert_imposto_item = (f"INSERT INTO impostos_item (id_item_nf, {', '.join(IMPOSTOS_ITEM_COLUMNS)}) "
+                           f"VALUES ($1, {_placeholders(len(IMPOSTOS_ITEM_COLUMNS), 2)})")
+
+    for nota in notas:
+        # Same value coercion as the bulk path, so only the write strategy differs
+        records = build_staging_records([nota])
+        await ensure_partitions(conn, [records['stg_notasfiscais'][0][NOTA_COLUMNS.index('data_emissao')]])
+        await conn.execute(insert_nota, *records['stg_notasfiscais'][0])
+        for record in records['stg_impostos_nota_fiscal']:
+            await conn.execute(insert_impostos_nota, *record)
+        item_ids = {}
+        for record in records['stg_itens_nota']:
+            item_ids[record[ITEM_COLUMNS.index('numero_produto')]] = await conn.fetchval(insert_item, *record)
+        for record in records['stg_impostos_item']:
+            id_item_nf = item_ids.get(record[IMPOSTOS_ITEM_COLUMNS.index('numero_item')])
+            if id_item_nf is not None:
+                await conn.execute(insert_imposto_item, id_item_nf, *record)
+
+
+async def write_bulk(conn: asyncpg.Connection, notas: list, batch: int):
+    for start in range(0, len(notas), batch):
+        await write_notas_batch(conn, notas[start:start + batch])
+
+
+async def cleanup(conn: asyncpg.Connection):
+    # No foreign keys between the partitioned tables: every table is cleaned up explicitly
+    for table, column in (('impostos_item', 'chave_acesso_nf'), ('itens_nota', 'chave_acesso_nf'),
+                          ('impostos_nota_fiscal', 'chave_acesso_nf'), ('notasfiscais', 'chave_acesso')):
+        await conn.execute(f"DELETE FROM {table} WHERE {column} LIKE $1", CHAVE_PREFIX + '%')
+
+
+def rows_in(notas: list) -> int:
+    return sum(1 + len(items) + len(impostos_items) + (1 if impostos_nota else 0)
+               for _nota, items, impostos_nota, impostos_items in notas)
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--notas', type=int, default=200, help="notas per strategy")
+    parser.add_argument('--items', type=int, default=100, help="items per nota")
+    parser.add_argument('--batch', type=int, default=50, help="notas per bulk transaction")
+    args = parser.parse_args()
+
+    await ensure_tables_exist()
+    row_by_row_notas = build_notas(args.notas, args.items, 0)
+    bulk_notas = build_notas(args.notas, args.items, args.notas)
+    rows = rows_in(bulk_notas)
+
+    conn = await asyncpg.connect(DATABASE_URL)
+    try:
+        await cleanup(conn)
+
+        start = time.perf_counter()
+        await write_row_by_row(conn, row_by_row_notas)
+        row_by_row = rows / (time.perf_counter() - start)
+
+        start = time.perf_counter()
+        await write_bulk(conn, bulk_notas, args.batch)
+        bulk = rows / (time.perf_counter() - start)
+    finally:
+        await cleanup(conn)
+        await conn.close()
+
+    print(f"{args.notas} notas x {args.items} items ({rows} rows per strategy)")
+    print(f"{'row-by-row rows/s':>20} {'bulk rows/s':>12} {'speedup':>8}")
+    print(f"{row_by_row:>20.0f} {bulk:>12.0f} {bulk / row_by_row:>7.1f}x")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,155 @@
+# bench_item_storage.py
+"""
+Benchmark item storage before and after normalization (migration 0004).
+
+Loads the same synthetic items (through the real XML parser and a JSON round
+trip, see bench_bulk_writer.build_notas) into two scratch tables in a
+temporary schema:
+
+    wide        the former itensnotafiscal layout, nota header repeated per item
+    normalized  the itens_nota layout, item-level fields only
+
+Both get the same primary key and (chave_acesso_nf, numero_produto) index and
+are written with COPY, `--batch` notas per transaction, like bulk_writer. For
+each layout it prints ingest rate, WAL generated (pg_current_wal_lsn before and
+after, so run it on an otherwise idle database) and table/index size. The
+nota header is written to notasfiscais in both layouts, so it is not counted.
+The scratch schema is dropped afterwards.
+
+Usage:
+    python bench_item_storage.py [--notas 500] [--items 100] [--batch 50]
+"""
+import argparse
+import asyncio
+import time
+
+import asyncpg
+
+from bench_bulk_writer import build_notas
+from bulk_writer import NOTA_COLUMNS, ITEM_COLUMNS, build_staging_records
+from db_utils import DATABASE_URL
+
+SCHEMA = "bench_item_storage"
+
+# Layout of itensnotafiscal before 0004
+WIDE_COLUMNS = (
+    'chave_acesso_nf', 'modelo', 'serie_nf', 'numero_nf', 'natureza_operacao', 'data_emissao',
+    'cpf_cnpj_emitente', 'razao_social_emitente', 'inscricao_estadual_emitente', 'uf_emitente',
+    'municipio_emitente', 'cnpj_destinatario', 'nome_destinatario', 'uf_destinatario',
+    'indicador_ie_destinatario', 'destino_operacao', 'consumidor_final', 'presenca_comprador',
+    'numero_produto', 'descricao_produto', 'codigo_ncm_sh', 'ncm_sh_tipo_produto', 'cfop',
+    'quantidade', 'unidade', 'valor_unitario', 'valor_total'
+)
+
+HEADER_DDL = """
+    modelo VARCHAR(100),
+    serie_nf VARCHAR(10),
+    numero_nf VARCHAR(20),
+    natureza_operacao VARCHAR(255),
+    data_emissao DATE NOT NULL,
+    cpf_cnpj_emitente VARCHAR(20),
+    razao_social_emitente VARCHAR(255),
+    inscricao_estadual_emitente VARCHAR(20),
+    uf_emitente CHAR(2),
+    municipio_emitente VARCHAR(100),
+    cnpj_destinatario VARCHAR(20),
+    nome_destinatario VARCHAR(255),
+    uf_destinatario CHAR(2),
+    indicador_ie_destinatario VARCHAR(50),
+    destino_operacao VARCHAR(100),
+    consumidor_final VARCHAR(50),
+    presenca_comprador VARCHAR(100),"""
+
+ITEM_DDL = """
+    numero_produto INT,
+    descricao_produto VARCHAR(500),
+    codigo_ncm_sh VARCHAR(20),
+    ncm_sh_tipo_produto VARCHAR(255),
+    cfop VARCHAR(10),
+    quantidade DECIMAL(15,4),
+    unidade VARCHAR(20),
+    valor_unitario DECIMAL(15,4),
+    valor_total DECIMAL(15,2),"""
+
+TABLE_DDL = {
+    "wide": f"""
+        id_item_nf SERIAL,
+        chave_acesso_nf VARCHAR(44) NOT NULL,{HEADER_DDL}{ITEM_DDL}
+        PRIMARY KEY (id_item_nf, data_emissao)""",
+    "normalized": f"""
+        id_item_nf SERIAL,
+        chave_acesso_nf VARCHAR(44) NOT NULL,
+        data_emissao DATE NOT NULL,{ITEM_DDL}
+        PRIMARY KEY (id_item_nf, data_emissao)""",
+}
+
+
+def build_records(notas: list) -> dict:
+    """COPY records of the items of `notas` in both layouts, coerced as bulk_writer does"""
+    records = build_staging_records(notas)
+    headers = {record[0]: dict(zip(NOTA_COLUMNS, record)) for record in records['stg_notasfiscais']}
+    wide = []
+    for record in records['stg_itens_nota']:
+        item = dict(zip(ITEM_COLUMNS, record))
+        row = {**headers[item['chave_acesso_nf']], **item}
+        wide.append(tuple(row[column] for column in WIDE_COLUMNS))
+    return {"wide": (WIDE_COLUMNS, wide), "normalized": (ITEM_COLUMNS, records['stg_itens_nota'])}
+
+
+async def load(conn: asyncpg.Connection, table: str, columns: tuple, batches: list) -> dict:
+    wal_start = await conn.fetchval("SELECT pg_current_wal_lsn()")
+    start = time.perf_counter()
+    for batch in batches:
+        async with conn.transaction():
+            await conn.copy_records_to_table(table, schema_name=SCHEMA, records=batch, columns=columns)
+    elapsed = time.perf_counter() - start
+    wal_bytes = await conn.fetchval("SELECT pg_wal_lsn_diff(pg_current_wal_lsn(), $1::pg_lsn)", wal_start)
+    await conn.execute(f"ANALYZE {SCHEMA}.{table}")
+    sizes = await conn.fetchrow("""
+        SELECT pg_table_size(c.oid) AS heap, pg_indexes_size(c.oid) AS indexes, pg_total_relation_size(c.oid) AS total
+        FROM pg_class c WHERE c.oid = to_regclass($1)
+    """, f"{SCHEMA}.{table}")
+    rows = sum(len(batch) for batch in batches)
+    return {"rows": rows, "rows_per_s": rows / elapsed, "wal": int(wal_bytes), **dict(sizes)}
+
+
+def _mb(value: int) -> str:
+    return f"{value / 1024 / 1024:.1f}"
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--notas', type=int, default=500, help="synthetic notas")
+    parser.add_argument('--items', type=int, default=100, help="items per nota")
+    parser.add_argument('--batch', type=int, default=50, help="notas per transaction")
+    args = parser.parse_args()
+
+    chunks = [build_records(build_notas(min(args.batch, args.notas - offset), args.items, offset))
+              for offset in range(0, args.notas, args.batch)]
+
+    conn = await asyncpg.connect(DATABASE_URL)
+    try:
+        await conn.execute(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE; CREATE SCHEMA {SCHEMA}")
+        results = {}
+        for layout, ddl in TABLE_DDL.items():
+            await conn.execute(f"CREATE TABLE {SCHEMA}.{layout} ({ddl})")
+            await conn.execute(f"CREATE INDEX ON {SCHEMA}.{layout} (chave_acesso_nf, numero_produto)")
+            columns = chunks[0][layout][0]
+            results[layout] = await load(conn, layout, columns, [chunk[layout][1] for chunk in chunks])
+    finally:
+        await conn.execute(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE")
+        await conn.close()
+
+    print(f"{args.notas} notas x {args.items} items ({results['wide']['rows']} item rows per layout)")
+    print(f"{'layout':>10} {'rows/s':>10} {'WAL MB':>8} {'heap MB':>8} {'index MB':>9} {'total MB':>9}")
+    for layout, result in results.items():
+        print(f"{layout:>10} {result['rows_per_s']:>10.0f} {_mb(result['wal']):>8} {_mb(result['heap']):>8} "
+              f"{_mb(result['indexes']):>9} {_mb(result['total']):>9}")
+    wide, normalized = results['wide'], results['normalized']
+    print(f"normalized vs wide: {1 - normalized['total'] / wide['total']:.0%} less storage, "
+          f"{1 - normalized['wal'] / wide['wal']:.0%} less WAL, "
+          f"{normalized['rows_per_s'] / wide['rows_per_s']:.1f}x ingest rate")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
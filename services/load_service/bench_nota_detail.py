@@ -0,0 +1,168 @@
+# bench_nota_detail.py
+"""
+Benchmark the single-statement nota detail against the previous three queries.
+
+Stores one synthetic nota per size (1, 100 and 990 items by default, 990
+being the NF-e item limit) with bulk_writer.write_notas_batch, then times the
+GET /api/notas/{chave} body both ways on one connection:
+
+  three queries  header, items + taxes, tax totals; the nested dicts are
+                 built in Python and serialized with json.dumps (FastAPI's
+                 jsonable_encoder, which the endpoint used to go through, is
+                 slower still, so this understates the old cost)
+  one statement  nota_detail.NOTA_DETAIL_SQL, JSON text from PostgreSQL
+                 encoded to bytes as the endpoint sends it
+
+and prints the median and p95 latency of each. Benchmark rows are deleted
+afterwards.
+
+Requires a database with the load_service tables (see DATABASE_URL in db_utils).
+
+Usage:
+    python bench_nota_detail.py [--sizes 1,100,990] [--runs 200]
+"""
+import argparse
+import asyncio
+import json
+import statistics
+import time
+
+import asyncpg
+
+from bench_bulk_writer import build_notas, cleanup
+from bulk_writer import write_notas_batch
+from db_utils import DATABASE_URL, ensure_tables_exist
+from nota_detail import NOTA_DETAIL_SQL
+
+HEADER_SQL = """
+SELECT chave_acesso, modelo, serie_nf as serie, numero_nf, natureza_operacao, data_emissao,
+       cpf_cnpj_emitente as emit_cnpj, razao_social_emitente as emit_xnome,
+       inscricao_estadual_emitente as emit_ie, uf_emitente as emit_uf, municipio_emitente as emit_xmun,
+       cnpj_destinatario as dest_cnpj, nome_destinatario as dest_xnome, uf_destinatario as dest_uf,
+       indicador_ie_destinatario as dest_indieiedest, destino_operacao, consumidor_final,
+       presenca_comprador, valor_nota_fiscal as valor_total, classificacao
+FROM notasfiscais
+WHERE chave_acesso = $1
+"""
+
+ITEMS_SQL = """
+SELECT inf.numero_produto as nitem, inf.descricao_produto as xprod, inf.codigo_ncm_sh as ncm, inf.cfop,
+       inf.quantidade as qcom, inf.unidade as ucom, inf.valor_unitario as vuncom, inf.valor_total as vprod,
+       inf.descricao_produto as cprod,
+       ii.v_tot_trib, ii.icms_orig, ii.icms_cst, ii.icms_mod_bc, ii.icms_v_bc, ii.icms_p_icms, ii.icms_v_icms,
+       ii.icms_uf_v_bc_uf_dest, ii.icms_uf_p_icms_uf_dest, ii.icms_uf_p_icms_inter, ii.icms_uf_v_icms_uf_dest,
+       ii.ipi_cst, ii.ipi_v_bc, ii.ipi_p_ipi, ii.ipi_v_ipi, ii.pis_cst, ii.pis_v_bc, ii.pis_p_pis, ii.pis_v_pis,
+       ii.cofins_cst, ii.cofins_v_bc, ii.cofins_p_cofins, ii.cofins_v_cofins
+FROM itens_nota inf
+LEFT JOIN impostos_item ii ON inf.id_item_nf = ii.id_item_nf AND ii.data_emissao = inf.data_emissao
+WHERE inf.chave_acesso_nf = $1 AND inf.data_emissao = $2
+ORDER BY inf.numero_produto
+"""
+
+TOTALS_SQL = """
+SELECT v_bc_icms, v_icms, v_icms_uf_dest, v_bc_st, v_st, v_ipi, v_pis, v_cofins, v_ii, v_tot_trib,
+       v_prod, v_frete, v_seg, v_desc, v_outro, v_nf
+FROM impostos_nota_fiscal
+WHERE chave_acesso_nf = $1
+"""
+
+TEXT_FIELDS = ('chave_acesso', 'modelo', 'serie', 'numero_nf', 'natureza_operacao', 'emit_cnpj', 'emit_xnome',
+               'emit_ie', 'emit_uf', 'emit_xmun', 'dest_cnpj', 'dest_xnome', 'dest_uf', 'dest_indieiedest',
+               'destino_operacao', 'consumidor_final', 'presenca_comprador', 'classificacao')
+
+
+def _number(value):
+    return float(value) if value else None
+
+
+def _group(row, prefix: str, fields: tuple, text_fields: tuple = ('cst',)) -> dict:
+    group = {field: row[f"{prefix}_{field}"] for field in text_fields}
+    group.update({field: _number(row[f"{prefix}_{field}"]) for field in fields})
+    return group
+
+
+async def detail_three_queries(conn: asyncpg.Connection, chave_acesso: str) -> bytes:
+    """The previous path: three round trips, dicts built field by field"""
+    header = await conn.fetchrow(HEADER_SQL, chave_acesso)
+    items_rows = await conn.fetch(ITEMS_SQL, chave_acesso, header['data_emissao'])
+    totals = await conn.fetchrow(TOTALS_SQL, chave_acesso)
+
+    nota = {field: header[field] for field in TEXT_FIELDS}
+    nota['data_emissao'] = header['data_emissao'].isoformat() if header['data_emissao'] else None
+    nota['valor_total'] = nota['icmstot_vprod'] = float(header['valor_total']) if header['valor_total'] else 0.0
+    nota['icmstot_vfrete'] = nota['icmstot_vdesc'] = 0.0
+    if totals:
+        nota['impostos'] = {field: _number(totals[field]) for field in totals.keys()}
+
+    itens = []
+    for row in items_rows:
+        item = {field: row[field] for field in ('nitem', 'xprod', 'ncm', 'cfop', 'ucom', 'cprod')}
+        item.update({field: float(row[field]) if row[field] else 0.0 for field in ('qcom', 'vuncom', 'vprod')})
+        if row['icms_cst'] or row['pis_cst'] or row['cofins_cst']:
+            icms = _group(row, 'icms', ('v_bc', 'p_icms', 'v_icms'), ('orig', 'cst', 'mod_bc'))
+            icms['uf_dest'] = _group(row, 'icms_uf', ('v_bc_uf_dest', 'p_icms_uf_dest', 'p_icms_inter',
+                                                      'v_icms_uf_dest'), ())
+            item['impostos'] = {
+                'v_tot_trib': _number(row['v_tot_trib']),
+                'icms': icms if row['icms_cst'] else None,
+                'ipi': _group(row, 'ipi', ('v_bc', 'p_ipi', 'v_ipi')) if row['ipi_cst'] else None,
+                'pis': _group(row, 'pis', ('v_bc', 'p_pis', 'v_pis')) if row['pis_cst'] else None,
+                'cofins': _group(row, 'cofins', ('v_bc', 'p_cofins', 'v_cofins')) if row['cofins_cst'] else None,
+            }
+        itens.append(item)
+    return json.dumps({'nota': nota, 'itens': itens}).encode('utf-8')
+
+
+async def detail_one_statement(conn: asyncpg.Connection, chave_acesso: str) -> bytes:
+    return (await conn.fetchval(NOTA_DETAIL_SQL, chave_acesso)).encode('utf-8')
+
+
+async def latencies(fetch, conn: asyncpg.Connection, chave_acesso: str, runs: int) -> list:
+    for _ in range(min(runs, 10)):  # warm up the statement cache and the buffers
+        await fetch(conn, chave_acesso)
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        await fetch(conn, chave_acesso)
+        timings.append((time.perf_counter() - start) * 1000)
+    return timings
+
+
+def p95(timings: list) -> float:
+    return sorted(timings)[int(len(timings) * 0.95) - 1]
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', default='1,100,990', help="items per nota, comma separated")
+    parser.add_argument('--runs', type=int, default=200, help="timed requests per strategy and size")
+    args = parser.parse_args()
+    sizes = [int(size) for size in args.sizes.split(',')]
+
+    await ensure_tables_exist()
+    conn = await asyncpg.connect(DATABASE_URL)
+    try:
+        await cleanup(conn)
+        chaves = {}
+        for offset, size in enumerate(sizes):
+            nota = build_notas(1, size, offset)[0]
+            await write_notas_batch(conn, [nota])
+            chaves[size] = nota[0]['chave_acesso']
+        await conn.execute("ANALYZE notasfiscais; ANALYZE itens_nota; ANALYZE impostos_item")
+
+        print(f"{'items':>6} {'3 queries p50 ms':>17} {'p95':>7} {'1 statement p50 ms':>19} {'p95':>7} "
+              f"{'speedup':>8} {'bytes':>8}")
+        for size in sizes:
+            chave = chaves[size]
+            old = await latencies(detail_three_queries, conn, chave, args.runs)
+            new = await latencies(detail_one_statement, conn, chave, args.runs)
+            body = await detail_one_statement(conn, chave)
+            print(f"{size:>6} {statistics.median(old):>17.2f} {p95(old):>7.2f} {statistics.median(new):>19.2f} "
+                  f"{p95(new):>7.2f} {statistics.median(old) / statistics.median(new):>7.1f}x {len(body):>8}")
+    finally:
+        await cleanup(conn)
+        await conn.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,120 @@
+# bench_xml_parser.py
+"""
+Benchmark the single-pass NFe parser against the legacy find()-based parser.
+
+Generates synthetic NF-e documents with 1, 50 and 990 items (990 is the schema
+limit for <det>), checks that both parsers return identical structures and
+prints notes/sec for each.
+
+Usage:
+    python bench_xml_parser.py [--seconds 2.0]
+"""
+import argparse
+import time
+
+from xml_parser import parse_nfe_xml, parse_nfe_xml_legacy
+
+ITEM_COUNTS = (1, 50, 990)
+
+ICMS_BLOCKS = (
+    "<ICMS00><orig>0</orig><CST>00</CST><modBC>3</modBC><vBC>{v}</vBC>"
+    "<pICMS>18.0000</pICMS><vICMS>{icms}</vICMS></ICMS00>",
+    "<ICMSSN102><orig>0</orig><CSOSN>102</CSOSN></ICMSSN102>",
+)
+
+PIS_BLOCKS = (
+    "<PISAliq><CST>01</CST><vBC>{v}</vBC><pPIS>1.6500</pPIS><vPIS>{pis}</vPIS></PISAliq>",
+    "<PISNT><CST>07</CST></PISNT>",
+)
+
+COFINS_BLOCKS = (
+    "<COFINSAliq><CST>01</CST><vBC>{v}</vBC><pCOFINS>7.6000</pCOFINS><vCOFINS>{cofins}</vCOFINS></COFINSAliq>",
+    "<COFINSNT><CST>07</CST></COFINSNT>",
+)
+
+
+def build_det(n: int) -> str:
+    valor = 10.0 + n
+    values = {
+        'v': f"{valor:.2f}",
+        'icms': f"{valor * 0.18:.2f}",
+        'pis': f"{valor * 0.0165:.2f}",
+        'cofins': f"{valor * 0.076:.2f}",
+    }
+    variant = n % 2
+    return (
+        f'<det nItem="{n}">'
+        f"<prod><cProd>{n:06d}</cProd><cEAN>SEM GTIN</cEAN><xProd>PRODUTO {n}</xProd>"
+        f"<NCM>84713012</NCM><CFOP>6102</CFOP><uCom>UN</uCom><qCom>1.0000</qCom>"
+        f"<vUnCom>{valor:.10f}</vUnCom><vProd>{valor:.2f}</vProd><indTot>1</indTot></prod>"
+        f"<imposto><vTotTrib>{valor * 0.3:.2f}</vTotTrib>"
+        f"<ICMS>{ICMS_BLOCKS[variant].format(**values)}</ICMS>"
+        f"<ICMSUFDest><vBCUFDest>{values['v']}</vBCUFDest><vBCFCPUFDest>{values['v']}</vBCFCPUFDest>"
+        f"<pFCPUFDest>2.0000</pFCPUFDest><pICMSUFDest>18.0000</pICMSUFDest><pICMSInter>12.00</pICMSInter>"
+        f"<pICMSInterPart>100.0000</pICMSInterPart><vFCPUFDest>0.20</vFCPUFDest>"
+        f"<vICMSUFDest>0.60</vICMSUFDest><vICMSUFRemet>0.00</vICMSUFRemet></ICMSUFDest>"
+        f"<IPI><cEnq>999</cEnq><IPINT><CST>53</CST></IPINT></IPI>"
+        f"<PIS>{PIS_BLOCKS[variant].format(**values)}</PIS>"
+        f"<COFINS>{COFINS_BLOCKS[variant].format(**values)}</COFINS>"
+        f"</imposto></det>"
+    )
+
+
+def build_nfe(item_count: int) -> bytes:
+    chave = "35250512345678000190550010000012341000012345"
+    dets = "".join(build_det(n) for n in range(1, item_count + 1))
+    xml = (
+        '<?xml version="1.0" encoding="UTF-8"?>'
+        '<nfeProc xmlns="http://www.portalfiscal.inf.br/nfe" versao="4.00"><NFe>'
+        f'<infNFe Id="NFe{chave}" versao="4.00">'
+        "<ide><cUF>35</cUF><natOp>VENDA DE MERCADORIA</natOp><mod>55</mod><serie>1</serie>"
+        "<nNF>1234</nNF><dhEmi>2025-05-19T10:00:00-03:00</dhEmi><tpNF>1</tpNF><idDest>2</idDest>"
+        "<indFinal>1</indFinal><indPres>2</indPres></ide>"
+        "<emit><CNPJ>12345678000190</CNPJ><xNome>EMITENTE LTDA</xNome>"
+        "<enderEmit><xMun>SAO PAULO</xMun><UF>SP</UF></enderEmit><IE>123456789</IE><CRT>3</CRT></emit>"
+        "<dest><CNPJ>98765432000110</CNPJ><xNome>DESTINATÁRIO S.A.</xNome>"
+        "<enderDest><xMun>RIO DE JANEIRO</xMun><UF>RJ</UF></enderDest><indIEDest>9</indIEDest></dest>"
+        f"{dets}"
+        "<total><ICMSTot><vBC>100.00</vBC><vICMS>18.00</vICMS><vICMSDeson>0.00</vICMSDeson>"
+        "<vFCPUFDest>0.20</vFCPUFDest><vICMSUFDest>0.60</vICMSUFDest><vICMSUFRemet>0.00</vICMSUFRemet>"
+        "<vBCST>0.00</vBCST><vST>0.00</vST><vProd>100.00</vProd><vFrete>0.00</vFrete><vSeg>0.00</vSeg>"
+        "<vDesc>0.00</vDesc><vII>0.00</vII><vIPI>0.00</vIPI><vIPIDevol>0.00</vIPIDevol><vPIS>1.65</vPIS>"
+        "<vCOFINS>7.60</vCOFINS><vOutro>0.00</vOutro><vNF>100.00</vNF><vTotTrib>30.00</vTotTrib>"
+        "</ICMSTot></total>"
+        "</infNFe></NFe></nfeProc>"
+    )
+    return xml.encode('utf-8')
+
+
+def notes_per_second(parse, payload, seconds: float) -> float:
+    count = 0
+    start = time.perf_counter()
+    deadline = start + seconds
+    while True:
+        parse(payload)
+        count += 1
+        now = time.perf_counter()
+        if now >= deadline:
+            return count / (now - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--seconds', type=float, default=2.0, help="time budget per measurement")
+    args = parser.parse_args()
+
+    print(f"{'items':>6} {'legacy notes/s':>15} {'single-pass notes/s':>20} {'speedup':>8}")
+    for item_count in ITEM_COUNTS:
+        payload = build_nfe(item_count)
+        legacy_payload = payload.decode('utf-8')
+
+        if parse_nfe_xml(payload) != parse_nfe_xml_legacy(legacy_payload):
+            raise SystemExit(f"Parsers disagree on the {item_count}-item note")
+
+        legacy = notes_per_second(parse_nfe_xml_legacy, legacy_payload, args.seconds)
+        single_pass = notes_per_second(parse_nfe_xml, payload, args.seconds)
+        print(f"{item_count:>6} {legacy:>15.1f} {single_pass:>20.1f} {single_pass / legacy:>7.2f}x")
+
+
+if __name__ == "__main__":
+    main()
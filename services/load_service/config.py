@@ -12,4 +12,67 @@ DB_NAME = os.getenv("DB_NAME", "notasfiscais")
 DATABASE_URL = f"postgresql://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}"
 
 # Directory for storing uploaded and extracted files
-UPLOAD_DIR = os.getenv("UPLOAD_DIR", "/app/uploads") 
\ No newline at end of file
+UPLOAD_DIR = os.getenv("UPLOAD_DIR", "/app/uploads") 
+
+# Bulk XML ingestion (ZIP of XMLs / enviNFe and nfeProc lots)
+BULK_PARSE_WORKERS = int(os.getenv("BULK_PARSE_WORKERS", str(os.cpu_count() or 2)))
+BULK_PARSE_CHUNK = int(os.getenv("BULK_PARSE_CHUNK", "32"))  # documents per process-pool task
+BULK_PUBLISH_BATCH = int(os.getenv("BULK_PUBLISH_BATCH", "500"))  # notas per RabbitMQ publish batch
+BULK_READ_SIZE = int(os.getenv("BULK_READ_SIZE", str(64 * 1024)))  # bytes fed to the XML pull parser per read
+
+# Chunked CSV ingestion (Cabecalho/Itens ZIP uploads)
+CSV_CHUNK_ROWS = int(os.getenv("CSV_CHUNK_ROWS", "50000"))  # rows per pandas chunk; bounds parser memory
+
+# Asynchronous ingestion jobs (upload is stored on disk, processed in the background)
+JOBS_DIR = os.getenv("JOBS_DIR", os.path.join(UPLOAD_DIR, "jobs"))
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "2"))  # jobs processed concurrently
+
+# RabbitMQ publisher (persistent connection with publisher confirms)
+PUBLISHER_CHANNELS = int(os.getenv("PUBLISHER_CHANNELS", "2"))  # confirm channels on the shared connection
+PUBLISHER_MAX_IN_FLIGHT = int(os.getenv("PUBLISHER_MAX_IN_FLIGHT", "1000"))  # unconfirmed messages before publish blocks
+PUBLISH_CONFIRM_TIMEOUT = float(os.getenv("PUBLISH_CONFIRM_TIMEOUT", "60"))  # seconds to wait for the broker's confirms
+
+# Bulk database writes (COPY into staging tables, one transaction per batch)
+BULK_WRITE_BATCH = int(os.getenv("BULK_WRITE_BATCH", "200"))  # notas per transaction
+
+# Queue consumer (rabbitmq_worker.py)
+CONSUMER_MODE = os.getenv("CONSUMER_MODE", "async")  # "async" (aio-pika, concurrent) or "blocking" (pika, one message at a time)
+CONSUMER_PREFETCH = int(os.getenv("CONSUMER_PREFETCH", "400"))  # unacked deliveries the broker sends ahead
+CONSUMER_CONCURRENCY = int(os.getenv("CONSUMER_CONCURRENCY", "4"))  # batches written to the database at once
+CONSUMER_BATCH_SIZE = int(os.getenv("CONSUMER_BATCH_SIZE", "100"))  # notas per transaction
+CONSUMER_BATCH_LINGER_MS = float(os.getenv("CONSUMER_BATCH_LINGER_MS", "50"))  # max wait before flushing a partial batch
+CONSUMER_BISECT_POLICY = os.getenv("CONSUMER_BISECT_POLICY", "bisect")  # failed batch isolation: bisect, single or none
+CONSUMER_METRICS_INTERVAL = float(os.getenv("CONSUMER_METRICS_INTERVAL", "60"))  # seconds between batch metrics log lines
+CONSUMER_SHUTDOWN_TIMEOUT = float(os.getenv("CONSUMER_SHUTDOWN_TIMEOUT", "30"))  # seconds to drain in-flight messages on stop
+
+# Failed messages: delayed retries, then the DLQ (retry_queues.py); same queues and settings as
+# onboarding_service, which consumes the same queue
+RABBITMQ_DLQ = os.getenv("RABBITMQ_DLQ", "notas_fiscais_dlq")
+RABBITMQ_MAX_RETRIES = int(os.getenv("RABBITMQ_MAX_RETRIES", "3"))
+RABBITMQ_RETRY_BASE_DELAY = float(os.getenv("RABBITMQ_RETRY_BASE_DELAY", "5"))  # seconds before the first retry, doubled for each next one
+RABBITMQ_RETRY_MAX_DELAY = float(os.getenv("RABBITMQ_RETRY_MAX_DELAY", "300"))  # upper bound of a retry delay, seconds
+RABBITMQ_RETRY_JITTER = float(os.getenv("RABBITMQ_RETRY_JITTER", "0.2"))  # +/- fraction of the delay, at random
+
+# Database connection pool (db_pool.py)
+DB_POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", "2"))  # connections kept open
+DB_POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", "10"))  # upper bound on open connections
+DB_STATEMENT_CACHE_SIZE = int(os.getenv("DB_STATEMENT_CACHE_SIZE", "100"))  # prepared statements per connection; 0 behind pgbouncer
+DB_COMMAND_TIMEOUT = float(os.getenv("DB_COMMAND_TIMEOUT", "60"))  # default per-query timeout, seconds
+DB_POOL_ACQUIRE_TIMEOUT = float(os.getenv("DB_POOL_ACQUIRE_TIMEOUT", "10"))  # max wait for a free connection, seconds
+
+# Monthly partitions of notasfiscais/itens_nota/impostos_item (partitions.py)
+PARTITION_MONTHS_AHEAD = int(os.getenv("PARTITION_MONTHS_AHEAD", "3"))  # months created ahead of the current one
+
+# Skip notas already stored unchanged before publishing (known_notas.py)
+KNOWN_NOTAS_CAPACITY = int(os.getenv("KNOWN_NOTAS_CAPACITY", "10000000"))  # content hashes the Bloom filter is sized for
+KNOWN_NOTAS_ERROR_RATE = float(os.getenv("KNOWN_NOTAS_ERROR_RATE", "0.01"))  # false positives (confirmed by a query) at capacity
+
+# Statistics table maintained by triggers (migration 0006)
+STATS_RECONCILE_INTERVAL = float(os.getenv("STATS_RECONCILE_INTERVAL", "0"))  # seconds between full recounts; 0 disables
+
+# Redis cache of the nota responses (nota_cache.py), invalidated by PostgreSQL notifications
+REDIS_HOST = os.getenv("REDIS_HOST", "redis")
+REDIS_PORT = int(os.getenv("REDIS_PORT", "6379"))
+REDIS_DB = int(os.getenv("REDIS_DB", "0"))
+NOTA_CACHE_ENABLED = os.getenv("NOTA_CACHE_ENABLED", "true").lower() == "true"
+NOTA_CACHE_TTL = int(os.getenv("NOTA_CACHE_TTL", "86400"))  # seconds; only reclaims replaced versions, freshness comes from invalidation
@@ -0,0 +1,27 @@
+# content_hash.py
+"""
+Content hash of a nota fiscal.
+
+SHA-256 over a canonical JSON rendering of the nota, its items and its tax
+data. classificacao (set later by onboarding) and the hash itself are left
+out. The parsers set it as nota_fiscal_data['content_hash'], and it is stored
+in notasfiscais.content_hash: a nota whose hash is already stored is unchanged
+and is not written again.
+
+The rendering uses json.dumps(default=str), like the queue messages, so the
+hash of a nota decoded from a message equals the hash computed at parse time.
+"""
+import hashlib
+import json
+from typing import Dict, List, Optional
+
+_EXCLUDED_KEYS = ('classificacao', 'content_hash')
+
+
+def nota_content_hash(nota_fiscal_data: Dict, items_data: Optional[List[Dict]],
+                      impostos_nota: Optional[Dict] = None, impostos_items: Optional[List[Dict]] = None) -> str:
+    """Hex SHA-256 of the nota's content"""
+    nota = {key: value for key, value in nota_fiscal_data.items() if key not in _EXCLUDED_KEYS}
+    canonical = json.dumps([nota, items_data or [], impostos_nota, impostos_items or []],
+                           sort_keys=True, separators=(',', ':'), ensure_ascii=False, default=str)
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
@@ -0,0 +1,72 @@
+# csv_batch.py
+"""
+Ingestion of Cabecalho/Itens CSV ZIP uploads.
+
+The CSV members are streamed out of the archive through the chunked parser in
+file_utils and notas are published to RabbitMQ in batches; notas already
+stored with the same content are skipped (known_notas). Progress is
+reported after every published batch, and a run can start from a checkpoint
+(the number of notas already handled) so interrupted jobs resume where they
+stopped.
+"""
+import logging
+from typing import BinaryIO, Callable, Dict, List, Optional, Tuple, Union
+
+from config import BULK_PUBLISH_BATCH
+from file_utils import open_zip_csv_members, iter_notas_from_csv
+from known_notas import split_unchanged, remember
+from rabbitmq_client import publish_notas_fiscais
+
+logger = logging.getLogger(__name__)
+
+
+def _flush(batch: List[Tuple], stats: Dict, on_progress: Optional[Callable[[Dict], None]]):
+    to_publish, skipped = split_unchanged(batch)
+    published, failed = publish_notas_fiscais(to_publish) if to_publish else (0, 0)
+    remember(to_publish)
+    stats['skipped'] += skipped
+    stats['published'] += published
+    stats['failed'] += failed
+    stats['checkpoint'] = stats['parsed']
+    batch.clear()
+    if on_progress:
+        on_progress(stats)
+
+
+def ingest_csv_zip(zip_file: Union[str, BinaryIO], checkpoint: int = 0,
+                   on_progress: Optional[Callable[[Dict], None]] = None) -> Dict:
+    """
+    Stream the Cabecalho/Itens CSVs inside a ZIP and publish every nota fiscal to RabbitMQ in batches.
+
+    Blocking: callers on the event loop should run it in a worker thread.
+
+    Args:
+        zip_file: Path or seekable binary file object of the ZIP
+        checkpoint: Number of notas, in file order, already handled by a previous run; they are skipped
+        on_progress: Called with the stats after every published batch
+
+    Returns:
+        Dict with parsed, skipped (stored unchanged), published and failed counters for this run, plus the
+        checkpoint (notas handled, relative to the starting checkpoint)
+    """
+    stats = {"parsed": 0, "skipped": 0, "published": 0, "failed": 0, "checkpoint": 0}
+    batch = []
+
+    with open_zip_csv_members(zip_file) as (cabecalho_stream, itens_stream):
+        for position, (nota_fiscal_data, items_data) in enumerate(iter_notas_from_csv(cabecalho_stream, itens_stream)):
+            if position < checkpoint:
+                continue
+            stats['parsed'] += 1
+            batch.append((nota_fiscal_data, items_data, None, None))
+            if len(batch) >= BULK_PUBLISH_BATCH:
+                _flush(batch, stats, on_progress)
+
+    if batch:
+        _flush(batch, stats, on_progress)
+
+    if checkpoint:
+        logger.info(f"Resumed CSV ingestion after {checkpoint} notas fiscais already handled")
+    logger.info(f"Parsed {stats['parsed']} notas fiscais from CSV")
+    logger.info(f"Published {stats['published']} notas fiscais to RabbitMQ. "
+                f"Skipped (unchanged): {stats['skipped']}. Failed: {stats['failed']}")
+    return stats
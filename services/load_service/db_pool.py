@@ -0,0 +1,136 @@
+# db_pool.py
+"""
+Pooled asyncpg connections shared by a service's endpoints.
+
+One DatabasePool per service (see db_utils.pool) is opened in the FastAPI
+startup hook and closed on shutdown. Connections keep their prepared
+statement cache between requests and every query gets a default timeout.
+The time callers wait for a free connection is recorded and reported by
+metrics().
+
+The pool belongs to the event loop that opened it. Code running on any other
+loop (e.g. a worker thread calling asyncio.run) gets a one-off connection
+from acquire() instead, which release() closes again.
+"""
+import asyncio
+import logging
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Dict, Optional
+
+import asyncpg
+
+from config import (
+    DB_POOL_MIN_SIZE, DB_POOL_MAX_SIZE, DB_STATEMENT_CACHE_SIZE,
+    DB_COMMAND_TIMEOUT, DB_POOL_ACQUIRE_TIMEOUT
+)
+
+logger = logging.getLogger(__name__)
+
+
+class DatabasePool:
+    """
+    Args:
+        dsn: Database URL
+        min_size: Connections opened up front and kept open
+        max_size: Upper bound on open connections
+        statement_cache_size: Prepared statements cached per connection (0 disables, e.g. behind pgbouncer)
+        command_timeout: Default per-query timeout in seconds
+        acquire_timeout: Seconds to wait for a free connection before failing
+    """
+
+    def __init__(self, dsn: str, min_size: int = DB_POOL_MIN_SIZE, max_size: int = DB_POOL_MAX_SIZE,
+                 statement_cache_size: int = DB_STATEMENT_CACHE_SIZE,
+                 command_timeout: Optional[float] = DB_COMMAND_TIMEOUT,
+                 acquire_timeout: Optional[float] = DB_POOL_ACQUIRE_TIMEOUT):
+        self.dsn = dsn
+        self.min_size = min_size
+        self.max_size = max(min_size, max_size)
+        self.statement_cache_size = statement_cache_size
+        self.command_timeout = command_timeout
+        self.acquire_timeout = acquire_timeout
+        self._pool: Optional[asyncpg.Pool] = None
+        self._loop = None
+        self._lock = asyncio.Lock()
+
+        self.acquires = 0
+        self.acquire_timeouts = 0
+        self._waits = deque(maxlen=1000)
+
+    async def open(self) -> asyncpg.Pool:
+        """
+        Create the pool on the running loop (idempotent). The loop is adopted
+        even if the database is not reachable yet; acquire() keeps retrying.
+        """
+        self._loop = asyncio.get_running_loop()
+        if self._pool is None:
+            async with self._lock:
+                if self._pool is None:
+                    self._pool = await asyncpg.create_pool(
+                        self.dsn,
+                        min_size=self.min_size,
+                        max_size=self.max_size,
+                        statement_cache_size=self.statement_cache_size,
+                        command_timeout=self.command_timeout
+                    )
+                    logger.info(f"Database pool opened (min={self.min_size}, max={self.max_size})")
+        return self._pool
+
+    async def close(self):
+        pool, self._pool, self._loop = self._pool, None, None
+        if pool is not None:
+            await pool.close()
+            logger.info("Database pool closed")
+
+    async def acquire(self) -> asyncpg.Connection:
+        """Take a connection; hand it back with release()"""
+        if self._loop is not asyncio.get_running_loop():
+            # Not the loop the pool was opened on (or never opened): plain connection
+            return await asyncpg.connect(self.dsn, statement_cache_size=self.statement_cache_size,
+                                         command_timeout=self.command_timeout)
+        pool = await self.open()
+        started = time.monotonic()
+        try:
+            conn = await pool.acquire(timeout=self.acquire_timeout)
+        except asyncio.TimeoutError:
+            self.acquire_timeouts += 1
+            logger.error(f"No database connection available after {self.acquire_timeout}s "
+                         f"({self.max_size} in use)")
+            raise
+        self.acquires += 1
+        self._waits.append(time.monotonic() - started)
+        return conn
+
+    async def release(self, conn: asyncpg.Connection):
+        if conn is None:
+            return
+        if isinstance(conn, asyncpg.pool.PoolConnectionProxy) and self._pool is not None:
+            await self._pool.release(conn)
+        else:
+            await conn.close()
+
+    @asynccontextmanager
+    async def connection(self):
+        conn = await self.acquire()
+        try:
+            yield conn
+        finally:
+            await self.release(conn)
+
+    def metrics(self) -> Dict:
+        """Pool size and connection wait times over the recent window"""
+        waits = sorted(self._waits)
+        pool = self._pool
+        return {
+            "open": pool is not None,
+            "size": pool.get_size() if pool else 0,
+            "idle": pool.get_idle_size() if pool else 0,
+            "min_size": self.min_size,
+            "max_size": self.max_size,
+            "acquires": self.acquires,
+            "acquire_timeouts": self.acquire_timeouts,
+            "wait_ms_avg": round(1000 * sum(waits) / len(waits), 2) if waits else 0.0,
+            "wait_ms_p95": round(1000 * waits[min(len(waits) - 1, int(0.95 * len(waits)))], 2) if waits else 0.0,
+            "wait_ms_max": round(1000 * waits[-1], 2) if waits else 0.0,
+        }
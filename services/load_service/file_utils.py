@@ -1,13 +1,19 @@
 import zipfile
+import io
 import os
 import shutil
 import re
-import csv
-from typing import Tuple, Dict, List
+from contextlib import contextmanager
+from itertools import groupby
+from operator import itemgetter
+from typing import BinaryIO, Dict, Iterator, List, Optional, TextIO, Tuple, Union
 from datetime import datetime
+
+import pandas as pd
 from fastapi import HTTPException, status
 
-from config import UPLOAD_DIR
+from config import UPLOAD_DIR, CSV_CHUNK_ROWS
+from content_hash import nota_content_hash
 
 CABECALHO_SUFFIX = "_NFs_Cabecalho.csv"
 ITENS_SUFFIX = "_NFs_Itens.csv" # Corrected from _Nfs_Itens.csv to _NFs_Itens.csv based on user query
@@ -29,72 +35,133 @@ def clean_upload_dir():
             except Exception as e:
                 print(f'Failed to delete {file_path}. Reason: {e}')
 
-def process_zip_file(file_path: str) -> tuple[str, str]:
-    # Only ensure directory exists, don't clean it
-    ensure_upload_dir_exists()
-    extracted_files = []
-    cabecalho_file = None
-    itens_file = None
+@contextmanager
+def open_zip_csv_members(zip_source: Union[str, BinaryIO]) -> Iterator[Tuple[TextIO, TextIO]]:
+    """
+    Open the Cabecalho and Itens CSV members of an uploaded ZIP as text streams.
+
+    Members are read straight out of the archive - nothing is extracted and no
+    shared directory is scanned - so concurrent uploads are fully isolated.
 
+    Args:
+        zip_source: Path or seekable binary file object of the ZIP
+
+    Yields:
+        Tuple (cabecalho_stream, itens_stream)
+    """
     try:
-        with zipfile.ZipFile(file_path, 'r') as zip_ref:
-            # Check for invalid characters in filenames within the zip
-            for member_name in zip_ref.namelist():
-                if '..' in member_name or member_name.startswith('/'):
-                    raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Zip file contains invalid or malicious file paths.")
-            
-            zip_ref.extractall(UPLOAD_DIR)
-            # Get only the extracted files, not including the original zip file
-            all_files = [os.path.join(UPLOAD_DIR, f) for f in os.listdir(UPLOAD_DIR) if os.path.isfile(os.path.join(UPLOAD_DIR, f))]
-            # Filter out the original zip file from the list
-            extracted_files = [f for f in all_files if not f.endswith('.zip')]
-            
+        zip_ref = zipfile.ZipFile(zip_source, 'r')
     except zipfile.BadZipFile:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid ZIP file.")
-    except Exception as e:
-        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=f"Error processing ZIP file: {e}")
 
-    if len(extracted_files) != 2:
+    with zip_ref:
+        cabecalho_info, itens_info = find_csv_members(zip_ref)
+        try:
+            with zip_ref.open(cabecalho_info) as cabecalho_raw, zip_ref.open(itens_info) as itens_raw:
+                # utf-8-sig to handle BOM; newline='' as required by the csv module
+                yield (io.TextIOWrapper(cabecalho_raw, encoding='utf-8-sig', newline=''),
+                       io.TextIOWrapper(itens_raw, encoding='utf-8-sig', newline=''))
+        except zipfile.BadZipFile as e:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"Corrupted ZIP file: {e}")
+
+
+def find_csv_members(zip_ref: zipfile.ZipFile) -> Tuple[zipfile.ZipInfo, zipfile.ZipInfo]:
+    """Locate and validate the Cabecalho and Itens members from the ZIP central directory"""
+    cabecalho_info = None
+    itens_info = None
+
+    members = [info for info in zip_ref.infolist() if not info.is_dir()]
+
+    if len(members) != 2:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, 
-                            detail=f"Expected 2 files in the ZIP, but found {len(extracted_files)}.")
+                            detail=f"Expected 2 files in the ZIP, but found {len(members)}.")
 
-    for f_path in extracted_files:
-        filename = os.path.basename(f_path)
+    for info in members:
+        filename = os.path.basename(info.filename)
         if filename.endswith(CABECALHO_SUFFIX):
-            if cabecalho_file:
+            if cabecalho_info:
                 raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Multiple Cabecalho files found.")
-            cabecalho_file = f_path
+            cabecalho_info = info
         elif filename.endswith(ITENS_SUFFIX):
-            if itens_file:
+            if itens_info:
                 raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Multiple Itens files found.")
-            itens_file = f_path
-        else:
-            # This check is a bit redundant given the exact match logic, but good for robustness
-            # or if suffix matching becomes more complex.
-            # For now, if it doesn't match either, it's an unexpected file.
-            pass # Let the later checks for None handle missing specific files
+            itens_info = info
 
-    if not cabecalho_file or not itens_file:
+    if not cabecalho_info or not itens_info:
         missing = []
-        if not cabecalho_file: missing.append("Cabecalho file (e.g., *" + CABECALHO_SUFFIX + ")")
-        if not itens_file: missing.append("Itens file (e.g., *" + ITENS_SUFFIX + ")")
+        if not cabecalho_info: missing.append("Cabecalho file (e.g., *" + CABECALHO_SUFFIX + ")")
+        if not itens_info: missing.append("Itens file (e.g., *" + ITENS_SUFFIX + ")")
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, 
                             detail=f"Missing required files: {', '.join(missing)}.")
 
     # Check if files are empty
-    if os.path.getsize(cabecalho_file) == 0:
+    if cabecalho_info.file_size == 0:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Cabecalho file is empty.")
-    if os.path.getsize(itens_file) == 0:
+    if itens_info.file_size == 0:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Itens file is empty.")
 
-    return cabecalho_file, itens_file
+    return cabecalho_info, itens_info
+
+
+@contextmanager
+def _open_csv(source: Union[str, TextIO]) -> Iterator[TextIO]:
+    """Accept either a CSV path or an already open text stream"""
+    if isinstance(source, str):
+        with open(source, mode='r', encoding='utf-8-sig', newline='') as csvfile:
+            yield csvfile
+    else:
+        yield source
+
+
+# Column layout of the portal exports, in file order (also the key order of the parsed dicts)
+CABECALHO_COLUMNS = [
+    'chave_acesso', 'modelo', 'serie_nf', 'numero_nf', 'natureza_operacao', 'data_emissao',
+    'evento_mais_recente', 'data_hora_evento_mais_recente', 'cpf_cnpj_emitente', 'razao_social_emitente',
+    'inscricao_estadual_emitente', 'uf_emitente', 'municipio_emitente', 'cnpj_destinatario',
+    'nome_destinatario', 'uf_destinatario', 'indicador_ie_destinatario', 'destino_operacao',
+    'consumidor_final', 'presenca_comprador', 'valor_nota_fiscal'
+]
+
+ITENS_COLUMNS = [
+    'chave_acesso_nf', 'modelo', 'serie_nf', 'numero_nf', 'natureza_operacao', 'data_emissao',
+    'cpf_cnpj_emitente', 'razao_social_emitente', 'inscricao_estadual_emitente', 'uf_emitente',
+    'municipio_emitente', 'cnpj_destinatario', 'nome_destinatario', 'uf_destinatario',
+    'indicador_ie_destinatario', 'destino_operacao', 'consumidor_final', 'presenca_comprador',
+    'numero_produto', 'descricao_produto', 'codigo_ncm_sh', 'ncm_sh_tipo_produto', 'cfop',
+    'quantidade', 'unidade', 'valor_unitario', 'valor_total'
+]
+
+# Itens columns kept per item: the header columns repeat the nota's Cabecalho
+# row and are not stored per item (itens_nota), so they are not even parsed
+ITENS_FIELDS = [
+    'chave_acesso_nf', 'data_emissao', 'numero_produto', 'descricao_produto', 'codigo_ncm_sh',
+    'ncm_sh_tipo_produto', 'cfop', 'quantidade', 'unidade', 'valor_unitario', 'valor_total'
+]
+
+DATE_FORMATS = ("%Y-%m-%d %H:%M:%S", "%Y-%m-%d", "%d/%m/%Y", "%Y/%m/%d")
+DATETIME_FORMATS = ("%Y-%m-%d %H:%M:%S", "%d/%m/%Y %H:%M:%S", "%Y/%m/%d %H:%M:%S")
+
+# Typed columns per file; everything else is kept as the raw string
+CABECALHO_TYPES = {
+    'data_emissao': 'date',
+    'data_hora_evento_mais_recente': 'datetime',
+    'valor_nota_fiscal': 'decimal',
+}
+
+ITENS_TYPES = {
+    'data_emissao': 'date',
+    'numero_produto': 'int',
+    'quantidade': 'decimal',
+    'valor_unitario': 'decimal',
+    'valor_total': 'decimal',
+}
 
 
 def parse_date(date_str):
     """Parse date from CSV format"""
     if not date_str:
         return None
-    for fmt in ("%Y-%m-%d %H:%M:%S", "%Y-%m-%d", "%d/%m/%Y", "%Y/%m/%d"):
+    for fmt in DATE_FORMATS:
         try:
             return datetime.strptime(date_str, fmt).date()
         except ValueError:
@@ -106,7 +173,7 @@ def parse_datetime(datetime_str):
     """Parse datetime from CSV format"""
     if not datetime_str:
         return None
-    for fmt in ("%Y-%m-%d %H:%M:%S", "%d/%m/%Y %H:%M:%S", "%Y/%m/%d %H:%M:%S"):
+    for fmt in DATETIME_FORMATS:
         try:
             return datetime.strptime(datetime_str, fmt)
         except ValueError:
@@ -134,109 +201,234 @@ def parse_int(value_str, default=None):
         return default
 
 
-def parse_csv_to_data(cabecalho_path: str, itens_path: str) -> List[Tuple[Dict, List[Dict]]]:
+def _infer_format(values: pd.Series, formats: Tuple[str, ...]) -> Optional[str]:
+    """Return the first format matching the column's first non-empty value"""
+    sample = values[values != '']
+    if sample.empty:
+        return None
+    first = sample.iloc[0]
+    for fmt in formats:
+        try:
+            datetime.strptime(first, fmt)
+            return fmt
+        except ValueError:
+            continue
+    return None
+
+
+def _none_for_missing(values: pd.Series) -> pd.Series:
+    """Object series with None (instead of NaN/NaT/NA) for missing values"""
+    return values.astype(object).where(values.notna(), None)
+
+
+def _convert_dates(values: pd.Series, column: str, kind: str, formats: Dict[str, str]) -> pd.Series:
+    # The format is inferred once per column per file and reused for every chunk
+    if column not in formats:
+        fmt = _infer_format(values, DATE_FORMATS if kind == 'date' else DATETIME_FORMATS)
+        if fmt is None:
+            return values.map(parse_date if kind == 'date' else parse_datetime)
+        formats[column] = fmt
+
+    parsed = pd.to_datetime(values, format=formats[column], errors='coerce')
+    if kind == 'date':
+        converted = _none_for_missing(parsed.dt.date)
+    else:
+        converted = _none_for_missing(pd.Series(parsed.dt.to_pydatetime(), index=parsed.index, dtype=object))
+
+    # Mixed-format files: only the values the inferred format rejected take the slow path
+    misses = parsed.isna() & (values != '')
+    if misses.any():
+        converted[misses] = values[misses].map(parse_date if kind == 'date' else parse_datetime)
+    return converted
+
+
+def _convert_chunk(chunk: pd.DataFrame, types: Dict[str, str], formats: Dict[str, str]) -> pd.DataFrame:
+    """Vectorized conversion of the typed columns of a raw (all-string) chunk"""
+    for column, kind in types.items():
+        values = chunk[column]
+        if kind == 'decimal':
+            chunk[column] = _none_for_missing(pd.to_numeric(values.str.replace(',', '.', regex=False), errors='coerce'))
+        elif kind == 'int':
+            integers = values.where(values.str.fullmatch(r'\s*[+-]?\d+\s*'))
+            chunk[column] = _none_for_missing(pd.to_numeric(integers, errors='coerce').astype('Int64'))
+        else:
+            chunk[column] = _convert_dates(values, column, kind, formats)
+    return chunk
+
+
+def _read_csv_chunks(source: Union[str, TextIO], columns: List[str], chunk_rows: int,
+                     fields: Optional[List[str]] = None) -> Iterator[pd.DataFrame]:
+    """
+    Read a CSV laid out as `columns` in fixed-size chunks of raw string columns,
+    keeping only `fields` (default: every column)
+    """
+    fields = fields or columns
+    with _open_csv(source) as csvfile:
+        reader = pd.read_csv(
+            csvfile,
+            header=None,
+            skiprows=1,  # Skip header
+            names=fields,
+            usecols=[columns.index(field) for field in fields],
+            dtype=str,
+            keep_default_na=False,
+            chunksize=chunk_rows,
+        )
+        with reader:
+            yield from reader
+
+
+def _read_cabecalho_index(source: Union[str, TextIO], chunk_rows: int) -> Dict[str, tuple]:
+    """
+    Index the Cabecalho file by chave_acesso.
+
+    Rows are kept as plain tuples (a fraction of the size of a dict per nota)
+    and only turned into dicts when their nota is emitted.
+    """
+    formats = {}
+    index = {}
+    for chunk in _read_csv_chunks(source, CABECALHO_COLUMNS, chunk_rows):
+        chunk = chunk[chunk['chave_acesso'] != '']
+        if chunk.empty:
+            continue
+        chunk = _convert_chunk(chunk.copy(), CABECALHO_TYPES, formats)
+        for row in chunk.itertuples(index=False, name=None):
+            index[row[0]] = row
+    return index
+
+
+def _nota(row: tuple, items_data: List[Dict]) -> Tuple[Dict, List[Dict]]:
+    nota_fiscal_data = dict(zip(CABECALHO_COLUMNS, row))
+    nota_fiscal_data['classificacao'] = None  # Will be set later by classification service
+    nota_fiscal_data['content_hash'] = nota_content_hash(nota_fiscal_data, items_data)
+    return nota_fiscal_data, items_data
+
+
+def _rewind(source: Union[str, TextIO]) -> bool:
+    """Make `source` readable again from the start; False for a stream that cannot seek"""
+    if isinstance(source, str):
+        return True
+    try:
+        if not source.seekable():
+            return False
+        source.seek(0)
+        return True
+    except (OSError, ValueError):
+        return False
+
+
+def _itens_grouped_by_chave(source: Union[str, TextIO], headers: Dict[str, tuple], chunk_rows: int) -> bool:
+    """
+    Whether the items of every nota form one run in the Itens file (reads only
+    the chave column, then rewinds the source; False when it cannot be rewound)
+    """
+    if not _rewind(source):
+        return False
+    seen = set()
+    last = None
+    for chunk in _read_csv_chunks(source, ITENS_COLUMNS, chunk_rows, ['chave_acesso_nf']):
+        chaves = chunk['chave_acesso_nf']
+        chaves = chaves[chaves.map(headers.__contains__)]
+        for chave in chaves[chaves != chaves.shift()]:
+            if chave == last:
+                continue  # the run goes on from the previous chunk
+            if chave in seen:
+                _rewind(source)
+                return False
+            seen.add(chave)
+            last = chave
+    return _rewind(source)
+
+
+def iter_notas_from_csv(cabecalho_path: Union[str, TextIO], itens_path: Union[str, TextIO],
+                        chunk_rows: int = CSV_CHUNK_ROWS) -> Iterator[Tuple[Dict, List[Dict]]]:
+    """
+    Stream (nota_fiscal_data, items_data) groups out of the Cabecalho/Itens CSVs,
+    one per nota with all of its items.
+
+    The Itens file is read in chunks of `chunk_rows` rows with vectorized date,
+    decimal and integer conversion. When the items are grouped by
+    chave_acesso_nf, as the portal exports them, a nota is yielded as soon as
+    its run of items ends, so memory is bounded by the chunk size plus the
+    Cabecalho index rather than by the Itens file. A first pass over the chave
+    column checks that; when a nota's items come back further down the file
+    (or the stream cannot be read twice) every item is grouped by chave first,
+    as a nota split in two groups would be stored with only part of its items.
+    Notas without items are yielded at the end.
+
+    Args:
+        cabecalho_path: Path to the cabecalho CSV file, or an open text stream
+        itens_path: Path to the itens CSV file, or an open text stream
+        chunk_rows: Number of CSV rows per chunk
+
+    Yields:
+        Tuples (nota_fiscal_data, items_data)
+    """
+    headers = _read_cabecalho_index(cabecalho_path, chunk_rows)
+    if _itens_grouped_by_chave(itens_path, headers, chunk_rows):
+        groups = _iter_item_runs(itens_path, headers, chunk_rows)
+    else:
+        groups = _group_items(itens_path, headers, chunk_rows).items()
+
+    emitted = set()
+    for chave, items_data in groups:
+        yield _nota(headers[chave], items_data)
+        emitted.add(chave)
+
+    for chave, row in headers.items():
+        if chave not in emitted:
+            yield _nota(row, [])
+
+
+def _iter_item_chunks(itens_path: Union[str, TextIO], headers: Dict[str, tuple],
+                      chunk_rows: int) -> Iterator[Tuple[str, Iterator[Dict]]]:
+    """(chave, items) runs of each converted Itens chunk"""
+    formats = {}
+    for chunk in _read_csv_chunks(itens_path, ITENS_COLUMNS, chunk_rows, ITENS_FIELDS):
+        # Items without a matching nota fiscal are dropped
+        chunk = chunk[chunk['chave_acesso_nf'].map(headers.__contains__)]
+        if chunk.empty:
+            continue
+        chunk = _convert_chunk(chunk.copy(), ITENS_TYPES, formats)
+        yield from groupby(chunk.to_dict('records'), key=itemgetter('chave_acesso_nf'))
+
+
+def _iter_item_runs(itens_path: Union[str, TextIO], headers: Dict[str, tuple],
+                    chunk_rows: int) -> Iterator[Tuple[str, List[Dict]]]:
+    """Items of an Itens file grouped by chave, one nota at a time"""
+    pending_chave, pending_items = None, []
+    for chave, group in _iter_item_chunks(itens_path, headers, chunk_rows):
+        # The last run of a chunk may continue into the next one
+        if chave == pending_chave:
+            pending_items.extend(group)
+            continue
+        if pending_chave is not None:
+            yield pending_chave, pending_items
+        pending_chave, pending_items = chave, list(group)
+    if pending_chave is not None:
+        yield pending_chave, pending_items
+
+
+def _group_items(itens_path: Union[str, TextIO], headers: Dict[str, tuple], chunk_rows: int) -> Dict[str, List[Dict]]:
+    """Every item of an Itens file not sorted by chave, by chave in first-seen order"""
+    groups = {}
+    for chave, group in _iter_item_chunks(itens_path, headers, chunk_rows):
+        groups.setdefault(chave, []).extend(group)
+    return groups
+
+
+def parse_csv_to_data(cabecalho_path: Union[str, TextIO], itens_path: Union[str, TextIO]) -> List[Tuple[Dict, List[Dict]]]:
     """
     Parse CSV files and return list of (nota_fiscal_data, items_data) tuples.
     Each tuple represents one nota fiscal with its items.
+
+    Materializes iter_notas_from_csv; prefer the generator for large files.
     
     Args:
-        cabecalho_path: Path to the cabecalho CSV file
-        itens_path: Path to the itens CSV file
+        cabecalho_path: Path to the cabecalho CSV file, or an open text stream
+        itens_path: Path to the itens CSV file, or an open text stream
         
     Returns:
         List of tuples (nota_fiscal_data, items_data)
     """
-    # Read cabecalho (notas fiscais)
-    notas_fiscais = {}
-    
-    with open(cabecalho_path, mode='r', encoding='utf-8-sig') as csvfile:
-        reader = csv.reader(csvfile, delimiter=',')
-        next(reader)  # Skip header
-        
-        for row in reader:
-            if len(row) < 21:
-                continue
-                
-            chave_acesso = row[0] if len(row) > 0 else None
-            if not chave_acesso:
-                continue
-                
-            nota_fiscal_data = {
-                'chave_acesso': chave_acesso,
-                'modelo': row[1] if len(row) > 1 else None,
-                'serie_nf': row[2] if len(row) > 2 else None,
-                'numero_nf': row[3] if len(row) > 3 else None,
-                'natureza_operacao': row[4] if len(row) > 4 else None,
-                'data_emissao': parse_date(row[5]) if len(row) > 5 else None,
-                'evento_mais_recente': row[6] if len(row) > 6 else None,
-                'data_hora_evento_mais_recente': parse_datetime(row[7]) if len(row) > 7 else None,
-                'cpf_cnpj_emitente': row[8] if len(row) > 8 else None,
-                'razao_social_emitente': row[9] if len(row) > 9 else None,
-                'inscricao_estadual_emitente': row[10] if len(row) > 10 else None,
-                'uf_emitente': row[11] if len(row) > 11 else None,
-                'municipio_emitente': row[12] if len(row) > 12 else None,
-                'cnpj_destinatario': row[13] if len(row) > 13 else None,
-                'nome_destinatario': row[14] if len(row) > 14 else None,
-                'uf_destinatario': row[15] if len(row) > 15 else None,
-                'indicador_ie_destinatario': row[16] if len(row) > 16 else None,
-                'destino_operacao': row[17] if len(row) > 17 else None,
-                'consumidor_final': row[18] if len(row) > 18 else None,
-                'presenca_comprador': row[19] if len(row) > 19 else None,
-                'valor_nota_fiscal': parse_decimal(row[20]) if len(row) > 20 else None,
-                'classificacao': None  # Will be set later by classification service
-            }
-            
-            notas_fiscais[chave_acesso] = {
-                'nota_fiscal': nota_fiscal_data,
-                'items': []
-            }
-    
-    # Read itens
-    with open(itens_path, mode='r', encoding='utf-8-sig') as csvfile:
-        reader = csv.reader(csvfile, delimiter=',')
-        next(reader)  # Skip header
-        
-        for row in reader:
-            if len(row) < 27:
-                continue
-                
-            chave_acesso_nf = row[0] if len(row) > 0 else None
-            if not chave_acesso_nf or chave_acesso_nf not in notas_fiscais:
-                continue
-                
-            item_data = {
-                'chave_acesso_nf': chave_acesso_nf,
-                'modelo': row[1] if len(row) > 1 else None,
-                'serie_nf': row[2] if len(row) > 2 else None,
-                'numero_nf': row[3] if len(row) > 3 else None,
-                'natureza_operacao': row[4] if len(row) > 4 else None,
-                'data_emissao': parse_date(row[5]) if len(row) > 5 else None,
-                'cpf_cnpj_emitente': row[6] if len(row) > 6 else None,
-                'razao_social_emitente': row[7] if len(row) > 7 else None,
-                'inscricao_estadual_emitente': row[8] if len(row) > 8 else None,
-                'uf_emitente': row[9] if len(row) > 9 else None,
-                'municipio_emitente': row[10] if len(row) > 10 else None,
-                'cnpj_destinatario': row[11] if len(row) > 11 else None,
-                'nome_destinatario': row[12] if len(row) > 12 else None,
-                'uf_destinatario': row[13] if len(row) > 13 else None,
-                'indicador_ie_destinatario': row[14] if len(row) > 14 else None,
-                'destino_operacao': row[15] if len(row) > 15 else None,
-                'consumidor_final': row[16] if len(row) > 16 else None,
-                'presenca_comprador': row[17] if len(row) > 17 else None,
-                'numero_produto': parse_int(row[18]) if len(row) > 18 else None,
-                'descricao_produto': row[19] if len(row) > 19 else None,
-                'codigo_ncm_sh': row[20] if len(row) > 20 else None,
-                'ncm_sh_tipo_produto': row[21] if len(row) > 21 else None,
-                'cfop': row[22] if len(row) > 22 else None,
-                'quantidade': parse_decimal(row[23]) if len(row) > 23 else None,
-                'unidade': row[24] if len(row) > 24 else None,
-                'valor_unitario': parse_decimal(row[25]) if len(row) > 25 else None,
-                'valor_total': parse_decimal(row[26]) if len(row) > 26 else None
-            }
-            
-            notas_fiscais[chave_acesso_nf]['items'].append(item_data)
-    
-    # Convert to list of tuples
-    result = [(nf['nota_fiscal'], nf['items']) for nf in notas_fiscais.values()]
-    
-    return result 
\ No newline at end of file
+    return list(iter_notas_from_csv(cabecalho_path, itens_path))
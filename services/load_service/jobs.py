@@ -0,0 +1,316 @@
+# jobs.py
+"""
+Background ingestion jobs for large uploads.
+
+The upload is streamed to JOBS_DIR/<job_id>/ and the request returns right
+away with the job id; parsing and publishing run on a thread pool. The job
+state is persisted next to the upload (job.json) after every published batch,
+together with a checkpoint - the number of notas (CSV) or NFe documents (XML)
+already handled - so jobs interrupted by a restart are resumed on startup
+from their last published batch instead of starting over.
+"""
+import json
+import logging
+import os
+import re
+import shutil
+import threading
+import time
+import uuid
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import BinaryIO, Dict, Optional
+
+from fastapi import HTTPException, status
+
+from config import JOBS_DIR, JOB_WORKERS
+from csv_batch import ingest_csv_zip
+from file_utils import find_csv_members
+from xml_batch import MAX_REPORTED_ERRORS, ingest_xml_batch
+
+logger = logging.getLogger(__name__)
+
+JOB_KIND_CSV_ZIP = "csv_zip"
+JOB_KIND_XML_BATCH = "xml_batch"
+
+STATUS_QUEUED = "queued"
+STATUS_RUNNING = "running"
+STATUS_COMPLETED = "completed"
+STATUS_FAILED = "failed"
+
+_JOB_ID = re.compile(r'[0-9a-f]{32}')
+_COUNTERS = ("documents", "parsed", "skipped", "published", "failed", "checkpoint")
+_COPY_BUFFER = 1024 * 1024
+
+_jobs: Dict[str, "IngestionJob"] = {}
+_jobs_lock = threading.Lock()
+_executor = None
+_stopping = threading.Event()
+
+
+class JobInterrupted(Exception):
+    """Raised inside a running job when the service shuts down"""
+
+
+class IngestionJob:
+    """State of one background ingestion, persisted as JSON next to its upload"""
+
+    def __init__(self, job_id: str, kind: str, filename: str, **state):
+        self.job_id = job_id
+        self.kind = kind
+        self.filename = filename
+        self.status = state.get("status", STATUS_QUEUED)
+        self.created_at = state.get("created_at") or datetime.now().isoformat()
+        self.started_at = state.get("started_at")
+        self.finished_at = state.get("finished_at")
+        self.error = state.get("error")
+        self.errors = state.get("errors", [])
+        for counter in _COUNTERS:
+            setattr(self, counter, state.get(counter, 0))
+
+        self._lock = threading.Lock()
+        self._base = {}
+        self._run_started = None
+
+    @property
+    def directory(self) -> str:
+        return os.path.join(JOBS_DIR, self.job_id)
+
+    @property
+    def upload_path(self) -> str:
+        return os.path.join(self.directory, "upload")
+
+    @property
+    def state_path(self) -> str:
+        return os.path.join(self.directory, "job.json")
+
+    def _state(self) -> Dict:
+        state = {
+            "job_id": self.job_id,
+            "kind": self.kind,
+            "filename": self.filename,
+            "status": self.status,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "error": self.error,
+            "errors": list(self.errors),
+        }
+        for counter in _COUNTERS:
+            state[counter] = getattr(self, counter)
+        return state
+
+    def save(self):
+        """Persist the job state atomically"""
+        with self._lock:
+            state = self._state()
+        tmp_path = self.state_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(state, f)
+        os.replace(tmp_path, self.state_path)
+
+    def start(self):
+        with self._lock:
+            self.status = STATUS_RUNNING
+            self.started_at = self.started_at or datetime.now().isoformat()
+            self.error = None
+            # Counters persisted at the last checkpoint; this run adds on top of them
+            self._base = {counter: getattr(self, counter) for counter in _COUNTERS}
+            self._base["errors"] = list(self.errors)
+            self._run_started = time.monotonic()
+        self.save()
+
+    def update(self, stats: Dict):
+        """Progress callback of the ingest functions: apply this run's counters and persist"""
+        with self._lock:
+            for counter in _COUNTERS:
+                if counter in stats:
+                    setattr(self, counter, self._base[counter] + stats[counter])
+            if stats.get("errors"):
+                self.errors = (self._base["errors"] + stats["errors"])[:MAX_REPORTED_ERRORS]
+        self.save()
+        # Only once the batch just published is checkpointed, so a resume does not publish it again
+        if _stopping.is_set():
+            raise JobInterrupted()
+
+    def finish(self, final_status: str, error: Optional[str] = None):
+        with self._lock:
+            self.status = final_status
+            self.error = error
+            self.finished_at = datetime.now().isoformat()
+        self.save()
+
+    def requeue(self):
+        """Leave the job to be resumed from its last checkpoint by the next startup"""
+        with self._lock:
+            self.status = STATUS_QUEUED
+        self.save()
+
+    def to_dict(self) -> Dict:
+        """Job status as reported by the API"""
+        with self._lock:
+            state = self._state()
+            throughput = None
+            if self.status == STATUS_RUNNING and self._run_started is not None:
+                elapsed = time.monotonic() - self._run_started
+                handled = ((self.skipped + self.published + self.failed)
+                           - (self._base["skipped"] + self._base["published"] + self._base["failed"]))
+                throughput = round(handled / elapsed, 2) if elapsed > 0 else 0.0
+
+        if throughput is None and state["started_at"] and state["finished_at"]:
+            elapsed = (datetime.fromisoformat(state["finished_at"]) - datetime.fromisoformat(state["started_at"])).total_seconds()
+            handled = state["skipped"] + state["published"] + state["failed"]
+            throughput = round(handled / elapsed, 2) if elapsed > 0 else None
+
+        return {
+            "job_id": state["job_id"],
+            "kind": state["kind"],
+            "filename": state["filename"],
+            "status": state["status"],
+            "created_at": state["created_at"],
+            "started_at": state["started_at"],
+            "finished_at": state["finished_at"],
+            "documents_found": state["documents"] if state["kind"] == JOB_KIND_XML_BATCH else None,
+            "notas_fiscais_processed": state["parsed"],
+            "skipped_unchanged": state["skipped"],
+            "published_to_queue": state["published"],
+            "failed": state["failed"],
+            "checkpoint": state["checkpoint"],
+            "throughput_notas_per_second": throughput,
+            "errors": state["errors"],
+            "error": state["error"],
+        }
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=JOB_WORKERS, thread_name_prefix="ingestion-job")
+    return _executor
+
+
+def _run_job(job: IngestionJob):
+    job.start()
+    logger.info(f"Job {job.job_id} ({job.kind}, '{job.filename}') started at checkpoint {job.checkpoint}")
+    try:
+        if job.kind == JOB_KIND_CSV_ZIP:
+            stats = ingest_csv_zip(job.upload_path, checkpoint=job.checkpoint, on_progress=job.update)
+        else:
+            with open(job.upload_path, "rb") as upload:
+                stats = ingest_xml_batch(upload, job.filename, checkpoint=job.checkpoint, on_progress=job.update)
+        job.update(stats)
+    except JobInterrupted:
+        logger.info(f"Job {job.job_id} interrupted at checkpoint {job.checkpoint}; it will resume on next startup")
+        job.requeue()
+        return
+    except HTTPException as e:
+        logger.error(f"Job {job.job_id} failed: {e.detail}")
+        job.finish(STATUS_FAILED, str(e.detail))
+        return
+    except Exception as e:
+        logger.error(f"Job {job.job_id} failed: {e}", exc_info=True)
+        job.finish(STATUS_FAILED, str(e))
+        return
+
+    job.finish(STATUS_COMPLETED)
+    # The upload is no longer needed once every nota has been handled
+    os.remove(job.upload_path)
+    logger.info(f"Job {job.job_id} completed: {job.parsed} parsed, {job.published} published, {job.failed} failed")
+
+
+def _submit(job: IngestionJob):
+    with _jobs_lock:
+        _jobs[job.job_id] = job
+    _get_executor().submit(_run_job, job)
+
+
+def _validate_csv_zip(path: str):
+    """Reject a CSV ZIP that can never be processed before a job is created for it"""
+    try:
+        with zipfile.ZipFile(path) as zip_ref:
+            find_csv_members(zip_ref)
+    except zipfile.BadZipFile:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid ZIP file.")
+
+
+def create_job(kind: str, filename: str, fileobj: BinaryIO) -> IngestionJob:
+    """
+    Store an upload on disk and queue it for background ingestion.
+
+    Blocking (copies the upload): callers on the event loop should run it in a worker thread.
+
+    Raises:
+        HTTPException: 400 if the upload is not a valid ZIP for the job kind
+    """
+    job = IngestionJob(uuid.uuid4().hex, kind, filename)
+    os.makedirs(job.directory)
+    try:
+        with open(job.upload_path, "wb") as upload:
+            shutil.copyfileobj(fileobj, upload, _COPY_BUFFER)
+        if kind == JOB_KIND_CSV_ZIP:
+            _validate_csv_zip(job.upload_path)
+        job.save()
+    except Exception:
+        shutil.rmtree(job.directory, ignore_errors=True)
+        raise
+
+    _submit(job)
+    logger.info(f"Job {job.job_id} queued for '{filename}'")
+    return job
+
+
+def _load_job(job_id: str) -> Optional[IngestionJob]:
+    state_path = os.path.join(JOBS_DIR, job_id, "job.json")
+    if not os.path.exists(state_path):
+        return None
+    with open(state_path) as f:
+        state = json.load(f)
+    return IngestionJob(state.pop("job_id"), state.pop("kind"), state.pop("filename"), **state)
+
+
+def get_job(job_id: str) -> Optional[Dict]:
+    """Status of a job, from memory or (for jobs of a previous run) from disk"""
+    if not _JOB_ID.fullmatch(job_id):
+        return None
+    with _jobs_lock:
+        job = _jobs.get(job_id)
+    if job is None:
+        job = _load_job(job_id)
+    return job.to_dict() if job else None
+
+
+def resume_pending_jobs() -> int:
+    """Re-queue the jobs a previous run left queued or running; returns how many were resumed"""
+    if not os.path.isdir(JOBS_DIR):
+        return 0
+
+    resumed = 0
+    for job_id in sorted(os.listdir(JOBS_DIR)):
+        if not _JOB_ID.fullmatch(job_id):
+            continue
+        try:
+            job = _load_job(job_id)
+        except (OSError, ValueError) as e:
+            logger.error(f"Could not read state of job {job_id}: {e}")
+            continue
+        if job is None or job.status not in (STATUS_QUEUED, STATUS_RUNNING):
+            continue
+        if not os.path.exists(job.upload_path):
+            job.finish(STATUS_FAILED, "Upload file missing, job cannot be resumed")
+            continue
+        _submit(job)
+        resumed += 1
+
+    if resumed:
+        logger.info(f"Resumed {resumed} unfinished ingestion jobs")
+    return resumed
+
+
+def shutdown_jobs():
+    """Stop running jobs at their next batch boundary; they resume on next startup"""
+    global _executor
+    _stopping.set()
+    if _executor is not None:
+        _executor.shutdown(wait=True, cancel_futures=True)
+        _executor = None
@@ -0,0 +1,159 @@
+# known_notas.py
+"""
+Skip notas that are already stored unchanged before publishing them.
+
+Every nota carries the content hash computed at parse time (content_hash.py),
+and notasfiscais.content_hash holds the hash of what was stored. A Bloom
+filter of the stored hashes, seeded from the database at startup and fed
+with every hash published since, answers "certainly new" for most notas
+without a query. The notas it reports as maybe present are confirmed with
+one query per batch on (chave_acesso, data_emissao, content_hash); only those
+found are skipped, so false positives of the filter cost a lookup, never a
+lost nota.
+
+The check is an optimization: the writers are idempotent by content hash, so
+a nota published anyway (filter still seeding, database unreachable) is
+skipped by the worker instead.
+"""
+import asyncio
+import logging
+import math
+import threading
+from datetime import date, datetime
+from typing import Dict, List, Optional, Sequence, Set, Tuple
+
+from config import KNOWN_NOTAS_CAPACITY, KNOWN_NOTAS_ERROR_RATE
+from content_hash import nota_content_hash
+from db_utils import pool
+from partitions import partition_date
+
+logger = logging.getLogger(__name__)
+
+SEED_FETCH_SIZE = 10000
+
+STORED_HASHES_SQL = "SELECT content_hash FROM notasfiscais WHERE content_hash IS NOT NULL"
+
+STORED_UNCHANGED_SQL = """
+SELECT n.chave_acesso
+FROM unnest($1::text[], $2::date[], $3::text[]) AS c(chave_acesso, data_emissao, content_hash)
+JOIN notasfiscais n
+  ON n.chave_acesso = c.chave_acesso AND n.data_emissao = c.data_emissao AND n.content_hash = c.content_hash
+"""
+
+
+class BloomFilter:
+    """
+    Bloom filter of hex SHA-256 digests.
+
+    Args:
+        capacity: Expected number of entries
+        error_rate: False positive rate at that number of entries
+    """
+
+    def __init__(self, capacity: int, error_rate: float):
+        self.size = max(8, int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def _positions(self, digest: str):
+        # The digest is already uniformly distributed: double hashing over two 64-bit slices of it
+        h1, h2 = int(digest[0:16], 16), int(digest[16:32], 16) | 1
+        return ((h1 + i * h2) % self.size for i in range(self.hashes))
+
+    def add(self, digest: str):
+        for position in self._positions(digest):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, digest: str) -> bool:
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(digest))
+
+
+_filter = BloomFilter(KNOWN_NOTAS_CAPACITY, KNOWN_NOTAS_ERROR_RATE)
+_filter_lock = threading.Lock()
+
+
+def _as_date(value) -> Optional[date]:
+    if value is None or isinstance(value, date):
+        return value.date() if isinstance(value, datetime) else value
+    try:
+        return datetime.fromisoformat(value).date()
+    except (TypeError, ValueError):
+        return None
+
+
+def _content_hash(nota: Tuple) -> str:
+    nota_fiscal_data, items_data, *impostos = nota
+    impostos_nota, impostos_items = (list(impostos) + [None, None])[:2]
+    return nota_fiscal_data.get('content_hash') or nota_content_hash(
+        nota_fiscal_data, items_data, impostos_nota, impostos_items)
+
+
+async def seed_known_notas():
+    """Load the stored content hashes into the filter (startup background task)"""
+    try:
+        async with pool.connection() as conn:
+            async with conn.transaction():
+                async for row in conn.cursor(STORED_HASHES_SQL, prefetch=SEED_FETCH_SIZE):
+                    with _filter_lock:
+                        _filter.add(row['content_hash'])
+        logger.info(f"Known notas filter seeded with {_filter.count} content hashes")
+    except Exception as e:
+        logger.warning(f"Known notas filter not seeded, every nota will be published: {e}")
+
+
+async def find_unchanged(notas: Sequence[Tuple]) -> Set[str]:
+    """
+    Chaves of the notas already stored with the same content hash.
+
+    Args:
+        notas: (nota_fiscal_data, items_data[, impostos_nota, impostos_items]) tuples
+
+    Returns:
+        Set of chave_acesso (empty when the database cannot be reached)
+    """
+    candidates = {}
+    with _filter_lock:
+        for nota in notas:
+            chave = nota[0].get('chave_acesso')
+            content_hash = _content_hash(nota)
+            if chave and content_hash in _filter:
+                candidates[chave] = (partition_date(chave, _as_date(nota[0].get('data_emissao'))), content_hash)
+    if not candidates:
+        return set()
+
+    chaves = list(candidates)
+    try:
+        async with pool.connection() as conn:
+            rows = await conn.fetch(STORED_UNCHANGED_SQL, chaves, [candidates[c][0] for c in chaves],
+                                    [candidates[c][1] for c in chaves])
+    except Exception as e:
+        logger.warning(f"Could not check {len(chaves)} notas against the database, publishing them: {e}")
+        return set()
+    return {row['chave_acesso'] for row in rows}
+
+
+def split_unchanged(notas: List[Tuple]) -> Tuple[List[Tuple], int]:
+    """
+    Blocking find_unchanged for worker threads.
+
+    Returns:
+        The notas to publish, and how many were skipped as unchanged
+    """
+    unchanged = asyncio.run(find_unchanged(notas))
+    if not unchanged:
+        return notas, 0
+    to_publish = [nota for nota in notas if nota[0].get('chave_acesso') not in unchanged]
+    return to_publish, len(notas) - len(to_publish)
+
+
+def remember(notas: Sequence[Tuple]):
+    """Add the content hashes of published notas to the filter"""
+    with _filter_lock:
+        for nota in notas:
+            _filter.add(_content_hash(nota))
+
+
+def metrics() -> Dict:
+    return {"entries": _filter.count, "bits": _filter.size, "hashes": _filter.hashes}
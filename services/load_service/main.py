@@ -1,17 +1,24 @@
 # main.py
 import uvicorn
-from fastapi import FastAPI, File, UploadFile, HTTPException, status
-import shutil
+from fastapi import FastAPI, File, UploadFile, HTTPException, Query, Request, status
 import os
 import logging
 import asyncio
-import asyncpg
+from datetime import date
+from decimal import Decimal
+from typing import Optional
 
-from config import UPLOAD_DIR, DATABASE_URL
-from file_utils import process_zip_file, parse_csv_to_data
-from db_utils import get_database_statistics, get_all_notas_fiscais, get_nota_fiscal_by_chave, clear_all_tables, ensure_tables_exist
+from config import UPLOAD_DIR, STATS_RECONCILE_INTERVAL
+from csv_batch import ingest_csv_zip
+from db_utils import DATABASE_URL, pool, get_database_statistics, reconcile_statistics, get_notas_fiscais_page, get_nota_fiscal_by_chave, clear_all_tables, ensure_tables_exist
 from xml_parser import parse_nfe_xml
-from rabbitmq_client import publish_nota_fiscal
+from xml_batch import ingest_xml_batch, shutdown_parse_pool
+from rabbitmq_client import publish_nota_fiscal, close_publisher
+from known_notas import seed_known_notas, find_unchanged, remember, metrics as known_notas_metrics
+from notas_listing import DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE, SORTS
+from nota_cache import NotaCache, LIST_SCOPE, list_resource
+from partitions import list_partitions, detach_month, attach_month, parse_month
+from jobs import JOB_KIND_CSV_ZIP, JOB_KIND_XML_BATCH, create_job, get_job, resume_pending_jobs, shutdown_jobs
 
 app = FastAPI()
 
@@ -19,12 +26,41 @@ app = FastAPI()
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Read-through cache of the nota responses, invalidated by database notifications
+cache = NotaCache(DATABASE_URL)
+
+async def _reconcile_statistics_periodically():
+    while True:
+        await asyncio.sleep(STATS_RECONCILE_INTERVAL)
+        try:
+            await reconcile_statistics()
+        except Exception as e:
+            logger.error(f"Error reconciling statistics: {e}")
+
 @app.on_event("startup")
 async def startup_event():
     if not os.path.exists(UPLOAD_DIR):
         os.makedirs(UPLOAD_DIR)
+    try:
+        await pool.open()
+    except Exception as e:
+        logger.warning(f"Database pool not opened at startup, retrying on first use: {e}")
+    # In the background: until it is seeded, notas are published and the worker skips the unchanged ones
+    asyncio.create_task(seed_known_notas())
+    if STATS_RECONCILE_INTERVAL > 0:
+        asyncio.create_task(_reconcile_statistics_periodically())
+    await cache.start()
+    resume_pending_jobs()
     logger.info("Load service started successfully")
 
+@app.on_event("shutdown")
+async def shutdown_event():
+    shutdown_jobs()
+    shutdown_parse_pool()
+    close_publisher()
+    await cache.close()
+    await pool.close()
+
 @app.get("/health")
 @app.get("/api/health")
 async def health_check():
@@ -40,7 +76,10 @@ async def status_check():
         return {
             "status": "online",
             "service": "load_service",
-            **db_stats
+            **db_stats,
+            "db_pool": pool.metrics(),
+            "known_notas_filter": known_notas_metrics(),
+            "nota_cache": cache.metrics()
         }
     except Exception as e:
         logger.error(f"Error getting status: {e}")
@@ -64,40 +103,18 @@ async def upload_nfe_zip(file: UploadFile = File(...)):
     if not file.filename.endswith('.zip'):
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid file type. Only ZIP files are allowed.")
 
-    temp_zip_path = os.path.join(UPLOAD_DIR, f"temp_{file.filename}")
-
     try:
-        # Save the uploaded zip file temporarily
-        with open(temp_zip_path, "wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
-        logger.info(f"Temporary ZIP file saved to {temp_zip_path}")
-
-        # Process the zip file (extract and validate)
-        cabecalho_csv_path, itens_csv_path = process_zip_file(temp_zip_path)
-        logger.info(f"ZIP file processed. Cabecalho: {cabecalho_csv_path}, Itens: {itens_csv_path}")
-
-        # Parse CSV files to data structures
-        notas_fiscais_data = parse_csv_to_data(cabecalho_csv_path, itens_csv_path)
-        logger.info(f"Parsed {len(notas_fiscais_data)} notas fiscais from CSV")
-
-        # Send each nota fiscal to RabbitMQ
-        published_count = 0
-        failed_count = 0
-        
-        for nota_fiscal_data, items_data in notas_fiscais_data:
-            if publish_nota_fiscal(nota_fiscal_data, items_data):
-                published_count += 1
-            else:
-                failed_count += 1
-                logger.error(f"Failed to publish nota fiscal: {nota_fiscal_data.get('chave_acesso')}")
-
-        logger.info(f"Published {published_count} notas fiscais to RabbitMQ. Failed: {failed_count}")
+        # The CSV members are streamed straight from the uploaded file - nothing is
+        # written to the shared UPLOAD_DIR - so concurrent uploads don't interfere.
+        # Parsing and publishing are blocking; keep them off the event loop.
+        result = await asyncio.to_thread(ingest_csv_zip, file.file)
 
         return {
             "message": f"File '{file.filename}' processed successfully",
-            "notas_fiscais_processed": len(notas_fiscais_data),
-            "published_to_queue": published_count,
-            "failed": failed_count
+            "notas_fiscais_processed": result["parsed"],
+            "skipped_unchanged": result["skipped"],
+            "published_to_queue": result["published"],
+            "failed": result["failed"]
         }
 
     except HTTPException as e:
@@ -106,16 +123,6 @@ async def upload_nfe_zip(file: UploadFile = File(...)):
     except Exception as e:
         logger.error(f"An unexpected error occurred: {e}", exc_info=True)
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=f"An unexpected error occurred: {str(e)}")
-    finally:
-        # Clean up the temporary zip file
-        if os.path.exists(temp_zip_path):
-            os.remove(temp_zip_path)
-            logger.info(f"Temporary ZIP file {temp_zip_path} removed.")
-        # Clean up extracted CSV files
-        if 'cabecalho_csv_path' in locals() and os.path.exists(cabecalho_csv_path):
-            os.remove(cabecalho_csv_path)
-        if 'itens_csv_path' in locals() and os.path.exists(itens_csv_path):
-            os.remove(itens_csv_path)
 
 @app.post("/upload-nfe-xml/")
 @app.post("/api/upload-nfe-xml/")
@@ -133,12 +140,11 @@ async def upload_nfe_xml(file: UploadFile = File(...)):
     try:
         # Read the uploaded XML file content
         xml_content = await file.read()
-        xml_string = xml_content.decode('utf-8')
         logger.info(f"XML file '{file.filename}' read successfully")
 
-        # Parse the XML file
+        # Parse the XML file (raw bytes - the parser honours the XML encoding declaration)
         try:
-            nota_fiscal_data, items_data, impostos_nota, impostos_items = parse_nfe_xml(xml_string)
+            nota_fiscal_data, items_data, impostos_nota, impostos_items = parse_nfe_xml(xml_content)
             logger.info(f"XML parsed successfully. Chave: {nota_fiscal_data.get('chave_acesso')}, Items: {len(items_data)}, Impostos Items: {len(impostos_items)}")
         except ValueError as e:
             logger.error(f"Error parsing XML: {e}")
@@ -147,9 +153,22 @@ async def upload_nfe_xml(file: UploadFile = File(...)):
                 detail=f"Error parsing XML file: {str(e)}"
             )
 
-        # Send to RabbitMQ
-        if publish_nota_fiscal(nota_fiscal_data, items_data, impostos_nota, impostos_items):
+        nota = (nota_fiscal_data, items_data, impostos_nota, impostos_items)
+        if await find_unchanged([nota]):
+            logger.info(f"Nota fiscal already stored unchanged, not published: {nota_fiscal_data.get('chave_acesso')}")
+            return {
+                "message": f"File '{file.filename}' is already stored unchanged",
+                "chave_acesso": nota_fiscal_data.get('chave_acesso'),
+                "numero_nf": nota_fiscal_data.get('numero_nf'),
+                "items_count": len(items_data),
+                "valor_total": nota_fiscal_data.get('valor_nota_fiscal'),
+                "status": "unchanged"
+            }
+
+        # Send to RabbitMQ (waits for the broker confirm; keep it off the event loop)
+        if await asyncio.to_thread(publish_nota_fiscal, nota_fiscal_data, items_data, impostos_nota, impostos_items):
             logger.info(f"Successfully published nota fiscal to RabbitMQ: {nota_fiscal_data.get('chave_acesso')}")
+            remember([nota])
             
             return {
                 "message": f"File '{file.filename}' processed and sent to queue successfully",
@@ -175,14 +194,132 @@ async def upload_nfe_xml(file: UploadFile = File(...)):
             detail=f"An unexpected error occurred: {str(e)}"
         )
 
+@app.post("/upload-nfe-xml-batch/")
+@app.post("/api/upload-nfe-xml-batch/")
+async def upload_nfe_xml_batch(file: UploadFile = File(...)):
+    """
+    Upload many NFe XMLs at once and send them to RabbitMQ queue in batches.
+    Accepts a ZIP of XML files or a single XML lot (an enviNFe, or several
+    nfeProc/NFe documents concatenated in one file).
+    """
+    if not file.filename.lower().endswith(('.zip', '.xml')):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Invalid file type. Only ZIP or XML files are allowed."
+        )
+
+    try:
+        # Parsing and publishing are blocking; keep them off the event loop
+        result = await asyncio.to_thread(ingest_xml_batch, file.file, file.filename)
+
+        return {
+            "message": f"File '{file.filename}' processed successfully",
+            "documents_found": result["documents"],
+            "notas_fiscais_processed": result["parsed"],
+            "skipped_unchanged": result["skipped"],
+            "published_to_queue": result["published"],
+            "failed": result["failed"],
+            "errors": result["errors"]
+        }
+
+    except HTTPException as e:
+        logger.error(f"HTTP Exception during batch upload: {e.detail}")
+        raise e
+    except Exception as e:
+        logger.error(f"An unexpected error occurred: {e}", exc_info=True)
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"An unexpected error occurred: {str(e)}"
+        )
+
+@app.post("/jobs/upload-nfe-zip/", status_code=status.HTTP_202_ACCEPTED)
+@app.post("/api/jobs/upload-nfe-zip/", status_code=status.HTTP_202_ACCEPTED)
+async def upload_nfe_zip_job(file: UploadFile = File(...)):
+    """
+    Job-based variant of /upload-nfe-zip/ for large files.
+    The ZIP is stored on disk and processed in the background; poll
+    /api/jobs/{job_id} for progress.
+    """
+    if not file.filename.endswith('.zip'):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid file type. Only ZIP files are allowed.")
+
+    return await _create_ingestion_job(JOB_KIND_CSV_ZIP, file)
+
+@app.post("/jobs/upload-nfe-xml-batch/", status_code=status.HTTP_202_ACCEPTED)
+@app.post("/api/jobs/upload-nfe-xml-batch/", status_code=status.HTTP_202_ACCEPTED)
+async def upload_nfe_xml_batch_job(file: UploadFile = File(...)):
+    """
+    Job-based variant of /upload-nfe-xml-batch/ for large files.
+    The ZIP or XML lot is stored on disk and processed in the background;
+    poll /api/jobs/{job_id} for progress.
+    """
+    if not file.filename.lower().endswith(('.zip', '.xml')):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Invalid file type. Only ZIP or XML files are allowed."
+        )
+
+    return await _create_ingestion_job(JOB_KIND_XML_BATCH, file)
+
+async def _create_ingestion_job(kind: str, file: UploadFile):
+    try:
+        # Copying the upload to disk is blocking; keep it off the event loop
+        job = await asyncio.to_thread(create_job, kind, file.filename, file.file)
+        return {
+            "message": f"File '{file.filename}' accepted for processing",
+            "job_id": job.job_id,
+            "status_url": f"/api/jobs/{job.job_id}"
+        }
+
+    except HTTPException as e:
+        logger.error(f"HTTP Exception during job upload: {e.detail}")
+        raise e
+    except Exception as e:
+        logger.error(f"An unexpected error occurred: {e}", exc_info=True)
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"An unexpected error occurred: {str(e)}"
+        )
+
+@app.get("/jobs/{job_id}")
+@app.get("/api/jobs/{job_id}")
+async def get_ingestion_job(job_id: str):
+    """
+    Progress of an ingestion job: status, parsed/published/failed counts and throughput
+    """
+    job = await asyncio.to_thread(get_job, job_id)
+    if not job:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Job {job_id} not found")
+    return job
+
 @app.get("/api/notas")
-async def list_notas_fiscais():
+async def list_notas_fiscais(
+    request: Request,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    sort: str = Query('data_desc', description=f"One of: {', '.join(SORTS)}"),
+    emitente: Optional[str] = None,
+    destinatario: Optional[str] = None,
+    uf_emitente: Optional[str] = Query(None, min_length=2, max_length=2),
+    uf_destinatario: Optional[str] = Query(None, min_length=2, max_length=2),
+    classificacao: Optional[str] = None,
+    data_inicio: Optional[date] = None,
+    data_fim: Optional[date] = None,
+    valor_min: Optional[Decimal] = None,
+    valor_max: Optional[Decimal] = None,
+    q: Optional[str] = None
+):
     """
-    List all notas fiscais with their basic information
+    List notas fiscais one page at a time; pass next_cursor as `cursor` for the next page
     """
     try:
-        notas = await get_all_notas_fiscais()
-        return {"notas": notas}
+        return await cache.respond(request, list_resource(request), LIST_SCOPE, lambda: get_notas_fiscais_page(
+            sort, limit, cursor, emitente=emitente, destinatario=destinatario, uf_emitente=uf_emitente,
+            uf_destinatario=uf_destinatario, classificacao=classificacao, data_inicio=data_inicio,
+            data_fim=data_fim, valor_min=valor_min, valor_max=valor_max, q=q
+        ))
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
     except Exception as e:
         logger.error(f"Error listing notas fiscais: {e}", exc_info=True)
         raise HTTPException(
@@ -191,18 +328,21 @@ async def list_notas_fiscais():
         )
 
 @app.get("/api/notas/{chave_acesso}")
-async def get_nota_fiscal_details(chave_acesso: str):
+async def get_nota_fiscal_details(chave_acesso: str, request: Request):
     """
-    Get detailed information about a specific nota fiscal including its items
+    Get detailed information about a specific nota fiscal: header and tax totals
+    (`nota`), items with their taxes (`itens`)
     """
     try:
-        result = await get_nota_fiscal_by_chave(chave_acesso)
-        if not result:
+        # Serialized by PostgreSQL: cached and sent as is
+        response = await cache.respond(request, "detail", chave_acesso,
+                                       lambda: get_nota_fiscal_by_chave(chave_acesso))
+        if response is None:
             raise HTTPException(
                 status_code=status.HTTP_404_NOT_FOUND,
                 detail=f"Nota fiscal with chave_acesso '{chave_acesso}' not found"
             )
-        return result
+        return response
     except HTTPException:
         raise
     except Exception as e:
@@ -213,27 +353,29 @@ async def get_nota_fiscal_details(chave_acesso: str):
         )
 
 @app.get("/api/impostos/nota/{chave_acesso}")
-async def get_impostos_nota(chave_acesso: str):
+async def get_impostos_nota(chave_acesso: str, request: Request):
     """
     Get tax totals for a specific nota fiscal by chave_acesso
     """
-    try:
-        conn = await asyncpg.connect(DATABASE_URL)
+    async def load():
+        conn = await pool.acquire()
         try:
             result = await conn.fetchrow("""
                 SELECT * FROM impostos_nota_fiscal
                 WHERE chave_acesso_nf = $1
             """, chave_acesso)
-            
-            if not result:
-                raise HTTPException(
-                    status_code=status.HTTP_404_NOT_FOUND,
-                    detail=f"Tax data not found for nota fiscal with chave_acesso '{chave_acesso}'"
-                )
-            
-            return dict(result)
+            return dict(result) if result else None
         finally:
-            await conn.close()
+            await pool.release(conn)
+
+    try:
+        response = await cache.respond(request, "impostos_nota", chave_acesso, load)
+        if response is None:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail=f"Tax data not found for nota fiscal with chave_acesso '{chave_acesso}'"
+            )
+        return response
     except HTTPException:
         raise
     except Exception as e:
@@ -244,24 +386,26 @@ async def get_impostos_nota(chave_acesso: str):
         )
 
 @app.get("/api/impostos/itens/{chave_acesso}")
-async def get_impostos_itens(chave_acesso: str):
+async def get_impostos_itens(chave_acesso: str, request: Request):
     """
     Get tax data for all items of a specific nota fiscal by chave_acesso
     """
-    try:
-        conn = await asyncpg.connect(DATABASE_URL)
+    async def load():
+        conn = await pool.acquire()
         try:
             results = await conn.fetch("""
                 SELECT ii.*, inf.numero_produto, inf.descricao_produto
                 FROM impostos_item ii
-                JOIN itensnotafiscal inf ON ii.id_item_nf = inf.id_item_nf
+                JOIN itens_nota inf ON ii.id_item_nf = inf.id_item_nf AND inf.data_emissao = ii.data_emissao
                 WHERE ii.chave_acesso_nf = $1
                 ORDER BY ii.numero_item
             """, chave_acesso)
-            
             return [dict(row) for row in results]
         finally:
-            await conn.close()
+            await pool.release(conn)
+
+    try:
+        return await cache.respond(request, "impostos_itens", chave_acesso, load)
     except Exception as e:
         logger.error(f"Error getting item tax data: {e}", exc_info=True)
         raise HTTPException(
@@ -270,12 +414,12 @@ async def get_impostos_itens(chave_acesso: str):
         )
 
 @app.get("/api/impostos/completo/{chave_acesso}")
-async def get_impostos_completo(chave_acesso: str):
+async def get_impostos_completo(chave_acesso: str, request: Request):
     """
     Get complete tax information (totals + items) for a specific nota fiscal
     """
-    try:
-        conn = await asyncpg.connect(DATABASE_URL)
+    async def load():
+        conn = await pool.acquire()
         try:
             # Get tax totals
             impostos_nota = await conn.fetchrow("""
@@ -287,7 +431,7 @@ async def get_impostos_completo(chave_acesso: str):
             impostos_itens = await conn.fetch("""
                 SELECT ii.*, inf.numero_produto, inf.descricao_produto
                 FROM impostos_item ii
-                JOIN itensnotafiscal inf ON ii.id_item_nf = inf.id_item_nf
+                JOIN itens_nota inf ON ii.id_item_nf = inf.id_item_nf AND inf.data_emissao = ii.data_emissao
                 WHERE ii.chave_acesso_nf = $1
                 ORDER BY ii.numero_item
             """, chave_acesso)
@@ -298,7 +442,10 @@ async def get_impostos_completo(chave_acesso: str):
                 "impostos_itens": [dict(row) for row in impostos_itens]
             }
         finally:
-            await conn.close()
+            await pool.release(conn)
+
+    try:
+        return await cache.respond(request, "impostos_completo", chave_acesso, load)
     except Exception as e:
         logger.error(f"Error getting complete tax data: {e}", exc_info=True)
         raise HTTPException(
@@ -342,5 +489,69 @@ async def ensure_tables():
             detail=f"Error ensuring tables exist: {str(e)}"
         )
 
+@app.post("/api/stats/reconcile")
+async def reconcile_stats():
+    """
+    Recount the statistics served by /status from the tables.
+    They are kept up to date by triggers; this is only needed to check or repair them.
+    """
+    try:
+        logger.info("Reconciling statistics")
+        return await reconcile_statistics()
+    except Exception as e:
+        logger.error(f"Error reconciling statistics: {e}", exc_info=True)
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Error reconciling statistics: {str(e)}"
+        )
+
+@app.get("/api/partitions")
+async def get_partitions():
+    """
+    List the monthly partitions of notasfiscais, itens_nota and impostos_item
+    (attached and detached), with estimated rows and size per table.
+    """
+    try:
+        async with pool.connection() as conn:
+            return await list_partitions(conn)
+    except Exception as e:
+        logger.error(f"Error listing partitions: {e}", exc_info=True)
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Error listing partitions: {str(e)}"
+        )
+
+async def _change_partitions(action, month: str):
+    try:
+        month_date = parse_month(month)
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+    try:
+        async with pool.connection() as conn:
+            return await action(conn, month_date)
+    except LookupError as e:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=str(e))
+    except Exception as e:
+        logger.error(f"Error changing partitions of {month}: {e}", exc_info=True)
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Error changing partitions of {month}: {str(e)}"
+        )
+
+@app.post("/api/partitions/{month}/detach")
+async def detach_partitions(month: str):
+    """
+    Archive a month (YYYY-MM): its partitions are detached from the three tables
+    and kept as standalone tables. Its notas stop showing up in every query.
+    """
+    logger.warning(f"Detaching partitions of {month}")
+    return await _change_partitions(detach_month, month)
+
+@app.post("/api/partitions/{month}/attach")
+async def attach_partitions(month: str):
+    """Bring an archived month (YYYY-MM) back by re-attaching its partitions"""
+    logger.info(f"Attaching partitions of {month}")
+    return await _change_partitions(attach_month, month)
+
 if __name__ == "__main__":
     uvicorn.run(app, host="0.0.0.0", port=8000) 
\ No newline at end of file
@@ -0,0 +1,187 @@
+# micro_batch.py
+"""
+Micro-batching stage for queue consumers.
+
+Messages are accumulated until there are `max_size` of them or the oldest has
+waited `linger_ms`, and the whole batch is written with a single call to a
+bulk write function (one database transaction). When a batch write fails the
+bisect policy decides how the failure is isolated, so a single poison message
+does not keep the rest of its batch from being stored:
+
+    bisect  split the batch in halves recursively until the failing messages are alone
+    single  retry every message of the batch on its own
+    none    fail the whole batch
+
+Batch sizes and flush latencies are recorded in BatchMetrics.
+"""
+import asyncio
+import logging
+import time
+from collections import deque
+from typing import Awaitable, Callable, Dict, List, Optional, Sequence
+
+logger = logging.getLogger(__name__)
+
+BISECT_POLICIES = ("bisect", "single", "none")
+
+
+class BatchMetrics:
+    """Batch-size and flush-latency metrics, logged every `log_interval` seconds"""
+
+    def __init__(self, name: str, log_interval: float = 60.0, window: int = 1000):
+        self.name = name
+        self.log_interval = log_interval
+        self.batches = 0
+        self.messages = 0
+        self.failed_messages = 0
+        self.splits = 0
+        self._sizes = deque(maxlen=window)
+        self._latencies = deque(maxlen=window)
+        self._last_log = time.monotonic()
+
+    def record_flush(self, size: int, latency: float, failed: int):
+        self.batches += 1
+        self.messages += size
+        self.failed_messages += failed
+        self._sizes.append(size)
+        self._latencies.append(latency)
+        if self.log_interval and time.monotonic() - self._last_log >= self.log_interval:
+            self.log()
+
+    def record_split(self):
+        self.splits += 1
+
+    @staticmethod
+    def _percentile(values: Sequence[float], fraction: float) -> float:
+        if not values:
+            return 0.0
+        ordered = sorted(values)
+        return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+    def snapshot(self) -> Dict:
+        """Totals since start, plus size and latency stats over the recent window"""
+        sizes, latencies = list(self._sizes), list(self._latencies)
+        return {
+            "batches": self.batches,
+            "messages": self.messages,
+            "failed_messages": self.failed_messages,
+            "splits": self.splits,
+            "batch_size_avg": round(sum(sizes) / len(sizes), 1) if sizes else 0.0,
+            "batch_size_max": max(sizes) if sizes else 0,
+            "flush_latency_ms_avg": round(1000 * sum(latencies) / len(latencies), 1) if latencies else 0.0,
+            "flush_latency_ms_p95": round(1000 * self._percentile(latencies, 0.95), 1),
+            "flush_latency_ms_max": round(1000 * max(latencies), 1) if latencies else 0.0,
+        }
+
+    def log(self):
+        self._last_log = time.monotonic()
+        stats = self.snapshot()
+        logger.info(f"[{self.name}] {stats['batches']} batches / {stats['messages']} messages "
+                    f"({stats['failed_messages']} failed, {stats['splits']} splits); "
+                    f"batch size avg {stats['batch_size_avg']} max {stats['batch_size_max']}; "
+                    f"flush latency avg {stats['flush_latency_ms_avg']}ms p95 {stats['flush_latency_ms_p95']}ms "
+                    f"max {stats['flush_latency_ms_max']}ms")
+
+
+async def write_isolating_failures(payloads: List, write: Callable[[List], Awaitable],
+                                   policy: str = "bisect",
+                                   metrics: Optional[BatchMetrics] = None) -> List[Optional[Exception]]:
+    """
+    Write `payloads` in one call, isolating failures according to `policy`.
+
+    Returns:
+        One entry per payload: None if it was written, otherwise the exception that failed it
+    """
+    try:
+        await write(payloads)
+        return [None] * len(payloads)
+    except Exception as e:
+        if len(payloads) == 1 or policy == "none":
+            return [e] * len(payloads)
+        error = e
+
+    if metrics:
+        metrics.record_split()
+    logger.warning(f"Batch of {len(payloads)} failed ({error}); isolating with policy '{policy}'")
+
+    if policy == "single":
+        results = []
+        for payload in payloads:
+            results.extend(await write_isolating_failures([payload], write, policy, metrics))
+        return results
+
+    middle = len(payloads) // 2
+    return (await write_isolating_failures(payloads[:middle], write, policy, metrics)
+            + await write_isolating_failures(payloads[middle:], write, policy, metrics))
+
+
+class MicroBatcher:
+    """
+    asyncio micro-batching stage.
+
+    Entries are (message, payload) pairs. Payloads are written in batches
+    with `write(payloads)`; afterwards `on_flushed(entries, errors)` is called
+    with one error (or None) per entry so the caller can settle the messages.
+
+    Args:
+        write: Async bulk write of a list of payloads, in a single transaction
+        on_flushed: Async callback settling a flushed batch
+        max_size: Flush as soon as this many entries are waiting
+        linger_ms: Flush when the oldest waiting entry is this old
+        policy: Failure isolation policy (see BISECT_POLICIES)
+        max_concurrent_flushes: Batches written at the same time
+        metrics: Where batch sizes and flush latencies are recorded
+    """
+
+    def __init__(self, write: Callable[[List], Awaitable], on_flushed: Callable[[List, List], Awaitable],
+                 max_size: int = 100, linger_ms: float = 50, policy: str = "bisect",
+                 max_concurrent_flushes: int = 1, metrics: Optional[BatchMetrics] = None):
+        if policy not in BISECT_POLICIES:
+            raise ValueError(f"Unknown bisect policy '{policy}', expected one of {BISECT_POLICIES}")
+        self._write = write
+        self._on_flushed = on_flushed
+        self.max_size = max(1, max_size)
+        self.linger = max(0.0, linger_ms) / 1000
+        self.policy = policy
+        self.metrics = metrics or BatchMetrics("batch")
+        self._flush_slots = asyncio.Semaphore(max(1, max_concurrent_flushes))
+        self._pending = []
+        self._timer = None
+        self._flushes = set()
+
+    def add(self, message, payload):
+        """Queue an entry; the batch is flushed when full or when it has lingered long enough"""
+        self._pending.append((message, payload))
+        if len(self._pending) >= self.max_size:
+            self._flush_pending()
+        elif self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self.linger, self._flush_pending)
+
+    async def close(self):
+        """Flush what is waiting and wait for every flush in progress"""
+        self._flush_pending()
+        if self._flushes:
+            await asyncio.gather(*self._flushes, return_exceptions=True)
+
+    def _flush_pending(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self._pending:
+            return
+        batch, self._pending = self._pending, []
+        task = asyncio.get_running_loop().create_task(self._flush(batch))
+        self._flushes.add(task)
+        task.add_done_callback(self._flushes.discard)
+
+    async def _flush(self, batch: List):
+        async with self._flush_slots:
+            started = time.monotonic()
+            errors = await write_isolating_failures([payload for _message, payload in batch],
+                                                    self._write, self.policy, self.metrics)
+            self.metrics.record_flush(len(batch), time.monotonic() - started,
+                                      sum(error is not None for error in errors))
+            try:
+                await self._on_flushed(batch, errors)
+            except Exception as e:
+                logger.error(f"Error settling batch of {len(batch)} messages: {e}", exc_info=True)
@@ -0,0 +1,192 @@
+# migrate.py
+"""
+Versioned schema migrations for the notas fiscais database.
+
+Migrations are the NNNN_name.sql files in migrations/, applied in version
+order and recorded in schema_migrations (with a checksum, so an edited
+migration is reported). A session advisory lock makes concurrent runners
+(e.g. several workers starting at once) apply each migration exactly once.
+
+A migration whose header contains "-- migrate: no-transaction" runs outside a
+transaction, one statement at a time, as CREATE INDEX CONCURRENTLY requires.
+Indexes it creates that were left INVALID by an interrupted run are dropped
+before it is retried.
+
+Usage:
+    python migrate.py                # apply pending migrations, create the coming months' partitions
+    python migrate.py --status       # list applied/pending migrations
+    python migrate.py --check-plans  # apply, then run the query-plan regression check
+"""
+import argparse
+import asyncio
+import hashlib
+import os
+import re
+import sys
+import time
+from typing import Dict, List, NamedTuple
+
+import asyncpg
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "migrations")
+ADVISORY_LOCK_KEY = 7_240_001  # arbitrary, shared by every runner of this schema
+NO_TRANSACTION_MARKER = "-- migrate: no-transaction"
+
+CREATE_MIGRATIONS_TABLE_SQL = """
+CREATE TABLE IF NOT EXISTS schema_migrations (
+    version INT PRIMARY KEY,
+    name VARCHAR(255) NOT NULL,
+    checksum VARCHAR(64) NOT NULL,
+    applied_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    duration_ms INT
+);
+"""
+
+_FILENAME = re.compile(r"^(\d{4})_(\w+)\.sql$")
+_INDEX_NAME = re.compile(r"CREATE\s+(?:UNIQUE\s+)?INDEX\s+CONCURRENTLY\s+(?:IF\s+NOT\s+EXISTS\s+)?(\w+)", re.I)
+
+
+class Migration(NamedTuple):
+    version: int
+    name: str
+    sql: str
+    checksum: str
+
+    @property
+    def transactional(self) -> bool:
+        return NO_TRANSACTION_MARKER not in self.sql
+
+    def statements(self) -> List[str]:
+        """Statements of the file, comments stripped (no-transaction migrations hold no DO blocks)"""
+        body = "\n".join(line for line in self.sql.splitlines() if not line.strip().startswith("--"))
+        return [statement.strip() for statement in body.split(";") if statement.strip()]
+
+
+def load_migrations(directory: str = MIGRATIONS_DIR) -> List[Migration]:
+    migrations = []
+    for filename in sorted(os.listdir(directory)):
+        match = _FILENAME.match(filename)
+        if not match:
+            continue
+        with open(os.path.join(directory, filename), encoding="utf-8") as f:
+            sql = f.read()
+        migrations.append(Migration(int(match.group(1)), match.group(2), sql,
+                                    hashlib.sha256(sql.encode("utf-8")).hexdigest()))
+    versions = [migration.version for migration in migrations]
+    if len(versions) != len(set(versions)):
+        raise ValueError(f"Duplicate migration versions in {directory}")
+    return migrations
+
+
+async def _applied(conn: asyncpg.Connection) -> Dict[int, str]:
+    rows = await conn.fetch("SELECT version, checksum FROM schema_migrations")
+    return {row["version"]: row["checksum"] for row in rows}
+
+
+async def _drop_invalid_indexes(conn: asyncpg.Connection, migration: Migration):
+    names = _INDEX_NAME.findall(migration.sql)
+    invalid = await conn.fetch("""
+        SELECT c.relname FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid
+        WHERE NOT i.indisvalid AND c.relname = ANY($1::text[])
+    """, names)
+    for row in invalid:
+        print(f"Dropping invalid index {row['relname']} left by an interrupted build")
+        await conn.execute(f'DROP INDEX CONCURRENTLY IF EXISTS "{row["relname"]}"')
+
+
+async def _apply(conn: asyncpg.Connection, migration: Migration):
+    started = time.monotonic()
+    if migration.transactional:
+        async with conn.transaction():
+            await conn.execute(migration.sql)
+            await _record(conn, migration, started)
+        return
+
+    await _drop_invalid_indexes(conn, migration)
+    for statement in migration.statements():
+        await conn.execute(statement)
+    await _record(conn, migration, started)
+
+
+async def _record(conn: asyncpg.Connection, migration: Migration, started: float):
+    await conn.execute(
+        "INSERT INTO schema_migrations (version, name, checksum, duration_ms) VALUES ($1, $2, $3, $4)",
+        migration.version, migration.name, migration.checksum, int(1000 * (time.monotonic() - started))
+    )
+
+
+async def apply_migrations(conn: asyncpg.Connection) -> List[str]:
+    """
+    Apply pending migrations on `conn` (must not be inside a transaction)
+
+    Returns:
+        Names of the migrations applied by this call
+    """
+    migrations = load_migrations()
+    await conn.execute("SELECT pg_advisory_lock($1)", ADVISORY_LOCK_KEY)
+    try:
+        await conn.execute(CREATE_MIGRATIONS_TABLE_SQL)
+        applied = await _applied(conn)
+        done = []
+        for migration in migrations:
+            label = f"{migration.version:04d}_{migration.name}"
+            if migration.version in applied:
+                if applied[migration.version] != migration.checksum:
+                    print(f"⚠️  Migration {label} was changed after being applied")
+                continue
+            print(f"Applying migration {label}...")
+            await _apply(conn, migration)
+            done.append(label)
+        if done:
+            print(f"✅ Applied {len(done)} migrations")
+        return done
+    finally:
+        await conn.execute("SELECT pg_advisory_unlock($1)", ADVISORY_LOCK_KEY)
+
+
+async def migration_status(conn: asyncpg.Connection) -> List[Dict]:
+    await conn.execute(CREATE_MIGRATIONS_TABLE_SQL)
+    applied = await _applied(conn)
+    return [{
+        "version": migration.version,
+        "name": migration.name,
+        "applied": migration.version in applied,
+        "modified": migration.version in applied and applied[migration.version] != migration.checksum,
+    } for migration in load_migrations()]
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--status", action="store_true", help="list migrations and exit")
+    parser.add_argument("--check-plans", action="store_true", help="run the query-plan regression check after migrating")
+    args = parser.parse_args()
+
+    # Imported here so the module can be used without db_utils' dependencies
+    from db_utils import DATABASE_URL, create_database_if_missing
+    from partitions import create_partitions_ahead
+
+    await create_database_if_missing()
+    conn = await asyncpg.connect(DATABASE_URL)
+    try:
+        if args.status:
+            for row in await migration_status(conn):
+                state = "applied" if row["applied"] else "pending"
+                if row["modified"]:
+                    state += " (modified since)"
+                print(f"{row['version']:04d}_{row['name']}: {state}")
+            return 0
+
+        await apply_migrations(conn)
+        await create_partitions_ahead(conn)
+
+        if args.check_plans:
+            from query_plans import check_query_plans
+            failures = await check_query_plans(conn)
+            return 1 if failures else 0
+        return 0
+    finally:
+        await conn.close()
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main()))
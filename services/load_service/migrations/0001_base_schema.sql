@@ -0,0 +1,176 @@
+-- 0001_base_schema.sql
+-- Tables as previously created by load_service/db_utils.create_db_and_tables
+-- and taxes_service/db_utils.ensure_analise_fiscal_table. IF NOT EXISTS keeps
+-- this a no-op on databases that already have them.
+
+CREATE TABLE IF NOT EXISTS notasfiscais (
+    chave_acesso VARCHAR(44) PRIMARY KEY,
+    modelo VARCHAR(100),
+    serie_nf VARCHAR(10),
+    numero_nf VARCHAR(20),
+    natureza_operacao VARCHAR(255),
+    data_emissao DATE,
+    evento_mais_recente VARCHAR(255),
+    data_hora_evento_mais_recente TIMESTAMP,
+    cpf_cnpj_emitente VARCHAR(20),
+    razao_social_emitente VARCHAR(255),
+    inscricao_estadual_emitente VARCHAR(20),
+    uf_emitente CHAR(2),
+    municipio_emitente VARCHAR(100),
+    cnpj_destinatario VARCHAR(20),
+    nome_destinatario VARCHAR(255),
+    uf_destinatario CHAR(2),
+    indicador_ie_destinatario VARCHAR(50),
+    destino_operacao VARCHAR(100),
+    consumidor_final VARCHAR(50),
+    presenca_comprador VARCHAR(100),
+    valor_nota_fiscal DECIMAL(15,2),
+    classificacao VARCHAR(50)
+);
+
+CREATE TABLE IF NOT EXISTS itensnotafiscal (
+    id_item_nf SERIAL PRIMARY KEY,
+    chave_acesso_nf VARCHAR(44) NOT NULL,
+    modelo VARCHAR(100),
+    serie_nf VARCHAR(10),
+    numero_nf VARCHAR(20),
+    natureza_operacao VARCHAR(255),
+    data_emissao DATE,
+    cpf_cnpj_emitente VARCHAR(20),
+    razao_social_emitente VARCHAR(255),
+    inscricao_estadual_emitente VARCHAR(20),
+    uf_emitente CHAR(2),
+    municipio_emitente VARCHAR(100),
+    cnpj_destinatario VARCHAR(20),
+    nome_destinatario VARCHAR(255),
+    uf_destinatario CHAR(2),
+    indicador_ie_destinatario VARCHAR(50),
+    destino_operacao VARCHAR(100),
+    consumidor_final VARCHAR(50),
+    presenca_comprador VARCHAR(100),
+    numero_produto INT,
+    descricao_produto VARCHAR(500),
+    codigo_ncm_sh VARCHAR(20),
+    ncm_sh_tipo_produto VARCHAR(255),
+    cfop VARCHAR(10),
+    quantidade DECIMAL(15,4),
+    unidade VARCHAR(20),
+    valor_unitario DECIMAL(15,4),
+    valor_total DECIMAL(15,2),
+    CONSTRAINT fk_nota_fiscal FOREIGN KEY (chave_acesso_nf) REFERENCES notasfiscais (chave_acesso) ON DELETE CASCADE
+);
+
+CREATE TABLE IF NOT EXISTS impostos_nota_fiscal (
+    id_impostos_nf SERIAL PRIMARY KEY,
+    chave_acesso_nf VARCHAR(44) NOT NULL UNIQUE,
+    -- ICMS Totais
+    v_bc_icms DECIMAL(15,2),           -- Base de cálculo do ICMS
+    v_icms DECIMAL(15,2),              -- Valor do ICMS
+    v_icms_deson DECIMAL(15,2),        -- Valor do ICMS desonerado
+    v_fcp_uf_dest DECIMAL(15,2),       -- Valor do FCP UF Destino
+    v_icms_uf_dest DECIMAL(15,2),      -- Valor do ICMS UF Destino
+    v_icms_uf_remet DECIMAL(15,2),     -- Valor do ICMS UF Remetente
+    -- Substituição Tributária
+    v_bc_st DECIMAL(15,2),             -- Base de cálculo do ICMS ST
+    v_st DECIMAL(15,2),                -- Valor do ICMS ST
+    -- IPI
+    v_ipi DECIMAL(15,2),               -- Valor do IPI
+    v_ipi_devol DECIMAL(15,2),         -- Valor do IPI devolvido
+    -- PIS
+    v_pis DECIMAL(15,2),               -- Valor do PIS
+    -- COFINS
+    v_cofins DECIMAL(15,2),            -- Valor do COFINS
+    -- Importação
+    v_ii DECIMAL(15,2),                -- Valor do Imposto de Importação
+    -- Outros
+    v_tot_trib DECIMAL(15,2),          -- Valor aproximado total de tributos
+    -- Valores da Nota
+    v_prod DECIMAL(15,2),              -- Valor total dos produtos
+    v_frete DECIMAL(15,2),             -- Valor do frete
+    v_seg DECIMAL(15,2),               -- Valor do seguro
+    v_desc DECIMAL(15,2),              -- Valor do desconto
+    v_outro DECIMAL(15,2),             -- Outras despesas acessórias
+    v_nf DECIMAL(15,2),                -- Valor total da NF-e
+    CONSTRAINT fk_impostos_nota FOREIGN KEY (chave_acesso_nf) REFERENCES notasfiscais (chave_acesso) ON DELETE CASCADE
+);
+
+CREATE TABLE IF NOT EXISTS impostos_item (
+    id_impostos_item SERIAL PRIMARY KEY,
+    id_item_nf INT NOT NULL,
+    chave_acesso_nf VARCHAR(44) NOT NULL,
+    numero_item INT NOT NULL,
+    -- Valor Total de Tributos
+    v_tot_trib DECIMAL(15,2),
+    -- ICMS
+    icms_orig INT,                     -- Origem da mercadoria
+    icms_cst VARCHAR(3),               -- CST do ICMS
+    icms_mod_bc INT,                   -- Modalidade da base de cálculo
+    icms_v_bc DECIMAL(15,2),           -- Base de cálculo do ICMS
+    icms_p_icms DECIMAL(5,4),          -- Alíquota do ICMS
+    icms_v_icms DECIMAL(15,2),         -- Valor do ICMS
+    -- ICMS UF Destino (DIFAL)
+    icms_uf_v_bc_uf_dest DECIMAL(15,2),      -- BC ICMS UF Destino
+    icms_uf_v_bc_fcp_uf_dest DECIMAL(15,2),  -- BC FCP UF Destino
+    icms_uf_p_fcp_uf_dest DECIMAL(5,4),      -- % FCP UF Destino
+    icms_uf_p_icms_uf_dest DECIMAL(5,4),     -- % ICMS UF Destino
+    icms_uf_p_icms_inter DECIMAL(5,4),       -- % ICMS Interestadual
+    icms_uf_p_icms_inter_part DECIMAL(5,4),  -- % ICMS partilha
+    icms_uf_v_fcp_uf_dest DECIMAL(15,2),     -- Valor FCP UF Destino
+    icms_uf_v_icms_uf_dest DECIMAL(15,2),    -- Valor ICMS UF Destino
+    icms_uf_v_icms_uf_remet DECIMAL(15,2),   -- Valor ICMS UF Remetente
+    -- IPI
+    ipi_c_enq VARCHAR(10),             -- Código de enquadramento do IPI
+    ipi_cst VARCHAR(3),                -- CST do IPI
+    ipi_v_bc DECIMAL(15,2),            -- Base de cálculo do IPI
+    ipi_p_ipi DECIMAL(5,4),            -- Alíquota do IPI
+    ipi_v_ipi DECIMAL(15,2),           -- Valor do IPI
+    -- PIS
+    pis_cst VARCHAR(3),                -- CST do PIS
+    pis_v_bc DECIMAL(15,2),            -- Base de cálculo do PIS
+    pis_p_pis DECIMAL(5,4),            -- Alíquota do PIS
+    pis_v_pis DECIMAL(15,2),           -- Valor do PIS
+    -- COFINS
+    cofins_cst VARCHAR(3),             -- CST do COFINS
+    cofins_v_bc DECIMAL(15,2),         -- Base de cálculo do COFINS
+    cofins_p_cofins DECIMAL(5,4),      -- Alíquota do COFINS
+    cofins_v_cofins DECIMAL(15,2),     -- Valor do COFINS
+    CONSTRAINT fk_impostos_item_nf FOREIGN KEY (id_item_nf) REFERENCES itensnotafiscal (id_item_nf) ON DELETE CASCADE,
+    CONSTRAINT fk_impostos_item_nota FOREIGN KEY (chave_acesso_nf) REFERENCES notasfiscais (chave_acesso) ON DELETE CASCADE
+);
+
+CREATE TABLE IF NOT EXISTS analise_fiscal (
+    id SERIAL PRIMARY KEY,
+    chave_acesso VARCHAR(44) NOT NULL UNIQUE,
+    numero_nota VARCHAR(50),
+    data_emissao DATE,
+    cnpj_emitente VARCHAR(18),
+    razao_social_emitente TEXT,
+    uf_emitente VARCHAR(2),
+    crt INTEGER,
+    regime_tributario_inferido VARCHAR(100),
+    cnpj_destinatario VARCHAR(18),
+    razao_social_destinatario TEXT,
+    uf_destinatario VARCHAR(2),
+    ind_ie_dest VARCHAR(50),
+    valor_produtos DECIMAL(15,2),
+    valor_total_nfe DECIMAL(15,2),
+    valor_total_icms_destacado DECIMAL(15,2),
+    regime_pis_cofins VARCHAR(100),
+    base_calculo_pis_cofins DECIMAL(15,2),
+    aliquota_pis DECIMAL(5,2),
+    aliquota_cofins DECIMAL(5,2),
+    valor_pis_estimado DECIMAL(15,2),
+    valor_cofins_estimado DECIMAL(15,2),
+    observacoes_pis_cofins TEXT,
+    icms_por_item JSONB,
+    potencial_difal BOOLEAN,
+    observacoes_difal TEXT,
+    recuperacao_credito JSONB,
+    dados_completos JSONB,
+    em_processamento BOOLEAN DEFAULT FALSE,
+    data_criacao TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    data_atualizacao TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    FOREIGN KEY (chave_acesso) REFERENCES notasfiscais(chave_acesso) ON DELETE CASCADE
+);
+
+CREATE INDEX IF NOT EXISTS idx_analise_fiscal_processamento ON analise_fiscal(em_processamento);
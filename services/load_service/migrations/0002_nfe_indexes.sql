@@ -0,0 +1,39 @@
+-- 0002_nfe_indexes.sql
+-- migrate: no-transaction
+--
+-- Secondary indexes for the detail/tax lookups, the listing and the filters
+-- the agent's SQL uses. Built CONCURRENTLY so writers are not blocked; the
+-- runner executes each statement on its own and drops an index left INVALID
+-- by an interrupted build before retrying it.
+
+-- Items of a nota, in item order; also the join key of the bulk writer
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_itensnotafiscal_chave_numero
+    ON itensnotafiscal (chave_acesso_nf, numero_produto);
+
+-- Item taxes joined by item id, and looked up / cascaded by nota
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_impostos_item_id_item_nf
+    ON impostos_item (id_item_nf);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_impostos_item_chave
+    ON impostos_item (chave_acesso_nf);
+
+-- Listing ordered by date, and filters combined with a period
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_notasfiscais_data_emissao
+    ON notasfiscais (data_emissao);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_notasfiscais_emitente_data
+    ON notasfiscais (cpf_cnpj_emitente, data_emissao);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_notasfiscais_destinatario_data
+    ON notasfiscais (cnpj_destinatario, data_emissao);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_notasfiscais_uf_emitente_data
+    ON notasfiscais (uf_emitente, data_emissao);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_notasfiscais_uf_destinatario_data
+    ON notasfiscais (uf_destinatario, data_emissao);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_notasfiscais_classificacao_data
+    ON notasfiscais (classificacao, data_emissao);
+
+-- Item filters: CFOP, NCM (pattern ops so prefix LIKE '8471%' can use it) and period
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_itensnotafiscal_cfop
+    ON itensnotafiscal (cfop);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_itensnotafiscal_ncm
+    ON itensnotafiscal (codigo_ncm_sh varchar_pattern_ops);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_itensnotafiscal_data_emissao
+    ON itensnotafiscal (data_emissao);
@@ -0,0 +1,251 @@
+-- 0003_partition_by_data_emissao.sql
+-- Monthly range partitioning of notasfiscais, itensnotafiscal and impostos_item
+-- by data_emissao.
+--
+-- The three tables get aligned partitions (<table>_pYYYY_MM). Items and item
+-- taxes carry the data_emissao of their nota, so joins on
+-- (chave, data_emissao) / (id_item_nf, data_emissao) prune to one partition
+-- of each table. Primary keys must include the partition key, and a foreign
+-- key to a partitioned table would make detaching a month scan the
+-- referencing tables, so the writers keep the tables consistent (a nota and
+-- its rows are always written in one transaction) instead of foreign keys.
+--
+-- Existing rows are copied into the new tables. The copy locks the tables
+-- for its duration: run it while the consumers are stopped.
+
+-- Partition month of a nota: data_emissao, else the AAMM of the chave de
+-- acesso (year/month of emission in the NF-e layout). Mirrored by
+-- partitions.partition_date
+CREATE OR REPLACE FUNCTION nfe_partition_date(p_chave VARCHAR, p_data_emissao DATE) RETURNS DATE
+LANGUAGE sql IMMUTABLE AS $$
+    SELECT COALESCE(
+        p_data_emissao,
+        CASE WHEN p_chave ~ '^[0-9]{4}(0[1-9]|1[0-2])'
+             THEN make_date(2000 + substr(p_chave, 3, 2)::int, substr(p_chave, 5, 2)::int, 1) END,
+        DATE '2000-01-01'
+    )
+$$;
+
+-- Create the partitions of `p_month` in the three tables (no-op when they
+-- exist). Fails for a month whose partitions were detached for archiving.
+CREATE OR REPLACE FUNCTION ensure_nfe_partition(p_month DATE) RETURNS BOOLEAN
+LANGUAGE plpgsql AS $$
+DECLARE
+    v_from DATE := date_trunc('month', p_month)::date;
+    v_to DATE := (date_trunc('month', p_month) + interval '1 month')::date;
+    v_table TEXT;
+    v_partition TEXT;
+    v_created BOOLEAN := false;
+BEGIN
+    -- Concurrent writers creating the same month wait for each other
+    PERFORM pg_advisory_xact_lock(7240013);
+    FOREACH v_table IN ARRAY ARRAY['notasfiscais', 'itensnotafiscal', 'impostos_item'] LOOP
+        v_partition := v_table || '_p' || to_char(v_from, 'YYYY_MM');
+        IF to_regclass(v_partition) IS NULL THEN
+            EXECUTE format('CREATE TABLE %I PARTITION OF %I FOR VALUES FROM (%L) TO (%L)',
+                           v_partition, v_table, v_from, v_to);
+            v_created := true;
+        ELSIF NOT EXISTS (SELECT 1 FROM pg_inherits WHERE inhrelid = to_regclass(v_partition)) THEN
+            RAISE EXCEPTION 'Partition % is detached (archived); attach it before writing notas of %',
+                            v_partition, to_char(v_from, 'YYYY-MM');
+        END IF;
+    END LOOP;
+    RETURN v_created;
+END $$;
+
+ALTER TABLE notasfiscais RENAME TO notasfiscais_unpartitioned;
+ALTER INDEX notasfiscais_pkey RENAME TO notasfiscais_unpartitioned_pkey;
+ALTER TABLE itensnotafiscal RENAME TO itensnotafiscal_unpartitioned;
+ALTER INDEX itensnotafiscal_pkey RENAME TO itensnotafiscal_unpartitioned_pkey;
+ALTER TABLE impostos_item RENAME TO impostos_item_unpartitioned;
+ALTER INDEX impostos_item_pkey RENAME TO impostos_item_unpartitioned_pkey;
+
+CREATE TABLE notasfiscais (
+    chave_acesso VARCHAR(44) NOT NULL,
+    modelo VARCHAR(100),
+    serie_nf VARCHAR(10),
+    numero_nf VARCHAR(20),
+    natureza_operacao VARCHAR(255),
+    data_emissao DATE NOT NULL,
+    evento_mais_recente VARCHAR(255),
+    data_hora_evento_mais_recente TIMESTAMP,
+    cpf_cnpj_emitente VARCHAR(20),
+    razao_social_emitente VARCHAR(255),
+    inscricao_estadual_emitente VARCHAR(20),
+    uf_emitente CHAR(2),
+    municipio_emitente VARCHAR(100),
+    cnpj_destinatario VARCHAR(20),
+    nome_destinatario VARCHAR(255),
+    uf_destinatario CHAR(2),
+    indicador_ie_destinatario VARCHAR(50),
+    destino_operacao VARCHAR(100),
+    consumidor_final VARCHAR(50),
+    presenca_comprador VARCHAR(100),
+    valor_nota_fiscal DECIMAL(15,2),
+    classificacao VARCHAR(50),
+    PRIMARY KEY (chave_acesso, data_emissao)
+) PARTITION BY RANGE (data_emissao);
+
+CREATE TABLE itensnotafiscal (
+    id_item_nf INT NOT NULL DEFAULT nextval('itensnotafiscal_id_item_nf_seq'),
+    chave_acesso_nf VARCHAR(44) NOT NULL,
+    modelo VARCHAR(100),
+    serie_nf VARCHAR(10),
+    numero_nf VARCHAR(20),
+    natureza_operacao VARCHAR(255),
+    data_emissao DATE NOT NULL,
+    cpf_cnpj_emitente VARCHAR(20),
+    razao_social_emitente VARCHAR(255),
+    inscricao_estadual_emitente VARCHAR(20),
+    uf_emitente CHAR(2),
+    municipio_emitente VARCHAR(100),
+    cnpj_destinatario VARCHAR(20),
+    nome_destinatario VARCHAR(255),
+    uf_destinatario CHAR(2),
+    indicador_ie_destinatario VARCHAR(50),
+    destino_operacao VARCHAR(100),
+    consumidor_final VARCHAR(50),
+    presenca_comprador VARCHAR(100),
+    numero_produto INT,
+    descricao_produto VARCHAR(500),
+    codigo_ncm_sh VARCHAR(20),
+    ncm_sh_tipo_produto VARCHAR(255),
+    cfop VARCHAR(10),
+    quantidade DECIMAL(15,4),
+    unidade VARCHAR(20),
+    valor_unitario DECIMAL(15,4),
+    valor_total DECIMAL(15,2),
+    PRIMARY KEY (id_item_nf, data_emissao)
+) PARTITION BY RANGE (data_emissao);
+
+CREATE TABLE impostos_item (
+    id_impostos_item INT NOT NULL DEFAULT nextval('impostos_item_id_impostos_item_seq'),
+    id_item_nf INT NOT NULL,
+    chave_acesso_nf VARCHAR(44) NOT NULL,
+    data_emissao DATE NOT NULL,        -- Data de emissão da nota (chave de partição)
+    numero_item INT NOT NULL,
+    v_tot_trib DECIMAL(15,2),
+    icms_orig INT,
+    icms_cst VARCHAR(3),
+    icms_mod_bc INT,
+    icms_v_bc DECIMAL(15,2),
+    icms_p_icms DECIMAL(5,4),
+    icms_v_icms DECIMAL(15,2),
+    icms_uf_v_bc_uf_dest DECIMAL(15,2),
+    icms_uf_v_bc_fcp_uf_dest DECIMAL(15,2),
+    icms_uf_p_fcp_uf_dest DECIMAL(5,4),
+    icms_uf_p_icms_uf_dest DECIMAL(5,4),
+    icms_uf_p_icms_inter DECIMAL(5,4),
+    icms_uf_p_icms_inter_part DECIMAL(5,4),
+    icms_uf_v_fcp_uf_dest DECIMAL(15,2),
+    icms_uf_v_icms_uf_dest DECIMAL(15,2),
+    icms_uf_v_icms_uf_remet DECIMAL(15,2),
+    ipi_c_enq VARCHAR(10),
+    ipi_cst VARCHAR(3),
+    ipi_v_bc DECIMAL(15,2),
+    ipi_p_ipi DECIMAL(5,4),
+    ipi_v_ipi DECIMAL(15,2),
+    pis_cst VARCHAR(3),
+    pis_v_bc DECIMAL(15,2),
+    pis_p_pis DECIMAL(5,4),
+    pis_v_pis DECIMAL(15,2),
+    cofins_cst VARCHAR(3),
+    cofins_v_bc DECIMAL(15,2),
+    cofins_p_cofins DECIMAL(5,4),
+    cofins_v_cofins DECIMAL(15,2),
+    PRIMARY KEY (id_impostos_item, data_emissao)
+) PARTITION BY RANGE (data_emissao);
+
+-- The id sequences move to the new tables, so ids keep growing from where they were
+ALTER SEQUENCE itensnotafiscal_id_item_nf_seq OWNED BY itensnotafiscal.id_item_nf;
+ALTER SEQUENCE impostos_item_id_impostos_item_seq OWNED BY impostos_item.id_impostos_item;
+
+-- Partitions for every month with data, plus the current month and the next three
+SELECT ensure_nfe_partition(month) FROM (
+    SELECT DISTINCT date_trunc('month', nfe_partition_date(chave_acesso, data_emissao))::date AS month
+    FROM notasfiscais_unpartitioned
+    UNION
+    SELECT generate_series(date_trunc('month', CURRENT_DATE), date_trunc('month', CURRENT_DATE) + interval '3 months',
+                           interval '1 month')::date
+) months;
+
+INSERT INTO notasfiscais (
+    chave_acesso, modelo, serie_nf, numero_nf, natureza_operacao, data_emissao,
+    evento_mais_recente, data_hora_evento_mais_recente, cpf_cnpj_emitente, razao_social_emitente,
+    inscricao_estadual_emitente, uf_emitente, municipio_emitente, cnpj_destinatario,
+    nome_destinatario, uf_destinatario, indicador_ie_destinatario, destino_operacao,
+    consumidor_final, presenca_comprador, valor_nota_fiscal, classificacao
+)
+SELECT
+    chave_acesso, modelo, serie_nf, numero_nf, natureza_operacao, nfe_partition_date(chave_acesso, data_emissao),
+    evento_mais_recente, data_hora_evento_mais_recente, cpf_cnpj_emitente, razao_social_emitente,
+    inscricao_estadual_emitente, uf_emitente, municipio_emitente, cnpj_destinatario,
+    nome_destinatario, uf_destinatario, indicador_ie_destinatario, destino_operacao,
+    consumidor_final, presenca_comprador, valor_nota_fiscal, classificacao
+FROM notasfiscais_unpartitioned;
+
+-- Items and item taxes take the partition date of their nota, keeping the partitions aligned
+INSERT INTO itensnotafiscal (
+    id_item_nf, chave_acesso_nf, modelo, serie_nf, numero_nf, natureza_operacao, data_emissao,
+    cpf_cnpj_emitente, razao_social_emitente, inscricao_estadual_emitente, uf_emitente,
+    municipio_emitente, cnpj_destinatario, nome_destinatario, uf_destinatario,
+    indicador_ie_destinatario, destino_operacao, consumidor_final, presenca_comprador,
+    numero_produto, descricao_produto, codigo_ncm_sh, ncm_sh_tipo_produto, cfop,
+    quantidade, unidade, valor_unitario, valor_total
+)
+SELECT
+    i.id_item_nf, i.chave_acesso_nf, i.modelo, i.serie_nf, i.numero_nf, i.natureza_operacao,
+    nfe_partition_date(n.chave_acesso, n.data_emissao),
+    i.cpf_cnpj_emitente, i.razao_social_emitente, i.inscricao_estadual_emitente, i.uf_emitente,
+    i.municipio_emitente, i.cnpj_destinatario, i.nome_destinatario, i.uf_destinatario,
+    i.indicador_ie_destinatario, i.destino_operacao, i.consumidor_final, i.presenca_comprador,
+    i.numero_produto, i.descricao_produto, i.codigo_ncm_sh, i.ncm_sh_tipo_produto, i.cfop,
+    i.quantidade, i.unidade, i.valor_unitario, i.valor_total
+FROM itensnotafiscal_unpartitioned i
+JOIN notasfiscais_unpartitioned n ON n.chave_acesso = i.chave_acesso_nf;
+
+INSERT INTO impostos_item (
+    id_impostos_item, id_item_nf, chave_acesso_nf, data_emissao, numero_item, v_tot_trib,
+    icms_orig, icms_cst, icms_mod_bc, icms_v_bc, icms_p_icms, icms_v_icms,
+    icms_uf_v_bc_uf_dest, icms_uf_v_bc_fcp_uf_dest, icms_uf_p_fcp_uf_dest,
+    icms_uf_p_icms_uf_dest, icms_uf_p_icms_inter, icms_uf_p_icms_inter_part,
+    icms_uf_v_fcp_uf_dest, icms_uf_v_icms_uf_dest, icms_uf_v_icms_uf_remet,
+    ipi_c_enq, ipi_cst, ipi_v_bc, ipi_p_ipi, ipi_v_ipi,
+    pis_cst, pis_v_bc, pis_p_pis, pis_v_pis,
+    cofins_cst, cofins_v_bc, cofins_p_cofins, cofins_v_cofins
+)
+SELECT
+    ii.id_impostos_item, ii.id_item_nf, ii.chave_acesso_nf, nfe_partition_date(n.chave_acesso, n.data_emissao),
+    ii.numero_item, ii.v_tot_trib,
+    ii.icms_orig, ii.icms_cst, ii.icms_mod_bc, ii.icms_v_bc, ii.icms_p_icms, ii.icms_v_icms,
+    ii.icms_uf_v_bc_uf_dest, ii.icms_uf_v_bc_fcp_uf_dest, ii.icms_uf_p_fcp_uf_dest,
+    ii.icms_uf_p_icms_uf_dest, ii.icms_uf_p_icms_inter, ii.icms_uf_p_icms_inter_part,
+    ii.icms_uf_v_fcp_uf_dest, ii.icms_uf_v_icms_uf_dest, ii.icms_uf_v_icms_uf_remet,
+    ii.ipi_c_enq, ii.ipi_cst, ii.ipi_v_bc, ii.ipi_p_ipi, ii.ipi_v_ipi,
+    ii.pis_cst, ii.pis_v_bc, ii.pis_p_pis, ii.pis_v_pis,
+    ii.cofins_cst, ii.cofins_v_bc, ii.cofins_p_cofins, ii.cofins_v_cofins
+FROM impostos_item_unpartitioned ii
+JOIN notasfiscais_unpartitioned n ON n.chave_acesso = ii.chave_acesso_nf;
+
+-- CASCADE also drops the foreign keys of impostos_nota_fiscal and analise_fiscal
+-- to notasfiscais(chave_acesso), which is no longer unique on its own
+DROP TABLE impostos_item_unpartitioned, itensnotafiscal_unpartitioned, notasfiscais_unpartitioned CASCADE;
+
+-- Indexes of 0002, now on the partitioned tables (created on every partition,
+-- present and future). The detail lookups by chave use the primary key.
+CREATE INDEX idx_itensnotafiscal_chave_numero ON itensnotafiscal (chave_acesso_nf, numero_produto);
+CREATE INDEX idx_impostos_item_id_item_nf ON impostos_item (id_item_nf);
+CREATE INDEX idx_impostos_item_chave ON impostos_item (chave_acesso_nf);
+CREATE INDEX idx_notasfiscais_data_emissao ON notasfiscais (data_emissao);
+CREATE INDEX idx_notasfiscais_emitente_data ON notasfiscais (cpf_cnpj_emitente, data_emissao);
+CREATE INDEX idx_notasfiscais_destinatario_data ON notasfiscais (cnpj_destinatario, data_emissao);
+CREATE INDEX idx_notasfiscais_uf_emitente_data ON notasfiscais (uf_emitente, data_emissao);
+CREATE INDEX idx_notasfiscais_uf_destinatario_data ON notasfiscais (uf_destinatario, data_emissao);
+CREATE INDEX idx_notasfiscais_classificacao_data ON notasfiscais (classificacao, data_emissao);
+CREATE INDEX idx_itensnotafiscal_cfop ON itensnotafiscal (cfop);
+CREATE INDEX idx_itensnotafiscal_ncm ON itensnotafiscal (codigo_ncm_sh varchar_pattern_ops);
+CREATE INDEX idx_itensnotafiscal_data_emissao ON itensnotafiscal (data_emissao);
+
+ANALYZE notasfiscais;
+ANALYZE itensnotafiscal;
+ANALYZE impostos_item;
@@ -0,0 +1,115 @@
+-- 0004_normalize_item_storage.sql
+-- Items without the nota header columns.
+--
+-- itensnotafiscal repeated 16 header columns of notasfiscais (modelo, série,
+-- número, natureza, emitente, destinatário, ...) on every item. The items
+-- move to itens_nota, which keeps only the item-level fields plus the join
+-- key (chave_acesso_nf, data_emissao). itensnotafiscal becomes a view with
+-- the old columns, in the old order, so existing SQL (nf_agent, reports, the
+-- data dictionary) keeps working. Writers insert into itens_nota.
+--
+-- The view joins on the primary key of notasfiscais, and a filter on
+-- data_emissao prunes both sides to one month. It is a LEFT JOIN so that,
+-- from PostgreSQL 16 on, a query reading only item columns skips the join.
+-- The services' own item queries read itens_nota directly.
+--
+-- Existing rows are copied. Run it while the consumers are stopped, and
+-- attach archived (detached) months first: their standalone
+-- itensnotafiscal_pYYYY_MM tables still have the wide layout.
+
+DO $$
+DECLARE
+    v_detached TEXT;
+BEGIN
+    SELECT string_agg(c.relname, ', ' ORDER BY c.relname) INTO v_detached
+    FROM pg_class c
+    WHERE c.relkind = 'r' AND c.relnamespace = 'public'::regnamespace
+      AND c.relname ~ '^itensnotafiscal_p[0-9]{4}_[0-9]{2}$'
+      AND NOT EXISTS (SELECT 1 FROM pg_inherits i WHERE i.inhrelid = c.oid);
+    IF v_detached IS NOT NULL THEN
+        RAISE EXCEPTION 'Detached partitions % must be attached before normalizing the items', v_detached;
+    END IF;
+END $$;
+
+CREATE TABLE itens_nota (
+    id_item_nf INT NOT NULL DEFAULT nextval('itensnotafiscal_id_item_nf_seq'),
+    chave_acesso_nf VARCHAR(44) NOT NULL,
+    data_emissao DATE NOT NULL,        -- Data de emissão da nota (chave de partição e de junção)
+    numero_produto INT,
+    descricao_produto VARCHAR(500),
+    codigo_ncm_sh VARCHAR(20),
+    ncm_sh_tipo_produto VARCHAR(255),
+    cfop VARCHAR(10),
+    quantidade DECIMAL(15,4),
+    unidade VARCHAR(20),
+    valor_unitario DECIMAL(15,4),
+    valor_total DECIMAL(15,2),
+    PRIMARY KEY (id_item_nf, data_emissao)
+) PARTITION BY RANGE (data_emissao);
+
+ALTER SEQUENCE itensnotafiscal_id_item_nf_seq OWNED BY itens_nota.id_item_nf;
+ALTER SEQUENCE itensnotafiscal_id_item_nf_seq RENAME TO itens_nota_id_item_nf_seq;
+
+-- Same as in 0003, with itens_nota in place of itensnotafiscal
+CREATE OR REPLACE FUNCTION ensure_nfe_partition(p_month DATE) RETURNS BOOLEAN
+LANGUAGE plpgsql AS $$
+DECLARE
+    v_from DATE := date_trunc('month', p_month)::date;
+    v_to DATE := (date_trunc('month', p_month) + interval '1 month')::date;
+    v_table TEXT;
+    v_partition TEXT;
+    v_created BOOLEAN := false;
+BEGIN
+    -- Concurrent writers creating the same month wait for each other
+    PERFORM pg_advisory_xact_lock(7240013);
+    FOREACH v_table IN ARRAY ARRAY['notasfiscais', 'itens_nota', 'impostos_item'] LOOP
+        v_partition := v_table || '_p' || to_char(v_from, 'YYYY_MM');
+        IF to_regclass(v_partition) IS NULL THEN
+            EXECUTE format('CREATE TABLE %I PARTITION OF %I FOR VALUES FROM (%L) TO (%L)',
+                           v_partition, v_table, v_from, v_to);
+            v_created := true;
+        ELSIF NOT EXISTS (SELECT 1 FROM pg_inherits WHERE inhrelid = to_regclass(v_partition)) THEN
+            RAISE EXCEPTION 'Partition % is detached (archived); attach it before writing notas of %',
+                            v_partition, to_char(v_from, 'YYYY-MM');
+        END IF;
+    END LOOP;
+    RETURN v_created;
+END $$;
+
+-- One itens_nota partition per existing notasfiscais partition
+SELECT ensure_nfe_partition(to_date(substr(c.relname, length('notasfiscais_p') + 1), 'YYYY_MM'))
+FROM pg_inherits i
+JOIN pg_class c ON c.oid = i.inhrelid
+WHERE i.inhparent = 'notasfiscais'::regclass;
+
+INSERT INTO itens_nota (
+    id_item_nf, chave_acesso_nf, data_emissao, numero_produto, descricao_produto, codigo_ncm_sh,
+    ncm_sh_tipo_produto, cfop, quantidade, unidade, valor_unitario, valor_total
+)
+SELECT
+    id_item_nf, chave_acesso_nf, data_emissao, numero_produto, descricao_produto, codigo_ncm_sh,
+    ncm_sh_tipo_produto, cfop, quantidade, unidade, valor_unitario, valor_total
+FROM itensnotafiscal;
+
+-- Its partitions go with it
+DROP TABLE itensnotafiscal;
+
+CREATE INDEX idx_itens_nota_chave_numero ON itens_nota (chave_acesso_nf, numero_produto);
+CREATE INDEX idx_itens_nota_cfop ON itens_nota (cfop);
+CREATE INDEX idx_itens_nota_ncm ON itens_nota (codigo_ncm_sh varchar_pattern_ops);
+CREATE INDEX idx_itens_nota_data_emissao ON itens_nota (data_emissao);
+
+CREATE VIEW itensnotafiscal AS
+SELECT
+    i.id_item_nf, i.chave_acesso_nf, n.modelo, n.serie_nf, n.numero_nf, n.natureza_operacao, i.data_emissao,
+    n.cpf_cnpj_emitente, n.razao_social_emitente, n.inscricao_estadual_emitente, n.uf_emitente,
+    n.municipio_emitente, n.cnpj_destinatario, n.nome_destinatario, n.uf_destinatario,
+    n.indicador_ie_destinatario, n.destino_operacao, n.consumidor_final, n.presenca_comprador,
+    i.numero_produto, i.descricao_produto, i.codigo_ncm_sh, i.ncm_sh_tipo_produto, i.cfop,
+    i.quantidade, i.unidade, i.valor_unitario, i.valor_total
+FROM itens_nota i
+LEFT JOIN notasfiscais n ON n.chave_acesso = i.chave_acesso_nf AND n.data_emissao = i.data_emissao;
+
+COMMENT ON VIEW itensnotafiscal IS 'Itens com as colunas de cabeçalho da nota (compatibilidade); os itens ficam em itens_nota';
+
+ANALYZE itens_nota;
@@ -0,0 +1,54 @@
+-- 0005_content_hash_unique_items.sql
+-- Idempotent re-ingestion.
+--
+-- notasfiscais.content_hash holds the hash of the nota's content computed at
+-- parse time (content_hash.py). The writers skip a nota whose stored hash is
+-- the same and replace the items and taxes of one whose hash differs, in the
+-- batch transaction. Notas stored before this migration have no hash and are
+-- replaced the first time they come in again.
+--
+-- Items and item taxes become unique per nota and item number (the partition
+-- key is part of every unique constraint on a partitioned table; all rows of
+-- a nota share its data_emissao). Duplicates left by redeliveries and
+-- repeated uploads are removed first, keeping the oldest row. The unique
+-- indexes replace the (chave, numero) / (chave) lookup indexes.
+--
+-- Deleting the duplicates locks the tables: run it while the consumers are stopped.
+
+ALTER TABLE notasfiscais ADD COLUMN content_hash VARCHAR(64);
+
+CREATE TEMP TABLE duplicate_items ON COMMIT DROP AS
+SELECT id_item_nf, data_emissao FROM (
+    SELECT id_item_nf, data_emissao,
+           row_number() OVER (PARTITION BY chave_acesso_nf, numero_produto, data_emissao ORDER BY id_item_nf) AS n
+    FROM itens_nota
+    WHERE numero_produto IS NOT NULL
+) ranked
+WHERE n > 1;
+
+DELETE FROM impostos_item ii USING duplicate_items d
+WHERE ii.id_item_nf = d.id_item_nf AND ii.data_emissao = d.data_emissao;
+
+DELETE FROM itens_nota i USING duplicate_items d
+WHERE i.id_item_nf = d.id_item_nf AND i.data_emissao = d.data_emissao;
+
+DELETE FROM impostos_item ii USING (
+    SELECT id_impostos_item, data_emissao FROM (
+        SELECT id_impostos_item, data_emissao,
+               row_number() OVER (PARTITION BY chave_acesso_nf, numero_item, data_emissao ORDER BY id_impostos_item) AS n
+        FROM impostos_item
+    ) ranked
+    WHERE n > 1
+) d
+WHERE ii.id_impostos_item = d.id_impostos_item AND ii.data_emissao = d.data_emissao;
+
+ALTER TABLE itens_nota
+    ADD CONSTRAINT itens_nota_chave_numero_key UNIQUE (chave_acesso_nf, numero_produto, data_emissao);
+DROP INDEX idx_itens_nota_chave_numero;
+
+ALTER TABLE impostos_item
+    ADD CONSTRAINT impostos_item_chave_numero_key UNIQUE (chave_acesso_nf, numero_item, data_emissao);
+DROP INDEX idx_impostos_item_chave;
+
+ANALYZE itens_nota;
+ANALYZE impostos_item;
@@ -0,0 +1,161 @@
+-- 0006_nfe_stats.sql
+-- Statistics maintained incrementally instead of counted per /status call.
+--
+-- nfe_stats holds the number of notas and items, the sum of valor_nota_fiscal,
+-- the number of classified notas and the latest data_emissao. Statement-level
+-- triggers on notasfiscais and itens_nota add each statement's changes (from
+-- its transition tables) to the row of a slot picked by backend pid, so
+-- concurrent writers update different rows instead of queueing on one row
+-- lock until they commit. Readers sum the 16 rows.
+--
+-- last_upload only moves forward: a delete does not lower it (notas are only
+-- removed by TRUNCATE, which resets it, or by detaching a month, which
+-- recomputes it). Detaching and attaching a month fire no triggers, so
+-- partitions.py applies the month's rows with nfe_stats_shift_month().
+-- refresh_nfe_stats() recounts everything (reconciliation).
+
+CREATE TABLE nfe_stats (
+    slot SMALLINT PRIMARY KEY,
+    notas BIGINT NOT NULL DEFAULT 0,
+    itens BIGINT NOT NULL DEFAULT 0,
+    valor_total NUMERIC NOT NULL DEFAULT 0,
+    notas_classificadas BIGINT NOT NULL DEFAULT 0,
+    last_upload DATE,
+    refreshed_at TIMESTAMP
+);
+
+COMMENT ON TABLE nfe_stats IS 'Totais de notasfiscais/itens_nota mantidos por triggers; somar as linhas (uma por slot)';
+
+INSERT INTO nfe_stats (slot) SELECT generate_series(0, 15);
+
+-- Row of nfe_stats written by the current backend (16 slots)
+CREATE OR REPLACE FUNCTION nfe_stats_slot() RETURNS SMALLINT
+LANGUAGE sql STABLE AS $$
+    SELECT (pg_backend_pid() % 16)::smallint
+$$;
+
+CREATE OR REPLACE FUNCTION nfe_stats_notas() RETURNS TRIGGER
+LANGUAGE plpgsql AS $$
+BEGIN
+    IF TG_OP = 'TRUNCATE' THEN
+        UPDATE nfe_stats SET notas = 0, valor_total = 0, notas_classificadas = 0, last_upload = NULL;
+    ELSIF TG_OP = 'INSERT' THEN
+        UPDATE nfe_stats s
+        SET notas = s.notas + d.notas,
+            valor_total = s.valor_total + d.valor_total,
+            notas_classificadas = s.notas_classificadas + d.classificadas,
+            last_upload = GREATEST(s.last_upload, d.last_upload)
+        FROM (SELECT count(*) AS notas, COALESCE(sum(valor_nota_fiscal), 0) AS valor_total,
+                     count(classificacao) AS classificadas, max(data_emissao) AS last_upload
+              FROM new_rows) d
+        WHERE s.slot = nfe_stats_slot() AND d.notas > 0;
+    ELSIF TG_OP = 'UPDATE' THEN
+        -- Skipped when no row changed (e.g. ON CONFLICT ... WHERE filtering out every row)
+        IF EXISTS (SELECT 1 FROM new_rows) THEN
+            UPDATE nfe_stats s
+            SET valor_total = s.valor_total + d.valor_total,
+                notas_classificadas = s.notas_classificadas + d.classificadas,
+                last_upload = GREATEST(s.last_upload, d.last_upload)
+            FROM (SELECT (SELECT COALESCE(sum(valor_nota_fiscal), 0) FROM new_rows)
+                         - (SELECT COALESCE(sum(valor_nota_fiscal), 0) FROM old_rows) AS valor_total,
+                         (SELECT count(classificacao) FROM new_rows)
+                         - (SELECT count(classificacao) FROM old_rows) AS classificadas,
+                         (SELECT max(data_emissao) FROM new_rows) AS last_upload) d
+            WHERE s.slot = nfe_stats_slot();
+        END IF;
+    ELSE
+        UPDATE nfe_stats s
+        SET notas = s.notas - d.notas,
+            valor_total = s.valor_total - d.valor_total,
+            notas_classificadas = s.notas_classificadas - d.classificadas
+        FROM (SELECT count(*) AS notas, COALESCE(sum(valor_nota_fiscal), 0) AS valor_total,
+                     count(classificacao) AS classificadas
+              FROM old_rows) d
+        WHERE s.slot = nfe_stats_slot() AND d.notas > 0;
+    END IF;
+    RETURN NULL;
+END $$;
+
+CREATE OR REPLACE FUNCTION nfe_stats_itens() RETURNS TRIGGER
+LANGUAGE plpgsql AS $$
+DECLARE
+    v_delta BIGINT;
+BEGIN
+    IF TG_OP = 'TRUNCATE' THEN
+        UPDATE nfe_stats SET itens = 0;
+        RETURN NULL;
+    ELSIF TG_OP = 'INSERT' THEN
+        SELECT count(*) INTO v_delta FROM new_rows;
+    ELSE
+        SELECT -count(*) INTO v_delta FROM old_rows;
+    END IF;
+    IF v_delta <> 0 THEN
+        UPDATE nfe_stats SET itens = itens + v_delta WHERE slot = nfe_stats_slot();
+    END IF;
+    RETURN NULL;
+END $$;
+
+-- A trigger with transition tables handles one event: one trigger per event
+CREATE TRIGGER nfe_stats_notas_insert AFTER INSERT ON notasfiscais
+    REFERENCING NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION nfe_stats_notas();
+CREATE TRIGGER nfe_stats_notas_update AFTER UPDATE ON notasfiscais
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION nfe_stats_notas();
+CREATE TRIGGER nfe_stats_notas_delete AFTER DELETE ON notasfiscais
+    REFERENCING OLD TABLE AS old_rows FOR EACH STATEMENT EXECUTE FUNCTION nfe_stats_notas();
+CREATE TRIGGER nfe_stats_notas_truncate AFTER TRUNCATE ON notasfiscais
+    FOR EACH STATEMENT EXECUTE FUNCTION nfe_stats_notas();
+
+CREATE TRIGGER nfe_stats_itens_insert AFTER INSERT ON itens_nota
+    REFERENCING NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION nfe_stats_itens();
+CREATE TRIGGER nfe_stats_itens_delete AFTER DELETE ON itens_nota
+    REFERENCING OLD TABLE AS old_rows FOR EACH STATEMENT EXECUTE FUNCTION nfe_stats_itens();
+CREATE TRIGGER nfe_stats_itens_truncate AFTER TRUNCATE ON itens_nota
+    FOR EACH STATEMENT EXECUTE FUNCTION nfe_stats_itens();
+
+-- Recount everything into slot 0 (reconciliation). The EXCLUSIVE lock waits
+-- for the writers holding a slot row and holds new ones off until commit, so
+-- the counts match the slots exactly.
+CREATE OR REPLACE FUNCTION refresh_nfe_stats() RETURNS VOID
+LANGUAGE plpgsql AS $$
+BEGIN
+    LOCK TABLE nfe_stats IN EXCLUSIVE MODE;
+    UPDATE nfe_stats SET notas = 0, itens = 0, valor_total = 0, notas_classificadas = 0,
+                         last_upload = NULL, refreshed_at = NULL;
+    UPDATE nfe_stats s
+    SET notas = n.notas, itens = (SELECT count(*) FROM itens_nota), valor_total = n.valor_total,
+        notas_classificadas = n.classificadas, last_upload = n.last_upload, refreshed_at = now()
+    FROM (SELECT count(*) AS notas, COALESCE(sum(valor_nota_fiscal), 0) AS valor_total,
+                 count(classificacao) AS classificadas, max(data_emissao) AS last_upload
+          FROM notasfiscais) n
+    WHERE s.slot = 0;
+END $$;
+
+-- Add (p_sign = 1) or remove (p_sign = -1) the rows of a month's partitions
+-- after attaching or detaching them; only that month is counted, and
+-- last_upload is taken again from the data_emissao index
+CREATE OR REPLACE FUNCTION nfe_stats_shift_month(p_month DATE, p_sign INT) RETURNS VOID
+LANGUAGE plpgsql AS $$
+DECLARE
+    v_suffix TEXT := '_p' || to_char(p_month, 'YYYY_MM');
+    v_notas BIGINT := 0;
+    v_valor NUMERIC := 0;
+    v_classificadas BIGINT := 0;
+    v_itens BIGINT := 0;
+BEGIN
+    IF to_regclass('notasfiscais' || v_suffix) IS NOT NULL THEN
+        EXECUTE format('SELECT count(*), COALESCE(sum(valor_nota_fiscal), 0), count(classificacao) FROM %I',
+                       'notasfiscais' || v_suffix)
+            INTO v_notas, v_valor, v_classificadas;
+    END IF;
+    IF to_regclass('itens_nota' || v_suffix) IS NOT NULL THEN
+        EXECUTE format('SELECT count(*) FROM %I', 'itens_nota' || v_suffix) INTO v_itens;
+    END IF;
+    UPDATE nfe_stats
+    SET notas = notas + p_sign * v_notas, valor_total = valor_total + p_sign * v_valor,
+        notas_classificadas = notas_classificadas + p_sign * v_classificadas, itens = itens + p_sign * v_itens
+    WHERE slot = nfe_stats_slot();
+    UPDATE nfe_stats
+    SET last_upload = CASE WHEN slot = 0 THEN (SELECT max(data_emissao) FROM notasfiscais) END;
+END $$;
+
+SELECT refresh_nfe_stats();
@@ -0,0 +1,18 @@
+-- 0007_notas_listing_indexes.sql
+-- Indexes for the keyset-paginated listing (GET /api/notas, notas_listing.py).
+--
+-- Pages are ordered by (sort key, chave_acesso) and start after the last row
+-- of the previous page, so each sort needs an index on exactly that pair:
+-- the date sorts read (data_emissao, chave_acesso), which also replaces the
+-- data_emissao index it starts with; the valor and número sorts read their
+-- expression keys. Indexes on a partitioned table cannot be built
+-- CONCURRENTLY: the build blocks writes to notasfiscais, so run it while the
+-- consumers are stopped.
+
+CREATE INDEX idx_notasfiscais_data_chave ON notasfiscais (data_emissao, chave_acesso);
+DROP INDEX idx_notasfiscais_data_emissao;
+
+CREATE INDEX idx_notasfiscais_valor_chave ON notasfiscais ((COALESCE(valor_nota_fiscal, 0)), chave_acesso);
+CREATE INDEX idx_notasfiscais_numero_chave ON notasfiscais ((lpad(COALESCE(numero_nf, ''), 20, '0')), chave_acesso);
+
+ANALYZE notasfiscais;
@@ -0,0 +1,56 @@
+-- 0008_nota_change_notify.sql
+-- Change notifications for the API response caches (nota_cache.py).
+--
+-- Every statement that writes notas, items, taxes or fiscal analyses sends
+-- the chaves it touched on the nota_changed channel, one notification per
+-- chave. Notifications are delivered at commit (and repeats within a
+-- transaction are folded), so a listener never sees a change before it is
+-- visible. TRUNCATE sends '*': everything is invalidated. Attaching and
+-- detaching a month fire no triggers; partitions.py sends '*' itself.
+
+CREATE OR REPLACE FUNCTION notify_nota_changed() RETURNS TRIGGER
+LANGUAGE plpgsql AS $$
+DECLARE
+    v_chave TEXT;
+BEGIN
+    IF TG_OP = 'TRUNCATE' THEN
+        PERFORM pg_notify('nota_changed', '*');
+    ELSIF TG_OP = 'DELETE' THEN
+        -- TG_ARGV[0]: the table's chave de acesso column
+        FOR v_chave IN EXECUTE format('SELECT DISTINCT %I FROM old_rows', TG_ARGV[0]) LOOP
+            PERFORM pg_notify('nota_changed', v_chave);
+        END LOOP;
+    ELSE
+        -- An UPDATE never changes the chave: the new rows name them all
+        FOR v_chave IN EXECUTE format('SELECT DISTINCT %I FROM new_rows', TG_ARGV[0]) LOOP
+            PERFORM pg_notify('nota_changed', v_chave);
+        END LOOP;
+    END IF;
+    RETURN NULL;
+END $$;
+
+-- A trigger with transition tables handles one event: one trigger per event
+DO $$
+DECLARE
+    v_table TEXT;
+    v_column TEXT;
+BEGIN
+    FOR v_table, v_column IN
+        VALUES ('notasfiscais', 'chave_acesso'), ('itens_nota', 'chave_acesso_nf'),
+               ('impostos_item', 'chave_acesso_nf'), ('impostos_nota_fiscal', 'chave_acesso_nf'),
+               ('analise_fiscal', 'chave_acesso')
+    LOOP
+        EXECUTE format('CREATE TRIGGER %I AFTER INSERT ON %I REFERENCING NEW TABLE AS new_rows '
+                       'FOR EACH STATEMENT EXECUTE FUNCTION notify_nota_changed(%L)',
+                       v_table || '_notify_insert', v_table, v_column);
+        EXECUTE format('CREATE TRIGGER %I AFTER UPDATE ON %I REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows '
+                       'FOR EACH STATEMENT EXECUTE FUNCTION notify_nota_changed(%L)',
+                       v_table || '_notify_update', v_table, v_column);
+        EXECUTE format('CREATE TRIGGER %I AFTER DELETE ON %I REFERENCING OLD TABLE AS old_rows '
+                       'FOR EACH STATEMENT EXECUTE FUNCTION notify_nota_changed(%L)',
+                       v_table || '_notify_delete', v_table, v_column);
+        EXECUTE format('CREATE TRIGGER %I AFTER TRUNCATE ON %I '
+                       'FOR EACH STATEMENT EXECUTE FUNCTION notify_nota_changed(%L)',
+                       v_table || '_notify_truncate', v_table, v_column);
+    END LOOP;
+END $$;
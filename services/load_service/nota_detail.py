@@ -0,0 +1,121 @@
+# nota_detail.py
+"""
+Detail of one nota fiscal (GET /api/notas/{chave_acesso}), built by PostgreSQL.
+
+A single statement returns the whole response document as JSON text: the
+header with its tax totals, and the items with their taxes, nested with
+json_build_object / json_agg. The endpoint sends it as it comes, so no dict
+is built per item and nothing is serialized in Python. Items and item taxes
+are read in the nota's month only (data_emissao is their partition key).
+
+The values follow the previous Python formatting: the nota total and the item
+quantities/values are 0 when missing, tax values are null when missing or
+zero, an item's tax groups are null when it has no CST for them, and
+`impostos` is null when there are no tax rows.
+"""
+
+NOTA_DETAIL_SQL = """
+SELECT json_build_object(
+    'nota', json_build_object(
+        'chave_acesso', nf.chave_acesso,
+        'modelo', nf.modelo,
+        'serie', nf.serie_nf,
+        'numero_nf', nf.numero_nf,
+        'natureza_operacao', nf.natureza_operacao,
+        'data_emissao', nf.data_emissao,
+        'emit_cnpj', nf.cpf_cnpj_emitente,
+        'emit_xnome', nf.razao_social_emitente,
+        'emit_ie', nf.inscricao_estadual_emitente,
+        'emit_uf', nf.uf_emitente,
+        'emit_xmun', nf.municipio_emitente,
+        'dest_cnpj', nf.cnpj_destinatario,
+        'dest_xnome', nf.nome_destinatario,
+        'dest_uf', nf.uf_destinatario,
+        'dest_indieiedest', nf.indicador_ie_destinatario,
+        'destino_operacao', nf.destino_operacao,
+        'consumidor_final', nf.consumidor_final,
+        'presenca_comprador', nf.presenca_comprador,
+        'valor_total', COALESCE(nf.valor_nota_fiscal, 0),
+        'classificacao', nf.classificacao,
+        'icmstot_vprod', COALESCE(nf.valor_nota_fiscal, 0),
+        'icmstot_vfrete', 0,
+        'icmstot_vdesc', 0,
+        'impostos', (
+            SELECT json_build_object(
+                'v_bc_icms', NULLIF(t.v_bc_icms, 0),
+                'v_icms', NULLIF(t.v_icms, 0),
+                'v_icms_uf_dest', NULLIF(t.v_icms_uf_dest, 0),
+                'v_bc_st', NULLIF(t.v_bc_st, 0),
+                'v_st', NULLIF(t.v_st, 0),
+                'v_ipi', NULLIF(t.v_ipi, 0),
+                'v_pis', NULLIF(t.v_pis, 0),
+                'v_cofins', NULLIF(t.v_cofins, 0),
+                'v_ii', NULLIF(t.v_ii, 0),
+                'v_tot_trib', NULLIF(t.v_tot_trib, 0),
+                'v_prod', NULLIF(t.v_prod, 0),
+                'v_frete', NULLIF(t.v_frete, 0),
+                'v_seg', NULLIF(t.v_seg, 0),
+                'v_desc', NULLIF(t.v_desc, 0),
+                'v_outro', NULLIF(t.v_outro, 0),
+                'v_nf', NULLIF(t.v_nf, 0)
+            )
+            FROM impostos_nota_fiscal t
+            WHERE t.chave_acesso_nf = nf.chave_acesso
+        )
+    ),
+    'itens', COALESCE((
+        SELECT json_agg(json_build_object(
+            'nitem', i.numero_produto,
+            'xprod', i.descricao_produto,
+            'ncm', i.codigo_ncm_sh,
+            'cfop', i.cfop,
+            'qcom', COALESCE(i.quantidade, 0),
+            'ucom', i.unidade,
+            'vuncom', COALESCE(i.valor_unitario, 0),
+            'vprod', COALESCE(i.valor_total, 0),
+            'cprod', i.descricao_produto,
+            'impostos', CASE WHEN COALESCE(NULLIF(ii.icms_cst, ''), NULLIF(ii.pis_cst, ''),
+                                           NULLIF(ii.cofins_cst, '')) IS NOT NULL THEN json_build_object(
+                'v_tot_trib', NULLIF(ii.v_tot_trib, 0),
+                'icms', CASE WHEN NULLIF(ii.icms_cst, '') IS NOT NULL THEN json_build_object(
+                    'orig', ii.icms_orig,
+                    'cst', ii.icms_cst,
+                    'mod_bc', ii.icms_mod_bc,
+                    'v_bc', NULLIF(ii.icms_v_bc, 0),
+                    'p_icms', NULLIF(ii.icms_p_icms, 0),
+                    'v_icms', NULLIF(ii.icms_v_icms, 0),
+                    'uf_dest', json_build_object(
+                        'v_bc_uf_dest', NULLIF(ii.icms_uf_v_bc_uf_dest, 0),
+                        'p_icms_uf_dest', NULLIF(ii.icms_uf_p_icms_uf_dest, 0),
+                        'p_icms_inter', NULLIF(ii.icms_uf_p_icms_inter, 0),
+                        'v_icms_uf_dest', NULLIF(ii.icms_uf_v_icms_uf_dest, 0)
+                    )
+                ) END,
+                'ipi', CASE WHEN NULLIF(ii.ipi_cst, '') IS NOT NULL THEN json_build_object(
+                    'cst', ii.ipi_cst,
+                    'v_bc', NULLIF(ii.ipi_v_bc, 0),
+                    'p_ipi', NULLIF(ii.ipi_p_ipi, 0),
+                    'v_ipi', NULLIF(ii.ipi_v_ipi, 0)
+                ) END,
+                'pis', CASE WHEN NULLIF(ii.pis_cst, '') IS NOT NULL THEN json_build_object(
+                    'cst', ii.pis_cst,
+                    'v_bc', NULLIF(ii.pis_v_bc, 0),
+                    'p_pis', NULLIF(ii.pis_p_pis, 0),
+                    'v_pis', NULLIF(ii.pis_v_pis, 0)
+                ) END,
+                'cofins', CASE WHEN NULLIF(ii.cofins_cst, '') IS NOT NULL THEN json_build_object(
+                    'cst', ii.cofins_cst,
+                    'v_bc', NULLIF(ii.cofins_v_bc, 0),
+                    'p_cofins', NULLIF(ii.cofins_p_cofins, 0),
+                    'v_cofins', NULLIF(ii.cofins_v_cofins, 0)
+                ) END
+            ) END
+        ) ORDER BY i.numero_produto)
+        FROM itens_nota i
+        LEFT JOIN impostos_item ii ON ii.id_item_nf = i.id_item_nf AND ii.data_emissao = i.data_emissao
+        WHERE i.chave_acesso_nf = nf.chave_acesso AND i.data_emissao = nf.data_emissao
+    ), '[]'::json)
+)::text
+FROM notasfiscais nf
+WHERE nf.chave_acesso = $1
+"""
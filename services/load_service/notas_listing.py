@@ -0,0 +1,203 @@
+# notas_listing.py
+"""
+Keyset-paginated listing of notas fiscais (GET /api/notas).
+
+A page is ordered by a sort key with chave_acesso as tie-breaker, and the
+next page starts right after the last row of the previous one (the opaque
+`cursor`), so every page is an index range scan however deep it is. The
+date sorts walk the (data_emissao, chave_acesso) index partition by
+partition, newest or oldest first, and stop at the page size. Filters are
+applied in SQL; there is no total count.
+
+Item counts are looked up for the rows of the page only, on the itens_nota
+(chave_acesso_nf, numero_produto, data_emissao) unique index.
+"""
+import base64
+import json
+import re
+from datetime import date
+from decimal import Decimal, InvalidOperation
+from typing import Dict, List, Optional, Tuple
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+
+# sort -> (key expression, SQL type of the key, direction). The valor and
+# numero keys match the expression indexes of migration 0007.
+SORTS = {
+    'data_desc': ("nf.data_emissao", 'date', 'DESC'),
+    'data_asc': ("nf.data_emissao", 'date', 'ASC'),
+    'valor_desc': ("COALESCE(nf.valor_nota_fiscal, 0)", 'numeric', 'DESC'),
+    'valor_asc': ("COALESCE(nf.valor_nota_fiscal, 0)", 'numeric', 'ASC'),
+    # numero_nf is text: zero-padded so that "9" sorts before "10"
+    'nf_desc': ("lpad(COALESCE(nf.numero_nf, ''), 20, '0')", 'text', 'DESC'),
+    'nf_asc': ("lpad(COALESCE(nf.numero_nf, ''), 20, '0')", 'text', 'ASC'),
+}
+
+_NON_DIGITS = re.compile(r'[.\-/\s]')
+
+
+def encode_cursor(sort: str, key, chave_acesso: str) -> str:
+    raw = json.dumps([sort, str(key), chave_acesso], separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor: str, sort: str) -> Tuple[object, str]:
+    """(sort key, chave_acesso) of the last row of the previous page"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        cursor_sort, key, chave_acesso = json.loads(raw)
+        key_type = SORTS[sort][1]
+        if key_type == 'date':
+            key = date.fromisoformat(key)
+        elif key_type == 'numeric':
+            key = Decimal(key)
+    except (ValueError, TypeError, KeyError, InvalidOperation):
+        raise ValueError("Invalid cursor")
+    if cursor_sort != sort:
+        raise ValueError("Cursor belongs to a different sort order")
+    return key, str(chave_acesso)
+
+
+def _like(value: str) -> str:
+    escaped = value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+    return f"%{escaped}%"
+
+
+def _party(value: str, document_column: str, name_column: str, args: list) -> str:
+    """A CNPJ/CPF (digits, punctuation allowed) matches the document exactly; anything else the name"""
+    digits = _NON_DIGITS.sub('', value)
+    if digits.isdigit():
+        args.append(digits)
+        return f"{document_column} = ${len(args)}"
+    args.append(_like(value.strip()))
+    return f"{name_column} ILIKE ${len(args)}"
+
+
+def notas_filters(args: list, emitente: Optional[str] = None, destinatario: Optional[str] = None,
+                  uf_emitente: Optional[str] = None, uf_destinatario: Optional[str] = None,
+                  classificacao: Optional[str] = None, data_inicio: Optional[date] = None,
+                  data_fim: Optional[date] = None, valor_min: Optional[Decimal] = None,
+                  valor_max: Optional[Decimal] = None, q: Optional[str] = None) -> List[str]:
+    """
+    WHERE conditions on notasfiscais (alias nf) for the given filters; their
+    values are appended to args. Also used by the site_service export (export.py).
+    """
+    conditions = []
+    if emitente:
+        conditions.append(_party(emitente, "nf.cpf_cnpj_emitente", "nf.razao_social_emitente", args))
+    if destinatario:
+        conditions.append(_party(destinatario, "nf.cnpj_destinatario", "nf.nome_destinatario", args))
+    for column, value in (("uf_emitente", uf_emitente), ("uf_destinatario", uf_destinatario)):
+        if value:
+            args.append(value.upper())
+            conditions.append(f"nf.{column} = ${len(args)}")
+    if classificacao:
+        args.append(classificacao)
+        conditions.append(f"nf.classificacao = ${len(args)}")
+    if data_inicio:
+        args.append(data_inicio)
+        conditions.append(f"nf.data_emissao >= ${len(args)}")
+    if data_fim:
+        args.append(data_fim)
+        conditions.append(f"nf.data_emissao <= ${len(args)}")
+    if valor_min is not None:
+        args.append(valor_min)
+        conditions.append(f"nf.valor_nota_fiscal >= ${len(args)}")
+    if valor_max is not None:
+        args.append(valor_max)
+        conditions.append(f"nf.valor_nota_fiscal <= ${len(args)}")
+    if q and q.strip():
+        term = q.strip()
+        if _NON_DIGITS.sub('', term).isdigit():
+            args.append(_NON_DIGITS.sub('', term))
+            n = len(args)
+            conditions.append(f"(nf.chave_acesso = ${n} OR nf.numero_nf = ${n} "
+                              f"OR nf.cpf_cnpj_emitente = ${n} OR nf.cnpj_destinatario = ${n})")
+        else:
+            args.append(_like(term))
+            n = len(args)
+            conditions.append(f"(nf.razao_social_emitente ILIKE ${n} OR nf.nome_destinatario ILIKE ${n})")
+    return conditions
+
+
+def build_notas_page_query(sort: str = 'data_desc', limit: int = DEFAULT_PAGE_SIZE, cursor: Optional[str] = None,
+                           **filters) -> Tuple[str, list]:
+    """
+    SQL and arguments of one page (fetches limit + 1 rows, to tell whether there is a next page).
+
+    Args:
+        **filters: See notas_filters
+
+    Raises:
+        ValueError: Unknown sort or invalid cursor
+    """
+    if sort not in SORTS:
+        raise ValueError(f"Invalid sort '{sort}'. Valid values: {', '.join(SORTS)}")
+    key, key_type, direction = SORTS[sort]
+    args = []
+    conditions = notas_filters(args, **filters)
+
+    if cursor:
+        last_key, last_chave = decode_cursor(cursor, sort)
+        args += [last_key, last_chave]
+        comparison = '<' if direction == 'DESC' else '>'
+        conditions.append(f"({key}, nf.chave_acesso) {comparison} (${len(args) - 1}::{key_type}, ${len(args)})")
+        if key_type == 'date':
+            # Same bound on the partition key alone, so the passed months are pruned
+            conditions.append(f"nf.data_emissao {comparison}= ${len(args) - 1}::date")
+
+    args.append(limit + 1)
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+    sql = f"""
+    SELECT page.*,
+        (SELECT count(*) FROM itens_nota i
+         WHERE i.chave_acesso_nf = page.chave_acesso AND i.data_emissao = page.data_emissao) AS total_items
+    FROM (
+        SELECT
+            nf.chave_acesso,
+            nf.numero_nf,
+            nf.data_emissao,
+            nf.razao_social_emitente as emit_xnome,
+            nf.cpf_cnpj_emitente as emit_cnpj,
+            nf.nome_destinatario as dest_xnome,
+            nf.cnpj_destinatario as dest_cnpj,
+            nf.uf_emitente as emit_uf,
+            nf.uf_destinatario as dest_uf,
+            nf.valor_nota_fiscal as valor_total,
+            nf.classificacao,
+            {key} AS sort_key
+        FROM notasfiscais nf
+        {where}
+        ORDER BY {key} {direction}, nf.chave_acesso {direction}
+        LIMIT ${len(args)}
+    ) page
+    ORDER BY page.sort_key {direction}, page.chave_acesso {direction}
+    """
+    return sql, args
+
+
+def notas_page(rows: List, sort: str, limit: int) -> Dict:
+    """API response for the rows fetched with build_notas_page_query"""
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    notas = []
+    for row in rows:
+        notas.append({
+            "chave_acesso": row["chave_acesso"],
+            "numero_nf": row["numero_nf"],
+            "data_emissao": row["data_emissao"].isoformat() if row["data_emissao"] else None,
+            "emit_xnome": row["emit_xnome"],
+            "emit_cnpj": row["emit_cnpj"],
+            "emit_uf": row["emit_uf"],
+            "dest_xnome": row["dest_xnome"],
+            "dest_cnpj": row["dest_cnpj"],
+            "dest_uf": row["dest_uf"],
+            "valor_total": float(row["valor_total"]) if row["valor_total"] else 0.0,
+            "classificacao": row["classificacao"],
+            "total_items": row["total_items"]
+        })
+    next_cursor = None
+    if has_more and rows:
+        next_cursor = encode_cursor(sort, rows[-1]["sort_key"], rows[-1]["chave_acesso"])
+    return {"notas": notas, "next_cursor": next_cursor, "has_more": has_more, "sort": sort, "limit": limit}
@@ -0,0 +1,206 @@
+# query_plans.py
+"""
+Query-plan regression check for the hot queries.
+
+Every query in HOT_QUERIES is EXPLAINed with sequential scans disabled for
+the transaction. If a table that should be reached through an index still
+shows up in a Seq Scan, or an expected index is missing from the plan, no
+usable index exists for that access path any more (dropped, invalid, or a
+query/column change the index no longer matches) and the check fails.
+Disabling seq scans keeps the check meaningful on small or empty databases,
+where the planner would otherwise rightly prefer them. On a table with no rows
+at all (a fresh deploy) every index path costs the same and the planner picks
+any of them, so an expected index it did not pick only has to exist and be
+valid there. Plans of the partitioned tables name the partitions and their
+indexes; they are reported under the partitioned table / index they belong to.
+
+Run with `python migrate.py --check-plans` (exit code 1 on regressions).
+"""
+from datetime import date
+from typing import Dict, Iterable, Iterator, List, NamedTuple, Sequence, Tuple
+import json
+
+import asyncpg
+
+SAMPLE_CHAVE = "0" * 44
+SAMPLE_DATE = date.today()  # the current month's partitions always exist
+# A period within the partitions create_partitions_ahead() always creates; a
+# fixed period would be pruned away on a database without those months
+SAMPLE_PERIOD_START = SAMPLE_DATE.replace(day=1)
+SAMPLE_PERIOD_END = SAMPLE_DATE
+
+
+class HotQuery(NamedTuple):
+    name: str
+    sql: str
+    args: Tuple
+    expected_indexes: Sequence[str]
+    # Tables that must never be read with a Seq Scan by this query
+    indexed_tables: Sequence[str]
+    # (table, column): some index of the table on that column must be used,
+    # where several indexes serve the query equally well
+    expected_columns: Sequence[Tuple[str, str]] = ()
+
+
+HOT_QUERIES = [
+    # The primary key, or any of the listing indexes that end in chave_acesso
+    HotQuery(
+        "nota_by_chave",
+        "SELECT * FROM notasfiscais WHERE chave_acesso = $1",
+        (SAMPLE_CHAVE,), [], ["notasfiscais"], [("notasfiscais", "chave_acesso")]
+    ),
+    HotQuery(
+        "itens_with_impostos_by_chave",
+        """SELECT inf.*, ii.* FROM itens_nota inf
+           LEFT JOIN impostos_item ii ON inf.id_item_nf = ii.id_item_nf AND ii.data_emissao = inf.data_emissao
+           WHERE inf.chave_acesso_nf = $1 AND inf.data_emissao = $2 ORDER BY inf.numero_produto""",
+        (SAMPLE_CHAVE, SAMPLE_DATE), ["itens_nota_chave_numero_key"], ["itens_nota", "impostos_item"]
+    ),
+    HotQuery(
+        "impostos_item_by_chave",
+        "SELECT * FROM impostos_item WHERE chave_acesso_nf = $1 ORDER BY numero_item",
+        (SAMPLE_CHAVE,), ["impostos_item_chave_numero_key"], ["impostos_item"]
+    ),
+    HotQuery(
+        "impostos_nota_by_chave",
+        "SELECT * FROM impostos_nota_fiscal WHERE chave_acesso_nf = $1",
+        (SAMPLE_CHAVE,), [], ["impostos_nota_fiscal"]
+    ),
+    HotQuery(
+        "analise_fiscal_by_chave",
+        "SELECT * FROM analise_fiscal WHERE chave_acesso = $1",
+        (SAMPLE_CHAVE,), [], ["analise_fiscal"]
+    ),
+    HotQuery(
+        "notas_latest",
+        "SELECT chave_acesso, data_emissao FROM notasfiscais ORDER BY data_emissao DESC, chave_acesso DESC LIMIT 50",
+        (), ["idx_notasfiscais_data_chave"], ["notasfiscais"]
+    ),
+    # Next pages of the listing (notas_listing.py): keyset on (sort key, chave_acesso)
+    HotQuery(
+        "notas_page_after_date",
+        """SELECT chave_acesso FROM notasfiscais nf
+           WHERE (nf.data_emissao, nf.chave_acesso) < ($1::date, $2) AND nf.data_emissao <= $1::date
+           ORDER BY nf.data_emissao DESC, nf.chave_acesso DESC LIMIT 50""",
+        (SAMPLE_DATE, SAMPLE_CHAVE), ["idx_notasfiscais_data_chave"], ["notasfiscais"]
+    ),
+    HotQuery(
+        "notas_page_after_valor",
+        """SELECT chave_acesso FROM notasfiscais nf
+           WHERE (COALESCE(nf.valor_nota_fiscal, 0), nf.chave_acesso) < ($1::numeric, $2)
+           ORDER BY COALESCE(nf.valor_nota_fiscal, 0) DESC, nf.chave_acesso DESC LIMIT 50""",
+        (1000, SAMPLE_CHAVE), ["idx_notasfiscais_valor_chave"], ["notasfiscais"]
+    ),
+    HotQuery(
+        "notas_by_emitente_period",
+        """SELECT * FROM notasfiscais WHERE cpf_cnpj_emitente = $1
+           AND data_emissao BETWEEN $2::date AND $3::date""",
+        ("00000000000000", SAMPLE_PERIOD_START, SAMPLE_PERIOD_END), ["idx_notasfiscais_emitente_data"], ["notasfiscais"]
+    ),
+    HotQuery(
+        "notas_by_uf_period",
+        """SELECT uf_emitente, SUM(valor_nota_fiscal) FROM notasfiscais
+           WHERE uf_destinatario = $1 AND data_emissao >= $2::date GROUP BY uf_emitente""",
+        ("SP", SAMPLE_PERIOD_START), ["idx_notasfiscais_uf_destinatario_data"], ["notasfiscais"]
+    ),
+    HotQuery(
+        "notas_by_classificacao",
+        "SELECT COUNT(*) FROM notasfiscais WHERE classificacao = $1",
+        ("VENDA",), ["idx_notasfiscais_classificacao_data"], ["notasfiscais"]
+    ),
+    # Through the itensnotafiscal view, as the nf_agent queries the items: the
+    # items of itens_nota by their index, each joined to its nota header by key
+    HotQuery(
+        "itens_by_cfop",
+        "SELECT * FROM itensnotafiscal WHERE cfop = $1",
+        ("5102",), ["idx_itens_nota_cfop", "notasfiscais_pkey"], ["itens_nota", "notasfiscais"]
+    ),
+    HotQuery(
+        "itens_by_ncm_prefix",
+        "SELECT * FROM itensnotafiscal WHERE codigo_ncm_sh LIKE $1",
+        ("8471%",), ["idx_itens_nota_ncm", "notasfiscais_pkey"], ["itens_nota", "notasfiscais"]
+    ),
+]
+
+
+def _nodes(plan: Dict) -> Iterator[Dict]:
+    yield plan
+    for child in plan.get("Plans", []):
+        yield from _nodes(child)
+
+
+async def explain(conn: asyncpg.Connection, query: HotQuery) -> Dict:
+    async with conn.transaction():
+        await conn.execute("SET LOCAL enable_seqscan = off")
+        result = await conn.fetchval(f"EXPLAIN (FORMAT JSON) {query.sql}", *query.args)
+    if isinstance(result, str):
+        result = json.loads(result)
+    return result[0]["Plan"]
+
+
+async def _roots(conn: asyncpg.Connection, names: Iterable[str]) -> Dict[str, str]:
+    """Partition or partition index name -> its partitioned table or index (other names map to themselves)"""
+    rows = await conn.fetch("""
+        SELECT c.relname, COALESCE(pg_partition_root(c.oid), c.oid)::regclass::text AS root
+        FROM pg_class c WHERE c.relname = ANY($1::text[]) AND c.relnamespace = 'public'::regnamespace
+    """, list(names))
+    return {row["relname"]: row["root"] for row in rows}
+
+
+async def _index_columns(conn: asyncpg.Connection, indexes: Iterable[str]) -> Dict[str, Tuple[str, set]]:
+    """Index name -> (its table, the columns of its key)"""
+    rows = await conn.fetch("""
+        SELECT i.indexrelid::regclass::text AS index, i.indrelid::regclass::text AS "table",
+               array_agg(a.attname::text) AS columns
+        FROM pg_index i JOIN pg_attribute a ON a.attrelid = i.indrelid AND a.attnum = ANY(i.indkey)
+        WHERE i.indexrelid = ANY(SELECT to_regclass(name) FROM unnest($1::text[]) name)
+        GROUP BY i.indexrelid, i.indrelid
+    """, list(indexes))
+    return {row["index"]: (row["table"], set(row["columns"])) for row in rows}
+
+
+async def _empty_table_index(conn: asyncpg.Connection, index: str) -> bool:
+    """True when `index` exists, is valid, and its table (every partition of it) has no rows"""
+    return bool(await conn.fetchval("""
+        SELECT i.indisvalid AND NOT EXISTS (
+            SELECT 1 FROM pg_partition_tree(i.indrelid) t
+            WHERE t.isleaf AND pg_relation_size(t.relid) > 0
+        )
+        FROM pg_index i WHERE i.indexrelid = to_regclass($1)
+    """, index))
+
+
+async def check_query_plans(conn: asyncpg.Connection, queries: Sequence[HotQuery] = HOT_QUERIES) -> List[str]:
+    """
+    Returns:
+        One message per regression found (empty when every plan is as expected)
+    """
+    failures = []
+    for query in queries:
+        plan = await explain(conn, query)
+        nodes = list(_nodes(plan))
+        seq_scanned = {node.get("Relation Name") for node in nodes if node.get("Node Type") == "Seq Scan"}
+        used_indexes = {node.get("Index Name") for node in nodes if node.get("Index Name")}
+        roots = await _roots(conn, seq_scanned | used_indexes)
+        seq_scanned = {roots.get(name, name) for name in seq_scanned}
+        used_indexes = {roots.get(name, name) for name in used_indexes}
+
+        problems = [f"seq scan on {table}" for table in query.indexed_tables if table in seq_scanned]
+        ties = [index for index in query.expected_indexes
+                if index not in used_indexes and await _empty_table_index(conn, index)]
+        problems += [f"index {index} not used" for index in query.expected_indexes
+                     if index not in used_indexes and index not in ties]
+        if query.expected_columns:
+            columns = await _index_columns(conn, used_indexes)
+            problems += [f"no index of {table} on {column} used" for table, column in query.expected_columns
+                         if not any(table == index_table and column in index_columns
+                                    for index_table, index_columns in columns.values())]
+        if problems:
+            failures.append(f"{query.name}: {', '.join(problems)}")
+            print(f"❌ {query.name}: {', '.join(problems)} (indexes used: {sorted(used_indexes) or 'none'})")
+        else:
+            tied = f" ({', '.join(ties)} valid, not picked on an empty table)" if ties else ""
+            print(f"✅ {query.name}: {', '.join(sorted(used_indexes)) or 'no index'}{tied}")
+
+    print(f"Query plan check: {len(queries) - len(failures)}/{len(queries)} ok")
+    return failures
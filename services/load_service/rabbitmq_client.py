@@ -2,8 +2,13 @@
 import pika
 import json
 import logging
+import threading
 import time
-from typing import Dict, List
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from typing import Dict, List, Tuple
+
+from config import PUBLISHER_CHANNELS, PUBLISHER_MAX_IN_FLIGHT, PUBLISH_CONFIRM_TIMEOUT
+from rabbitmq_publisher import ConfirmingPublisher
 
 logger = logging.getLogger(__name__)
 
@@ -13,20 +18,36 @@ RABBITMQ_USER = "admin"
 RABBITMQ_PASS = "admin"
 QUEUE_NAME = "notas_fiscais"
 
+MESSAGE_PROPERTIES = pika.BasicProperties(
+    delivery_mode=2,  # make message persistent
+    content_type='application/json'
+)
+
+_publisher = None
+_publisher_lock = threading.Lock()
+
+
+def get_connection_parameters() -> pika.ConnectionParameters:
+    credentials = pika.PlainCredentials(RABBITMQ_USER, RABBITMQ_PASS)
+    return pika.ConnectionParameters(
+        host=RABBITMQ_HOST,
+        port=RABBITMQ_PORT,
+        credentials=credentials,
+        heartbeat=600,
+        blocked_connection_timeout=300
+    )
+
+
+def get_amqp_url() -> str:
+    """AMQP URL for asyncio clients (aio-pika), equivalent to get_connection_parameters()"""
+    return f"amqp://{RABBITMQ_USER}:{RABBITMQ_PASS}@{RABBITMQ_HOST}:{RABBITMQ_PORT}/?heartbeat=600"
+
 
 def get_rabbitmq_connection(retries=5, delay=2):
     """Get RabbitMQ connection with retry logic"""
     for attempt in range(retries):
         try:
-            credentials = pika.PlainCredentials(RABBITMQ_USER, RABBITMQ_PASS)
-            parameters = pika.ConnectionParameters(
-                host=RABBITMQ_HOST,
-                port=RABBITMQ_PORT,
-                credentials=credentials,
-                heartbeat=600,
-                blocked_connection_timeout=300
-            )
-            connection = pika.BlockingConnection(parameters)
+            connection = pika.BlockingConnection(get_connection_parameters())
             logger.info("Successfully connected to RabbitMQ")
             return connection
         except Exception as e:
@@ -37,6 +58,40 @@ def get_rabbitmq_connection(retries=5, delay=2):
                 raise
 
 
+def build_message_body(nota_fiscal_data: Dict, items_data: List[Dict], impostos_nota: Dict = None, impostos_items: List[Dict] = None) -> str:
+    """Serialize a nota fiscal into the JSON payload consumed by the workers"""
+    message = {
+        "nota_fiscal": nota_fiscal_data,
+        "items": items_data,
+        "impostos_nota": impostos_nota,
+        "impostos_items": impostos_items or []
+    }
+    return json.dumps(message, default=str)
+
+
+def get_publisher() -> ConfirmingPublisher:
+    """Get the process-wide publisher (connects on first use)"""
+    global _publisher
+    with _publisher_lock:
+        if _publisher is None:
+            _publisher = ConfirmingPublisher(
+                get_connection_parameters(),
+                queues=[QUEUE_NAME],
+                channels=PUBLISHER_CHANNELS,
+                max_in_flight=PUBLISHER_MAX_IN_FLIGHT
+            )
+        return _publisher
+
+
+def close_publisher():
+    """Close the publisher connection, if it was opened"""
+    global _publisher
+    with _publisher_lock:
+        if _publisher is not None:
+            _publisher.close()
+            _publisher = None
+
+
 def publish_nota_fiscal(nota_fiscal_data: Dict, items_data: List[Dict], impostos_nota: Dict = None, impostos_items: List[Dict] = None) -> bool:
     """
     Publish nota fiscal, its items, and tax data to RabbitMQ queue
@@ -48,42 +103,52 @@ def publish_nota_fiscal(nota_fiscal_data: Dict, items_data: List[Dict], impostos
         impostos_items: List of dictionaries with tax data for each item
         
     Returns:
-        bool: True if published successfully, False otherwise
+        bool: True if the broker confirmed the message, False otherwise
     """
-    connection = None
     try:
-        connection = get_rabbitmq_connection()
-        channel = connection.channel()
-        
-        # Declare queue (idempotent)
-        channel.queue_declare(queue=QUEUE_NAME, durable=True)
-        
-        # Create message payload
-        message = {
-            "nota_fiscal": nota_fiscal_data,
-            "items": items_data,
-            "impostos_nota": impostos_nota,
-            "impostos_items": impostos_items or []
-        }
-        
-        # Publish message
-        channel.basic_publish(
-            exchange='',
-            routing_key=QUEUE_NAME,
-            body=json.dumps(message, default=str),
-            properties=pika.BasicProperties(
-                delivery_mode=2,  # make message persistent
-                content_type='application/json'
-            )
-        )
-        
-        logger.info(f"Published nota fiscal to RabbitMQ: {nota_fiscal_data.get('chave_acesso')}")
-        return True
-        
+        body = build_message_body(nota_fiscal_data, items_data, impostos_nota, impostos_items)
+        confirmed = get_publisher().publish(QUEUE_NAME, body, MESSAGE_PROPERTIES).result(PUBLISH_CONFIRM_TIMEOUT)
+    except FutureTimeoutError:
+        confirmed = False
     except Exception as e:
         logger.error(f"Error publishing to RabbitMQ: {e}", exc_info=True)
         return False
-    finally:
-        if connection and not connection.is_closed:
-            connection.close()
 
+    if confirmed:
+        logger.info(f"Published nota fiscal to RabbitMQ: {nota_fiscal_data.get('chave_acesso')}")
+    else:
+        logger.error(f"RabbitMQ did not confirm nota fiscal: {nota_fiscal_data.get('chave_acesso')}")
+    return confirmed
+
+
+def publish_notas_fiscais(notas: List[Tuple]) -> Tuple[int, int]:
+    """
+    Publish a batch of notas fiscais, pipelined over the shared publisher
+    
+    Args:
+        notas: List of (nota_fiscal_data, items_data, impostos_nota, impostos_items) tuples,
+               as returned by xml_parser.parse_nfe_xml
+        
+    Returns:
+        Tuple[int, int]: (published, failed), where published counts broker-confirmed messages
+    """
+    if not notas:
+        return 0, 0
+    
+    try:
+        results = get_publisher().publish_many(
+            ((QUEUE_NAME, build_message_body(*nota)) for nota in notas),
+            MESSAGE_PROPERTIES,
+            timeout=PUBLISH_CONFIRM_TIMEOUT
+        )
+    except Exception as e:
+        logger.error(f"Error publishing batch to RabbitMQ: {e}", exc_info=True)
+        return 0, len(notas)
+    
+    published = sum(results)
+    for nota, confirmed in zip(notas, results):
+        if not confirmed:
+            logger.error(f"RabbitMQ did not confirm nota fiscal: {nota[0].get('chave_acesso')}")
+    
+    logger.info(f"Published batch of {published}/{len(notas)} notas fiscais to RabbitMQ")
+    return published, len(notas) - published
@@ -5,9 +5,23 @@ import logging
 import asyncio
 import sys
 import signal
+from datetime import timedelta
+from itertools import islice
+from typing import Optional
 
-from rabbitmq_client import get_rabbitmq_connection, QUEUE_NAME
-from db_utils import load_data_from_xml, create_db_and_tables
+import aio_pika
+
+from config import (
+    CONSUMER_MODE, CONSUMER_PREFETCH, CONSUMER_CONCURRENCY, CONSUMER_SHUTDOWN_TIMEOUT,
+    CONSUMER_BATCH_SIZE, CONSUMER_BATCH_LINGER_MS, CONSUMER_BISECT_POLICY, CONSUMER_METRICS_INTERVAL,
+    RABBITMQ_DLQ
+)
+from rabbitmq_client import get_rabbitmq_connection, get_amqp_url, QUEUE_NAME
+from db_utils import DATABASE_URL, load_data_from_xml, ensure_schema
+from bulk_writer import write_notas_batch
+from db_pool import DatabasePool
+from micro_batch import BatchMetrics, MicroBatcher
+from retry_queues import RetryPolicy, describe_error
 
 # Configure logging
 logging.basicConfig(
@@ -27,6 +41,17 @@ def signal_handler(signum, frame):
     should_stop = True
 
 
+def decode_message(body) -> tuple:
+    """Decode a queue message into a (nota_fiscal_data, items_data, impostos_nota, impostos_items) tuple"""
+    message = json.loads(body)
+    return (
+        message.get('nota_fiscal'),
+        message.get('items', []),
+        message.get('impostos_nota'),
+        message.get('impostos_items', [])
+    )
+
+
 def process_message(ch, method, properties, body):
     """
     Process a single message from RabbitMQ queue
@@ -45,11 +70,7 @@ def process_message(ch, method, properties, body):
     
     try:
         # Parse message
-        message = json.loads(body)
-        nota_fiscal_data = message.get('nota_fiscal')
-        items_data = message.get('items', [])
-        impostos_nota = message.get('impostos_nota')
-        impostos_items = message.get('impostos_items', [])
+        nota_fiscal_data, items_data, impostos_nota, impostos_items = decode_message(body)
         
         chave_acesso = nota_fiscal_data.get('chave_acesso') if nota_fiscal_data else None
         logger.info(f"Processing nota fiscal: {chave_acesso} with {len(items_data)} items and {len(impostos_items)} tax items")
@@ -72,8 +93,209 @@ def process_message(ch, method, properties, body):
         ch.basic_nack(delivery_tag=method.delivery_tag, requeue=True)
 
 
+class AsyncConsumer:
+    """
+    asyncio consumer: one event loop, one aio-pika connection and one asyncpg pool.
+
+    Up to `prefetch` deliveries are buffered by the broker. Messages go through
+    a MicroBatcher: up to `batch_size` notas (or whatever arrived within
+    `linger_ms`) are written in one transaction, and up to `concurrency`
+    batches are written at once. Messages are acked only after their
+    transaction has committed, with a single multiple=True ack when the whole
+    batch succeeded. On stop, consumption is cancelled, waiting and in-flight
+    batches are drained and anything not yet written is left unacked so the
+    broker redelivers it.
+
+    A nota that fails on its own goes through the retry path of
+    onboarding_service (retry_queues.py): it waits in a delay queue and comes
+    back, and after RABBITMQ_MAX_RETRIES it goes to RABBITMQ_DLQ with its
+    retry headers. The failed delivery is acked once the broker has confirmed
+    the copy, so a database outage delays notas but never drops them.
+    """
+
+    def __init__(self, prefetch: int = CONSUMER_PREFETCH, concurrency: int = CONSUMER_CONCURRENCY,
+                 batch_size: int = CONSUMER_BATCH_SIZE, linger_ms: float = CONSUMER_BATCH_LINGER_MS,
+                 bisect_policy: str = CONSUMER_BISECT_POLICY,
+                 shutdown_timeout: float = CONSUMER_SHUTDOWN_TIMEOUT):
+        self.prefetch = prefetch
+        self.concurrency = concurrency
+        self.shutdown_timeout = shutdown_timeout
+        self.metrics = BatchMetrics("load_service worker", CONSUMER_METRICS_INTERVAL)
+        self._batcher = MicroBatcher(
+            self._write, self._settle,
+            max_size=batch_size,
+            linger_ms=linger_ms,
+            policy=bisect_policy,
+            max_concurrent_flushes=concurrency,
+            metrics=self.metrics
+        )
+        self._stopping = asyncio.Event()
+        # Received but not yet acked/rejected, in delivery order
+        self._unsettled = {}
+        self._pool = None
+        self._channel = None
+        self.retries = RetryPolicy(QUEUE_NAME)
+
+    def stop(self):
+        if not self._stopping.is_set():
+            logger.info("Stopping consumer, draining in-flight messages...")
+            self._stopping.set()
+
+    async def run(self):
+        self._pool = DatabasePool(DATABASE_URL, min_size=1, max_size=self.concurrency)
+        await self._pool.open()
+        connection = await aio_pika.connect_robust(get_amqp_url())
+        try:
+            channel = await connection.channel()
+            await channel.set_qos(prefetch_count=self.prefetch)
+            queue = await channel.declare_queue(QUEUE_NAME, durable=True)
+            await self._declare_failure_queues(channel)
+            self._channel = channel
+            consumer_tag = await queue.consume(self._on_message)
+            logger.info(f"Waiting for messages in queue '{QUEUE_NAME}' (prefetch={self.prefetch}, "
+                        f"batch={self._batcher.max_size}/{self._batcher.linger * 1000:.0f}ms, "
+                        f"concurrency={self.concurrency}). Press CTRL+C to exit.")
+
+            await self._stopping.wait()
+            await queue.cancel(consumer_tag)
+            await self._drain()
+        finally:
+            # Closing the channel returns every unacked delivery to the queue
+            await connection.close()
+            await self._pool.close()
+            self.metrics.log()
+            logger.info("Connection closed")
+
+    async def _drain(self):
+        try:
+            await asyncio.wait_for(self._batcher.close(), timeout=self.shutdown_timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"{len(self._unsettled)} messages still in flight after {self.shutdown_timeout}s; "
+                           f"they will be redelivered")
+
+    async def _on_message(self, message: aio_pika.abc.AbstractIncomingMessage):
+        if self._stopping.is_set():
+            # Delivered after stop was requested: hand it back untouched
+            await message.nack(requeue=True)
+            return
+
+        # Unsettled until acked, also while a malformed one waits for its DLQ confirm
+        self._unsettled[message] = None
+        try:
+            nota = decode_message(message.body)
+        except json.JSONDecodeError as e:
+            logger.error(f"Failed to parse message JSON: {e}")
+            # Malformed messages are not retried: straight to the DLQ
+            try:
+                await self._fail(message, e, reason="Invalid JSON format")
+            finally:
+                self._unsettled.pop(message, None)
+            return
+
+        self._batcher.add(message, nota)
+
+    async def _write(self, notas: list):
+        async with self._pool.connection() as conn:
+            await write_notas_batch(conn, notas)
+
+    async def _settle(self, batch: list, errors: list):
+        messages = [message for message, _nota in batch]
+        try:
+            if all(error is None for error in errors) and self._acks_whole_prefix(messages):
+                # The transaction has committed; one ack confirms the whole batch
+                await messages[-1].ack(multiple=True)
+                logger.info(f"Successfully saved batch of {len(messages)} notas fiscais")
+                return
+
+            for (message, nota), error in zip(batch, errors):
+                if error is None:
+                    await message.ack()
+                    continue
+                chave_acesso = nota[0].get('chave_acesso') if nota[0] else None
+                logger.error(f"Error processing nota fiscal {chave_acesso}: {error}")
+                await self._fail(message, error)
+        finally:
+            for message in messages:
+                self._unsettled.pop(message, None)
+
+    async def _declare_failure_queues(self, channel):
+        """The DLQ and the delay queues, declared as onboarding_service declares them"""
+        await channel.declare_queue(RABBITMQ_DLQ, durable=True)
+        for attempt in range(1, self.retries.max_retries + 1):
+            await channel.declare_queue(self.retries.delay_queue(attempt), durable=True,
+                                        arguments=self.retries.queue_arguments(attempt))
+
+    async def _fail(self, message: aio_pika.abc.AbstractIncomingMessage, error, reason: Optional[str] = None):
+        """
+        Publish a failed message to the delay queue of its next retry, or to the
+        DLQ (always when `reason` is given), then ack it
+        """
+        retry = None if reason else self.retries.next_retry(message, error)
+        if retry is not None:
+            routing_key, headers, expiration = retry
+            expiration = timedelta(milliseconds=expiration)
+        else:
+            reason = reason or f"Max retries exceeded - {describe_error(error)}"
+            routing_key, headers, expiration = RABBITMQ_DLQ, self.retries.dlq_headers(message, reason, error), None
+        try:
+            # Publisher confirms are on: this returns once the broker has the copy
+            await self._channel.default_exchange.publish(
+                aio_pika.Message(
+                    message.body,
+                    headers=headers,
+                    content_type=message.content_type,
+                    delivery_mode=aio_pika.DeliveryMode.PERSISTENT,
+                    expiration=expiration
+                ),
+                routing_key=routing_key
+            )
+        except Exception as e:
+            logger.error(f"Could not move the failed message to '{routing_key}', requeuing it: {e}")
+            await message.nack(requeue=True)
+            return
+        if retry is None:
+            logger.warning(f"💀 Message sent to DLQ. Reason: {reason}")
+        await message.ack()
+
+    def _acks_whole_prefix(self, messages: list) -> bool:
+        """
+        A multiple=True ack settles every unacked delivery up to the given tag
+        on the channel, so it is only safe when the batch is exactly the oldest
+        unsettled messages: none still in flight elsewhere (another batch, a
+        DLQ publish) was delivered before its last one.
+        """
+        oldest = list(islice(self._unsettled, len(messages)))
+        channel = messages[0].channel
+        return (len(oldest) == len(messages) and all(a is b for a, b in zip(oldest, messages))
+                and all(message.channel is channel for message in messages))
+
+
+async def consume_async():
+    """Run the asyncio consumer until SIGINT/SIGTERM"""
+    try:
+        await ensure_schema()
+        logger.info("Database structure verified/created")
+    except Exception as e:
+        logger.error(f"Failed to create database structure: {e}")
+        sys.exit(1)
+
+    consumer = AsyncConsumer()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, consumer.stop)
+    await consumer.run()
+
+
 def start_consumer():
     """Start consuming messages from RabbitMQ queue"""
+    if CONSUMER_MODE == "async":
+        logger.info("Starting asyncio RabbitMQ consumer...")
+        try:
+            asyncio.run(consume_async())
+        except Exception as e:
+            logger.error(f"Error in consumer: {e}", exc_info=True)
+        return
+
     logger.info("Starting RabbitMQ consumer...")
     
     # Register signal handlers
@@ -82,7 +304,7 @@ def start_consumer():
     
     # Ensure database structure exists
     try:
-        asyncio.run(create_db_and_tables())
+        asyncio.run(ensure_schema())
         logger.info("Database structure verified/created")
     except Exception as e:
         logger.error(f"Failed to create database structure: {e}")
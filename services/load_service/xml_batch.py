@@ -0,0 +1,251 @@
+# xml_batch.py
+"""
+Streaming bulk ingestion of NFe XML documents.
+
+Accepts a ZIP of XML files or a single XML lot (an enviNFe, or several
+nfeProc/NFe documents concatenated in one file). Every source is fed through
+an incremental pull parser; each <NFe> is serialized as soon as it is complete
+and then cleared, so memory stays flat regardless of archive size. Parsing
+fans out over a process pool running xml_parser.parse_nfe_xml, and results
+are published to RabbitMQ in batches, less the notas already stored with the
+same content (known_notas). Progress is reported after every
+published batch, and a run can start from a checkpoint (the number of NFe
+documents already handled) so interrupted jobs resume where they stopped.
+"""
+import logging
+import re
+import zipfile
+import xml.etree.ElementTree as ET
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from typing import BinaryIO, Callable, Dict, Iterator, List, Optional, Tuple
+
+from fastapi import HTTPException, status
+
+from config import BULK_PARSE_WORKERS, BULK_PARSE_CHUNK, BULK_PUBLISH_BATCH, BULK_READ_SIZE
+from xml_parser import Q, parse_nfe_xml
+from known_notas import split_unchanged, remember
+from rabbitmq_client import publish_notas_fiscais
+
+logger = logging.getLogger(__name__)
+
+_NFE = Q + 'NFe'
+
+# Concatenated documents each carry their own prolog (and possibly a BOM), which is
+# only legal at the very start of a document, so they are dropped before parsing.
+# NF-e is mandated to be UTF-8, which is the pull parser's default.
+_XML_DECLARATION = re.compile(rb'(?:\xef\xbb\xbf)?<\?xml[^>]*\?>')
+
+# Synthetic root wrapping every source, so concatenated documents form one tree
+_LOT_START = b'<lote>'
+_LOT_END = b'</lote>'
+
+MAX_REPORTED_ERRORS = 50
+
+_parse_pool = None
+
+
+def get_parse_pool() -> ProcessPoolExecutor:
+    """Get the process pool used to parse NFe documents (created on first use)"""
+    global _parse_pool
+    if _parse_pool is None:
+        _parse_pool = ProcessPoolExecutor(max_workers=BULK_PARSE_WORKERS)
+        logger.info(f"Started XML parse pool with {BULK_PARSE_WORKERS} workers")
+    return _parse_pool
+
+
+def shutdown_parse_pool():
+    """Shut down the parse pool, if it was started"""
+    global _parse_pool
+    if _parse_pool is not None:
+        _parse_pool.shutdown(wait=True, cancel_futures=True)
+        _parse_pool = None
+
+
+def parse_documents(documents: List[Tuple[str, bytes]]) -> List[Tuple[str, bool, object]]:
+    """
+    Process-pool task: parse a chunk of serialized NFe documents.
+
+    Returns:
+        List of (source, ok, result) where result is the parse_nfe_xml tuple
+        when ok, or the error message otherwise
+    """
+    results = []
+    for source, document in documents:
+        try:
+            results.append((source, True, parse_nfe_xml(document)))
+        except ValueError as e:
+            results.append((source, False, str(e)))
+    return results
+
+
+def _without_declarations(stream: BinaryIO) -> Iterator[bytes]:
+    """Read stream in chunks, removing XML declarations (which may straddle chunk boundaries)"""
+    pending = b''
+    while True:
+        chunk = stream.read(BULK_READ_SIZE)
+        if not chunk:
+            break
+        data = pending + chunk
+        # Hold back a trailing, still unterminated markup fragment until the next read
+        cut = data.rfind(b'<')
+        if cut != -1 and data.find(b'>', cut) == -1:
+            data, pending = data[:cut], data[cut:]
+        else:
+            pending = b''
+        yield _XML_DECLARATION.sub(b'', data)
+    if pending:
+        yield _XML_DECLARATION.sub(b'', pending)
+
+
+def _drain(parser: ET.XMLPullParser, stack: List[ET.Element]) -> Iterator[bytes]:
+    for event, element in parser.read_events():
+        if event == 'start':
+            stack.append(element)
+            continue
+
+        stack.pop()
+        is_nfe = element.tag == _NFE
+        if is_nfe:
+            element.tail = None
+            yield ET.tostring(element)
+
+        # Detach finished NFe elements and finished top-level documents (e.g. the
+        # protNFe left inside an nfeProc) so the tree never grows with the source
+        if stack and (is_nfe or len(stack) == 1):
+            element.clear()
+            stack[-1].remove(element)
+
+
+def iter_nfe_documents(stream: BinaryIO) -> Iterator[bytes]:
+    """
+    Yield every <NFe> element found in an XML stream as standalone XML bytes.
+
+    Works for a single NFe/nfeProc document, an enviNFe lot, or any number of
+    such documents concatenated in the same stream.
+
+    Raises:
+        ET.ParseError: if the stream is not well-formed
+    """
+    parser = ET.XMLPullParser(events=('start', 'end'))
+    stack = []
+    parser.feed(_LOT_START)
+    for data in _without_declarations(stream):
+        parser.feed(data)
+        yield from _drain(parser, stack)
+    parser.feed(_LOT_END)
+    yield from _drain(parser, stack)
+    parser.close()
+
+
+def _iter_sources(fileobj: BinaryIO, filename: str, stats: Dict) -> Iterator[Tuple[str, bytes]]:
+    """Yield (source, document) for every NFe in the upload, recording unreadable sources in stats"""
+    if not filename.lower().endswith('.zip'):
+        try:
+            for index, document in enumerate(iter_nfe_documents(fileobj), start=1):
+                yield f"{filename}#{index}", document
+        except ET.ParseError as e:
+            _record_error(stats, filename, f"Invalid XML format: {e}")
+        return
+
+    try:
+        zip_ref = zipfile.ZipFile(fileobj)
+    except zipfile.BadZipFile:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid ZIP file.")
+
+    with zip_ref:
+        for info in zip_ref.infolist():
+            if info.is_dir() or not info.filename.lower().endswith('.xml'):
+                continue
+            try:
+                with zip_ref.open(info) as member:
+                    for index, document in enumerate(iter_nfe_documents(member), start=1):
+                        yield f"{info.filename}#{index}", document
+            except ET.ParseError as e:
+                _record_error(stats, info.filename, f"Invalid XML format: {e}")
+
+
+def _record_error(stats: Dict, source: str, message: str):
+    stats['failed'] += 1
+    if len(stats['errors']) < MAX_REPORTED_ERRORS:
+        stats['errors'].append({"source": source, "error": message})
+
+
+def _flush(buffer: List[Tuple], stats: Dict, on_progress: Optional[Callable[[Dict], None]]):
+    to_publish, skipped = split_unchanged(buffer)
+    published, failed = publish_notas_fiscais(to_publish) if to_publish else (0, 0)
+    remember(to_publish)
+    stats['skipped'] += skipped
+    stats['published'] += published
+    stats['failed'] += failed
+    buffer.clear()
+    # Results are collected in document order, so everything collected so far is handled
+    stats['checkpoint'] = stats['collected']
+    if on_progress:
+        on_progress(stats)
+
+
+def _collect(future: Future, buffer: List[Tuple], stats: Dict, on_progress: Optional[Callable[[Dict], None]]):
+    for source, ok, result in future.result():
+        stats['collected'] += 1
+        if not ok:
+            _record_error(stats, source, result)
+            continue
+        stats['parsed'] += 1
+        buffer.append(result)
+        if len(buffer) >= BULK_PUBLISH_BATCH:
+            _flush(buffer, stats, on_progress)
+
+
+def ingest_xml_batch(fileobj: BinaryIO, filename: str, checkpoint: int = 0,
+                     on_progress: Optional[Callable[[Dict], None]] = None) -> Dict:
+    """
+    Parse every NFe in a ZIP or XML lot and publish them to RabbitMQ in batches.
+
+    Blocking: callers on the event loop should run it in a worker thread.
+
+    Args:
+        fileobj: Binary file object of the upload (seekable when it is a ZIP)
+        filename: Upload file name, used to tell ZIPs from XML lots and in error reports
+        checkpoint: Number of NFe documents, in upload order, already handled by a previous run; they are skipped
+        on_progress: Called with the stats after every published batch
+
+    Returns:
+        Dict with documents, parsed, skipped (stored unchanged), published and failed counters for this run,
+        the checkpoint (documents handled, relative to the starting checkpoint)
+        plus the first MAX_REPORTED_ERRORS errors
+    """
+    stats = {"documents": 0, "parsed": 0, "skipped": 0, "published": 0, "failed": 0, "errors": [],
+             "collected": 0, "checkpoint": 0}
+    pool = get_parse_pool()
+    in_flight = deque()
+    publish_buffer = []
+    chunk = []
+
+    # Bound the number of chunks waiting in the pool so memory stays flat
+    max_in_flight = BULK_PARSE_WORKERS * 2
+
+    for position, (source, document) in enumerate(_iter_sources(fileobj, filename, stats)):
+        if position < checkpoint:
+            continue
+        stats['documents'] += 1
+        chunk.append((source, document))
+        if len(chunk) >= BULK_PARSE_CHUNK:
+            in_flight.append(pool.submit(parse_documents, chunk))
+            chunk = []
+            if len(in_flight) >= max_in_flight:
+                _collect(in_flight.popleft(), publish_buffer, stats, on_progress)
+
+    if chunk:
+        in_flight.append(pool.submit(parse_documents, chunk))
+    while in_flight:
+        _collect(in_flight.popleft(), publish_buffer, stats, on_progress)
+    if publish_buffer:
+        _flush(publish_buffer, stats, on_progress)
+    else:
+        stats['checkpoint'] = stats['collected']
+
+    logger.info(f"Bulk XML ingestion of '{filename}': {stats['documents']} documents, "
+                f"{stats['parsed']} parsed, {stats['skipped']} skipped (unchanged), {stats['published']} published, "
+                f"{stats['failed']} failed")
+    return stats
@@ -1,14 +1,77 @@
 # xml_parser.py
 import xml.etree.ElementTree as ET
 from datetime import datetime
-from typing import Dict, List, Tuple
+from typing import Callable, Dict, List, Optional, Tuple, Union
+
+from content_hash import nota_content_hash
 
 # Namespace da NFe
 NS = {'nfe': 'http://www.portalfiscal.inf.br/nfe'}
 
-def parse_nfe_xml(xml_content: str) -> Tuple[Dict, List[Dict]]:
+# Qualified tag prefix ("{namespace}") used by the single-pass engine
+Q = '{' + NS['nfe'] + '}'
+
+MODELO_MAP = {
+    '55': '55 - NF-E EMITIDA EM SUBSTITUIÇÃO AO MODELO 1 OU 1A',
+    '65': '65 - NFC-E'
+}
+
+INDICADOR_IE_MAP = {
+    '1': '1 - Contribuinte ICMS',
+    '2': '2 - Contribuinte isento de Inscrição no cadastro de Contribuintes',
+    '9': '9 - Não Contribuinte'
+}
+
+DESTINO_OPERACAO_MAP = {
+    '1': '1 - Interna',
+    '2': '2 - Interestadual',
+    '3': '3 - Exterior'
+}
+
+CONSUMIDOR_FINAL_MAP = {
+    '0': '0 - Não',
+    '1': '1 - Sim'
+}
+
+PRESENCA_COMPRADOR_MAP = {
+    '0': '0 - Não se aplica',
+    '1': '1 - Operação presencial',
+    '2': '2 - Operação não presencial, pela Internet',
+    '3': '3 - Operação não presencial, Teleatendimento',
+    '4': '4 - NFC-e em operação com entrega a domicílio',
+    '5': '5 - Operação presencial, fora do estabelecimento',
+    '9': '9 - Operação não presencial, outros'
+}
+
+
+def parse_nfe_xml(xml_content: Union[bytes, str]) -> Tuple[Dict, List[Dict], Optional[Dict], List[Dict]]:
+    """
+    Parse NFe XML in a single pass and extract data for notasfiscais, itensnotafiscal,
+    impostos_nota_fiscal and impostos_item tables.
+
+    Accepts the raw uploaded bytes (the encoding declared in the XML prolog is honoured),
+    so callers don't need to decode the file first.
+
+    Returns:
+        Tuple[Dict, List[Dict], Dict, List[Dict]]: (nota_fiscal_data, items_data, impostos_nota, impostos_items)
+    """
+    try:
+        root = ET.fromstring(xml_content)
+    except ET.ParseError as e:
+        raise ValueError(f"Invalid XML format: {e}")
+
+    inf_nfe = next(root.iter(Q + 'infNFe'), None)
+    if inf_nfe is None:
+        raise ValueError("Invalid NFe XML: infNFe element not found")
+
+    return parse_inf_nfe(inf_nfe)
+
+
+def parse_nfe_xml_legacy(xml_content: str) -> Tuple[Dict, List[Dict], Optional[Dict], List[Dict]]:
     """
     Parse NFe XML and extract data for notasfiscais and itensnotafiscal tables.
+
+    Original find()-based implementation, kept as the reference for bench_xml_parser.py.
     
     Returns:
         Tuple[Dict, List[Dict], Dict, List[Dict]]: (nota_fiscal_data, items_data, impostos_nota, impostos_items)
@@ -40,6 +103,7 @@ def parse_nfe_xml(xml_content: str) -> Tuple[Dict, List[Dict]]:
     # Parse impostos dos itens
     impostos_items = extract_impostos_items(inf_nfe, chave_acesso)
     
+    nota_fiscal_data['content_hash'] = nota_content_hash(nota_fiscal_data, items_data, impostos_nota, impostos_items)
     return nota_fiscal_data, items_data, impostos_nota, impostos_items
 
 
@@ -60,11 +124,7 @@ def extract_nota_fiscal_data(inf_nfe: ET.Element, chave_acesso: str) -> Dict:
     
     # Extract modelo
     modelo_code = get_text(ide, 'nfe:mod', NS)
-    modelo_map = {
-        '55': '55 - NF-E EMITIDA EM SUBSTITUIÇÃO AO MODELO 1 OU 1A',
-        '65': '65 - NFC-E'
-    }
-    modelo = modelo_map.get(modelo_code, modelo_code)
+    modelo = MODELO_MAP.get(modelo_code, modelo_code)
     
     # Extract data_emissao
     dh_emi = get_text(ide, 'nfe:dhEmi', NS)
@@ -93,42 +153,19 @@ def extract_nota_fiscal_data(inf_nfe: ET.Element, chave_acesso: str) -> Dict:
     
     # Extract indicador IE destinatario
     ind_ie_dest = get_text(dest, 'nfe:indIEDest', NS) if dest is not None else None
-    indicador_ie_map = {
-        '1': '1 - Contribuinte ICMS',
-        '2': '2 - Contribuinte isento de Inscrição no cadastro de Contribuintes',
-        '9': '9 - Não Contribuinte'
-    }
-    indicador_ie_destinatario = indicador_ie_map.get(ind_ie_dest, ind_ie_dest)
+    indicador_ie_destinatario = INDICADOR_IE_MAP.get(ind_ie_dest, ind_ie_dest)
     
     # Extract destino operacao
     id_dest = get_text(ide, 'nfe:idDest', NS)
-    destino_operacao_map = {
-        '1': '1 - Interna',
-        '2': '2 - Interestadual',
-        '3': '3 - Exterior'
-    }
-    destino_operacao = destino_operacao_map.get(id_dest, id_dest)
+    destino_operacao = DESTINO_OPERACAO_MAP.get(id_dest, id_dest)
     
     # Extract consumidor final
     ind_final = get_text(ide, 'nfe:indFinal', NS)
-    consumidor_final_map = {
-        '0': '0 - Não',
-        '1': '1 - Sim'
-    }
-    consumidor_final = consumidor_final_map.get(ind_final, ind_final)
+    consumidor_final = CONSUMIDOR_FINAL_MAP.get(ind_final, ind_final)
     
     # Extract presenca comprador
     ind_pres = get_text(ide, 'nfe:indPres', NS)
-    presenca_comprador_map = {
-        '0': '0 - Não se aplica',
-        '1': '1 - Operação presencial',
-        '2': '2 - Operação não presencial, pela Internet',
-        '3': '3 - Operação não presencial, Teleatendimento',
-        '4': '4 - NFC-e em operação com entrega a domicílio',
-        '5': '5 - Operação presencial, fora do estabelecimento',
-        '9': '9 - Operação não presencial, outros'
-    }
-    presenca_comprador = presenca_comprador_map.get(ind_pres, ind_pres)
+    presenca_comprador = PRESENCA_COMPRADOR_MAP.get(ind_pres, ind_pres)
     
     # Extract valor nota fiscal
     valor_nota_fiscal = get_decimal(total, 'nfe:vNF', NS)
@@ -188,23 +225,7 @@ def extract_items_data(inf_nfe: ET.Element, chave_acesso: str, nota_fiscal_data:
         
         item_data = {
             'chave_acesso_nf': chave_acesso,
-            'modelo': nota_fiscal_data.get('modelo'),
-            'serie_nf': nota_fiscal_data.get('serie_nf'),
-            'numero_nf': nota_fiscal_data.get('numero_nf'),
-            'natureza_operacao': nota_fiscal_data.get('natureza_operacao'),
             'data_emissao': nota_fiscal_data.get('data_emissao'),
-            'cpf_cnpj_emitente': nota_fiscal_data.get('cpf_cnpj_emitente'),
-            'razao_social_emitente': nota_fiscal_data.get('razao_social_emitente'),
-            'inscricao_estadual_emitente': nota_fiscal_data.get('inscricao_estadual_emitente'),
-            'uf_emitente': nota_fiscal_data.get('uf_emitente'),
-            'municipio_emitente': nota_fiscal_data.get('municipio_emitente'),
-            'cnpj_destinatario': nota_fiscal_data.get('cnpj_destinatario'),
-            'nome_destinatario': nota_fiscal_data.get('nome_destinatario'),
-            'uf_destinatario': nota_fiscal_data.get('uf_destinatario'),
-            'indicador_ie_destinatario': nota_fiscal_data.get('indicador_ie_destinatario'),
-            'destino_operacao': nota_fiscal_data.get('destino_operacao'),
-            'consumidor_final': nota_fiscal_data.get('consumidor_final'),
-            'presenca_comprador': nota_fiscal_data.get('presenca_comprador'),
             'numero_produto': int(numero_produto) if numero_produto else None,
             'descricao_produto': descricao_produto,
             'codigo_ncm_sh': codigo_ncm_sh,
@@ -484,3 +505,385 @@ def get_int(element: ET.Element, path: str, namespace: dict) -> int:
             return None
     return None
 
+
+
+# ---------------------------------------------------------------------------
+# Single-pass engine
+#
+# The document is walked exactly once. Every element is dispatched on its
+# qualified tag through the lookup tables below, which are built once at import
+# time, instead of running a namespaced find() per field.
+# ---------------------------------------------------------------------------
+
+def _text(text: str) -> str:
+    return text if text else None
+
+
+def _decimal(text: str) -> float:
+    if text:
+        try:
+            return float(text)
+        except ValueError:
+            return None
+    return None
+
+
+def _percentage(text: str) -> float:
+    if text:
+        try:
+            return float(text) / 100.0
+        except ValueError:
+            return None
+    return None
+
+
+def _int(text: str) -> int:
+    if text:
+        try:
+            return int(text)
+        except ValueError:
+            return None
+    return None
+
+
+def _fields(*specs) -> Dict[str, Tuple[str, Callable]]:
+    """Build a {qualified tag: (output key, converter)} lookup table"""
+    return {Q + tag: (key, converter) for tag, key, converter in specs}
+
+
+def _ranks(*tags) -> Dict[str, int]:
+    """Build a {qualified tag: priority} table for mutually exclusive tax groups"""
+    return {Q + tag: rank for rank, tag in enumerate(tags)}
+
+
+_INF_NFE = Q + 'infNFe'
+_IDE = Q + 'ide'
+_EMIT = Q + 'emit'
+_DEST = Q + 'dest'
+_TOTAL = Q + 'total'
+_ICMS_TOT = Q + 'ICMSTot'
+_ENDER_EMIT = Q + 'enderEmit'
+_ENDER_DEST = Q + 'enderDest'
+_DET = Q + 'det'
+_PROD = Q + 'prod'
+_IMPOSTO = Q + 'imposto'
+_V_TOT_TRIB = Q + 'vTotTrib'
+_C_ENQ = Q + 'cEnq'
+_IPI_TRIB = Q + 'IPITrib'
+_IPI_NT = Q + 'IPINT'
+
+_IDE_FIELDS = _fields(
+    ('mod', 'mod', _text),
+    ('serie', 'serie', _text),
+    ('nNF', 'nNF', _text),
+    ('natOp', 'natOp', _text),
+    ('dhEmi', 'dhEmi', _text),
+    ('idDest', 'idDest', _text),
+    ('indFinal', 'indFinal', _text),
+    ('indPres', 'indPres', _text),
+)
+
+_EMIT_FIELDS = _fields(
+    ('CNPJ', 'CNPJ', _text),
+    ('CPF', 'CPF', _text),
+    ('xNome', 'xNome', _text),
+    ('IE', 'IE', _text),
+)
+
+_ENDER_EMIT_FIELDS = _fields(
+    ('UF', 'UF', _text),
+    ('xMun', 'xMun', _text),
+)
+
+_DEST_FIELDS = _fields(
+    ('CNPJ', 'CNPJ', _text),
+    ('xNome', 'xNome', _text),
+    ('indIEDest', 'indIEDest', _text),
+)
+
+_ENDER_DEST_FIELDS = _fields(
+    ('UF', 'UF', _text),
+)
+
+_ICMS_TOT_FIELDS = _fields(
+    ('vBC', 'v_bc_icms', _decimal),
+    ('vICMS', 'v_icms', _decimal),
+    ('vICMSDeson', 'v_icms_deson', _decimal),
+    ('vFCPUFDest', 'v_fcp_uf_dest', _decimal),
+    ('vICMSUFDest', 'v_icms_uf_dest', _decimal),
+    ('vICMSUFRemet', 'v_icms_uf_remet', _decimal),
+    ('vBCST', 'v_bc_st', _decimal),
+    ('vST', 'v_st', _decimal),
+    ('vIPI', 'v_ipi', _decimal),
+    ('vIPIDevol', 'v_ipi_devol', _decimal),
+    ('vPIS', 'v_pis', _decimal),
+    ('vCOFINS', 'v_cofins', _decimal),
+    ('vII', 'v_ii', _decimal),
+    ('vTotTrib', 'v_tot_trib', _decimal),
+    ('vProd', 'v_prod', _decimal),
+    ('vFrete', 'v_frete', _decimal),
+    ('vSeg', 'v_seg', _decimal),
+    ('vDesc', 'v_desc', _decimal),
+    ('vOutro', 'v_outro', _decimal),
+    ('vNF', 'v_nf', _decimal),
+)
+_ICMS_TOT_KEYS = tuple(key for key, _ in _ICMS_TOT_FIELDS.values())
+
+_PROD_FIELDS = _fields(
+    ('xProd', 'descricao_produto', _text),
+    ('NCM', 'codigo_ncm_sh', _text),
+    ('CFOP', 'cfop', _text),
+    ('qCom', 'quantidade', _decimal),
+    ('uCom', 'unidade', _text),
+    ('vUnCom', 'valor_unitario', _decimal),
+    ('vProd', 'valor_total', _decimal),
+)
+_PROD_KEYS = ('descricao_produto', 'codigo_ncm_sh', 'ncm_sh_tipo_produto', 'cfop',
+              'quantidade', 'unidade', 'valor_unitario', 'valor_total')
+
+_ICMS_VARIANTS = _ranks('ICMS00', 'ICMS10', 'ICMS20', 'ICMS30', 'ICMS40', 'ICMS51', 'ICMS60', 'ICMS70', 'ICMS90',
+                        'ICMSSN101', 'ICMSSN102', 'ICMSSN201', 'ICMSSN202', 'ICMSSN500', 'ICMSSN900')
+_ICMS_FIELDS = _fields(
+    ('orig', 'icms_orig', _int),
+    ('CST', 'icms_cst', _text),
+    ('CSOSN', 'icms_cst', _text),
+    ('modBC', 'icms_mod_bc', _int),
+    ('vBC', 'icms_v_bc', _decimal),
+    ('pICMS', 'icms_p_icms', _percentage),
+    ('vICMS', 'icms_v_icms', _decimal),
+)
+_ICMS_KEYS = ('icms_orig', 'icms_cst', 'icms_mod_bc', 'icms_v_bc', 'icms_p_icms', 'icms_v_icms')
+
+_ICMS_UF_DEST_FIELDS = _fields(
+    ('vBCUFDest', 'icms_uf_v_bc_uf_dest', _decimal),
+    ('vBCFCPUFDest', 'icms_uf_v_bc_fcp_uf_dest', _decimal),
+    ('pFCPUFDest', 'icms_uf_p_fcp_uf_dest', _percentage),
+    ('pICMSUFDest', 'icms_uf_p_icms_uf_dest', _percentage),
+    ('pICMSInter', 'icms_uf_p_icms_inter', _percentage),
+    ('pICMSInterPart', 'icms_uf_p_icms_inter_part', _percentage),
+    ('vFCPUFDest', 'icms_uf_v_fcp_uf_dest', _decimal),
+    ('vICMSUFDest', 'icms_uf_v_icms_uf_dest', _decimal),
+    ('vICMSUFRemet', 'icms_uf_v_icms_uf_remet', _decimal),
+)
+_ICMS_UF_DEST_KEYS = tuple(key for key, _ in _ICMS_UF_DEST_FIELDS.values())
+
+_IPI_FIELDS = _fields(
+    ('CST', 'ipi_cst', _text),
+    ('vBC', 'ipi_v_bc', _decimal),
+    ('pIPI', 'ipi_p_ipi', _percentage),
+    ('vIPI', 'ipi_v_ipi', _decimal),
+)
+_IPI_KEYS = ('ipi_cst', 'ipi_v_bc', 'ipi_p_ipi', 'ipi_v_ipi')
+
+_PIS_VARIANTS = _ranks('PISAliq', 'PISQtde', 'PISNT', 'PISOutr')
+_PIS_FIELDS = _fields(
+    ('CST', 'pis_cst', _text),
+    ('vBC', 'pis_v_bc', _decimal),
+    ('pPIS', 'pis_p_pis', _percentage),
+    ('vPIS', 'pis_v_pis', _decimal),
+)
+_PIS_KEYS = ('pis_cst', 'pis_v_bc', 'pis_p_pis', 'pis_v_pis')
+
+_COFINS_VARIANTS = _ranks('COFINSAliq', 'COFINSQtde', 'COFINSNT', 'COFINSOutr')
+_COFINS_FIELDS = _fields(
+    ('CST', 'cofins_cst', _text),
+    ('vBC', 'cofins_v_bc', _decimal),
+    ('pCOFINS', 'cofins_p_cofins', _percentage),
+    ('vCOFINS', 'cofins_v_cofins', _decimal),
+)
+_COFINS_KEYS = ('cofins_cst', 'cofins_v_bc', 'cofins_p_cofins', 'cofins_v_cofins')
+
+# Nota columns carried by every item (itens_nota keeps only the join key; the
+# itensnotafiscal view adds the rest of the header)
+_ITEM_HEADER_KEYS = ('data_emissao',)
+
+
+def _read_fields(element: ET.Element, table: Dict, out: Dict) -> Dict:
+    """Copy the direct children of element listed in table into out"""
+    for child in element:
+        spec = table.get(child.tag)
+        if spec is not None:
+            out[spec[0]] = spec[1](child.text)
+    return out
+
+
+def _read_party(element: ET.Element, table: Dict, address_tag: str, address_table: Dict) -> Dict:
+    """Read an emit/dest block together with its nested address"""
+    out = {}
+    for child in element:
+        if child.tag == address_tag:
+            _read_fields(child, address_table, out)
+        else:
+            spec = table.get(child.tag)
+            if spec is not None:
+                out[spec[0]] = spec[1](child.text)
+    return out
+
+
+def _read_variant(element: ET.Element, variants: Dict, table: Dict, keys: Tuple) -> Dict:
+    """Read the highest-priority variant child (e.g. ICMS00, PISAliq) of a tax group"""
+    chosen = None
+    chosen_rank = None
+    for child in element:
+        rank = variants.get(child.tag)
+        if rank is not None and (chosen is None or rank < chosen_rank):
+            chosen, chosen_rank = child, rank
+    if chosen is None:
+        return {}
+    return _read_fields(chosen, table, dict.fromkeys(keys))
+
+
+def _read_icms(element: ET.Element) -> Dict:
+    return _read_variant(element, _ICMS_VARIANTS, _ICMS_FIELDS, _ICMS_KEYS)
+
+
+def _read_icms_uf_dest(element: ET.Element) -> Dict:
+    return _read_fields(element, _ICMS_UF_DEST_FIELDS, dict.fromkeys(_ICMS_UF_DEST_KEYS))
+
+
+def _read_ipi(element: ET.Element) -> Dict:
+    out = {'ipi_c_enq': None}
+    ipi_trib = ipi_nt = None
+    for child in element:
+        tag = child.tag
+        if tag == _C_ENQ:
+            out['ipi_c_enq'] = _text(child.text)
+        elif tag == _IPI_TRIB:
+            ipi_trib = child
+        elif tag == _IPI_NT:
+            ipi_nt = child
+    ipi_element = ipi_trib if ipi_trib is not None else ipi_nt
+    if ipi_element is None:
+        return out
+    out.update(dict.fromkeys(_IPI_KEYS))
+    return _read_fields(ipi_element, _IPI_FIELDS, out)
+
+
+def _read_pis(element: ET.Element) -> Dict:
+    return _read_variant(element, _PIS_VARIANTS, _PIS_FIELDS, _PIS_KEYS)
+
+
+def _read_cofins(element: ET.Element) -> Dict:
+    return _read_variant(element, _COFINS_VARIANTS, _COFINS_FIELDS, _COFINS_KEYS)
+
+
+# Tax groups inside <imposto>, merged into the impostos_item row in this order
+_TAX_GROUPS = {
+    Q + 'ICMS': (0, _read_icms),
+    Q + 'ICMSUFDest': (1, _read_icms_uf_dest),
+    Q + 'IPI': (2, _read_ipi),
+    Q + 'PIS': (3, _read_pis),
+    Q + 'COFINS': (4, _read_cofins),
+}
+
+
+def parse_inf_nfe(inf_nfe: ET.Element) -> Tuple[Dict, List[Dict], Optional[Dict], List[Dict]]:
+    """
+    Extract the four ingestion structures from an infNFe element in one walk.
+
+    Used by parse_nfe_xml and by streaming readers that already hold an infNFe
+    element (e.g. one produced by iterparse).
+
+    Returns:
+        Tuple[Dict, List[Dict], Dict, List[Dict]]: (nota_fiscal_data, items_data, impostos_nota, impostos_items)
+    """
+    chave_acesso = inf_nfe.get('Id', '').replace('NFe', '')
+    if not chave_acesso:
+        raise ValueError("Invalid NFe XML: chave de acesso not found")
+
+    ide, emit, dest = {}, {}, {}
+    impostos_nota = None
+    det_elements = []
+
+    for child in inf_nfe:
+        tag = child.tag
+        if tag == _DET:
+            det_elements.append(child)
+        elif tag == _IDE:
+            ide = _read_fields(child, _IDE_FIELDS, {})
+        elif tag == _EMIT:
+            emit = _read_party(child, _EMIT_FIELDS, _ENDER_EMIT, _ENDER_EMIT_FIELDS)
+        elif tag == _DEST:
+            dest = _read_party(child, _DEST_FIELDS, _ENDER_DEST, _ENDER_DEST_FIELDS)
+        elif tag == _TOTAL:
+            icms_tot = child.find(_ICMS_TOT)
+            if icms_tot is not None:
+                impostos_nota = {'chave_acesso_nf': chave_acesso, **dict.fromkeys(_ICMS_TOT_KEYS)}
+                _read_fields(icms_tot, _ICMS_TOT_FIELDS, impostos_nota)
+
+    modelo_code = ide.get('mod')
+    ind_ie_dest = dest.get('indIEDest')
+    id_dest = ide.get('idDest')
+    ind_final = ide.get('indFinal')
+    ind_pres = ide.get('indPres')
+
+    nota_fiscal_data = {
+        'chave_acesso': chave_acesso,
+        'modelo': MODELO_MAP.get(modelo_code, modelo_code),
+        'serie_nf': ide.get('serie'),
+        'numero_nf': ide.get('nNF'),
+        'natureza_operacao': ide.get('natOp'),
+        'data_emissao': parse_nfe_date(ide.get('dhEmi')),
+        'evento_mais_recente': None,  # XML doesn't have this info - comes from eventos externos
+        'data_hora_evento_mais_recente': None,  # XML doesn't have this info
+        'cpf_cnpj_emitente': emit.get('CNPJ') or emit.get('CPF'),
+        'razao_social_emitente': emit.get('xNome'),
+        'inscricao_estadual_emitente': emit.get('IE'),
+        'uf_emitente': emit.get('UF'),
+        'municipio_emitente': emit.get('xMun'),
+        'cnpj_destinatario': dest.get('CNPJ'),
+        'nome_destinatario': dest.get('xNome'),
+        'uf_destinatario': dest.get('UF'),
+        'indicador_ie_destinatario': INDICADOR_IE_MAP.get(ind_ie_dest, ind_ie_dest),
+        'destino_operacao': DESTINO_OPERACAO_MAP.get(id_dest, id_dest),
+        'consumidor_final': CONSUMIDOR_FINAL_MAP.get(ind_final, ind_final),
+        'presenca_comprador': PRESENCA_COMPRADOR_MAP.get(ind_pres, ind_pres),
+        'valor_nota_fiscal': impostos_nota['v_nf'] if impostos_nota else None,
+        'classificacao': None  # Will be set later by classification service
+    }
+
+    item_header = {'chave_acesso_nf': chave_acesso}
+    for key in _ITEM_HEADER_KEYS:
+        item_header[key] = nota_fiscal_data[key]
+    prod_template = dict.fromkeys(_PROD_KEYS)
+
+    items = []
+    impostos_items = []
+
+    for idx, det in enumerate(det_elements, start=1):
+        numero_item = det.get('nItem')
+        prod = imposto = None
+        for child in det:
+            if child.tag == _PROD:
+                prod = child
+            elif child.tag == _IMPOSTO:
+                imposto = child
+
+        if prod is not None:
+            item = dict(item_header)
+            item['numero_produto'] = int(numero_item) if numero_item else None
+            item.update(prod_template)
+            items.append(_read_fields(prod, _PROD_FIELDS, item))
+
+        if imposto is not None:
+            groups = [None, None, None, None, None]
+            item_impostos = {
+                'chave_acesso_nf': chave_acesso,
+                'numero_item': int(numero_item) if numero_item else idx,
+                'v_tot_trib': None
+            }
+            for child in imposto:
+                tag = child.tag
+                if tag == _V_TOT_TRIB:
+                    item_impostos['v_tot_trib'] = _decimal(child.text)
+                else:
+                    group = _TAX_GROUPS.get(tag)
+                    if group is not None:
+                        groups[group[0]] = group[1](child)
+            for group_data in groups:
+                if group_data:
+                    item_impostos.update(group_data)
+            impostos_items.append(item_impostos)
+
+    nota_fiscal_data['content_hash'] = nota_content_hash(nota_fiscal_data, items, impostos_nota, impostos_items)
+    return nota_fiscal_data, items, impostos_nota, impostos_items
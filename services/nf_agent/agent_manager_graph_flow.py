@@ -215,7 +215,7 @@ class AgentManagerGraphFlow:
                 unidade (VARCHAR, 20) - Unidade de medida
                 valor_unitario (DECIMAL, 15,4) - Valor unitário do produto
                 valor_total (DECIMAL, 15,2) - Valor total do item
-                Relacionamentos: itensnotafiscal.chave_acesso_nf é FK para notasfiscais.chave_acesso.
+                Relacionamentos: itensnotafiscal.chave_acesso_nf referencia notasfiscais.chave_acesso. As duas tabelas são particionadas por mês de data_emissao: junte por chave_acesso E data_emissao (itensnotafiscal.data_emissao = notasfiscais.data_emissao) e filtre por período de data_emissao sempre que possível, para que só as partições necessárias sejam lidas.
                 6. Comportamento em Caso de Sucesso:
                 Se a tarefa for BEM SUCEDIDA (query executada, resultados obtidos via ferramenta), você DEVE retornar a seguinte mensagem de confirmação, seguida pelos resultados:
                 "tarefa {agent:"pg_agent", tarefa:"[a tarefa original solicitada]"} concluída."
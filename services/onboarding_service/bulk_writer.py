@@ -0,0 +1,289 @@
+# bulk_writer.py
+"""
+Set-based bulk persistence of classified notas fiscais.
+
+A batch of notas is streamed with COPY (copy_records_to_table) into
+session-private staging tables and then moved into the real tables with one
+INSERT ... SELECT per table, all in a single transaction. Item tax rows are
+attached to their items by joining on (chave_acesso_nf, numero_produto) with
+the ids RETURNING'd by the item insert, so no per-row round trips are needed
+to resolve id_item_nf.
+
+Same approach as load_service/bulk_writer.py (including the partition date
+every row is written with, and the content hash check that skips unchanged
+notas and replaces changed ones); a nota that already exists has its
+classification (and most recent event) updated even when unchanged.
+"""
+from datetime import date, datetime
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import asyncpg
+
+from content_hash import nota_content_hash
+from partitions import ensure_partitions, partition_date
+
+NOTA_COLUMNS = (
+    'chave_acesso', 'modelo', 'serie_nf', 'numero_nf', 'natureza_operacao', 'data_emissao',
+    'evento_mais_recente', 'data_hora_evento_mais_recente', 'cpf_cnpj_emitente', 'razao_social_emitente',
+    'inscricao_estadual_emitente', 'uf_emitente', 'municipio_emitente', 'cnpj_destinatario',
+    'nome_destinatario', 'uf_destinatario', 'indicador_ie_destinatario', 'destino_operacao',
+    'consumidor_final', 'presenca_comprador', 'valor_nota_fiscal', 'classificacao', 'content_hash'
+)
+
+# Item-level fields only; the nota header is read through the itensnotafiscal view
+ITEM_COLUMNS = (
+    'chave_acesso_nf', 'data_emissao', 'numero_produto', 'descricao_produto', 'codigo_ncm_sh',
+    'ncm_sh_tipo_produto', 'cfop', 'quantidade', 'unidade', 'valor_unitario', 'valor_total'
+)
+
+IMPOSTOS_NOTA_COLUMNS = (
+    'chave_acesso_nf', 'v_bc_icms', 'v_icms', 'v_icms_deson', 'v_fcp_uf_dest', 'v_icms_uf_dest',
+    'v_icms_uf_remet', 'v_bc_st', 'v_st', 'v_ipi', 'v_ipi_devol', 'v_pis', 'v_cofins', 'v_ii',
+    'v_tot_trib', 'v_prod', 'v_frete', 'v_seg', 'v_desc', 'v_outro', 'v_nf'
+)
+
+# Everything but id_item_nf, which is resolved in the database
+IMPOSTOS_ITEM_COLUMNS = (
+    'chave_acesso_nf', 'data_emissao', 'numero_item', 'v_tot_trib',
+    'icms_orig', 'icms_cst', 'icms_mod_bc', 'icms_v_bc', 'icms_p_icms', 'icms_v_icms',
+    'icms_uf_v_bc_uf_dest', 'icms_uf_v_bc_fcp_uf_dest', 'icms_uf_p_fcp_uf_dest',
+    'icms_uf_p_icms_uf_dest', 'icms_uf_p_icms_inter', 'icms_uf_p_icms_inter_part',
+    'icms_uf_v_fcp_uf_dest', 'icms_uf_v_icms_uf_dest', 'icms_uf_v_icms_uf_remet',
+    'ipi_c_enq', 'ipi_cst', 'ipi_v_bc', 'ipi_p_ipi', 'ipi_v_ipi',
+    'pis_cst', 'pis_v_bc', 'pis_p_pis', 'pis_v_pis',
+    'cofins_cst', 'cofins_v_bc', 'cofins_p_cofins', 'cofins_v_cofins'
+)
+
+# staging table -> (target table, columns)
+STAGING_TABLES = {
+    'stg_notasfiscais': ('notasfiscais', NOTA_COLUMNS),
+    'stg_itens_nota': ('itens_nota', ITEM_COLUMNS),
+    'stg_impostos_nota_fiscal': ('impostos_nota_fiscal', IMPOSTOS_NOTA_COLUMNS),
+    'stg_impostos_item': ('impostos_item', IMPOSTOS_ITEM_COLUMNS),
+}
+
+
+def _cols(columns: Sequence[str], prefix: str = '') -> str:
+    return ', '.join(prefix + column for column in columns)
+
+
+# Temporary tables are never WAL-logged and are private to the session, so
+# concurrent writers never see each other's staged rows; ON COMMIT DELETE ROWS
+# empties them at the end of every batch transaction.
+CREATE_STAGING_SQL = '\n'.join(
+    f"CREATE TEMP TABLE IF NOT EXISTS {staging} ON COMMIT DELETE ROWS AS "
+    f"SELECT {_cols(columns)} FROM {target} WITH NO DATA;"
+    for staging, (target, columns) in STAGING_TABLES.items()
+)
+
+# Staged notas that are already stored: an unchanged one (same content hash)
+# has its staged items and taxes dropped, a changed one has all of its stored
+# items and item taxes deleted, so the staged ones replace them. A nota is
+# staged whole: its items are grouped by chave over the whole upload and the
+# repeated groups of a batch are merged before hashing (merge_repeated_notas)
+RECONCILE_STORED_SQL = """
+WITH stored AS (
+    SELECT s.chave_acesso, s.data_emissao, COALESCE(n.content_hash = s.content_hash, false) AS unchanged
+    FROM stg_notasfiscais s
+    JOIN notasfiscais n ON n.chave_acesso = s.chave_acesso AND n.data_emissao = s.data_emissao
+),
+staged_itens AS (
+    DELETE FROM stg_itens_nota t USING stored
+    WHERE stored.unchanged AND t.chave_acesso_nf = stored.chave_acesso
+),
+staged_impostos_item AS (
+    DELETE FROM stg_impostos_item t USING stored
+    WHERE stored.unchanged AND t.chave_acesso_nf = stored.chave_acesso
+),
+staged_impostos_nota AS (
+    DELETE FROM stg_impostos_nota_fiscal t USING stored
+    WHERE stored.unchanged AND t.chave_acesso_nf = stored.chave_acesso
+),
+stored_itens AS (
+    DELETE FROM itens_nota t USING stored
+    WHERE NOT stored.unchanged AND t.chave_acesso_nf = stored.chave_acesso AND t.data_emissao = stored.data_emissao
+),
+stored_impostos_item AS (
+    DELETE FROM impostos_item t USING stored
+    WHERE NOT stored.unchanged AND t.chave_acesso_nf = stored.chave_acesso AND t.data_emissao = stored.data_emissao
+)
+SELECT count(*) FILTER (WHERE unchanged) AS unchanged, count(*) FILTER (WHERE NOT unchanged) AS replaced
+FROM stored;
+"""
+
+# The header of an unchanged nota is the same, so every column can be overwritten
+INSERT_NOTAS_SQL = f"""
+INSERT INTO notasfiscais ({_cols(NOTA_COLUMNS)})
+SELECT {_cols(NOTA_COLUMNS)} FROM stg_notasfiscais
+ON CONFLICT (chave_acesso, data_emissao) DO UPDATE SET
+    {', '.join(f'{column} = EXCLUDED.{column}' for column in NOTA_COLUMNS
+               if column not in ('chave_acesso', 'data_emissao'))};
+"""
+
+INSERT_IMPOSTOS_NOTA_SQL = f"""
+INSERT INTO impostos_nota_fiscal ({_cols(IMPOSTOS_NOTA_COLUMNS)})
+SELECT {_cols(IMPOSTOS_NOTA_COLUMNS)} FROM stg_impostos_nota_fiscal
+ON CONFLICT (chave_acesso_nf) DO UPDATE SET
+    {', '.join(f'{column} = EXCLUDED.{column}' for column in IMPOSTOS_NOTA_COLUMNS[1:])};
+"""
+
+INSERT_ITENS_AND_IMPOSTOS_SQL = f"""
+WITH inserted AS (
+    INSERT INTO itens_nota ({_cols(ITEM_COLUMNS)})
+    SELECT {_cols(ITEM_COLUMNS)} FROM stg_itens_nota
+    ON CONFLICT DO NOTHING
+    RETURNING id_item_nf, chave_acesso_nf, numero_produto
+)
+INSERT INTO impostos_item (id_item_nf, {_cols(IMPOSTOS_ITEM_COLUMNS)})
+SELECT i.id_item_nf, {_cols(IMPOSTOS_ITEM_COLUMNS, 's.')}
+FROM stg_impostos_item s
+JOIN inserted i ON i.chave_acesso_nf = s.chave_acesso_nf AND i.numero_produto = s.numero_item
+ON CONFLICT DO NOTHING;
+"""
+
+_DATE_COLUMNS = {'data_emissao'}
+_DATETIME_COLUMNS = {'data_hora_evento_mais_recente'}
+
+
+def _as_date(value) -> Optional[date]:
+    """Dates arrive as ISO strings once a nota has been through a JSON message"""
+    if value is None or isinstance(value, date):
+        return value.date() if isinstance(value, datetime) else value
+    try:
+        return datetime.fromisoformat(value).date()
+    except (TypeError, ValueError):
+        return None
+
+
+def _as_datetime(value) -> Optional[datetime]:
+    if value is None or isinstance(value, datetime):
+        return value
+    try:
+        return datetime.fromisoformat(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _record(data: Dict, columns: Sequence[str], data_emissao: Optional[date] = None) -> tuple:
+    """COPY record of `data`; `data_emissao` (the nota's partition date) replaces the row's own"""
+    record = []
+    for column in columns:
+        value = data.get(column)
+        if column == 'data_emissao' and data_emissao is not None:
+            value = data_emissao
+        elif column in _DATE_COLUMNS:
+            value = _as_date(value)
+        elif column in _DATETIME_COLUMNS:
+            value = _as_datetime(value)
+        record.append(value)
+    return tuple(record)
+
+
+# Header columns two occurrences of a nota in one batch must agree on to be merged
+_MERGE_COLUMNS = tuple(column for column in NOTA_COLUMNS if column not in ('classificacao', 'content_hash'))
+
+
+def _keyed(rows: Optional[Sequence[Dict]], key: str, into: Dict) -> Dict:
+    for row in rows or []:
+        into[row.get(key) if row.get(key) is not None else ('row', len(into))] = row
+    return into
+
+
+def merge_repeated_notas(notas: Sequence[Tuple]) -> List[Tuple]:
+    """
+    One (nota_fiscal_data, items_data, impostos_nota, impostos_items) tuple per chave.
+
+    The occurrences of a chave whose header fields agree are merged: their
+    items (by numero_produto) and item taxes (by numero_item) are concatenated,
+    the later one winning for the same number, so a nota split across groups
+    keeps all of its items and a redelivered message is not staged twice. A
+    merged nota gets its content hash computed over all of its items. An
+    occurrence with a different header is a newer version of the nota and
+    replaces the earlier ones.
+    """
+    merged = {}  # chave -> [nota_fiscal_data, items, impostos_nota, impostos_items, repeated]
+    for nota in notas:
+        nota_fiscal_data, items_data, *impostos = nota
+        if not nota_fiscal_data or not nota_fiscal_data.get('chave_acesso'):
+            continue
+        impostos_nota, impostos_items = (list(impostos) + [None, None])[:2]
+        entry = merged.get(nota_fiscal_data['chave_acesso'])
+        if entry is not None and _record(entry[0], _MERGE_COLUMNS) == _record(nota_fiscal_data, _MERGE_COLUMNS):
+            entry[0] = nota_fiscal_data
+            _keyed(items_data, 'numero_produto', entry[1])
+            entry[2] = impostos_nota or entry[2]
+            _keyed(impostos_items, 'numero_item', entry[3])
+            entry[4] = True
+        else:
+            merged[nota_fiscal_data['chave_acesso']] = [
+                nota_fiscal_data, _keyed(items_data, 'numero_produto', {}), impostos_nota,
+                _keyed(impostos_items, 'numero_item', {}), False
+            ]
+
+    result = []
+    for nota_fiscal_data, items, impostos_nota, impostos_items, repeated in merged.values():
+        items_data, impostos_items = list(items.values()), list(impostos_items.values()) or None
+        if repeated or not nota_fiscal_data.get('content_hash'):
+            nota_fiscal_data = {**nota_fiscal_data, 'content_hash': nota_content_hash(
+                nota_fiscal_data, items_data, impostos_nota, impostos_items)}
+        result.append((nota_fiscal_data, items_data, impostos_nota, impostos_items))
+    return result
+
+
+def build_staging_records(notas: Sequence[Tuple]) -> Dict[str, List[tuple]]:
+    """
+    Turn (nota_fiscal_data, items_data, impostos_nota, impostos_items) tuples into
+    COPY records per staging table.
+
+    A nota repeated in the same batch (a redelivered message, or its items
+    split in several groups) is staged once with all of its items
+    (merge_repeated_notas). Notas without a content hash (published before it
+    existed) get it computed here.
+    """
+    records = {staging: [] for staging in STAGING_TABLES}
+    for nota_fiscal_data, items_data, impostos_nota, impostos_items in merge_repeated_notas(notas):
+        data_emissao = partition_date(nota_fiscal_data['chave_acesso'],
+                                      _as_date(nota_fiscal_data.get('data_emissao')))
+        records['stg_notasfiscais'].append(_record(nota_fiscal_data, NOTA_COLUMNS, data_emissao))
+        if impostos_nota and impostos_nota.get('chave_acesso_nf'):
+            records['stg_impostos_nota_fiscal'].append(_record(impostos_nota, IMPOSTOS_NOTA_COLUMNS))
+        for item in items_data or []:
+            records['stg_itens_nota'].append(_record(item, ITEM_COLUMNS, data_emissao))
+        for imposto_item in impostos_items or []:
+            records['stg_impostos_item'].append(_record(imposto_item, IMPOSTOS_ITEM_COLUMNS, data_emissao))
+    return records
+
+
+async def write_notas_batch(conn: asyncpg.Connection, notas: Sequence[Tuple]) -> Dict[str, int]:
+    """
+    Persist a batch of notas fiscais in a single transaction.
+
+    Args:
+        conn: Open connection (not inside a transaction)
+        notas: (nota_fiscal_data, items_data[, impostos_nota, impostos_items]) tuples
+
+    Returns:
+        Dict with the number of staged rows per target table, plus the number
+        of notas already stored 'unchanged' (not written) and 'replaced'
+    """
+    records = build_staging_records(notas)
+    if not records['stg_notasfiscais']:
+        return {**{target: 0 for target, _columns in STAGING_TABLES.values()}, 'unchanged': 0, 'replaced': 0}
+
+    await ensure_partitions(conn, {record[NOTA_COLUMNS.index('data_emissao')]
+                                   for record in records['stg_notasfiscais']})
+    await conn.execute(CREATE_STAGING_SQL)
+    async with conn.transaction():
+        for staging, (_target, columns) in STAGING_TABLES.items():
+            if records[staging]:
+                await conn.copy_records_to_table(staging, records=records[staging], columns=columns)
+
+        stored = await conn.fetchrow(RECONCILE_STORED_SQL)
+        await conn.execute(INSERT_NOTAS_SQL)
+        if records['stg_impostos_nota_fiscal']:
+            await conn.execute(INSERT_IMPOSTOS_NOTA_SQL)
+        if records['stg_itens_nota']:
+            await conn.execute(INSERT_ITENS_AND_IMPOSTOS_SQL)
+
+    counts = {target: len(records[staging]) for staging, (target, _columns) in STAGING_TABLES.items()}
+    return {**counts, 'unchanged': stored['unchanged'], 'replaced': stored['replaced']}
@@ -19,10 +19,41 @@ RABBITMQ_PASS = os.getenv('RABBITMQ_PASS', 'admin')
 RABBITMQ_QUEUE = os.getenv('RABBITMQ_QUEUE', 'notas_fiscais')
 RABBITMQ_DLQ = os.getenv('RABBITMQ_DLQ', 'notas_fiscais_dlq')
 RABBITMQ_MAX_RETRIES = int(os.getenv('RABBITMQ_MAX_RETRIES', '3'))
+RABBITMQ_RETRY_BASE_DELAY = float(os.getenv('RABBITMQ_RETRY_BASE_DELAY', '5'))  # seconds before the first retry, doubled for each next one
+RABBITMQ_RETRY_MAX_DELAY = float(os.getenv('RABBITMQ_RETRY_MAX_DELAY', '300'))  # upper bound of a retry delay, seconds
+RABBITMQ_RETRY_JITTER = float(os.getenv('RABBITMQ_RETRY_JITTER', '0.2'))  # +/- fraction of the delay, at random
+
+# DLQ inspection and replay (dlq_replay.py)
+REPLAY_DLQ = RABBITMQ_DLQ
+REPLAY_QUEUE = RABBITMQ_QUEUE
+DLQ_REPLAY_RATE = float(os.getenv('DLQ_REPLAY_RATE', '20'))  # replayed messages per second, by default
+DLQ_REPLAY_BATCH_SIZE = int(os.getenv('DLQ_REPLAY_BATCH_SIZE', '100'))  # messages published and confirmed together
+DLQ_REPLAY_MAX_QUEUE_DEPTH = int(os.getenv('DLQ_REPLAY_MAX_QUEUE_DEPTH', '1000'))  # the replay waits while the queue holds more
+DLQ_SCAN_LIMIT = int(os.getenv('DLQ_SCAN_LIMIT', '10000'))  # messages an inspection reads at most
 
 # Service configuration
 SERVICE_PORT = int(os.getenv('SERVICE_PORT', '8001'))
 
 # Classification service configuration
 CLASSIFICATION_SERVICE_URL = os.getenv('CLASSIFICATION_SERVICE_URL', 'http://localhost:5678/webhook-test/nf-input')
+CLASSIFICATION_TIMEOUT = float(os.getenv('CLASSIFICATION_TIMEOUT', '30'))  # seconds per classification call
+CLASSIFICATION_CONCURRENCY = int(os.getenv('CLASSIFICATION_CONCURRENCY', '8'))  # calls in flight per batch
+CLASSIFICATION_BATCH_TIMEOUT = float(os.getenv('CLASSIFICATION_BATCH_TIMEOUT', '90'))  # deadline to classify a whole batch, seconds
+
+
+# Consumer micro-batching (classified notas are saved in one transaction per batch)
+CONSUMER_PREFETCH = int(os.getenv('CONSUMER_PREFETCH', '100'))  # unacked deliveries the broker sends ahead
+CONSUMER_BATCH_SIZE = int(os.getenv('CONSUMER_BATCH_SIZE', '50'))  # messages per batch
+CONSUMER_BATCH_LINGER_MS = float(os.getenv('CONSUMER_BATCH_LINGER_MS', '200'))  # max wait before flushing a partial batch
+CONSUMER_BISECT_POLICY = os.getenv('CONSUMER_BISECT_POLICY', 'bisect')  # failed batch isolation: bisect, single or none
+CONSUMER_METRICS_INTERVAL = float(os.getenv('CONSUMER_METRICS_INTERVAL', '60'))  # seconds between batch metrics log lines
+
+# Database connection pool (db_pool.py)
+DB_POOL_MIN_SIZE = int(os.getenv('DB_POOL_MIN_SIZE', '2'))  # connections kept open
+DB_POOL_MAX_SIZE = int(os.getenv('DB_POOL_MAX_SIZE', '10'))  # upper bound on open connections
+DB_STATEMENT_CACHE_SIZE = int(os.getenv('DB_STATEMENT_CACHE_SIZE', '100'))  # prepared statements per connection; 0 behind pgbouncer
+DB_COMMAND_TIMEOUT = float(os.getenv('DB_COMMAND_TIMEOUT', '30'))  # default per-query timeout, seconds
+DB_POOL_ACQUIRE_TIMEOUT = float(os.getenv('DB_POOL_ACQUIRE_TIMEOUT', '10'))  # max wait for a free connection, seconds
 
+# Monthly partitions of notasfiscais/itens_nota/impostos_item (partitions.py)
+PARTITION_MONTHS_AHEAD = int(os.getenv('PARTITION_MONTHS_AHEAD', '3'))  # months created ahead of the current one
@@ -0,0 +1,509 @@
+# dlq_replay.py
+"""
+Inspection and throttled replay of the dead-letter queue of a worker.
+
+Messages sent to the DLQ (rabbitmq_worker.send_to_dlq) carry why they died
+and their retry state in headers (retry_queues.py). Each one is put in a
+group: its x-death-reason without the error message, e.g.
+"Max retries exceeded - ConnectionError".
+
+inspect() reads up to DLQ_SCAN_LIMIT messages without removing any. They are
+fetched one at a time (basic_get), so only the message being counted is held
+in memory, and left unacked: they go back to their place when the channel
+closes. It counts them per group and returns one page of them.
+
+A replay (start(), in a background thread) moves the messages of the selected
+groups back to their queue (x-original-queue, else REPLAY_QUEUE). It goes
+DLQ_REPLAY_BATCH_SIZE messages at a time through the confirming publisher
+(rabbitmq_publisher.py):
+
+- at most `rate` messages per second, and none while the queue already holds
+  DLQ_REPLAY_MAX_QUEUE_DEPTH ready messages. Draining a large DLQ does not
+  flood the workers, n8n or PostgreSQL;
+- the retry headers are reset, so a replayed message gets the whole retry
+  budget again. x-replayed-from and x-replayed-at mark it;
+- a DLQ message is acked once the broker confirmed its copy (at least once).
+  When the replay stops halfway, the messages not yet confirmed stay in the
+  DLQ.
+
+Messages of the other groups are moved to the tail of the DLQ unchanged, so
+they never fill the consumer window. One pass visits once each message that
+was in the DLQ when it started. The replay is an exclusive consumer of the
+DLQ: while it runs, other replays and inspections of that DLQ are refused
+(ReplayBusy).
+
+Usage:
+    python dlq_replay.py inspect [--offset 0] [--limit 20]
+    python dlq_replay.py replay --group "Max retries exceeded - ConnectionError" [--rate 20] [--max 1000]
+    python dlq_replay.py replay --all
+"""
+import argparse
+import json
+import logging
+import math
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from datetime import datetime
+from typing import Dict, List, Optional
+
+import pika
+from pika.exceptions import ChannelClosedByBroker
+
+from config import (
+    RABBITMQ_HOST, RABBITMQ_PORT, RABBITMQ_USER, RABBITMQ_PASS, REPLAY_DLQ, REPLAY_QUEUE,
+    DLQ_REPLAY_RATE, DLQ_REPLAY_BATCH_SIZE, DLQ_REPLAY_MAX_QUEUE_DEPTH, DLQ_SCAN_LIMIT
+)
+from rabbitmq_publisher import ConfirmingPublisher
+
+logger = logging.getLogger(__name__)
+
+UNKNOWN_GROUP = 'unknown'
+MAX_GROUP_LENGTH = 200
+IDLE_TIMEOUT = 5.0  # seconds without deliveries before a replay takes the DLQ as drained
+CONFIRM_TIMEOUT = 30.0  # seconds to wait for the broker confirms of a batch
+BACKLOG_POLL = 2.0  # seconds between queue depth checks while the queue is full
+JOBS_KEPT = 20  # finished replays kept for GET
+
+STATUS_RUNNING = "running"
+STATUS_COMPLETED = "completed"
+STATUS_STOPPED = "stopped"
+STATUS_FAILED = "failed"
+
+
+class ReplayBusy(Exception):
+    """A replay is consuming the DLQ"""
+
+
+def death_group(reason) -> str:
+    """Group of a dead message: its x-death-reason up to the error message"""
+    if isinstance(reason, bytes):
+        reason = reason.decode('utf-8', 'replace')
+    if not reason:
+        return UNKNOWN_GROUP
+    return str(reason).split(': ', 1)[0][:MAX_GROUP_LENGTH]
+
+
+def _headers(properties) -> Dict:
+    return getattr(properties, 'headers', None) or {}
+
+
+def _chave_acesso(body) -> Optional[str]:
+    try:
+        data = json.loads(body)
+        return (data.get('nota_fiscal') or {}).get('chave_acesso') or data.get('chave_acesso')
+    except Exception:
+        return None
+
+
+def describe_message(position: int, properties, body) -> Dict:
+    headers = _headers(properties)
+    return {
+        "position": position,
+        "group": death_group(headers.get('x-death-reason')),
+        "reason": headers.get('x-death-reason'),
+        "chave_acesso": _chave_acesso(body),
+        "original_queue": headers.get('x-original-queue'),
+        "retry_count": headers.get('x-retry-count'),
+        "first_failure_at": headers.get('x-first-failure-at'),
+        "last_error": headers.get('x-last-error'),
+        "replayed_at": headers.get('x-replayed-at'),
+        "size": len(body),
+    }
+
+
+def get_connection_parameters() -> pika.ConnectionParameters:
+    return pika.ConnectionParameters(
+        host=RABBITMQ_HOST,
+        port=RABBITMQ_PORT,
+        credentials=pika.PlainCredentials(RABBITMQ_USER, RABBITMQ_PASS),
+        heartbeat=600,
+        blocked_connection_timeout=300
+    )
+
+
+class ReplayJob:
+    """Progress of one replay"""
+
+    def __init__(self, dlq: str, groups: Optional[List[str]], rate: float, max_messages: Optional[int]):
+        self.replay_id = uuid.uuid4().hex
+        self.dlq = dlq
+        self.groups = set(groups) if groups is not None else None
+        self.rate = rate
+        self.max_messages = max_messages
+        self.status = STATUS_RUNNING
+        self.error = None
+        self.exception: Optional[Exception] = None
+        self.started_at = datetime.now().isoformat()
+        self.finished_at = None
+        self.total = None  # messages in the DLQ when the replay started
+        self.visited = 0
+        self.replayed = 0
+        self.kept = 0
+        self.backlog_wait_s = 0.0
+        self.replayed_by_group: Dict[str, int] = {}
+        self.stop_requested = threading.Event()
+        self.consuming = threading.Event()  # set once the DLQ consumer is registered, or the replay failed before
+        self._started = time.monotonic()
+        self._elapsed = None
+
+    def finish(self, status: str, error: Optional[Exception] = None):
+        self.status = status
+        if error is not None:
+            self.error = str(error)
+            self.exception = error
+        self.finished_at = datetime.now().isoformat()
+        self._elapsed = time.monotonic() - self._started
+        self.consuming.set()
+
+    def selects(self, group: str) -> bool:
+        return self.groups is None or group in self.groups
+
+    def to_dict(self) -> Dict:
+        elapsed = self._elapsed if self._elapsed is not None else time.monotonic() - self._started
+        return {
+            "replay_id": self.replay_id,
+            "dlq": self.dlq,
+            "groups": sorted(self.groups) if self.groups is not None else None,
+            "rate": self.rate,
+            "max_messages": self.max_messages,
+            "status": self.status,
+            "error": self.error,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "total": self.total,
+            "visited": self.visited,
+            "replayed": self.replayed,
+            "kept": self.kept,
+            "replayed_by_group": self.replayed_by_group,
+            "backlog_wait_s": round(self.backlog_wait_s, 1),
+            "elapsed_s": round(elapsed, 1),
+            "replayed_per_s": round(self.replayed / elapsed, 2) if elapsed > 0 else 0.0,
+        }
+
+
+class DLQReplayer:
+    """
+    Args:
+        dlq: Dead-letter queue inspected and replayed
+        queue: Queue of the messages without x-original-queue; its depth throttles the replay
+        rate: Default replayed messages per second
+        batch_size: Messages published and confirmed together
+        max_queue_depth: Ready messages in `queue` above which the replay waits
+    """
+
+    def __init__(self, dlq: str = REPLAY_DLQ, queue: str = REPLAY_QUEUE, rate: float = DLQ_REPLAY_RATE,
+                 batch_size: int = DLQ_REPLAY_BATCH_SIZE, max_queue_depth: int = DLQ_REPLAY_MAX_QUEUE_DEPTH,
+                 parameters: Optional[pika.ConnectionParameters] = None):
+        self.dlq = dlq
+        self.queue = queue
+        self.rate = rate
+        self.batch_size = max(1, batch_size)
+        self.max_queue_depth = max_queue_depth
+        self.parameters = parameters or get_connection_parameters()
+        self._jobs: "OrderedDict[str, ReplayJob]" = OrderedDict()
+        self._threads: Dict[str, threading.Thread] = {}
+        self._lock = threading.Lock()
+
+    def _declare(self, channel):
+        """Declare the DLQ and the queue as the workers do; Queue.DeclareOk of the DLQ (message and consumer counts)"""
+        channel.queue_declare(queue=self.queue, durable=True)
+        return channel.queue_declare(queue=self.dlq, durable=True).method
+
+    # ------------------------------------------------------------------
+    # Inspection
+    # ------------------------------------------------------------------
+
+    def inspect(self, offset: int = 0, limit: int = 20, scan_limit: int = DLQ_SCAN_LIMIT) -> Dict:
+        """
+        Count the DLQ messages per group and describe one page of them
+
+        Raises:
+            ReplayBusy: A replay is consuming the DLQ
+        """
+        offset, limit = max(0, offset), max(0, limit)
+        connection = pika.BlockingConnection(self.parameters)
+        try:
+            channel = connection.channel()
+            declared = self._declare(channel)
+            if declared.consumer_count:
+                # Only replays consume a DLQ; basic_get would take its messages from under it
+                raise ReplayBusy(f"A replay is consuming '{self.dlq}'")
+            total = declared.message_count
+            to_scan = min(total, scan_limit)
+            groups: Dict[str, Dict] = {}
+            page = []
+            scanned = 0
+            while scanned < to_scan:
+                method, properties, body = channel.basic_get(self.dlq, auto_ack=False)
+                if method is None:
+                    break
+                headers = _headers(properties)
+                reason = headers.get('x-death-reason')
+                group = groups.setdefault(death_group(reason), {
+                    "group": death_group(reason), "count": 0, "example_reason": reason,
+                    "oldest_failure_at": None, "size": 0
+                })
+                group["count"] += 1
+                group["size"] += len(body)
+                first_failure = headers.get('x-first-failure-at')
+                if first_failure and (group["oldest_failure_at"] is None
+                                      or first_failure < group["oldest_failure_at"]):
+                    group["oldest_failure_at"] = first_failure
+                if offset <= scanned < offset + limit:
+                    page.append(describe_message(scanned, properties, body))
+                scanned += 1
+            # Nothing was acked: every message goes back to its place when the connection closes
+        finally:
+            if connection.is_open:
+                connection.close()
+        return {
+            "dlq": self.dlq,
+            "queue": self.queue,
+            "messages": total,
+            "scanned": scanned,
+            "complete": scanned >= total,
+            "groups": sorted(groups.values(), key=lambda group: -group["count"]),
+            "offset": offset,
+            "limit": limit,
+            "page": page,
+        }
+
+    # ------------------------------------------------------------------
+    # Replay
+    # ------------------------------------------------------------------
+
+    def start(self, groups: Optional[List[str]] = None, all_groups: bool = False, rate: Optional[float] = None,
+              max_messages: Optional[int] = None) -> Dict:
+        """
+        Start replaying the DLQ in a background thread
+
+        Args:
+            groups: Groups replayed (see inspect()); or
+            all_groups: Replay every message
+            rate: Messages per second (default DLQ_REPLAY_RATE)
+            max_messages: Stop after replaying this many
+
+        Raises:
+            ValueError: No group selected, or an invalid rate / max_messages
+            ReplayBusy: A replay is consuming the DLQ
+        """
+        job = self._new_job(groups, all_groups, rate, max_messages)
+        thread = threading.Thread(target=self.run, args=(job,), name=f"dlq-replay-{job.replay_id[:8]}", daemon=True)
+        with self._lock:
+            self._threads[job.replay_id] = thread
+        thread.start()
+        # Wait for the exclusive consumer, so a busy DLQ is reported to the caller
+        job.consuming.wait()
+        if isinstance(job.exception, ReplayBusy):
+            raise job.exception
+        return job.to_dict()
+
+    def _new_job(self, groups, all_groups, rate, max_messages) -> ReplayJob:
+        groups = [group for group in (groups or []) if group]
+        if not groups and not all_groups:
+            raise ValueError("Select the groups to replay, or all of them")
+        rate = self.rate if rate is None else rate
+        if rate <= 0:
+            raise ValueError("rate must be positive")
+        if max_messages is not None and max_messages <= 0:
+            raise ValueError("max_messages must be positive")
+        job = ReplayJob(self.dlq, None if all_groups else groups, rate, max_messages)
+        with self._lock:
+            self._jobs[job.replay_id] = job
+            finished = [replay_id for replay_id, other in self._jobs.items() if other.status != STATUS_RUNNING]
+            for replay_id in finished[:max(0, len(self._jobs) - JOBS_KEPT)]:
+                del self._jobs[replay_id]
+        return job
+
+    def get(self, replay_id: str) -> Optional[Dict]:
+        job = self._jobs.get(replay_id)
+        return job.to_dict() if job else None
+
+    def stop(self, replay_id: str) -> Optional[Dict]:
+        """Ask a replay to stop after its current batch"""
+        job = self._jobs.get(replay_id)
+        if job is None:
+            return None
+        job.stop_requested.set()
+        return job.to_dict()
+
+    def close(self, timeout: float = 10.0):
+        """Stop the running replays (shutdown hook)"""
+        for job in list(self._jobs.values()):
+            job.stop_requested.set()
+        for thread in list(self._threads.values()):
+            thread.join(timeout)
+
+    def metrics(self) -> Dict:
+        running = [job.to_dict() for job in self._jobs.values() if job.status == STATUS_RUNNING]
+        return {"dlq": self.dlq, "running": running}
+
+    def run(self, job: ReplayJob):
+        """Replay the DLQ in this thread"""
+        connection = publisher = None
+        try:
+            connection = pika.BlockingConnection(self.parameters)
+            channel = connection.channel()
+            job.total = self._declare(channel).message_count
+            batch_size = max(1, min(self.batch_size, math.ceil(job.rate)))
+            channel.basic_qos(prefetch_count=batch_size)
+            received = []
+            try:
+                channel.basic_consume(self.dlq, lambda _ch, method, properties, body:
+                                      received.append((method, properties, body)), exclusive=True)
+            except ChannelClosedByBroker as e:
+                if e.reply_code == 403:
+                    raise ReplayBusy(f"A replay is already consuming '{self.dlq}'") from e
+                raise
+            job.consuming.set()
+            logger.info(f"♻️  Replaying {job.total} messages of '{self.dlq}' "
+                        f"(groups: {sorted(job.groups) if job.groups is not None else 'all'}, {job.rate:g}/s)")
+
+            publisher = ConfirmingPublisher(self.parameters, channels=1, max_in_flight=2 * batch_size)
+            next_send = time.monotonic()
+            while job.visited < job.total and not job.stop_requested.is_set():
+                if job.max_messages is not None and job.replayed >= job.max_messages:
+                    break
+                batch = self._next_batch(connection, received, min(batch_size, job.total - job.visited), job)
+                if not batch:
+                    break  # the DLQ was emptied meanwhile
+                replay, keep = [], []
+                for delivery in batch:
+                    group = death_group(_headers(delivery[1]).get('x-death-reason'))
+                    room = job.max_messages is None or job.replayed + len(replay) < job.max_messages
+                    (replay if job.selects(group) and room else keep).append((group, delivery))
+                if replay:
+                    self._wait_for_queue(connection, channel, job)
+                    wait = next_send - time.monotonic()
+                    if wait > 0:
+                        connection.sleep(wait)
+                    next_send = max(next_send, time.monotonic()) + len(replay) / job.rate
+                self._move(channel, publisher, job, replay, keep)
+
+            job.finish(STATUS_STOPPED if job.stop_requested.is_set() else STATUS_COMPLETED)
+        except Exception as e:
+            if not isinstance(e, ReplayBusy):
+                logger.error(f"DLQ replay {job.replay_id} failed: {e}", exc_info=True)
+            job.finish(STATUS_FAILED, e)
+        finally:
+            if publisher is not None:
+                publisher.close()
+            # Deliveries not acked (unconfirmed, or past the end of the pass) go back to the DLQ
+            if connection is not None and connection.is_open:
+                connection.close()
+            with self._lock:
+                self._threads.pop(job.replay_id, None)
+        logger.info(f"♻️  DLQ replay {job.replay_id} {job.status}: {job.replayed} replayed, "
+                    f"{job.kept} kept of {job.visited} visited")
+
+    def _next_batch(self, connection, received: list, size: int, job: ReplayJob) -> list:
+        deadline = time.monotonic() + IDLE_TIMEOUT
+        while len(received) < size and time.monotonic() < deadline and not job.stop_requested.is_set():
+            connection.process_data_events(time_limit=0.1)
+        batch = received[:size]
+        del received[:size]
+        return batch
+
+    def _wait_for_queue(self, connection, channel, job: ReplayJob):
+        """Wait while the queue holds max_queue_depth ready messages"""
+        while not job.stop_requested.is_set():
+            depth = channel.queue_declare(queue=self.queue, durable=True).method.message_count
+            if depth < self.max_queue_depth:
+                return
+            connection.sleep(BACKLOG_POLL)
+            job.backlog_wait_s += BACKLOG_POLL
+
+    def _move(self, channel, publisher: ConfirmingPublisher, job: ReplayJob, replay: list, keep: list):
+        """Publish the batch (replayed: to their queue, kept: to the DLQ tail), then ack what was confirmed"""
+        # Kept messages keep their properties; they are confirmed while the replayed ones are
+        kept = [publisher.publish(self.dlq, body, properties) for _group, (_method, properties, body) in keep]
+        replayed = publisher.publish_many(
+            ((_headers(properties).get('x-original-queue') or self.queue, body)
+             for _group, (_method, properties, body) in replay),
+            pika.BasicProperties(
+                content_type='application/json',
+                delivery_mode=pika.DeliveryMode.Persistent,
+                headers={'x-replayed-from': self.dlq, 'x-replayed-at': int(time.time())}
+            ),
+            timeout=CONFIRM_TIMEOUT
+        )
+        deadline = time.monotonic() + CONFIRM_TIMEOUT
+        kept = [self._confirmed(future, deadline) for future in kept]
+
+        unconfirmed = 0
+        for (group, (method, _properties, _body)), confirmed in zip(replay, replayed):
+            job.visited += 1
+            if confirmed:
+                channel.basic_ack(method.delivery_tag)
+                job.replayed += 1
+                job.replayed_by_group[group] = job.replayed_by_group.get(group, 0) + 1
+            else:
+                unconfirmed += 1
+        for (_group, (method, _properties, _body)), confirmed in zip(keep, kept):
+            job.visited += 1
+            if confirmed:
+                channel.basic_ack(method.delivery_tag)
+                job.kept += 1
+            else:
+                unconfirmed += 1
+        if unconfirmed:
+            # Left unacked, they go back to the DLQ when the connection closes
+            raise RuntimeError(f"RabbitMQ did not confirm {unconfirmed} messages; replay stopped")
+
+    @staticmethod
+    def _confirmed(future, deadline: float) -> bool:
+        try:
+            return future.result(max(0.0, deadline - time.monotonic()))
+        except Exception:
+            return False
+
+
+def _print_inspection(result: Dict):
+    print(f"{result['dlq']}: {result['messages']} messages, {result['scanned']} scanned")
+    for group in result["groups"]:
+        print(f"{group['count']:>8}  {group['group']}")
+    for message in result["page"]:
+        print(f"  #{message['position']:<6} {message['chave_acesso'] or '-':<44} "
+              f"retries={message['retry_count']}  {message['reason']}")
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--dlq', default=REPLAY_DLQ, help="dead-letter queue")
+    parser.add_argument('--queue', default=REPLAY_QUEUE, help="queue of the messages without x-original-queue")
+    commands = parser.add_subparsers(dest='command', required=True)
+    inspect_parser = commands.add_parser('inspect', help="count the DLQ messages per group")
+    inspect_parser.add_argument('--offset', type=int, default=0, help="first message listed")
+    inspect_parser.add_argument('--limit', type=int, default=20, help="messages listed")
+    inspect_parser.add_argument('--scan-limit', type=int, default=DLQ_SCAN_LIMIT, help="messages read at most")
+    replay_parser = commands.add_parser('replay', help="move groups of messages back to their queue")
+    replay_parser.add_argument('--group', action='append', dest='groups', help="group to replay (repeatable)")
+    replay_parser.add_argument('--all', action='store_true', help="replay every group")
+    replay_parser.add_argument('--rate', type=float, default=DLQ_REPLAY_RATE, help="messages per second")
+    replay_parser.add_argument('--max', type=int, dest='max_messages', help="stop after this many")
+    args = parser.parse_args()
+
+    replayer = DLQReplayer(args.dlq, args.queue)
+    if args.command == 'inspect':
+        _print_inspection(replayer.inspect(args.offset, args.limit, args.scan_limit))
+        return
+
+    job = replayer._new_job(args.groups, args.all, args.rate, args.max_messages)
+    thread = threading.Thread(target=replayer.run, args=(job,), daemon=True)
+    thread.start()
+    try:
+        while thread.is_alive():
+            thread.join(10)
+            print(json.dumps({key: value for key, value in job.to_dict().items() if key != "groups"}))
+    except KeyboardInterrupt:
+        print("Stopping after the current batch...")
+        job.stop_requested.set()
+        thread.join()
+    print(json.dumps(job.to_dict(), indent=2))
+
+
+if __name__ == "__main__":
+    main()
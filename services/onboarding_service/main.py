@@ -1,13 +1,17 @@
 # main.py
 import uvicorn
 from fastapi import FastAPI, File, UploadFile, HTTPException, status
+from pydantic import BaseModel
+from typing import List, Optional
+import asyncio
 import logging
 import json
 import threading
 
 from config import SERVICE_PORT
-from db_utils import insert_nota_fiscal_from_json, get_database_statistics
-from rabbitmq_worker import start_consumer
+from db_utils import pool, insert_nota_fiscal_from_json, get_database_statistics
+from rabbitmq_worker import start_consumer, batch_metrics
+from dlq_replay import DLQReplayer, ReplayBusy
 
 app = FastAPI(title="Onboarding Service", version="1.0.0")
 
@@ -15,9 +19,23 @@ app = FastAPI(title="Onboarding Service", version="1.0.0")
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Inspection and throttled replay of the notas fiscais DLQ
+replays = DLQReplayer()
+
+
+class DLQReplayRequest(BaseModel):
+    groups: Optional[List[str]] = None
+    all: bool = False
+    rate: Optional[float] = None
+    max_messages: Optional[int] = None
+
 
 @app.on_event("startup")
 async def startup_event():
+    try:
+        await pool.open()
+    except Exception as e:
+        logger.warning(f"Database pool not opened at startup, retrying on first use: {e}")
     logger.info("Onboarding service started successfully")
     
     # Start RabbitMQ consumer in a separate thread
@@ -26,6 +44,12 @@ async def startup_event():
     logger.info("RabbitMQ consumer worker started in background")
 
 
+@app.on_event("shutdown")
+async def shutdown_event():
+    await asyncio.to_thread(replays.close)
+    await pool.close()
+
+
 @app.get("/health")
 async def health_check():
     """Health check endpoint"""
@@ -41,7 +65,10 @@ async def status_check():
             "status": "online",
             "service": "onboarding_service",
             "version": "1.0.0",
-            **db_stats
+            **db_stats,
+            "consumer_batches": batch_metrics.snapshot(),
+            "db_pool": pool.metrics(),
+            "dlq_replay": replays.metrics()
         }
     except Exception as e:
         logger.error(f"Error getting status: {e}")
@@ -135,6 +162,68 @@ async def insert_nota_fiscal(file: UploadFile = File(...)):
         )
 
 
+@app.get("/dlq")
+async def inspect_dlq(offset: int = 0, limit: int = 20):
+    """
+    Messages of the notas fiscais dead-letter queue, counted per group (x-death-reason
+    without the error message), and the page [offset, offset + limit) of them.
+    Nothing is removed from the queue.
+    """
+    try:
+        return await asyncio.to_thread(replays.inspect, offset, limit)
+    except ReplayBusy as e:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=str(e))
+    except Exception as e:
+        logger.error(f"Error inspecting DLQ: {e}", exc_info=True)
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail=f"Error inspecting DLQ: {str(e)}"
+        )
+
+
+@app.post("/dlq/replay", status_code=status.HTTP_202_ACCEPTED)
+async def replay_dlq(request: DLQReplayRequest):
+    """
+    Move the messages of the selected groups (or `all`) back to their queue,
+    at most `rate` per second, with their retry headers reset.
+    
+    Returns:
+        replay_id and progress counters; follow them at GET /dlq/replay/{replay_id}
+    """
+    try:
+        replay = await asyncio.to_thread(
+            replays.start, request.groups, request.all, request.rate, request.max_messages
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+    except ReplayBusy as e:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=str(e))
+    if replay["status"] == "failed":
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail=f"Error replaying DLQ: {replay['error']}"
+        )
+    return {**replay, "status_url": f"/dlq/replay/{replay['replay_id']}"}
+
+
+@app.get("/dlq/replay/{replay_id}")
+async def get_dlq_replay(replay_id: str):
+    """Progress of a replay: messages visited, replayed (per group) and kept in the DLQ"""
+    replay = replays.get(replay_id)
+    if not replay:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Replay {replay_id} not found")
+    return replay
+
+
+@app.post("/dlq/replay/{replay_id}/stop")
+async def stop_dlq_replay(replay_id: str):
+    """Stop a replay after its current batch; the messages not replayed stay in the DLQ"""
+    replay = replays.stop(replay_id)
+    if not replay:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Replay {replay_id} not found")
+    return replay
+
+
 if __name__ == "__main__":
     uvicorn.run(app, host="0.0.0.0", port=SERVICE_PORT)
 
@@ -0,0 +1,167 @@
+# partitions.py
+"""
+Monthly partitions of notasfiscais, itens_nota and impostos_item.
+
+The three tables are range-partitioned by data_emissao with aligned monthly
+partitions named <table>_pYYYY_MM (load_service migrations 0003 and 0004). A nota's
+items and item taxes always carry the nota's data_emissao, so they land in
+the same month.
+
+Partitions are created by the ensure_nfe_partition() SQL function:
+create_partitions_ahead() creates the coming months at startup, and writers
+call ensure_partitions() for the months of a batch before writing it. That
+call happens outside the batch transaction, because creating a partition
+locks the parent table.
+
+A month is archived with detach_month(). Its three partitions become
+standalone tables (a catalog-only change, no rows are moved) that can be
+dumped or dropped. attach_month() puts them back. It first validates a CHECK
+constraint that matches the month's range on each table, which does not lock
+the parent, so the ATTACH itself skips the scan.
+"""
+from datetime import date, datetime
+from typing import Dict, Iterable, List, Optional
+
+import asyncpg
+
+from config import PARTITION_MONTHS_AHEAD
+
+# In parent -> child order; detached in reverse
+PARTITIONED_TABLES = ("notasfiscais", "itens_nota", "impostos_item")
+
+# Months whose partitions this process already ensured
+_ensured_months = set()
+
+
+def month_start(value: date) -> date:
+    return date(value.year, value.month, 1)
+
+
+def add_months(value: date, months: int) -> date:
+    index = value.year * 12 + value.month - 1 + months
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def parse_month(value: str) -> date:
+    """'YYYY-MM' -> first day of that month"""
+    try:
+        return datetime.strptime(value, "%Y-%m").date()
+    except (TypeError, ValueError):
+        raise ValueError(f"Invalid month '{value}', expected YYYY-MM")
+
+
+def partition_name(table: str, month: date) -> str:
+    return f"{table}_p{month:%Y_%m}"
+
+
+def partition_date(chave_acesso: Optional[str], data_emissao: Optional[date]) -> date:
+    """
+    Partition key of a nota: its data_emissao, else the AAMM (year/month of
+    emission) encoded in the chave de acesso. Mirrors nfe_partition_date() in SQL.
+    """
+    if data_emissao is not None:
+        return data_emissao
+    chave = chave_acesso or ""
+    if len(chave) >= 6 and chave[:6].isdigit() and 1 <= int(chave[4:6]) <= 12:
+        return date(2000 + int(chave[2:4]), int(chave[4:6]), 1)
+    return date(2000, 1, 1)
+
+
+async def ensure_partitions(conn: asyncpg.Connection, dates: Iterable[date]):
+    """Create the partitions of the months of `dates` that this process has not ensured yet"""
+    months = {month_start(value) for value in dates} - _ensured_months
+    if not months:
+        return
+    await conn.execute("SELECT ensure_nfe_partition(m) FROM unnest($1::date[]) AS m", sorted(months))
+    _ensured_months.update(months)
+
+
+async def create_partitions_ahead(conn: asyncpg.Connection, months_ahead: int = PARTITION_MONTHS_AHEAD):
+    """Partitions for the current month and the next `months_ahead` months"""
+    current = month_start(date.today())
+    await ensure_partitions(conn, [add_months(current, n) for n in range(months_ahead + 1)])
+
+
+async def list_partitions(conn: asyncpg.Connection) -> List[Dict]:
+    """Every month with partitions (attached or detached), newest first"""
+    rows = await conn.fetch("""
+        SELECT c.relname, i.inhparent IS NOT NULL AS attached,
+               GREATEST(c.reltuples, 0)::bigint AS rows_estimate, pg_total_relation_size(c.oid) AS bytes
+        FROM pg_class c
+        LEFT JOIN pg_inherits i ON i.inhrelid = c.oid
+        WHERE c.relkind = 'r' AND c.relnamespace = 'public'::regnamespace
+          AND c.relname ~ '^(notasfiscais|itens_nota|impostos_item)_p[0-9]{4}_[0-9]{2}$'
+    """)
+    months = {}
+    for row in rows:
+        table, suffix = row["relname"].rsplit("_p", 1)
+        month = months.setdefault(suffix.replace("_", "-"), {"attached": True, "tables": {}})
+        month["attached"] = month["attached"] and row["attached"]
+        month["tables"][table] = {
+            "partition": row["relname"],
+            "attached": row["attached"],
+            "rows_estimate": row["rows_estimate"],
+            "bytes": row["bytes"],
+        }
+    return [{"month": month, **info} for month, info in sorted(months.items(), reverse=True)]
+
+
+async def _partition_states(conn: asyncpg.Connection, month: date) -> Dict[str, Optional[bool]]:
+    """Per table: True if the month's partition is attached, False if detached, None if missing"""
+    states = {}
+    for table in PARTITIONED_TABLES:
+        states[table] = await conn.fetchval("""
+            SELECT EXISTS (SELECT 1 FROM pg_inherits WHERE inhrelid = to_regclass($1))
+            WHERE to_regclass($1) IS NOT NULL
+        """, partition_name(table, month))
+    return states
+
+
+async def detach_month(conn: asyncpg.Connection, month: date) -> Dict:
+    """
+    Detach the month's partitions of the three tables (one transaction).
+    Their rows disappear from the parent tables but are kept in the
+    standalone <table>_pYYYY_MM tables.
+    """
+    month = month_start(month)
+    async with conn.transaction():
+        states = await _partition_states(conn, month)
+        if not any(states.values()):
+            raise LookupError(f"No attached partitions for {month:%Y-%m}")
+        detached = []
+        for table in reversed(PARTITIONED_TABLES):
+            if states[table]:
+                await conn.execute(f'ALTER TABLE {table} DETACH PARTITION "{partition_name(table, month)}"')
+                detached.append(partition_name(table, month))
+        # DETACH fires no triggers: take the month out of nfe_stats, drop every cached response
+        await conn.execute("SELECT nfe_stats_shift_month($1, -1)", month)
+        await conn.execute("SELECT pg_notify('nota_changed', '*')")
+    _ensured_months.discard(month)
+    return {"month": f"{month:%Y-%m}", "detached": detached}
+
+
+async def attach_month(conn: asyncpg.Connection, month: date) -> Dict:
+    """Re-attach the month's detached partitions (see the module docstring for how the scan is avoided)"""
+    month = month_start(month)
+    states = await _partition_states(conn, month)
+    pending = [table for table in PARTITIONED_TABLES if states[table] is False]
+    if not pending:
+        raise LookupError(f"No detached partitions for {month:%Y-%m}")
+
+    bounds = f"data_emissao >= '{month}' AND data_emissao < '{add_months(month, 1)}'"
+    for table in pending:
+        name = partition_name(table, month)
+        await conn.execute(f'ALTER TABLE "{name}" DROP CONSTRAINT IF EXISTS "{name}_range"')
+        await conn.execute(f'ALTER TABLE "{name}" ADD CONSTRAINT "{name}_range" CHECK ({bounds}) NOT VALID')
+        # Scans the standalone table only; the parent is not locked yet
+        await conn.execute(f'ALTER TABLE "{name}" VALIDATE CONSTRAINT "{name}_range"')
+
+    async with conn.transaction():
+        for table in pending:
+            name = partition_name(table, month)
+            await conn.execute(f"ALTER TABLE {table} ATTACH PARTITION \"{name}\" "
+                               f"FOR VALUES FROM ('{month}') TO ('{add_months(month, 1)}')")
+            await conn.execute(f'ALTER TABLE "{name}" DROP CONSTRAINT "{name}_range"')
+        await conn.execute("SELECT nfe_stats_shift_month($1, 1)", month)
+        await conn.execute("SELECT pg_notify('nota_changed', '*')")
+    return {"month": f"{month:%Y-%m}", "attached": [partition_name(table, month) for table in pending]}
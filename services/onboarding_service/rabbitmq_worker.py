@@ -6,14 +6,23 @@ import sys
 import os
 import requests
 import asyncio
-from typing import Dict
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from typing import Dict, List, Tuple
+
+import asyncpg
 
 from config import (
     RABBITMQ_HOST, RABBITMQ_PORT, RABBITMQ_USER, RABBITMQ_PASS, 
     RABBITMQ_QUEUE, RABBITMQ_DLQ, RABBITMQ_MAX_RETRIES,
-    CLASSIFICATION_SERVICE_URL
+    CLASSIFICATION_SERVICE_URL, CLASSIFICATION_TIMEOUT, CLASSIFICATION_CONCURRENCY, CLASSIFICATION_BATCH_TIMEOUT,
+    CONSUMER_PREFETCH, CONSUMER_BATCH_SIZE, CONSUMER_BATCH_LINGER_MS, CONSUMER_BISECT_POLICY,
+    CONSUMER_METRICS_INTERVAL
 )
-from db_utils import insert_nota_fiscal_from_json
+from db_utils import DATABASE_URL
+from bulk_writer import write_notas_batch
+from micro_batch import BISECT_POLICIES, BatchMetrics, write_isolating_failures
+from retry_queues import RetryPolicy, retry_count as get_retry_count
 
 # Configure logging
 logging.basicConfig(
@@ -22,6 +31,12 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Batch-size and flush-latency metrics of the consumer, reported by /status
+batch_metrics = BatchMetrics("onboarding worker", CONSUMER_METRICS_INTERVAL)
+
+# Failed messages wait in delay queues (exponential backoff) before coming back
+retries = RetryPolicy(RABBITMQ_QUEUE)
+
 
 def get_rabbitmq_connection(retries=5, delay=2):
     """Get RabbitMQ connection with retry logic"""
@@ -60,12 +75,15 @@ def setup_queues(channel):
     channel.queue_declare(queue=RABBITMQ_QUEUE, durable=True)
     logger.info(f"📦 Main queue '{RABBITMQ_QUEUE}' declared")
     
+    # Declare the delay queues failed messages wait in before coming back
+    retries.declare(channel)
+    
     logger.info(f"🔁 Max retries configured: {RABBITMQ_MAX_RETRIES}")
 
 
-def send_to_dlq(channel, body, reason="Max retries exceeded"):
+def send_to_dlq(channel, body, reason="Max retries exceeded", properties=None, error=None):
     """
-    Send message to Dead Letter Queue
+    Send message to Dead Letter Queue, with its retry headers
     """
     try:
         channel.basic_publish(
@@ -74,7 +92,7 @@ def send_to_dlq(channel, body, reason="Max retries exceeded"):
             body=body,
             properties=pika.BasicProperties(
                 delivery_mode=pika.DeliveryMode.Persistent,
-                headers={'x-death-reason': reason}
+                headers=retries.dlq_headers(properties, reason, error)
             )
         )
         logger.warning(f"💀 Message sent to DLQ. Reason: {reason}")
@@ -136,7 +154,7 @@ def send_to_classification_service(data: Dict) -> Dict:
             CLASSIFICATION_SERVICE_URL,
             json=data,
             headers={'Content-Type': 'application/json'},
-            timeout=30  # 30 seconds timeout
+            timeout=CLASSIFICATION_TIMEOUT
         )
         
         response.raise_for_status()
@@ -162,106 +180,178 @@ def send_to_classification_service(data: Dict) -> Dict:
         raise
 
 
-def process_message(ch, method, properties, body):
+def handle_failure(ch, body, properties, error: Exception):
     """
-    Process a single message from RabbitMQ queue:
-    1. Receive nota fiscal from queue
-    2. Send to classification service
-    3. Save classified nota fiscal to database
-    
-    Implements retry logic with Dead Letter Queue (DLQ)
-    
-    Args:
-        ch: Channel
-        method: Method
-        properties: Properties
-        body: Message body
+    Retry a failed message after a delay (retry_queues.RetryPolicy: delay
+    queue, exponential backoff with jitter), or send it to the DLQ once
+    RABBITMQ_MAX_RETRIES is exceeded.
+    The original delivery is acknowledged by the caller.
     """
-    # Get retry count from message headers
-    retry_count = 0
-    if properties.headers and 'x-retry-count' in properties.headers:
-        retry_count = properties.headers['x-retry-count']
-    
+    if retries.schedule(ch, body, properties, error):
+        return
+
+    logger.warning(f"⚠️  Max retries ({RABBITMQ_MAX_RETRIES}) exceeded")
+    error_type = type(error).__name__
+    send_to_dlq(ch, body, reason=f"Max retries exceeded - {error_type}: {str(error)}",
+                properties=properties, error=error)
+
+
+def classify_message(body, properties) -> Tuple:
+    """
+    Parse a message and send it to the classification service
+
+    Returns:
+        (nota_fiscal, items, impostos_nota, impostos_items) of the classified nota fiscal
+    """
+    retry_count = get_retry_count(properties)
     logger.info(f"📋 Processing message (attempt {retry_count + 1}/{RABBITMQ_MAX_RETRIES + 1})")
-    
-    try:
-        # Parse message
-        message = json.loads(body)
-        
-        # Print the JSON content
-        print_json_pretty(message, "📨 Nova Nota Fiscal Recebida do RabbitMQ")
-        
-        # Send to classification service
-        logger.info("🔄 Step 1: Sending to classification service...")
-        classified_data = send_to_classification_service(message)
-        
-        # Print classified data
-        print_json_pretty(classified_data, "🎯 Nota Fiscal Classificada Recebida")
-        
-        # Save to database
-        logger.info("🔄 Step 2: Saving to database...")
-        nota_fiscal = classified_data.get('nota_fiscal', {})
-        items = classified_data.get('items', [])
-        impostos_nota = classified_data.get('impostos_nota')
-        impostos_items = classified_data.get('impostos_items')
-        
-        # Run async function in sync context
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-        success = loop.run_until_complete(insert_nota_fiscal_from_json(nota_fiscal, items, impostos_nota, impostos_items))
-        loop.close()
-        
-        if success:
-            logger.info("💾 Successfully saved to database")
-            logger.info(f"   Chave: {nota_fiscal.get('chave_acesso')}")
-            logger.info(f"   Classification: {nota_fiscal.get('classificacao')}")
-        else:
-            logger.error("❌ Failed to save to database")
-            raise Exception("Database insertion failed")
-        
-        # Acknowledge message only after everything succeeds
-        ch.basic_ack(delivery_tag=method.delivery_tag)
-        logger.info("✅ Message processed and acknowledged")
+
+    # Parse message
+    message = json.loads(body)
+
+    # Print the JSON content
+    print_json_pretty(message, "📨 Nova Nota Fiscal Recebida do RabbitMQ")
+
+    # Send to classification service
+    logger.info("🔄 Step 1: Sending to classification service...")
+    classified_data = send_to_classification_service(message)
+
+    # Print classified data
+    print_json_pretty(classified_data, "🎯 Nota Fiscal Classificada Recebida")
+
+    nota_fiscal = classified_data.get('nota_fiscal', {})
+    impostos_nota = classified_data.get('impostos_nota')
+    if impostos_nota and nota_fiscal.get('chave_acesso'):
+        impostos_nota = {**impostos_nota, 'chave_acesso_nf': nota_fiscal.get('chave_acesso')}
+    return (
+        nota_fiscal,
+        classified_data.get('items', []),
+        impostos_nota,
+        classified_data.get('impostos_items')
+    )
+
+
+class BatchSink:
+    """
+    Micro-batching stage of the consumer.
+
+    Deliveries are accumulated until CONSUMER_BATCH_SIZE of them are waiting or
+    the oldest has waited CONSUMER_BATCH_LINGER_MS. The messages are then
+    classified CLASSIFICATION_CONCURRENCY at a time on a thread pool, within
+    CLASSIFICATION_BATCH_TIMEOUT for the whole batch; meanwhile the connection
+    keeps serving heartbeats, so a slow classification service does not get the
+    connection dropped and the batch redelivered. The classified notas are
+    saved in a single transaction (failures isolated with
+    CONSUMER_BISECT_POLICY), failed messages go through the retry/DLQ path and
+    the whole batch is acknowledged with one multiple=True ack.
+    """
+
+    def __init__(self, max_size: int = CONSUMER_BATCH_SIZE, linger_ms: float = CONSUMER_BATCH_LINGER_MS,
+                 policy: str = CONSUMER_BISECT_POLICY, metrics: BatchMetrics = None,
+                 classify_concurrency: int = CLASSIFICATION_CONCURRENCY,
+                 classify_timeout: float = CLASSIFICATION_BATCH_TIMEOUT):
+        if policy not in BISECT_POLICIES:
+            raise ValueError(f"Unknown bisect policy '{policy}', expected one of {BISECT_POLICIES}")
+        self.max_size = max(1, max_size)
+        self.linger = max(0.0, linger_ms) / 1000
+        self.policy = policy
+        self.metrics = metrics or batch_metrics
+        self._pending = []
+        self._first_at = None
+        self.classify_timeout = classify_timeout
+        self._classifier = ThreadPoolExecutor(max_workers=max(1, classify_concurrency),
+                                              thread_name_prefix="classification")
+        self._loop = asyncio.new_event_loop()
+        self._conn = None
+
+    def add(self, method, properties, body):
+        if not self._pending:
+            self._first_at = time.monotonic()
+        self._pending.append((method, properties, body))
+
+    def due(self) -> bool:
+        return bool(self._pending) and (
+            len(self._pending) >= self.max_size or time.monotonic() - self._first_at >= self.linger
+        )
+
+    def flush(self, ch):
+        if not self._pending:
+            return
+        batch, self._pending = self._pending, []
+        started = time.monotonic()
+
+        classified = []
+        failed = 0
+        for (method, properties, body), outcome in zip(batch, self._classify(ch, batch)):
+            if not isinstance(outcome, Exception):
+                classified.append(((properties, body), outcome))
+            elif isinstance(outcome, json.JSONDecodeError):
+                logger.error(f"❌ Failed to parse message JSON: {outcome}")
+                logger.error(f"Raw message: {body}")
+                # Malformed JSON - send directly to DLQ
+                send_to_dlq(ch, body, reason="Invalid JSON format", properties=properties, error=outcome)
+                failed += 1
+            else:
+                logger.error(f"❌ Error processing message: {outcome}", exc_info=outcome)
+                handle_failure(ch, body, properties, outcome)
+                failed += 1
+
+        if classified:
+            logger.info(f"🔄 Step 2: Saving {len(classified)} notas fiscais to database...")
+            errors = self._loop.run_until_complete(write_isolating_failures(
+                [nota for _delivery, nota in classified], self._write, self.policy, self.metrics
+            ))
+            for ((properties, body), nota), error in zip(classified, errors):
+                nota_fiscal = nota[0]
+                if error is None:
+                    logger.info(f"💾 Saved {nota_fiscal.get('chave_acesso')} "
+                                f"(classification: {nota_fiscal.get('classificacao')})")
+                    continue
+                logger.error(f"❌ Failed to save {nota_fiscal.get('chave_acesso')} to database: {error}")
+                handle_failure(ch, body, properties, error)
+                failed += 1
+
+        # Every message is now saved, requeued with a retry count or in the DLQ
+        ch.basic_ack(delivery_tag=batch[-1][0].delivery_tag, multiple=True)
+        self.metrics.record_flush(len(batch), time.monotonic() - started, failed)
+        logger.info(f"✅ Batch of {len(batch)} messages processed and acknowledged ({failed} failed)")
         logger.info("=" * 80)
-        
-    except json.JSONDecodeError as e:
-        logger.error(f"❌ Failed to parse message JSON: {e}")
-        logger.error(f"Raw message: {body}")
-        # Malformed JSON - send directly to DLQ
-        send_to_dlq(ch, body, reason="Invalid JSON format")
-        ch.basic_ack(delivery_tag=method.delivery_tag)
-        
-    except (requests.exceptions.RequestException, Exception) as e:
-        logger.error(f"❌ Error processing message: {e}", exc_info=True)
-        
-        # Check if we've exceeded max retries
-        if retry_count >= RABBITMQ_MAX_RETRIES:
-            logger.warning(f"⚠️  Max retries ({RABBITMQ_MAX_RETRIES}) exceeded")
-            # Send to DLQ
-            error_type = type(e).__name__
-            send_to_dlq(ch, body, reason=f"Max retries exceeded - {error_type}: {str(e)}")
-            # Acknowledge the message to remove it from main queue
-            ch.basic_ack(delivery_tag=method.delivery_tag)
-        else:
-            # Increment retry count and requeue
-            new_retry_count = retry_count + 1
-            logger.info(f"🔄 Requeuing message (retry {new_retry_count}/{RABBITMQ_MAX_RETRIES})")
-            
-            # Publish back to queue with incremented retry count
-            new_properties = pika.BasicProperties(
-                delivery_mode=pika.DeliveryMode.Persistent,
-                headers={'x-retry-count': new_retry_count}
-            )
-            
-            ch.basic_publish(
-                exchange='',
-                routing_key=RABBITMQ_QUEUE,
-                body=body,
-                properties=new_properties
-            )
-            
-            # Acknowledge the original message
-            ch.basic_ack(delivery_tag=method.delivery_tag)
+
+    def _classify(self, ch, batch: List) -> List:
+        """
+        Classify the messages of a batch concurrently
+
+        Returns:
+            Per message, the classified nota tuple or the exception it failed with
+        """
+        futures = [self._classifier.submit(classify_message, body, properties) for _method, properties, body in batch]
+        deadline = time.monotonic() + self.classify_timeout
+        pending = set(futures)
+        while pending and time.monotonic() < deadline:
+            _done, pending = wait(pending, timeout=min(0.2, max(0.0, deadline - time.monotonic())))
+            # Heartbeats and broker frames; deliveries wait in the consumer's buffer
+            ch.connection.process_data_events(time_limit=0)
+
+        outcomes = []
+        for future in futures:
+            if not future.done():
+                # Not started yet: never sent; already running: its result is ignored
+                future.cancel()
+                outcomes.append(TimeoutError(f"Classification not done within {self.classify_timeout:.0f}s"))
+            else:
+                outcomes.append(future.exception() or future.result())
+        return outcomes
+
+    async def _write(self, notas: List[Tuple]):
+        if self._conn is None or self._conn.is_closed():
+            self._conn = await asyncpg.connect(DATABASE_URL)
+        await write_notas_batch(self._conn, notas)
+
+    def close(self):
+        self._classifier.shutdown(wait=False, cancel_futures=True)
+        if self._conn is not None and not self._conn.is_closed():
+            self._loop.run_until_complete(self._conn.close())
+        self._loop.close()
 
 
 def start_consumer():
@@ -271,6 +361,7 @@ def start_consumer():
     
     # Connect to RabbitMQ
     connection = None
+    sink = None
     try:
         connection = get_rabbitmq_connection()
         channel = connection.channel()
@@ -278,25 +369,39 @@ def start_consumer():
         # Setup queues (main queue and DLQ)
         setup_queues(channel)
         
-        # Set QoS - process one message at a time
-        channel.basic_qos(prefetch_count=1)
-        
-        # Start consuming
-        channel.basic_consume(
-            queue=RABBITMQ_QUEUE,
-            on_message_callback=process_message,
-            auto_ack=False  # Manual acknowledgment
-        )
-        
-        logger.info(f"👂 Waiting for messages in queue '{RABBITMQ_QUEUE}'. Press CTRL+C to exit.")
+        # Set QoS - enough deliveries in flight to fill a batch
+        channel.basic_qos(prefetch_count=max(CONSUMER_PREFETCH, CONSUMER_BATCH_SIZE))
+
+        sink = BatchSink()
+        logger.info(f"👂 Waiting for messages in queue '{RABBITMQ_QUEUE}' "
+                    f"(batch={sink.max_size}/{sink.linger * 1000:.0f}ms, policy={sink.policy}). Press CTRL+C to exit.")
         logger.info("=" * 80)
-        channel.start_consuming()
-        
+
+        # Wake up at least every linger period so partial batches are flushed on time
+        for method, properties, body in channel.consume(
+            queue=RABBITMQ_QUEUE,
+            auto_ack=False,  # Manual acknowledgment
+            inactivity_timeout=max(sink.linger, 0.01)
+        ):
+            if method is not None:
+                sink.add(method, properties, body)
+            if sink.due():
+                sink.flush(channel)
+
     except KeyboardInterrupt:
         logger.info("\n⚠️  Interrupted by user")
     except Exception as e:
         logger.error(f"❌ Error in consumer: {e}", exc_info=True)
     finally:
+        if sink is not None:
+            try:
+                if connection and connection.is_open:
+                    sink.flush(channel)
+            except Exception as e:
+                # Unacked deliveries are redelivered once the connection closes
+                logger.error(f"❌ Failed to flush last batch: {e}")
+            sink.close()
+            batch_metrics.log()
         if connection and not connection.is_closed:
             connection.close()
             logger.info("🔌 Connection closed")
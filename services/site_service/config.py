@@ -17,3 +17,22 @@ SERVICE_PORT = int(os.getenv('SERVICE_PORT', '8004'))
 # Database URL
 DATABASE_URL = f"postgresql://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}"
 
+
+# Database connection pool (db_pool.py)
+DB_POOL_MIN_SIZE = int(os.getenv('DB_POOL_MIN_SIZE', '2'))  # connections kept open
+DB_POOL_MAX_SIZE = int(os.getenv('DB_POOL_MAX_SIZE', '10'))  # upper bound on open connections
+DB_STATEMENT_CACHE_SIZE = int(os.getenv('DB_STATEMENT_CACHE_SIZE', '100'))  # prepared statements per connection; 0 behind pgbouncer
+DB_COMMAND_TIMEOUT = float(os.getenv('DB_COMMAND_TIMEOUT', '30'))  # default per-query timeout, seconds
+DB_POOL_ACQUIRE_TIMEOUT = float(os.getenv('DB_POOL_ACQUIRE_TIMEOUT', '10'))  # max wait for a free connection, seconds
+
+# Redis cache of the nota responses (nota_cache.py), invalidated by PostgreSQL notifications
+REDIS_HOST = os.getenv('REDIS_HOST', 'redis')
+REDIS_PORT = int(os.getenv('REDIS_PORT', '6379'))
+REDIS_DB = int(os.getenv('REDIS_DB', '0'))
+NOTA_CACHE_ENABLED = os.getenv('NOTA_CACHE_ENABLED', 'true').lower() == 'true'
+NOTA_CACHE_TTL = int(os.getenv('NOTA_CACHE_TTL', '86400'))  # seconds; only reclaims replaced versions, freshness comes from invalidation
+
+# Streaming export (export.py)
+EXPORT_CHUNK_SIZE = int(os.getenv('EXPORT_CHUNK_SIZE', '2000'))  # rows fetched from the server-side cursor at a time
+EXPORT_PARQUET_ROW_GROUP_SIZE = int(os.getenv('EXPORT_PARQUET_ROW_GROUP_SIZE', '50000'))  # rows per Parquet row group
+EXPORT_MAX_CONCURRENT = int(os.getenv('EXPORT_MAX_CONCURRENT', '2'))  # exports running at once, each on its own connection
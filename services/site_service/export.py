@@ -0,0 +1,426 @@
+# export.py
+"""
+Streaming bulk export of notas fiscais and their items (GET /api/notas/export).
+
+The rows are read through a server-side cursor, EXPORT_CHUNK_SIZE at a time,
+in one read-only REPEATABLE READ transaction (a consistent snapshot however
+long the download takes), and each chunk is encoded and sent before the
+next one is fetched. Memory stays bounded by a chunk (a row group for
+parquet) whatever the size of the export:
+
+  ndjson   one JSON object per line; numbers are JSON numbers
+  csv      header line, then one line per row; decimals exactly as stored
+  parquet  columns typed as in the database (decimal, date, int), written
+           one row group per EXPORT_PARQUET_ROW_GROUP_SIZE rows and sent as
+           each row group is complete; compressed with zstd per column
+
+ndjson and csv are compressed on the fly with zstd or gzip when the client's
+Accept-Encoding allows it (Content-Encoding); parquet is sent as is.
+
+Exports run on their own connection, not on the pool of the API, and at most
+EXPORT_MAX_CONCURRENT at once. Rows come in (data_emissao, chave_acesso)
+order, items in numero_produto order within their nota. Filters are those of
+the listing (notas_listing.notas_filters); the date range selects the monthly
+partitions read.
+"""
+import csv
+import io
+import json
+import logging
+import zlib
+from datetime import date
+from decimal import Decimal
+from typing import AsyncIterator, Callable, Dict, List, Optional, Tuple
+
+import asyncpg
+import pyarrow as pa
+import pyarrow.parquet as pq
+import zstandard
+
+from config import (
+    DATABASE_URL, DB_COMMAND_TIMEOUT, EXPORT_CHUNK_SIZE, EXPORT_PARQUET_ROW_GROUP_SIZE, EXPORT_MAX_CONCURRENT
+)
+from notas_listing import notas_filters
+
+logger = logging.getLogger(__name__)
+
+# (output column, SQL expression, type). Types: text, int, date, decimal(p,s) as in the tables
+NOTA_COLUMNS = [
+    ('chave_acesso', "nf.chave_acesso", 'text'),
+    ('modelo', "nf.modelo", 'text'),
+    ('serie', "nf.serie_nf", 'text'),
+    ('numero_nf', "nf.numero_nf", 'text'),
+    ('natureza_operacao', "nf.natureza_operacao", 'text'),
+    ('data_emissao', "nf.data_emissao", 'date'),
+    ('emit_cnpj', "nf.cpf_cnpj_emitente", 'text'),
+    ('emit_xnome', "nf.razao_social_emitente", 'text'),
+    ('emit_ie', "nf.inscricao_estadual_emitente", 'text'),
+    ('emit_uf', "nf.uf_emitente", 'text'),
+    ('emit_xmun', "nf.municipio_emitente", 'text'),
+    ('dest_cnpj', "nf.cnpj_destinatario", 'text'),
+    ('dest_xnome', "nf.nome_destinatario", 'text'),
+    ('dest_uf', "nf.uf_destinatario", 'text'),
+    ('dest_indieiedest', "nf.indicador_ie_destinatario", 'text'),
+    ('destino_operacao', "nf.destino_operacao", 'text'),
+    ('consumidor_final', "nf.consumidor_final", 'text'),
+    ('presenca_comprador', "nf.presenca_comprador", 'text'),
+    ('valor_total', "nf.valor_nota_fiscal", 'decimal(15,2)'),
+    ('classificacao', "nf.classificacao", 'text'),
+]
+
+ITEM_COLUMNS = [
+    ('chave_acesso', "nf.chave_acesso", 'text'),
+    ('numero_nf', "nf.numero_nf", 'text'),
+    ('data_emissao', "nf.data_emissao", 'date'),
+    ('emit_cnpj', "nf.cpf_cnpj_emitente", 'text'),
+    ('emit_uf', "nf.uf_emitente", 'text'),
+    ('dest_cnpj', "nf.cnpj_destinatario", 'text'),
+    ('dest_uf', "nf.uf_destinatario", 'text'),
+    ('classificacao', "nf.classificacao", 'text'),
+    ('nitem', "i.numero_produto", 'int'),
+    ('xprod', "i.descricao_produto", 'text'),
+    ('ncm', "i.codigo_ncm_sh", 'text'),
+    ('cfop', "i.cfop", 'text'),
+    ('qcom', "i.quantidade", 'decimal(15,4)'),
+    ('ucom', "i.unidade", 'text'),
+    ('vuncom', "i.valor_unitario", 'decimal(15,4)'),
+    ('vprod', "i.valor_total", 'decimal(15,2)'),
+    ('v_tot_trib', "ii.v_tot_trib", 'decimal(15,2)'),
+    ('icms_cst', "ii.icms_cst", 'text'),
+    ('icms_v_bc', "ii.icms_v_bc", 'decimal(15,2)'),
+    ('icms_p_icms', "ii.icms_p_icms", 'decimal(5,4)'),
+    ('icms_v_icms', "ii.icms_v_icms", 'decimal(15,2)'),
+    ('ipi_cst', "ii.ipi_cst", 'text'),
+    ('ipi_v_ipi', "ii.ipi_v_ipi", 'decimal(15,2)'),
+    ('pis_cst', "ii.pis_cst", 'text'),
+    ('pis_v_pis', "ii.pis_v_pis", 'decimal(15,2)'),
+    ('cofins_cst', "ii.cofins_cst", 'text'),
+    ('cofins_v_cofins', "ii.cofins_v_cofins", 'decimal(15,2)'),
+]
+
+# dataset -> (columns, FROM clause, ORDER BY)
+DATASETS = {
+    'notas': (NOTA_COLUMNS, "notasfiscais nf", "nf.data_emissao, nf.chave_acesso"),
+    'itens': (
+        ITEM_COLUMNS,
+        """notasfiscais nf
+        JOIN itens_nota i ON i.chave_acesso_nf = nf.chave_acesso AND i.data_emissao = nf.data_emissao
+        LEFT JOIN impostos_item ii ON ii.id_item_nf = i.id_item_nf AND ii.data_emissao = i.data_emissao""",
+        "nf.data_emissao, nf.chave_acesso, i.numero_produto"
+    ),
+}
+
+FORMATS = ('ndjson', 'csv', 'parquet')
+
+# Content-Encoding in order of preference
+ENCODINGS = ('zstd', 'gzip')
+
+
+def build_export_query(dataset: str, **filters) -> Tuple[str, list]:
+    """
+    SQL and arguments of an export
+
+    Args:
+        dataset: 'notas' or 'itens'
+        **filters: See notas_listing.notas_filters
+
+    Raises:
+        ValueError: Unknown dataset
+    """
+    if dataset not in DATASETS:
+        raise ValueError(f"Invalid dataset '{dataset}'. Valid values: {', '.join(DATASETS)}")
+    columns, source, order = DATASETS[dataset]
+    args = []
+    conditions = notas_filters(args, **filters)
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+    select = ",\n        ".join(f"{expression} AS {name}" for name, expression, _ in columns)
+    sql = f"""
+    SELECT
+        {select}
+    FROM {source}
+    {where}
+    ORDER BY {order}
+    """
+    return sql, args
+
+
+def choose_encoding(accept_encoding: Optional[str]) -> Optional[str]:
+    """Preferred Content-Encoding the client accepts (None: identity)"""
+    accepted = set()
+    for part in (accept_encoding or '').split(','):
+        name, _, params = part.strip().partition(';')
+        quality = params.strip().removeprefix('q=')
+        try:
+            if quality and float(quality) == 0:
+                continue
+        except ValueError:
+            continue
+        accepted.add(name.strip().lower())
+    return next((encoding for encoding in ENCODINGS if encoding in accepted), None)
+
+
+def _compressor(encoding: Optional[str]):
+    if encoding == 'zstd':
+        return zstandard.ZstdCompressor(level=3).compressobj()
+    if encoding == 'gzip':
+        return zlib.compressobj(6, zlib.DEFLATED, 31)  # wbits 31: gzip header and trailer
+    return None
+
+
+def _json_value(value):
+    # DECIMAL(15,x) has at most 15 significant digits: a float prints them back exactly
+    if isinstance(value, Decimal):
+        return float(value)
+    if isinstance(value, date):
+        return value.isoformat()
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+
+class NdjsonWriter:
+    media_type = 'application/x-ndjson'
+
+    def __init__(self, columns: List):
+        pass
+
+    def start(self) -> bytes:
+        return b''
+
+    def write(self, rows: List) -> bytes:
+        return ''.join(
+            json.dumps(dict(row), default=_json_value, ensure_ascii=False) + '\n' for row in rows
+        ).encode('utf-8')
+
+    def finish(self) -> bytes:
+        return b''
+
+
+class CsvWriter:
+    media_type = 'text/csv; charset=utf-8'
+
+    def __init__(self, columns: List):
+        self.names = [name for name, _, _ in columns]
+
+    def _lines(self, rows) -> bytes:
+        buffer = io.StringIO()
+        csv.writer(buffer, lineterminator='\n').writerows(rows)
+        return buffer.getvalue().encode('utf-8')
+
+    def start(self) -> bytes:
+        return self._lines([self.names])
+
+    def write(self, rows: List) -> bytes:
+        # Records are sequences of the column values; None is written as an empty field
+        return self._lines(rows)
+
+    def finish(self) -> bytes:
+        return b''
+
+
+class _ParquetSink:
+    """Write-only file collecting what the Parquet writer produces until it is taken"""
+
+    def __init__(self):
+        self._chunks = []
+        self._position = 0
+        self.closed = False
+
+    def write(self, data) -> int:
+        data = bytes(data)
+        self._chunks.append(data)
+        self._position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self._position
+
+    def writable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return False
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def take(self) -> bytes:
+        data, self._chunks = b''.join(self._chunks), []
+        return data
+
+
+def _arrow_type(column_type: str) -> pa.DataType:
+    if column_type.startswith('decimal('):
+        precision, scale = column_type[len('decimal('):-1].split(',')
+        return pa.decimal128(int(precision), int(scale))
+    return {'text': pa.string(), 'int': pa.int32(), 'date': pa.date32()}[column_type]
+
+
+class ParquetWriter:
+    media_type = 'application/vnd.apache.parquet'
+
+    def __init__(self, columns: List, row_group_size: int = EXPORT_PARQUET_ROW_GROUP_SIZE):
+        self.schema = pa.schema([(name, _arrow_type(column_type)) for name, _, column_type in columns])
+        self.row_group_size = row_group_size
+        self._rows = []
+        self._sink = _ParquetSink()
+        self._writer = pq.ParquetWriter(self._sink, self.schema, compression='zstd')
+
+    def _write_row_group(self):
+        values = list(zip(*self._rows))
+        arrays = [pa.array(column, type=field.type) for column, field in zip(values, self.schema)]
+        self._writer.write_table(pa.Table.from_arrays(arrays, schema=self.schema), row_group_size=len(self._rows))
+        self._rows = []
+
+    def start(self) -> bytes:
+        return self._sink.take()
+
+    def write(self, rows: List) -> bytes:
+        self._rows.extend(rows)
+        if len(self._rows) >= self.row_group_size:
+            self._write_row_group()
+        return self._sink.take()
+
+    def finish(self) -> bytes:
+        if self._rows:
+            self._write_row_group()
+        self._writer.close()
+        return self._sink.take()
+
+
+WRITERS = {'ndjson': NdjsonWriter, 'csv': CsvWriter, 'parquet': ParquetWriter}
+
+
+class NotaExporter:
+    """
+    Args:
+        dsn: Database URL of the export connections
+        chunk_size: Rows fetched from the cursor at a time
+        max_concurrent: Exports running at once; reserve() refuses beyond
+    """
+
+    def __init__(self, dsn: str = DATABASE_URL, chunk_size: int = EXPORT_CHUNK_SIZE,
+                 max_concurrent: int = EXPORT_MAX_CONCURRENT):
+        self.dsn = dsn
+        self.chunk_size = chunk_size
+        self.max_concurrent = max_concurrent
+
+        self.active = 0
+        self.exports = 0
+        self.failed = 0
+        self.rows = 0
+        self.bytes_sent = 0
+
+    def busy(self) -> bool:
+        return self.active >= self.max_concurrent
+
+    def reserve(self) -> Optional[Callable[[], None]]:
+        """
+        Take an export slot before the export is prepared, so requests that
+        arrive together cannot all pass the check before any body starts.
+
+        Returns:
+            The function releasing the slot (only the first call counts), or
+            None when max_concurrent exports are already running
+        """
+        if self.busy():
+            return None
+        self.active += 1
+        released = False
+
+        def release():
+            nonlocal released
+            if not released:
+                released = True
+                self.active -= 1
+
+        return release
+
+    def prepare(self, dataset: str, fmt: str, release: Callable[[], None], accept_encoding: Optional[str] = None,
+                **filters) -> Tuple[AsyncIterator[bytes], str, Dict]:
+        """
+        Body, media type and headers of an export. The query is built (and
+        the arguments validated) here; nothing is read before the body is iterated.
+
+        Args:
+            dataset: 'notas' or 'itens'
+            fmt: One of FORMATS
+            release: From reserve(); called when the body is done. The caller
+                releases the slot itself if this raises or the body is never iterated
+            accept_encoding: The request's Accept-Encoding header
+            **filters: See notas_listing.notas_filters
+
+        Raises:
+            ValueError: Unknown dataset or format
+        """
+        if fmt not in FORMATS:
+            raise ValueError(f"Invalid format '{fmt}'. Valid values: {', '.join(FORMATS)}")
+        sql, args = build_export_query(dataset, **filters)
+        columns = DATASETS[dataset][0]
+        encoding = choose_encoding(accept_encoding) if fmt != 'parquet' else None
+
+        period = f"{filters.get('data_inicio') or 'inicio'}_{filters.get('data_fim') or 'fim'}"
+        headers = {'Content-Disposition': f'attachment; filename="{dataset}_{period}.{fmt}"', 'Vary': 'Accept-Encoding'}
+        if encoding:
+            headers['Content-Encoding'] = encoding
+        body = self._stream(sql, args, WRITERS[fmt], columns, encoding, release)
+        return body, WRITERS[fmt].media_type, headers
+
+    async def _stream(self, sql: str, args: list, writer_class, columns: List,
+                      encoding: Optional[str], release: Callable[[], None]) -> AsyncIterator[bytes]:
+        self.exports += 1
+        conn = None
+        rows = 0
+        try:
+            writer = writer_class(columns)
+            compressor = _compressor(encoding)
+
+            def encode(data: bytes) -> bytes:
+                data = compressor.compress(data) if compressor and data else data
+                self.bytes_sent += len(data)
+                return data
+
+            conn = await asyncpg.connect(self.dsn, command_timeout=DB_COMMAND_TIMEOUT)
+            async with conn.transaction(isolation='repeatable_read', readonly=True):
+                cursor = await conn.cursor(sql, *args)
+                data = encode(writer.start())
+                if data:
+                    yield data
+                while True:
+                    chunk = await cursor.fetch(self.chunk_size)
+                    if not chunk:
+                        break
+                    rows += len(chunk)
+                    self.rows += len(chunk)
+                    data = encode(writer.write(chunk))
+                    if data:
+                        yield data
+
+            data = encode(writer.finish())
+            if compressor:
+                tail = compressor.flush()
+                self.bytes_sent += len(tail)
+                data += tail
+            if data:
+                yield data
+            logger.info(f"Export finished: {rows} rows")
+        except Exception as e:
+            # The status line is already sent: the client sees a truncated body
+            self.failed += 1
+            logger.error(f"Export failed after {rows} rows: {e}", exc_info=True)
+            raise
+        finally:
+            release()
+            if conn is not None:
+                await conn.close()
+
+    def metrics(self) -> Dict:
+        return {
+            "active": self.active,
+            "max_concurrent": self.max_concurrent,
+            "exports": self.exports,
+            "failed": self.failed,
+            "rows": self.rows,
+            "bytes_sent": self.bytes_sent
+        }
@@ -1,11 +1,19 @@
 # main.py
 import uvicorn
-from fastapi import FastAPI, HTTPException, status
+from fastapi import FastAPI, HTTPException, Query, Request, status
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
+from starlette.background import BackgroundTask
 import logging
+from datetime import date
+from decimal import Decimal
+from typing import Optional
 
-from config import SERVICE_PORT
-from db_utils import get_all_notas_fiscais, get_nota_fiscal_by_chave, get_database_statistics
+from config import SERVICE_PORT, DATABASE_URL
+from db_utils import pool, get_notas_fiscais_page, get_nota_fiscal_by_chave, get_database_statistics
+from notas_listing import DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE, SORTS
+from nota_cache import NotaCache, LIST_SCOPE, list_resource
+from export import NotaExporter, DATASETS, FORMATS
 
 app = FastAPI(title="Site Service", version="1.0.0")
 
@@ -22,28 +30,70 @@ app.add_middleware(
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Read-through cache of the responses below, invalidated by database notifications
+cache = NotaCache(DATABASE_URL)
+
+# Streaming bulk exports, each on its own connection
+exporter = NotaExporter(DATABASE_URL)
+
 
 @app.on_event("startup")
 async def startup_event():
+    try:
+        await pool.open()
+    except Exception as e:
+        logger.warning(f"Database pool not opened at startup, retrying on first use: {e}")
+    await cache.start()
     logger.info("Site service started successfully")
 
 
+@app.on_event("shutdown")
+async def shutdown_event():
+    await cache.close()
+    await pool.close()
+
+
 @app.get("/health")
 async def health_check():
     """Health check endpoint"""
-    return {"status": "healthy", "service": "site_service"}
+    return {"status": "healthy", "service": "site_service", "db_pool": pool.metrics(), "nota_cache": cache.metrics(),
+            "export": exporter.metrics()}
 
 
 @app.get("/api/notas")
-async def list_notas_fiscais():
+async def list_notas_fiscais(
+    request: Request,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE, description="Notas per page"),
+    cursor: Optional[str] = Query(None, description="next_cursor of the previous page"),
+    sort: str = Query('data_desc', description=f"One of: {', '.join(SORTS)}"),
+    emitente: Optional[str] = Query(None, description="CNPJ/CPF (exact) or part of the name of the emitente"),
+    destinatario: Optional[str] = Query(None, description="CNPJ (exact) or part of the name of the destinatário"),
+    uf_emitente: Optional[str] = Query(None, min_length=2, max_length=2),
+    uf_destinatario: Optional[str] = Query(None, min_length=2, max_length=2),
+    classificacao: Optional[str] = None,
+    data_inicio: Optional[date] = None,
+    data_fim: Optional[date] = None,
+    valor_min: Optional[Decimal] = None,
+    valor_max: Optional[Decimal] = None,
+    q: Optional[str] = Query(None, description="Chave, número da NF, CNPJ or part of a name")
+):
     """
-    List all notas fiscais with their basic information
+    List notas fiscais, one page at a time (keyset pagination).
+    Pass the returned next_cursor as `cursor` to get the next page; has_more is false on the last one.
     """
+    async def load_page():
+        page = await get_notas_fiscais_page(
+            sort, limit, cursor, emitente=emitente, destinatario=destinatario, uf_emitente=uf_emitente,
+            uf_destinatario=uf_destinatario, classificacao=classificacao, data_inicio=data_inicio,
+            data_fim=data_fim, valor_min=valor_min, valor_max=valor_max, q=q
+        )
+        logger.info(f"Returning {len(page['notas'])} notas fiscais (sort={sort}, has_more={page['has_more']})")
+        return page
+
     try:
-        logger.info("Fetching all notas fiscais")
-        notas = await get_all_notas_fiscais()
-        logger.info(f"Found {len(notas)} notas fiscais")
-        return {"notas": notas}
+        return await cache.respond(request, list_resource(request), LIST_SCOPE, load_page)
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
     except Exception as e:
         logger.error(f"Error listing notas fiscais: {e}", exc_info=True)
         raise HTTPException(
@@ -52,20 +102,65 @@ async def list_notas_fiscais():
         )
 
 
+@app.get("/api/notas/export")
+async def export_notas(
+    request: Request,
+    dataset: str = Query('notas', description=f"One of: {', '.join(DATASETS)}"),
+    format: str = Query('ndjson', description=f"One of: {', '.join(FORMATS)}"),
+    data_inicio: Optional[date] = None,
+    data_fim: Optional[date] = None,
+    uf_emitente: Optional[str] = Query(None, min_length=2, max_length=2),
+    uf_destinatario: Optional[str] = Query(None, min_length=2, max_length=2),
+    classificacao: Optional[str] = None
+):
+    """
+    Export notas fiscais (dataset=notas) or their items with taxes (dataset=itens)
+    as NDJSON, CSV or Parquet, streamed from a server-side cursor.
+    NDJSON and CSV are compressed with zstd or gzip when Accept-Encoding allows it.
+    """
+    release = exporter.reserve()
+    if release is None:
+        raise HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail=f"{exporter.max_concurrent} exports already running, try again later"
+        )
+    try:
+        body, media_type, headers = exporter.prepare(
+            dataset, format, release, request.headers.get('accept-encoding'), data_inicio=data_inicio,
+            data_fim=data_fim, uf_emitente=uf_emitente, uf_destinatario=uf_destinatario, classificacao=classificacao
+        )
+    except ValueError as e:
+        release()
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+    except Exception:
+        release()
+        raise
+    logger.info(f"Exporting {dataset} as {format} ({data_inicio} - {data_fim}, "
+                f"encoding={headers.get('Content-Encoding', 'identity')})")
+    # The body releases the slot when it ends; the background task covers a
+    # client gone before the body was ever iterated
+    return StreamingResponse(body, media_type=media_type, headers=headers, background=BackgroundTask(release))
+
+
 @app.get("/api/notas/{chave_acesso}")
-async def get_nota_fiscal_details(chave_acesso: str):
+async def get_nota_fiscal_details(chave_acesso: str, request: Request):
     """
-    Get detailed information about a specific nota fiscal including its items
+    Get detailed information about a specific nota fiscal: header and tax totals
+    (`nota`), items with their taxes (`itens`). Everything the detail page shows
+    comes from this one response. Cached until the nota changes; send the
+    ETag back as If-None-Match to get 304 while it has not.
     """
     try:
         logger.info(f"Fetching nota fiscal with chave: {chave_acesso}")
-        result = await get_nota_fiscal_by_chave(chave_acesso)
-        if not result:
+        # Serialized by PostgreSQL: cached and sent as is
+        response = await cache.respond(request, "detail", chave_acesso,
+                                       lambda: get_nota_fiscal_by_chave(chave_acesso))
+        if response is None:
             raise HTTPException(
                 status_code=status.HTTP_404_NOT_FOUND,
                 detail=f"Nota fiscal with chave_acesso '{chave_acesso}' not found"
             )
-        return result
+        return response
     except HTTPException:
         raise
     except Exception as e:
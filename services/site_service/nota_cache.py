@@ -0,0 +1,266 @@
+# nota_cache.py
+"""
+Read-through Redis cache of the nota responses (detail, impostos, análise
+fiscal, list pages), invalidated by the database instead of a TTL.
+
+An entry is stored under the versions it was built from:
+
+    nfe:cache:<resource>:<scope>:<generation>.<version>
+
+scope is the chave de acesso, or LIST_SCOPE for list pages; version is the
+token at nfe:cache:ver:<scope> and generation the token at nfe:cache:gen. The
+tokens are read before the database is queried, so a response built while the
+nota was being written is stored under the version being replaced and never
+served. A missing token (first use, expired, evicted) is created with a new
+random value, so a version never comes back.
+
+Invalidation comes from PostgreSQL (load_service migration 0008): every
+statement writing notas, items, taxes or fiscal analyses notifies the chaves
+it touched on the nota_changed channel at commit, whichever service or worker
+wrote them. Each service LISTENs on a dedicated connection and gives those
+chaves, and LIST_SCOPE, new version tokens within FLUSH_INTERVAL. '*' (TRUNCATE,
+attaching or detaching a month) gets a new generation, and so does every
+(re)connection of the listener, which may have missed notifications. While
+the listener is down the cache is bypassed. The entries' TTL only reclaims
+the memory of replaced versions.
+
+Responses carry an ETag (hash of the body) and `Cache-Control: no-cache`:
+clients revalidate with If-None-Match and get 304 without a body while the
+nota is unchanged.
+"""
+import asyncio
+import hashlib
+import json
+import logging
+import uuid
+from typing import Awaitable, Callable, Dict, Optional, Tuple
+
+import asyncpg
+from fastapi import Request, Response
+from fastapi.encoders import jsonable_encoder
+from redis import asyncio as aioredis
+
+from config import NOTA_CACHE_ENABLED, NOTA_CACHE_TTL, REDIS_HOST, REDIS_PORT, REDIS_DB
+
+logger = logging.getLogger(__name__)
+
+CHANNEL = 'nota_changed'
+ALL = '*'
+LIST_SCOPE = '_list'
+KEY_PREFIX = 'nfe:cache'
+FLUSH_INTERVAL = 0.05  # seconds between applying the notifications received
+PING_INTERVAL = 10  # seconds between checks of the LISTEN connection
+RECONNECT_DELAY = 5
+
+# A loader returns the response body (bytes, or anything FastAPI could serialize), or None for "not found"
+Loader = Callable[[], Awaitable[object]]
+
+
+def to_json_bytes(content) -> bytes:
+    """Serialize like FastAPI's JSONResponse"""
+    return json.dumps(jsonable_encoder(content), ensure_ascii=False, allow_nan=False,
+                      indent=None, separators=(',', ':')).encode('utf-8')
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    for candidate in if_none_match.split(','):
+        candidate = candidate.strip()
+        if candidate == '*' or candidate.removeprefix('W/') == etag:
+            return True
+    return False
+
+
+def list_resource(request: Request) -> str:
+    """Resource name of a list page: the path and its query string, in a stable order"""
+    query = sorted(request.query_params.multi_items())
+    digest = hashlib.blake2b(repr((request.url.path, query)).encode('utf-8'), digest_size=16).hexdigest()
+    return f"list:{digest}"
+
+
+class NotaCache:
+    """
+    Args:
+        dsn: Database URL of the LISTEN connection
+        enabled: False serves every request from the database
+        ttl: Seconds an entry is kept (reclaims the memory of replaced versions)
+    """
+
+    def __init__(self, dsn: str, enabled: bool = NOTA_CACHE_ENABLED, ttl: int = NOTA_CACHE_TTL):
+        self.dsn = dsn
+        self.enabled = enabled
+        self.ttl = ttl
+        self._redis: Optional[aioredis.Redis] = None
+        self._listener: Optional[asyncio.Task] = None
+        self._pending = set()
+        # False until the listener runs and has started a generation, and again
+        # whenever it stops: invalidations may be missing, entries are not used
+        self._live = False
+
+        self.hits = 0
+        self.misses = 0
+        self.not_modified = 0
+        self.errors = 0
+        self.invalidations = 0
+
+    async def start(self):
+        """Connect to Redis and start the listener (startup hook)"""
+        if not self.enabled:
+            logger.info("Nota cache disabled")
+            return
+        self._redis = aioredis.Redis(host=REDIS_HOST, port=REDIS_PORT, db=REDIS_DB)
+        self._listener = asyncio.create_task(self._listen())
+
+    async def close(self):
+        self._live = False
+        if self._listener:
+            self._listener.cancel()
+            try:
+                await self._listener
+            except asyncio.CancelledError:
+                pass
+            self._listener = None
+        if self._redis:
+            await self._redis.close()
+            self._redis = None
+
+    def _on_notification(self, connection, pid, channel, payload):
+        self._pending.add(payload)
+
+    def _on_termination(self, connection):
+        self._live = False
+
+    async def _listen(self):
+        while True:
+            conn = None
+            try:
+                conn = await asyncpg.connect(self.dsn)
+                conn.add_termination_listener(self._on_termination)
+                await conn.add_listener(CHANNEL, self._on_notification)
+                # Changes made while nobody was listening are unknown: start a new generation
+                self._pending.add(ALL)
+                await self._apply_pending()
+                self._live = True
+                logger.info(f"Nota cache listening on '{CHANNEL}'")
+
+                since_ping = 0.0
+                while not conn.is_closed():
+                    await asyncio.sleep(FLUSH_INTERVAL)
+                    if self._pending:
+                        await self._apply_pending()
+                    since_ping += FLUSH_INTERVAL
+                    if since_ping >= PING_INTERVAL:
+                        await conn.fetchval("SELECT 1")
+                        since_ping = 0.0
+                raise ConnectionError("LISTEN connection closed")
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"Nota cache listener interrupted, serving from the database: {e}")
+            finally:
+                self._live = False
+                if conn is not None:
+                    conn.terminate()
+            await asyncio.sleep(RECONNECT_DELAY)
+
+    async def _apply_pending(self):
+        pending, self._pending = self._pending, set()
+        try:
+            async with self._redis.pipeline(transaction=False) as pipe:
+                if ALL in pending:
+                    pipe.set(f"{KEY_PREFIX}:gen", uuid.uuid4().hex)
+                else:
+                    for scope in pending | {LIST_SCOPE}:
+                        # Outlives the entries built with it (see _entry_key)
+                        pipe.set(f"{KEY_PREFIX}:ver:{scope}", uuid.uuid4().hex, ex=2 * self.ttl)
+                await pipe.execute()
+        except Exception:
+            self._pending |= pending
+            raise
+        self.invalidations += len(pending)
+
+    async def _entry_key(self, resource: str, scope: str) -> str:
+        # SET NX GET: the current token, or the new one when there was none
+        generation, version = uuid.uuid4().hex, uuid.uuid4().hex
+        async with self._redis.pipeline(transaction=False) as pipe:
+            pipe.set(f"{KEY_PREFIX}:gen", generation, nx=True, get=True)
+            pipe.set(f"{KEY_PREFIX}:ver:{scope}", version, nx=True, get=True, ex=2 * self.ttl)
+            current_generation, current_version = await pipe.execute()
+        generation = current_generation.decode() if current_generation else generation
+        version = current_version.decode() if current_version else version
+        return f"{KEY_PREFIX}:{resource}:{scope}:{generation}.{version}"
+
+    @staticmethod
+    async def _build(loader: Loader) -> Optional[Tuple[bytes, str]]:
+        content = await loader()
+        if content is None:
+            return None
+        body = content if isinstance(content, bytes) else to_json_bytes(content)
+        return body, f'"{hashlib.blake2b(body, digest_size=16).hexdigest()}"'
+
+    def _redis_error(self, e: Exception):
+        self.errors += 1
+        logger.warning(f"Nota cache unavailable, serving from the database: {e}")
+
+    async def get_or_load(self, resource: str, scope: str, loader: Loader) -> Optional[Tuple[bytes, str]]:
+        """
+        (body, etag) of a response, from the cache or built by `loader` and stored.
+
+        Args:
+            resource: Kind of response, e.g. "detail"
+            scope: chave_acesso the response is about, or LIST_SCOPE
+            loader: Builds the response from the database
+
+        Returns:
+            None when the loader returns None (not cached)
+        """
+        if not (self._live and self._redis):
+            return await self._build(loader)
+        try:
+            key = await self._entry_key(resource, scope)
+            etag, body = await self._redis.hmget(key, 'etag', 'body')
+        except Exception as e:
+            self._redis_error(e)
+            return await self._build(loader)
+        if body is not None:
+            self.hits += 1
+            return body, etag.decode()
+
+        self.misses += 1
+        entry = await self._build(loader)
+        if entry is not None:
+            try:
+                async with self._redis.pipeline(transaction=True) as pipe:
+                    pipe.hset(key, mapping={'etag': entry[1], 'body': entry[0]})
+                    pipe.expire(key, self.ttl)
+                    await pipe.execute()
+            except Exception as e:
+                self._redis_error(e)
+        return entry
+
+    async def respond(self, request: Request, resource: str, scope: str, loader: Loader) -> Optional[Response]:
+        """
+        JSON response with its ETag, or 304 when the request's If-None-Match
+        matches it; None when the loader returns None
+        """
+        entry = await self.get_or_load(resource, scope, loader)
+        if entry is None:
+            return None
+        body, etag = entry
+        headers = {'ETag': etag, 'Cache-Control': 'no-cache'}
+        if etag_matches(request.headers.get('if-none-match'), etag):
+            self.not_modified += 1
+            return Response(status_code=304, headers=headers)
+        return Response(content=body, media_type='application/json', headers=headers)
+
+    def metrics(self) -> Dict:
+        return {
+            "enabled": self.enabled,
+            "live": self._live,
+            "hits": self.hits,
+            "misses": self.misses,
+            "not_modified": self.not_modified,
+            "errors": self.errors,
+            "invalidations": self.invalidations
+        }
@@ -0,0 +1,310 @@
+# batches.py
+"""
+Background batches of notas sent to the taxes calculation queue
+(POST /calculate-taxes/batch).
+
+A batch selects notas by a list of chaves de acesso or by filters
+(notas_listing.notas_filters, plus "not analysed yet"). The request
+returns right away with the batch id. The notas are then loaded page by
+page, BATCH_PAGE_SIZE documents per statement (db_utils.get_notas_fiscais_page):
+the filters walk (data_emissao, chave_acesso) with a keyset, the chave
+lists go in slices. Each page is published through the shared confirming
+publisher (rabbitmq_client.publish_many_to_taxes_queue), and optionally queued
+for the n8n webhook (webhook_dispatcher.py).
+
+The state of a batch is kept in Redis as JSON (nfe:batch:<id>): its counters
+and a checkpoint (last keyset position, or chaves done). It is saved after
+every page, so any instance can report the progress. The lock
+nfe:batch:<id>:lock, renewed every page, keeps two instances from running the
+same batch. An instance shutting down releases the locks of its batches; every
+instance looks for active batches without a lock when it starts and every
+BATCH_RESUME_INTERVAL seconds, and resumes them from their checkpoint (a
+batch of a crashed instance once its lock has expired).
+"""
+import asyncio
+import json
+import logging
+import uuid
+from datetime import date, datetime
+from typing import Dict, List, Optional
+
+from redis import asyncio as aioredis
+
+from config import (
+    REDIS_HOST, REDIS_PORT, REDIS_DB, BATCH_PAGE_SIZE, BATCH_MAX_CHAVES, BATCH_STATE_TTL, BATCH_RESUME_INTERVAL
+)
+from db_utils import get_notas_fiscais_page
+from notas_listing import notas_filters
+from rabbitmq_client import publish_many_to_taxes_queue
+
+logger = logging.getLogger(__name__)
+
+KEY_PREFIX = 'nfe:batch'
+LOCK_TTL = 120  # seconds; renewed every page
+
+STATUS_QUEUED = "queued"
+STATUS_RUNNING = "running"
+STATUS_COMPLETED = "completed"
+STATUS_FAILED = "failed"
+
+_COUNTERS = ("pages", "selected", "published", "failed", "skipped", "webhook_queued", "webhook_rejected")
+FILTERS = ("emitente", "destinatario", "uf_emitente", "uf_destinatario", "classificacao", "data_inicio", "data_fim")
+
+NOT_ANALYSED_CONDITION = (
+    "NOT EXISTS (SELECT 1 FROM analise_fiscal a "
+    "WHERE a.chave_acesso = nf.chave_acesso AND a.dados_completos IS NOT NULL)"
+)
+
+
+class AnalysisBatch:
+    """State of one batch, persisted as JSON in Redis"""
+
+    def __init__(self, batch_id: str, filters: Dict, chaves: Optional[List[str]] = None,
+                 nao_analisadas: bool = False, webhook: bool = False, **state):
+        self.batch_id = batch_id
+        self.filters = filters
+        self.chaves = chaves
+        self.nao_analisadas = nao_analisadas
+        self.webhook = webhook
+        self.status = state.get("status", STATUS_QUEUED)
+        self.created_at = state.get("created_at") or datetime.now().isoformat()
+        self.started_at = state.get("started_at")
+        self.finished_at = state.get("finished_at")
+        self.error = state.get("error")
+        # Filters: [data_emissao, chave_acesso] of the last nota done; chaves: number of chaves done
+        self.checkpoint = state.get("checkpoint")
+        for counter in _COUNTERS:
+            setattr(self, counter, state.get(counter, 0))
+
+    @property
+    def key(self) -> str:
+        return f"{KEY_PREFIX}:{self.batch_id}"
+
+    def state(self) -> Dict:
+        return {
+            "batch_id": self.batch_id,
+            "filters": self.filters,
+            "chaves": self.chaves,
+            "nao_analisadas": self.nao_analisadas,
+            "webhook": self.webhook,
+            "status": self.status,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "error": self.error,
+            "checkpoint": self.checkpoint,
+            **{counter: getattr(self, counter) for counter in _COUNTERS}
+        }
+
+    def to_dict(self) -> Dict:
+        """Progress report (the chave list itself is left out)"""
+        state = self.state()
+        chaves = state.pop("chaves")
+        state.pop("checkpoint")
+        state["total"] = len(chaves) if chaves is not None else None
+        return state
+
+    def page_query(self, page_size: int):
+        """(conditions, args) of the next page, or None when done"""
+        args = []
+        conditions = notas_filters(args, **{name: self._filter(name) for name in FILTERS})
+        if self.nao_analisadas:
+            conditions.append(NOT_ANALYSED_CONDITION)
+        if self.chaves is not None:
+            done = self.checkpoint or 0
+            if done >= len(self.chaves):
+                return None
+            args.append(self.chaves[done:done + page_size])
+            conditions.append(f"nf.chave_acesso = ANY(${len(args)}::varchar[])")
+        elif self.checkpoint:
+            args += [date.fromisoformat(self.checkpoint[0]), self.checkpoint[1]]
+            conditions.append(f"(nf.data_emissao, nf.chave_acesso) > (${len(args) - 1}::date, ${len(args)})")
+            # Same bound on the partition key alone, so the passed months are pruned
+            conditions.append(f"nf.data_emissao >= ${len(args) - 1}::date")
+        return conditions, args
+
+    def _filter(self, name: str):
+        value = self.filters.get(name)
+        return date.fromisoformat(value) if value and name in ("data_inicio", "data_fim") else value
+
+
+class BatchRunner:
+    """
+    Args:
+        dispatcher: webhook_dispatcher.WebhookDispatcher, for batches sent to n8n as well
+        page_size: Notas loaded and published per page
+        max_chaves: Longest chave list accepted
+    """
+
+    def __init__(self, dispatcher=None, page_size: int = BATCH_PAGE_SIZE, max_chaves: int = BATCH_MAX_CHAVES,
+                 state_ttl: int = BATCH_STATE_TTL, resume_interval: float = BATCH_RESUME_INTERVAL):
+        self.dispatcher = dispatcher
+        self.page_size = page_size
+        self.max_chaves = max_chaves
+        self.state_ttl = state_ttl
+        self.resume_interval = resume_interval
+        self._redis: Optional[aioredis.Redis] = None
+        self._tasks: Dict[str, asyncio.Task] = {}
+        self._watcher: Optional[asyncio.Task] = None
+
+    async def start(self):
+        """Connect to Redis and resume the interrupted batches (startup hook)"""
+        self._redis = aioredis.Redis(host=REDIS_HOST, port=REDIS_PORT, db=REDIS_DB)
+        await self._resume_interrupted()
+        self._watcher = asyncio.create_task(self._watch())
+
+    async def _watch(self):
+        while True:
+            await asyncio.sleep(self.resume_interval)
+            await self._resume_interrupted()
+
+    async def _resume_interrupted(self):
+        """Take over the active batches nobody holds the lock of"""
+        try:
+            resumed = 0
+            for batch_id in await self._redis.smembers(f"{KEY_PREFIX}:active"):
+                if batch_id.decode() in self._tasks:
+                    continue
+                batch = await self._load(batch_id.decode())
+                if batch is None:
+                    await self._redis.srem(f"{KEY_PREFIX}:active", batch_id)
+                elif await self._lock(batch):
+                    self._submit(batch)
+                    resumed += 1
+            if resumed:
+                logger.info(f"Resumed {resumed} interrupted taxes batches")
+        except Exception as e:
+            logger.warning(f"Interrupted taxes batches not checked: {e}")
+
+    async def close(self):
+        if self._watcher:
+            self._watcher.cancel()
+            await asyncio.gather(self._watcher, return_exceptions=True)
+            self._watcher = None
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if self._redis:
+            await self._redis.close()
+            self._redis = None
+
+    async def create(self, chaves: Optional[List[str]] = None, nao_analisadas: bool = False,
+                     webhook: bool = False, **filters) -> Dict:
+        """
+        Start a batch
+
+        Args:
+            chaves: Chaves de acesso to send; or else
+            **filters: See FILTERS, with nao_analisadas
+
+        Raises:
+            ValueError: Neither chaves nor a filter, both, or too many chaves
+        """
+        filters = {name: value.isoformat() if isinstance(value, date) else value
+                   for name, value in filters.items() if name in FILTERS and value}
+        if chaves is not None:
+            chaves = list(dict.fromkeys(chave.strip() for chave in chaves if chave and chave.strip()))
+            if not chaves:
+                raise ValueError("chaves cannot be empty")
+            if filters:
+                raise ValueError("Send either chaves or filters, not both")
+            if len(chaves) > self.max_chaves:
+                raise ValueError(f"At most {self.max_chaves} chaves per batch; use filters for more")
+        elif not filters and not nao_analisadas:
+            raise ValueError("Send chaves or at least one filter")
+
+        batch = AnalysisBatch(uuid.uuid4().hex, filters, chaves, nao_analisadas, webhook)
+        await self._save(batch)
+        # Locked before it is active, so no other instance's check takes it over
+        await self._lock(batch)
+        await self._redis.sadd(f"{KEY_PREFIX}:active", batch.batch_id)
+        self._submit(batch)
+        selection = f"{len(chaves)} chaves" if chaves is not None else f"filters {filters}"
+        logger.info(f"📦 Taxes batch {batch.batch_id} created ({selection}, nao_analisadas={nao_analisadas})")
+        return batch.to_dict()
+
+    async def get(self, batch_id: str) -> Optional[Dict]:
+        batch = await self._load(batch_id)
+        return batch.to_dict() if batch else None
+
+    async def _load(self, batch_id: str) -> Optional[AnalysisBatch]:
+        raw = await self._redis.get(f"{KEY_PREFIX}:{batch_id}")
+        return AnalysisBatch(**json.loads(raw)) if raw else None
+
+    async def _save(self, batch: AnalysisBatch):
+        await self._redis.set(batch.key, json.dumps(batch.state()), ex=self.state_ttl)
+
+    async def _lock(self, batch: AnalysisBatch) -> bool:
+        return bool(await self._redis.set(f"{batch.key}:lock", 1, nx=True, ex=LOCK_TTL))
+
+    def _submit(self, batch: AnalysisBatch):
+        task = asyncio.create_task(self._run(batch))
+        self._tasks[batch.batch_id] = task
+        task.add_done_callback(lambda _: self._tasks.pop(batch.batch_id, None))
+
+    async def _run(self, batch: AnalysisBatch):
+        batch.status = STATUS_RUNNING
+        batch.started_at = batch.started_at or datetime.now().isoformat()
+        try:
+            while True:
+                query = batch.page_query(self.page_size)
+                if query is None:
+                    break
+                documents = await get_notas_fiscais_page(*query, limit=self.page_size)
+                await self._publish(batch, documents)
+                batch.pages += 1
+                if batch.chaves is not None:
+                    requested = min(self.page_size, len(batch.chaves) - (batch.checkpoint or 0))
+                    batch.skipped += requested - len(documents)
+                    batch.checkpoint = (batch.checkpoint or 0) + requested
+                elif len(documents) < self.page_size:
+                    break
+                else:
+                    last = documents[-1]['nota_fiscal']
+                    batch.checkpoint = [last['data_emissao'], last['chave_acesso']]
+                await self._save(batch)
+                await self._redis.expire(f"{batch.key}:lock", LOCK_TTL)
+            batch.status = STATUS_COMPLETED
+        except asyncio.CancelledError:
+            # Shutdown: another instance resumes from the last checkpoint on its next check
+            try:
+                await self._redis.delete(f"{batch.key}:lock")
+            except Exception as e:
+                logger.warning(f"Lock of taxes batch {batch.batch_id} not released, it expires in {LOCK_TTL}s: {e}")
+            raise
+        except Exception as e:
+            logger.error(f"Taxes batch {batch.batch_id} failed: {e}", exc_info=True)
+            batch.status = STATUS_FAILED
+            batch.error = str(e)
+        batch.finished_at = datetime.now().isoformat()
+        await self._save(batch)
+        await self._redis.srem(f"{KEY_PREFIX}:active", batch.batch_id)
+        await self._redis.delete(f"{batch.key}:lock")
+        logger.info(f"📦 Taxes batch {batch.batch_id} {batch.status}: {batch.published} published, "
+                    f"{batch.failed} failed, {batch.skipped} skipped")
+
+    async def _publish(self, batch: AnalysisBatch, documents: List[Dict]):
+        if not documents:
+            return
+        batch.selected += len(documents)
+        # Waits for the broker confirms: off the event loop
+        results = await asyncio.to_thread(publish_many_to_taxes_queue, documents)
+        batch.published += sum(results)
+        batch.failed += len(results) - sum(results)
+        if batch.webhook and self.dispatcher is not None:
+            for document, published in zip(documents, results):
+                if not published:
+                    continue
+                try:
+                    queued = await self.dispatcher.enqueue(document['nota_fiscal']['chave_acesso'])
+                except Exception as e:
+                    logger.warning(f"Webhook backlog unavailable: {e}")
+                    queued = {"status": "unavailable"}
+                if queued["status"] in ("backlog_full", "unavailable"):
+                    batch.webhook_rejected += 1
+                else:
+                    batch.webhook_queued += 1
+
+    def metrics(self) -> Dict:
+        return {"running_here": len(self._tasks)}
@@ -0,0 +1,158 @@
+# check_analise_fiscal_concurrency.py
+"""
+Concurrency check for the analise_fiscal save path.
+
+Creates synthetic notas, then runs `--savers` tasks saving analyses
+(save_analise_fiscal / update_analise_fiscal_processamento) in parallel with
+`--readers` tasks calling get_analise_fiscal_by_chave, all through the shared
+pool. While they run, pg_locks is sampled: the check fails (exit code 1) if
+any lock on analise_fiscal is ever waited for, or an ACCESS EXCLUSIVE lock
+(DDL) is taken on it. Save and read latencies are printed. Synthetic rows are
+deleted afterwards.
+
+Requires a database with the notasfiscais and analise_fiscal tables
+(load_service/migrate.py).
+
+Usage:
+    python check_analise_fiscal_concurrency.py [--notas 200] [--savers 8] [--readers 8] [--rounds 5]
+"""
+import argparse
+import asyncio
+import sys
+import time
+
+from db_utils import pool, save_analise_fiscal, update_analise_fiscal_processamento, get_analise_fiscal_by_chave
+
+CHAVE_PREFIX = "99"  # no real chave de acesso starts with UF code 99
+
+LOCKS_ON_ANALISE_FISCAL_SQL = """
+SELECT l.mode, l.granted FROM pg_locks l
+WHERE l.relation = 'analise_fiscal'::regclass AND l.pid <> pg_backend_pid()
+  AND (NOT l.granted OR l.mode = 'AccessExclusiveLock')
+"""
+
+
+async def cleanup(conn):
+    for table in ("analise_fiscal", "notasfiscais"):
+        await conn.execute(f"DELETE FROM {table} WHERE chave_acesso LIKE $1", CHAVE_PREFIX + '%')
+
+
+def build_analise(chave: str, n: int) -> dict:
+    return {
+        "analise_fiscal": {
+            "info_nfe": {
+                "numero_nota": n,
+                "data_emissao": "2024-01-15",
+                "emitente": {"cnpj": "00000000000191", "razao_social": "Emitente Teste", "uf": "SP", "crt": "3",
+                             "regime_tributario_inferido": "Lucro Real"},
+                "destinatario": {"cnpj": "00000000000272", "razao_social": "Destinatario Teste", "uf": "RJ",
+                                 "ind_ie_dest": 1},
+                "valores_totais": {"valor_produtos": "1000.00", "valor_total_nfe": 1100.0,
+                                   "valor_total_icms_destacado": 180.0},
+            },
+            "tributos_calculados": {
+                "pis_cofins": {"regime_aplicado": "Nao cumulativo", "base_calculo_estimada": 1000.0,
+                               "aliquota_pis": 1.65, "aliquota_cofins": 7.6,
+                               "valor_pis_estimado": 16.5, "valor_cofins_estimado": 76.0},
+                "icms_geral": {"potencial_difal": True, "observacoes_difal": "Operacao interestadual"},
+                "icms_por_item": [{"item": 1, "aliquota": 12.0}],
+            },
+            "recuperacao_credito_expectativa": {"pis": 16.5, "cofins": 76.0},
+        },
+        "chave_acesso": chave,
+    }
+
+
+def percentile(values: list, fraction: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))] if ordered else 0.0
+
+
+async def timed(latencies: list, coro):
+    started = time.perf_counter()
+    result = await coro
+    latencies.append(time.perf_counter() - started)
+    return result
+
+
+async def saver(chaves: list, rounds: int, latencies: list):
+    for n in range(rounds):
+        for chave in chaves:
+            await timed(latencies, update_analise_fiscal_processamento(chave, True))
+            await timed(latencies, save_analise_fiscal(chave, build_analise(chave, n)))
+
+
+async def reader(chaves: list, stop: asyncio.Event, latencies: list):
+    while not stop.is_set():
+        for chave in chaves:
+            await timed(latencies, get_analise_fiscal_by_chave(chave))
+
+
+async def sample_locks(stop: asyncio.Event, problems: list):
+    conn = await pool.acquire()
+    try:
+        while not stop.is_set():
+            for row in await conn.fetch(LOCKS_ON_ANALISE_FISCAL_SQL):
+                problems.append(f"{row['mode']} {'granted' if row['granted'] else 'waited for'}")
+            await asyncio.sleep(0.005)
+    finally:
+        await pool.release(conn)
+
+
+def report(name: str, latencies: list):
+    print(f"{name:>8}: {len(latencies):>6} calls  avg {1000 * sum(latencies) / max(1, len(latencies)):7.2f}ms  "
+          f"p95 {1000 * percentile(latencies, 0.95):7.2f}ms  max {1000 * max(latencies, default=0):7.2f}ms")
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--notas', type=int, default=200, help="synthetic notas (one analysis each)")
+    parser.add_argument('--savers', type=int, default=8, help="concurrent saving tasks")
+    parser.add_argument('--readers', type=int, default=8, help="concurrent reading tasks")
+    parser.add_argument('--rounds', type=int, default=5, help="saves per nota")
+    args = parser.parse_args()
+
+    chaves = [f"{CHAVE_PREFIX}{n:042d}" for n in range(args.notas)]
+    # One connection per task, so pool waits don't hide (or stand in for) lock waits
+    pool.max_size = max(pool.max_size, args.savers + args.readers + 1)
+    await pool.open()
+    conn = await pool.acquire()
+    try:
+        await cleanup(conn)
+        # Current month: its partition is created ahead by the migrations
+        await conn.executemany("INSERT INTO notasfiscais (chave_acesso, data_emissao) VALUES ($1, CURRENT_DATE)",
+                               [(c,) for c in chaves])
+    finally:
+        await pool.release(conn)
+
+    save_latencies, read_latencies, problems = [], [], []
+    stop = asyncio.Event()
+    try:
+        sampler = asyncio.create_task(sample_locks(stop, problems))
+        readers = [asyncio.create_task(reader(chaves, stop, read_latencies)) for _ in range(args.readers)]
+        started = time.perf_counter()
+        # Every saver works on its own slice of notas, so no two saves touch the same row
+        await asyncio.gather(*(saver(chaves[i::args.savers], args.rounds, save_latencies)
+                               for i in range(args.savers)))
+        elapsed = time.perf_counter() - started
+        stop.set()
+        await asyncio.gather(sampler, *readers)
+    finally:
+        stop.set()
+        async with pool.connection() as conn:
+            await cleanup(conn)
+        await pool.close()
+
+    print(f"{args.savers} savers / {args.readers} readers, {len(save_latencies)} writes in {elapsed:.2f}s "
+          f"({len(save_latencies) / elapsed:.0f}/s)")
+    report("save", save_latencies)
+    report("read", read_latencies)
+    if problems:
+        print(f"❌ Lock contention on analise_fiscal: {len(problems)} samples, e.g. {sorted(set(problems))}")
+        return 1
+    print("✅ No lock waits and no ACCESS EXCLUSIVE locks on analise_fiscal")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main()))
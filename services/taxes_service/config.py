@@ -19,6 +19,22 @@ RABBITMQ_PASS = os.getenv('RABBITMQ_PASS', 'admin')
 RABBITMQ_TAXES_QUEUE = os.getenv('RABBITMQ_TAXES_QUEUE', 'taxes_calculation')
 RABBITMQ_TAXES_DLQ = os.getenv('RABBITMQ_TAXES_DLQ', 'taxes_calculation_dlq')
 RABBITMQ_MAX_RETRIES = int(os.getenv('RABBITMQ_MAX_RETRIES', '3'))
+RABBITMQ_RETRY_BASE_DELAY = float(os.getenv('RABBITMQ_RETRY_BASE_DELAY', '5'))  # seconds before the first retry, doubled for each next one
+RABBITMQ_RETRY_MAX_DELAY = float(os.getenv('RABBITMQ_RETRY_MAX_DELAY', '300'))  # upper bound of a retry delay, seconds
+RABBITMQ_RETRY_JITTER = float(os.getenv('RABBITMQ_RETRY_JITTER', '0.2'))  # +/- fraction of the delay, at random
+
+# DLQ inspection and replay (dlq_replay.py)
+REPLAY_DLQ = RABBITMQ_TAXES_DLQ
+REPLAY_QUEUE = RABBITMQ_TAXES_QUEUE
+DLQ_REPLAY_RATE = float(os.getenv('DLQ_REPLAY_RATE', '20'))  # replayed messages per second, by default
+DLQ_REPLAY_BATCH_SIZE = int(os.getenv('DLQ_REPLAY_BATCH_SIZE', '100'))  # messages published and confirmed together
+DLQ_REPLAY_MAX_QUEUE_DEPTH = int(os.getenv('DLQ_REPLAY_MAX_QUEUE_DEPTH', '1000'))  # the replay waits while the queue holds more
+DLQ_SCAN_LIMIT = int(os.getenv('DLQ_SCAN_LIMIT', '10000'))  # messages an inspection reads at most
+
+# RabbitMQ publisher (persistent connection with publisher confirms)
+PUBLISHER_CHANNELS = int(os.getenv('PUBLISHER_CHANNELS', '2'))
+PUBLISHER_MAX_IN_FLIGHT = int(os.getenv('PUBLISHER_MAX_IN_FLIGHT', '1000'))
+PUBLISH_CONFIRM_TIMEOUT = float(os.getenv('PUBLISH_CONFIRM_TIMEOUT', '30'))
 
 # Service configuration
 SERVICE_PORT = int(os.getenv('SERVICE_PORT', '8002'))
@@ -26,3 +42,35 @@ SERVICE_PORT = int(os.getenv('SERVICE_PORT', '8002'))
 # Taxes calculation webhook URL
 TAXES_WEBHOOK_URL = os.getenv('TAXES_WEBHOOK_URL', 'http://n8n:5678/webhook/taxes-nf')
 
+# Webhook dispatcher (webhook_dispatcher.py): backlog in Redis, bounded calls to n8n
+WEBHOOK_MAX_IN_FLIGHT = int(os.getenv('WEBHOOK_MAX_IN_FLIGHT', '4'))  # n8n workflows running at once, per instance
+WEBHOOK_TIMEOUT = float(os.getenv('WEBHOOK_TIMEOUT', '300'))  # seconds per webhook call
+WEBHOOK_BACKLOG_MAX = int(os.getenv('WEBHOOK_BACKLOG_MAX', '10000'))  # notas waiting before requests get 429
+WEBHOOK_RESULT_TTL = int(os.getenv('WEBHOOK_RESULT_TTL', '86400'))  # seconds the outcome of a dispatch is kept
+
+# Batches of notas sent to the taxes queue (batches.py)
+BATCH_PAGE_SIZE = int(os.getenv('BATCH_PAGE_SIZE', '500'))  # notas loaded and published per statement
+BATCH_MAX_CHAVES = int(os.getenv('BATCH_MAX_CHAVES', '10000'))  # longest chave list per request
+BATCH_STATE_TTL = int(os.getenv('BATCH_STATE_TTL', '604800'))  # seconds a batch's progress is kept
+BATCH_RESUME_INTERVAL = float(os.getenv('BATCH_RESUME_INTERVAL', '60'))  # seconds between checks for batches left without a runner
+
+
+# Database connection pool (db_pool.py)
+DB_POOL_MIN_SIZE = int(os.getenv('DB_POOL_MIN_SIZE', '2'))  # connections kept open
+DB_POOL_MAX_SIZE = int(os.getenv('DB_POOL_MAX_SIZE', '10'))  # upper bound on open connections
+DB_STATEMENT_CACHE_SIZE = int(os.getenv('DB_STATEMENT_CACHE_SIZE', '100'))  # prepared statements per connection; 0 behind pgbouncer
+DB_COMMAND_TIMEOUT = float(os.getenv('DB_COMMAND_TIMEOUT', '30'))  # default per-query timeout, seconds
+DB_POOL_ACQUIRE_TIMEOUT = float(os.getenv('DB_POOL_ACQUIRE_TIMEOUT', '10'))  # max wait for a free connection, seconds
+
+# Redis cache of the nota responses (nota_cache.py), invalidated by PostgreSQL notifications
+REDIS_HOST = os.getenv('REDIS_HOST', 'redis')
+REDIS_PORT = int(os.getenv('REDIS_PORT', '6379'))
+REDIS_DB = int(os.getenv('REDIS_DB', '0'))
+NOTA_CACHE_ENABLED = os.getenv('NOTA_CACHE_ENABLED', 'true').lower() == 'true'
+NOTA_CACHE_TTL = int(os.getenv('NOTA_CACHE_TTL', '86400'))  # seconds; only reclaims replaced versions, freshness comes from invalidation
+
+# Tax engine (tax_engine.py): NCM / ICMS rates from gov_service (gov_rates.py)
+GOV_SERVICE_URL = os.getenv('GOV_SERVICE_URL', 'http://gov-service:8003')
+GOV_SERVICE_TIMEOUT = float(os.getenv('GOV_SERVICE_TIMEOUT', '10'))  # seconds per batch request
+GOV_RATES_CACHE_TTL = float(os.getenv('GOV_RATES_CACHE_TTL', '3600'))  # seconds a looked up rate is reused
+GOV_RATES_CACHE_SIZE = int(os.getenv('GOV_RATES_CACHE_SIZE', '10000'))  # rates kept in process
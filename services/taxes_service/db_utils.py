@@ -1,20 +1,165 @@
 # db_utils.py
-import asyncpg
 import logging
 import json
 from typing import Dict, List, Optional
 from datetime import datetime, date
 
+from db_pool import DatabasePool
+from tax_engine import merge_analysis
 from config import DB_USER, DB_PASSWORD, DB_HOST, DB_PORT, DB_NAME
 
 logger = logging.getLogger(__name__)
 
 DATABASE_URL = f"postgresql://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}"
 
+# Shared connection pool, opened/closed by the app's startup/shutdown hooks
+pool = DatabasePool(DATABASE_URL)
+
+
+# The payload sent to the taxes webhook and queue, built in one statement.
+# Missing or zero numbers are null, as before; `impostos` is null when the nota
+# has no tax totals row, and an item's when it has no v_tot_trib.
+NOTA_FISCAL_DOCUMENT_JSON = """
+json_build_object(
+    'nota_fiscal', json_build_object(
+        'chave_acesso', nf.chave_acesso,
+        'modelo', nf.modelo,
+        'serie_nf', nf.serie_nf,
+        'numero_nf', nf.numero_nf,
+        'natureza_operacao', nf.natureza_operacao,
+        'data_emissao', nf.data_emissao,
+        'evento_mais_recente', nf.evento_mais_recente,
+        'data_hora_evento_mais_recente', nf.data_hora_evento_mais_recente,
+        'cpf_cnpj_emitente', nf.cpf_cnpj_emitente,
+        'razao_social_emitente', nf.razao_social_emitente,
+        'inscricao_estadual_emitente', nf.inscricao_estadual_emitente,
+        'uf_emitente', nf.uf_emitente,
+        'municipio_emitente', nf.municipio_emitente,
+        'cnpj_destinatario', nf.cnpj_destinatario,
+        'nome_destinatario', nf.nome_destinatario,
+        'uf_destinatario', nf.uf_destinatario,
+        'indicador_ie_destinatario', nf.indicador_ie_destinatario,
+        'destino_operacao', nf.destino_operacao,
+        'consumidor_final', nf.consumidor_final,
+        'presenca_comprador', nf.presenca_comprador,
+        'valor_nota_fiscal', NULLIF(nf.valor_nota_fiscal, 0),
+        'classificacao', nf.classificacao,
+        'impostos', (
+            SELECT json_build_object(
+                'v_bc_icms', NULLIF(t.v_bc_icms, 0),
+                'v_icms', NULLIF(t.v_icms, 0),
+                'v_icms_deson', NULLIF(t.v_icms_deson, 0),
+                'v_fcp_uf_dest', NULLIF(t.v_fcp_uf_dest, 0),
+                'v_icms_uf_dest', NULLIF(t.v_icms_uf_dest, 0),
+                'v_icms_uf_remet', NULLIF(t.v_icms_uf_remet, 0),
+                'v_bc_st', NULLIF(t.v_bc_st, 0),
+                'v_st', NULLIF(t.v_st, 0),
+                'v_ipi', NULLIF(t.v_ipi, 0),
+                'v_ipi_devol', NULLIF(t.v_ipi_devol, 0),
+                'v_pis', NULLIF(t.v_pis, 0),
+                'v_cofins', NULLIF(t.v_cofins, 0),
+                'v_ii', NULLIF(t.v_ii, 0),
+                'v_tot_trib', NULLIF(t.v_tot_trib, 0),
+                'v_prod', NULLIF(t.v_prod, 0),
+                'v_frete', NULLIF(t.v_frete, 0),
+                'v_seg', NULLIF(t.v_seg, 0),
+                'v_desc', NULLIF(t.v_desc, 0),
+                'v_outro', NULLIF(t.v_outro, 0),
+                'v_nf', NULLIF(t.v_nf, 0)
+            )
+            FROM impostos_nota_fiscal t
+            WHERE t.chave_acesso_nf = nf.chave_acesso
+        )
+    ),
+    'items', COALESCE((
+        SELECT json_agg(json_build_object(
+            'chave_acesso_nf', nf.chave_acesso,
+            'modelo', nf.modelo,
+            'serie_nf', nf.serie_nf,
+            'numero_nf', nf.numero_nf,
+            'natureza_operacao', nf.natureza_operacao,
+            'data_emissao', nf.data_emissao,
+            'cpf_cnpj_emitente', nf.cpf_cnpj_emitente,
+            'razao_social_emitente', nf.razao_social_emitente,
+            'inscricao_estadual_emitente', nf.inscricao_estadual_emitente,
+            'uf_emitente', nf.uf_emitente,
+            'municipio_emitente', nf.municipio_emitente,
+            'cnpj_destinatario', nf.cnpj_destinatario,
+            'nome_destinatario', nf.nome_destinatario,
+            'uf_destinatario', nf.uf_destinatario,
+            'indicador_ie_destinatario', nf.indicador_ie_destinatario,
+            'destino_operacao', nf.destino_operacao,
+            'consumidor_final', nf.consumidor_final,
+            'presenca_comprador', nf.presenca_comprador,
+            'numero_produto', i.numero_produto,
+            'descricao_produto', i.descricao_produto,
+            'codigo_ncm_sh', i.codigo_ncm_sh,
+            'ncm_sh_tipo_produto', i.ncm_sh_tipo_produto,
+            'cfop', i.cfop,
+            'quantidade', NULLIF(i.quantidade, 0),
+            'unidade', i.unidade,
+            'valor_unitario', NULLIF(i.valor_unitario, 0),
+            'valor_total', NULLIF(i.valor_total, 0),
+            'impostos', CASE WHEN imp.v_tot_trib IS NOT NULL THEN json_build_object(
+                'v_tot_trib', NULLIF(imp.v_tot_trib, 0),
+                'icms', json_build_object(
+                    'orig', imp.icms_orig,
+                    'cst', imp.icms_cst,
+                    'mod_bc', imp.icms_mod_bc,
+                    'v_bc', NULLIF(imp.icms_v_bc, 0),
+                    'p_icms', NULLIF(imp.icms_p_icms, 0),
+                    'v_icms', NULLIF(imp.icms_v_icms, 0)
+                ),
+                'icms_uf_dest', json_build_object(
+                    'v_bc_uf_dest', NULLIF(imp.icms_uf_v_bc_uf_dest, 0),
+                    'v_bc_fcp_uf_dest', NULLIF(imp.icms_uf_v_bc_fcp_uf_dest, 0),
+                    'p_fcp_uf_dest', NULLIF(imp.icms_uf_p_fcp_uf_dest, 0),
+                    'p_icms_uf_dest', NULLIF(imp.icms_uf_p_icms_uf_dest, 0),
+                    'p_icms_inter', NULLIF(imp.icms_uf_p_icms_inter, 0),
+                    'p_icms_inter_part', NULLIF(imp.icms_uf_p_icms_inter_part, 0),
+                    'v_fcp_uf_dest', NULLIF(imp.icms_uf_v_fcp_uf_dest, 0),
+                    'v_icms_uf_dest', NULLIF(imp.icms_uf_v_icms_uf_dest, 0),
+                    'v_icms_uf_remet', NULLIF(imp.icms_uf_v_icms_uf_remet, 0)
+                ),
+                'ipi', json_build_object(
+                    'c_enq', imp.ipi_c_enq,
+                    'cst', imp.ipi_cst,
+                    'v_bc', NULLIF(imp.ipi_v_bc, 0),
+                    'p_ipi', NULLIF(imp.ipi_p_ipi, 0),
+                    'v_ipi', NULLIF(imp.ipi_v_ipi, 0)
+                ),
+                'pis', json_build_object(
+                    'cst', imp.pis_cst,
+                    'v_bc', NULLIF(imp.pis_v_bc, 0),
+                    'p_pis', NULLIF(imp.pis_p_pis, 0),
+                    'v_pis', NULLIF(imp.pis_v_pis, 0)
+                ),
+                'cofins', json_build_object(
+                    'cst', imp.cofins_cst,
+                    'v_bc', NULLIF(imp.cofins_v_bc, 0),
+                    'p_cofins', NULLIF(imp.cofins_p_cofins, 0),
+                    'v_cofins', NULLIF(imp.cofins_v_cofins, 0)
+                )
+            ) END
+        ) ORDER BY i.numero_produto)
+        FROM itens_nota i
+        LEFT JOIN impostos_item imp ON imp.id_item_nf = i.id_item_nf AND imp.data_emissao = i.data_emissao
+        WHERE i.chave_acesso_nf = nf.chave_acesso AND i.data_emissao = nf.data_emissao
+    ), '[]'::json)
+)
+"""
+
+NOTA_FISCAL_DOCUMENT_SQL = (
+    "SELECT " + NOTA_FISCAL_DOCUMENT_JSON + "::text\n"
+    "FROM notasfiscais nf\n"
+    "WHERE nf.chave_acesso = $1"
+)
+
 
 async def get_nota_fiscal_by_chave(chave_acesso: str) -> Optional[Dict]:
     """
-    Retrieve nota fiscal and its items from database by chave_acesso
+    Retrieve nota fiscal and its items from database by chave_acesso.
+    The whole document is built by one query (NOTA_FISCAL_DOCUMENT_SQL).
     
     Args:
         chave_acesso: Access key of the nota fiscal
@@ -24,220 +169,61 @@ async def get_nota_fiscal_by_chave(chave_acesso: str) -> Optional[Dict]:
     """
     conn = None
     try:
-        conn = await asyncpg.connect(DATABASE_URL)
-        
-        # Query nota fiscal header
-        nf_query = """
-        SELECT 
-            chave_acesso, modelo, serie_nf, numero_nf, natureza_operacao, data_emissao,
-            evento_mais_recente, data_hora_evento_mais_recente, cpf_cnpj_emitente, 
-            razao_social_emitente, inscricao_estadual_emitente, uf_emitente, 
-            municipio_emitente, cnpj_destinatario, nome_destinatario, uf_destinatario, 
-            indicador_ie_destinatario, destino_operacao, consumidor_final, 
-            presenca_comprador, valor_nota_fiscal, classificacao
-        FROM notasfiscais
-        WHERE chave_acesso = $1
-        """
-        
-        nf_row = await conn.fetchrow(nf_query, chave_acesso)
+        conn = await pool.acquire()
+        document = await conn.fetchval(NOTA_FISCAL_DOCUMENT_SQL, chave_acesso)
         
-        if not nf_row:
+        if document is None:
             logger.warning(f"Nota fiscal not found: {chave_acesso}")
             return None
         
-        # Convert nota fiscal row to dict
-        nota_fiscal = {
-            'chave_acesso': nf_row['chave_acesso'],
-            'modelo': nf_row['modelo'],
-            'serie_nf': nf_row['serie_nf'],
-            'numero_nf': nf_row['numero_nf'],
-            'natureza_operacao': nf_row['natureza_operacao'],
-            'data_emissao': nf_row['data_emissao'].isoformat() if nf_row['data_emissao'] else None,
-            'evento_mais_recente': nf_row['evento_mais_recente'],
-            'data_hora_evento_mais_recente': nf_row['data_hora_evento_mais_recente'].isoformat() if nf_row['data_hora_evento_mais_recente'] else None,
-            'cpf_cnpj_emitente': nf_row['cpf_cnpj_emitente'],
-            'razao_social_emitente': nf_row['razao_social_emitente'],
-            'inscricao_estadual_emitente': nf_row['inscricao_estadual_emitente'],
-            'uf_emitente': nf_row['uf_emitente'],
-            'municipio_emitente': nf_row['municipio_emitente'],
-            'cnpj_destinatario': nf_row['cnpj_destinatario'],
-            'nome_destinatario': nf_row['nome_destinatario'],
-            'uf_destinatario': nf_row['uf_destinatario'],
-            'indicador_ie_destinatario': nf_row['indicador_ie_destinatario'],
-            'destino_operacao': nf_row['destino_operacao'],
-            'consumidor_final': nf_row['consumidor_final'],
-            'presenca_comprador': nf_row['presenca_comprador'],
-            'valor_nota_fiscal': float(nf_row['valor_nota_fiscal']) if nf_row['valor_nota_fiscal'] else None,
-            'classificacao': nf_row['classificacao']
-        }
-        
-        # Query impostos totais da nota
-        impostos_nota_query = """
-        SELECT 
-            v_bc_icms, v_icms, v_icms_deson, v_fcp_uf_dest, v_icms_uf_dest, v_icms_uf_remet,
-            v_bc_st, v_st, v_ipi, v_ipi_devol, v_pis, v_cofins, v_ii, v_tot_trib,
-            v_prod, v_frete, v_seg, v_desc, v_outro, v_nf
-        FROM impostos_nota_fiscal
-        WHERE chave_acesso_nf = $1
-        """
-        
-        impostos_nota_row = await conn.fetchrow(impostos_nota_query, chave_acesso)
-        
-        # Add impostos to nota_fiscal if available
-        if impostos_nota_row:
-            nota_fiscal['impostos'] = {
-                'v_bc_icms': float(impostos_nota_row['v_bc_icms']) if impostos_nota_row['v_bc_icms'] else None,
-                'v_icms': float(impostos_nota_row['v_icms']) if impostos_nota_row['v_icms'] else None,
-                'v_icms_deson': float(impostos_nota_row['v_icms_deson']) if impostos_nota_row['v_icms_deson'] else None,
-                'v_fcp_uf_dest': float(impostos_nota_row['v_fcp_uf_dest']) if impostos_nota_row['v_fcp_uf_dest'] else None,
-                'v_icms_uf_dest': float(impostos_nota_row['v_icms_uf_dest']) if impostos_nota_row['v_icms_uf_dest'] else None,
-                'v_icms_uf_remet': float(impostos_nota_row['v_icms_uf_remet']) if impostos_nota_row['v_icms_uf_remet'] else None,
-                'v_bc_st': float(impostos_nota_row['v_bc_st']) if impostos_nota_row['v_bc_st'] else None,
-                'v_st': float(impostos_nota_row['v_st']) if impostos_nota_row['v_st'] else None,
-                'v_ipi': float(impostos_nota_row['v_ipi']) if impostos_nota_row['v_ipi'] else None,
-                'v_ipi_devol': float(impostos_nota_row['v_ipi_devol']) if impostos_nota_row['v_ipi_devol'] else None,
-                'v_pis': float(impostos_nota_row['v_pis']) if impostos_nota_row['v_pis'] else None,
-                'v_cofins': float(impostos_nota_row['v_cofins']) if impostos_nota_row['v_cofins'] else None,
-                'v_ii': float(impostos_nota_row['v_ii']) if impostos_nota_row['v_ii'] else None,
-                'v_tot_trib': float(impostos_nota_row['v_tot_trib']) if impostos_nota_row['v_tot_trib'] else None,
-                'v_prod': float(impostos_nota_row['v_prod']) if impostos_nota_row['v_prod'] else None,
-                'v_frete': float(impostos_nota_row['v_frete']) if impostos_nota_row['v_frete'] else None,
-                'v_seg': float(impostos_nota_row['v_seg']) if impostos_nota_row['v_seg'] else None,
-                'v_desc': float(impostos_nota_row['v_desc']) if impostos_nota_row['v_desc'] else None,
-                'v_outro': float(impostos_nota_row['v_outro']) if impostos_nota_row['v_outro'] else None,
-                'v_nf': float(impostos_nota_row['v_nf']) if impostos_nota_row['v_nf'] else None
-            }
-        
-        # Query items with tax data
-        items_query = """
-        SELECT 
-            i.chave_acesso_nf, i.modelo, i.serie_nf, i.numero_nf, i.natureza_operacao, i.data_emissao,
-            i.cpf_cnpj_emitente, i.razao_social_emitente, i.inscricao_estadual_emitente, 
-            i.uf_emitente, i.municipio_emitente, i.cnpj_destinatario, i.nome_destinatario, 
-            i.uf_destinatario, i.indicador_ie_destinatario, i.destino_operacao, 
-            i.consumidor_final, i.presenca_comprador, i.numero_produto, i.descricao_produto, 
-            i.codigo_ncm_sh, i.ncm_sh_tipo_produto, i.cfop, i.quantidade, i.unidade, 
-            i.valor_unitario, i.valor_total,
-            imp.v_tot_trib, imp.icms_orig, imp.icms_cst, imp.icms_mod_bc, imp.icms_v_bc, 
-            imp.icms_p_icms, imp.icms_v_icms,
-            imp.icms_uf_v_bc_uf_dest, imp.icms_uf_v_bc_fcp_uf_dest, imp.icms_uf_p_fcp_uf_dest,
-            imp.icms_uf_p_icms_uf_dest, imp.icms_uf_p_icms_inter, imp.icms_uf_p_icms_inter_part,
-            imp.icms_uf_v_fcp_uf_dest, imp.icms_uf_v_icms_uf_dest, imp.icms_uf_v_icms_uf_remet,
-            imp.ipi_c_enq, imp.ipi_cst, imp.ipi_v_bc, imp.ipi_p_ipi, imp.ipi_v_ipi,
-            imp.pis_cst, imp.pis_v_bc, imp.pis_p_pis, imp.pis_v_pis,
-            imp.cofins_cst, imp.cofins_v_bc, imp.cofins_p_cofins, imp.cofins_v_cofins
-        FROM itensnotafiscal i
-        LEFT JOIN impostos_item imp ON i.id_item_nf = imp.id_item_nf
-        WHERE i.chave_acesso_nf = $1
-        ORDER BY i.numero_produto
-        """
-        
-        items_rows = await conn.fetch(items_query, chave_acesso)
-        
-        # Convert items to list of dicts
-        items = []
-        for item_row in items_rows:
-            item = {
-                'chave_acesso_nf': item_row['chave_acesso_nf'],
-                'modelo': item_row['modelo'],
-                'serie_nf': item_row['serie_nf'],
-                'numero_nf': item_row['numero_nf'],
-                'natureza_operacao': item_row['natureza_operacao'],
-                'data_emissao': item_row['data_emissao'].isoformat() if item_row['data_emissao'] else None,
-                'cpf_cnpj_emitente': item_row['cpf_cnpj_emitente'],
-                'razao_social_emitente': item_row['razao_social_emitente'],
-                'inscricao_estadual_emitente': item_row['inscricao_estadual_emitente'],
-                'uf_emitente': item_row['uf_emitente'],
-                'municipio_emitente': item_row['municipio_emitente'],
-                'cnpj_destinatario': item_row['cnpj_destinatario'],
-                'nome_destinatario': item_row['nome_destinatario'],
-                'uf_destinatario': item_row['uf_destinatario'],
-                'indicador_ie_destinatario': item_row['indicador_ie_destinatario'],
-                'destino_operacao': item_row['destino_operacao'],
-                'consumidor_final': item_row['consumidor_final'],
-                'presenca_comprador': item_row['presenca_comprador'],
-                'numero_produto': item_row['numero_produto'],
-                'descricao_produto': item_row['descricao_produto'],
-                'codigo_ncm_sh': item_row['codigo_ncm_sh'],
-                'ncm_sh_tipo_produto': item_row['ncm_sh_tipo_produto'],
-                'cfop': item_row['cfop'],
-                'quantidade': float(item_row['quantidade']) if item_row['quantidade'] else None,
-                'unidade': item_row['unidade'],
-                'valor_unitario': float(item_row['valor_unitario']) if item_row['valor_unitario'] else None,
-                'valor_total': float(item_row['valor_total']) if item_row['valor_total'] else None
-            }
-            
-            # Add tax data if available (LEFT JOIN may return NULL)
-            if item_row['v_tot_trib'] is not None:
-                item['impostos'] = {
-                    'v_tot_trib': float(item_row['v_tot_trib']) if item_row['v_tot_trib'] else None,
-                    'icms': {
-                        'orig': item_row['icms_orig'],
-                        'cst': item_row['icms_cst'],
-                        'mod_bc': item_row['icms_mod_bc'],
-                        'v_bc': float(item_row['icms_v_bc']) if item_row['icms_v_bc'] else None,
-                        'p_icms': float(item_row['icms_p_icms']) if item_row['icms_p_icms'] else None,
-                        'v_icms': float(item_row['icms_v_icms']) if item_row['icms_v_icms'] else None
-                    },
-                    'icms_uf_dest': {
-                        'v_bc_uf_dest': float(item_row['icms_uf_v_bc_uf_dest']) if item_row['icms_uf_v_bc_uf_dest'] else None,
-                        'v_bc_fcp_uf_dest': float(item_row['icms_uf_v_bc_fcp_uf_dest']) if item_row['icms_uf_v_bc_fcp_uf_dest'] else None,
-                        'p_fcp_uf_dest': float(item_row['icms_uf_p_fcp_uf_dest']) if item_row['icms_uf_p_fcp_uf_dest'] else None,
-                        'p_icms_uf_dest': float(item_row['icms_uf_p_icms_uf_dest']) if item_row['icms_uf_p_icms_uf_dest'] else None,
-                        'p_icms_inter': float(item_row['icms_uf_p_icms_inter']) if item_row['icms_uf_p_icms_inter'] else None,
-                        'p_icms_inter_part': float(item_row['icms_uf_p_icms_inter_part']) if item_row['icms_uf_p_icms_inter_part'] else None,
-                        'v_fcp_uf_dest': float(item_row['icms_uf_v_fcp_uf_dest']) if item_row['icms_uf_v_fcp_uf_dest'] else None,
-                        'v_icms_uf_dest': float(item_row['icms_uf_v_icms_uf_dest']) if item_row['icms_uf_v_icms_uf_dest'] else None,
-                        'v_icms_uf_remet': float(item_row['icms_uf_v_icms_uf_remet']) if item_row['icms_uf_v_icms_uf_remet'] else None
-                    },
-                    'ipi': {
-                        'c_enq': item_row['ipi_c_enq'],
-                        'cst': item_row['ipi_cst'],
-                        'v_bc': float(item_row['ipi_v_bc']) if item_row['ipi_v_bc'] else None,
-                        'p_ipi': float(item_row['ipi_p_ipi']) if item_row['ipi_p_ipi'] else None,
-                        'v_ipi': float(item_row['ipi_v_ipi']) if item_row['ipi_v_ipi'] else None
-                    },
-                    'pis': {
-                        'cst': item_row['pis_cst'],
-                        'v_bc': float(item_row['pis_v_bc']) if item_row['pis_v_bc'] else None,
-                        'p_pis': float(item_row['pis_p_pis']) if item_row['pis_p_pis'] else None,
-                        'v_pis': float(item_row['pis_v_pis']) if item_row['pis_v_pis'] else None
-                    },
-                    'cofins': {
-                        'cst': item_row['cofins_cst'],
-                        'v_bc': float(item_row['cofins_v_bc']) if item_row['cofins_v_bc'] else None,
-                        'p_cofins': float(item_row['cofins_p_cofins']) if item_row['cofins_p_cofins'] else None,
-                        'v_cofins': float(item_row['cofins_v_cofins']) if item_row['cofins_v_cofins'] else None
-                    }
-                }
-            
-            items.append(item)
-        
-        logger.info(f"Retrieved nota fiscal {chave_acesso} with {len(items)} items")
-        
-        return {
-            'nota_fiscal': nota_fiscal,
-            'items': items
-        }
+        nota_fiscal_data = json.loads(document)
+        logger.info(f"Retrieved nota fiscal {chave_acesso} with {len(nota_fiscal_data['items'])} items")
+        return nota_fiscal_data
         
     except Exception as e:
         logger.error(f"Error retrieving nota fiscal from database: {e}", exc_info=True)
         return None
     finally:
         if conn:
-            await conn.close()
+            await pool.release(conn)
+
+
+async def get_notas_fiscais_page(conditions: List[str], args: list, limit: int,
+                                 database: DatabasePool = pool) -> List[Dict]:
+    """
+    Documents of a page of notas fiscais in (data_emissao, chave_acesso) order,
+    built by one statement (NOTA_FISCAL_DOCUMENT_JSON for every row).
+
+    Args:
+        conditions: WHERE conditions on notasfiscais (alias nf), their values in args
+        limit: Notas in the page
+
+    Returns:
+        Dicts with 'nota_fiscal' and 'items', as get_nota_fiscal_by_chave
+    """
+    args = [*args, limit]
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+    sql = (
+        "SELECT " + NOTA_FISCAL_DOCUMENT_JSON + "::text AS document\n"
+        f"FROM notasfiscais nf\n{where}\n"
+        f"ORDER BY nf.data_emissao, nf.chave_acesso\nLIMIT ${len(args)}"
+    )
+    async with database.connection() as conn:
+        rows = await conn.fetch(sql, *args)
+    return [json.loads(row["document"]) for row in rows]
 
 
 async def get_database_statistics():
     """Get database statistics for status reporting"""
     conn = None
     try:
-        conn = await asyncpg.connect(DATABASE_URL)
+        conn = await pool.acquire()
         
         stats_query = """
-        SELECT 
-            (SELECT COUNT(*) FROM notasfiscais) as notas_fiscais,
-            (SELECT COUNT(*) FROM itensnotafiscal) as itens_nota_fiscal
+        SELECT
+            SUM(notas)::bigint as notas_fiscais,
+            SUM(itens)::bigint as itens_nota_fiscal
+        FROM nfe_stats
         """
         
         stats = await conn.fetchrow(stats_query)
@@ -260,283 +246,303 @@ async def get_database_statistics():
         }
     finally:
         if conn:
-            await conn.close()
+            await pool.release(conn)
+
+
+# Column types analise_fiscal must have; older deployments created some of them smaller
+ANALISE_FISCAL_COLUMN_TYPES = {
+    "ind_ie_dest": "VARCHAR(50)",
+    "numero_nota": "VARCHAR(50)",
+    "razao_social_emitente": "TEXT",
+    "razao_social_destinatario": "TEXT",
+    "regime_tributario_inferido": "VARCHAR(100)",
+    "regime_pis_cofins": "VARCHAR(100)",
+}
+
+CREATE_ANALISE_FISCAL_TABLE_SQL = """
+CREATE TABLE IF NOT EXISTS analise_fiscal (
+    id SERIAL PRIMARY KEY,
+    chave_acesso VARCHAR(44) NOT NULL UNIQUE,
+    numero_nota VARCHAR(50),
+    data_emissao DATE,
+    cnpj_emitente VARCHAR(18),
+    razao_social_emitente TEXT,
+    uf_emitente VARCHAR(2),
+    crt INTEGER,
+    regime_tributario_inferido VARCHAR(100),
+    cnpj_destinatario VARCHAR(18),
+    razao_social_destinatario TEXT,
+    uf_destinatario VARCHAR(2),
+    ind_ie_dest VARCHAR(50),
+    valor_produtos DECIMAL(15,2),
+    valor_total_nfe DECIMAL(15,2),
+    valor_total_icms_destacado DECIMAL(15,2),
+    regime_pis_cofins VARCHAR(100),
+    base_calculo_pis_cofins DECIMAL(15,2),
+    aliquota_pis DECIMAL(5,2),
+    aliquota_cofins DECIMAL(5,2),
+    valor_pis_estimado DECIMAL(15,2),
+    valor_cofins_estimado DECIMAL(15,2),
+    observacoes_pis_cofins TEXT,
+    icms_por_item JSONB,
+    potencial_difal BOOLEAN,
+    observacoes_difal TEXT,
+    recuperacao_credito JSONB,
+    dados_completos JSONB,
+    em_processamento BOOLEAN DEFAULT FALSE,
+    data_criacao TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    data_atualizacao TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    -- No foreign key to notasfiscais: it is partitioned by data_emissao and
+    -- chave_acesso alone is no longer unique there (see migration 0003)
+);
+
+CREATE INDEX IF NOT EXISTS idx_analise_fiscal_processamento ON analise_fiscal(em_processamento);
+"""
+
+UPSERT_ANALISE_FISCAL_SQL = """
+INSERT INTO analise_fiscal (
+    chave_acesso,
+    numero_nota,
+    data_emissao,
+    cnpj_emitente,
+    razao_social_emitente,
+    uf_emitente,
+    crt,
+    regime_tributario_inferido,
+    cnpj_destinatario,
+    razao_social_destinatario,
+    uf_destinatario,
+    ind_ie_dest,
+    valor_produtos,
+    valor_total_nfe,
+    valor_total_icms_destacado,
+    regime_pis_cofins,
+    base_calculo_pis_cofins,
+    aliquota_pis,
+    aliquota_cofins,
+    valor_pis_estimado,
+    valor_cofins_estimado,
+    observacoes_pis_cofins,
+    icms_por_item,
+    potencial_difal,
+    observacoes_difal,
+    recuperacao_credito,
+    dados_completos,
+    em_processamento,
+    data_atualizacao
+) VALUES (
+    $1, $2, $3, $4, $5, $6, $7, $8, $9, $10, $11, $12, $13, $14, $15,
+    $16, $17, $18, $19, $20, $21, $22, $23, $24, $25, $26, $27, $28,
+    CURRENT_TIMESTAMP
+)
+ON CONFLICT (chave_acesso)
+DO UPDATE SET
+    numero_nota = EXCLUDED.numero_nota,
+    data_emissao = EXCLUDED.data_emissao,
+    cnpj_emitente = EXCLUDED.cnpj_emitente,
+    razao_social_emitente = EXCLUDED.razao_social_emitente,
+    uf_emitente = EXCLUDED.uf_emitente,
+    crt = EXCLUDED.crt,
+    regime_tributario_inferido = EXCLUDED.regime_tributario_inferido,
+    cnpj_destinatario = EXCLUDED.cnpj_destinatario,
+    razao_social_destinatario = EXCLUDED.razao_social_destinatario,
+    uf_destinatario = EXCLUDED.uf_destinatario,
+    ind_ie_dest = EXCLUDED.ind_ie_dest,
+    valor_produtos = EXCLUDED.valor_produtos,
+    valor_total_nfe = EXCLUDED.valor_total_nfe,
+    valor_total_icms_destacado = EXCLUDED.valor_total_icms_destacado,
+    regime_pis_cofins = EXCLUDED.regime_pis_cofins,
+    base_calculo_pis_cofins = EXCLUDED.base_calculo_pis_cofins,
+    aliquota_pis = EXCLUDED.aliquota_pis,
+    aliquota_cofins = EXCLUDED.aliquota_cofins,
+    valor_pis_estimado = EXCLUDED.valor_pis_estimado,
+    valor_cofins_estimado = EXCLUDED.valor_cofins_estimado,
+    observacoes_pis_cofins = EXCLUDED.observacoes_pis_cofins,
+    icms_por_item = EXCLUDED.icms_por_item,
+    potencial_difal = EXCLUDED.potencial_difal,
+    observacoes_difal = EXCLUDED.observacoes_difal,
+    recuperacao_credito = EXCLUDED.recuperacao_credito,
+    dados_completos = EXCLUDED.dados_completos,
+    em_processamento = EXCLUDED.em_processamento,
+    data_atualizacao = CURRENT_TIMESTAMP
+RETURNING id
+"""
+
+# Saves of one nota take this lock first (it also covers notas without a row
+# yet); the stored analysis is read in a later statement, so its snapshot sees
+# the save that held the lock before
+LOCK_ANALISE_FISCAL_SQL = "SELECT pg_advisory_xact_lock(hashtext('analise_fiscal:' || $1))"
+SELECT_ANALISE_FISCAL_STORED_SQL = (
+    "SELECT dados_completos::text AS dados, em_processamento FROM analise_fiscal WHERE chave_acesso = $1"
+)
+
+# Insert-or-update of the processing flag in one statement. The INSERT only
+# produces a row when the nota fiscal exists; xmax = 0 tells a fresh insert
+# apart from an update.
+UPSERT_ANALISE_PROCESSAMENTO_SQL = """
+INSERT INTO analise_fiscal (chave_acesso, em_processamento, data_criacao, data_atualizacao)
+SELECT chave_acesso, $2, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP
+FROM notasfiscais WHERE chave_acesso = $1
+ON CONFLICT (chave_acesso)
+DO UPDATE SET
+    em_processamento = EXCLUDED.em_processamento,
+    data_atualizacao = CURRENT_TIMESTAMP
+RETURNING id, em_processamento, data_atualizacao, (xmax = 0) AS created
+"""
 
 
 async def ensure_analise_fiscal_table():
-    """Create analise_fiscal table if it doesn't exist"""
+    """
+    Create analise_fiscal if it doesn't exist and widen columns left with old sizes.
+
+    Runs once at startup (see main.startup_event), never on the request path:
+    the ALTERs take an ACCESS EXCLUSIVE lock, so they are only issued for
+    columns whose type actually differs.
+    """
     conn = None
     try:
-        conn = await asyncpg.connect(DATABASE_URL)
-        
-        create_table_query = """
-        CREATE TABLE IF NOT EXISTS analise_fiscal (
-            id SERIAL PRIMARY KEY,
-            chave_acesso VARCHAR(44) NOT NULL UNIQUE,
-            numero_nota VARCHAR(50),
-            data_emissao DATE,
-            cnpj_emitente VARCHAR(18),
-            razao_social_emitente TEXT,
-            uf_emitente VARCHAR(2),
-            crt INTEGER,
-            regime_tributario_inferido VARCHAR(100),
-            cnpj_destinatario VARCHAR(18),
-            razao_social_destinatario TEXT,
-            uf_destinatario VARCHAR(2),
-            ind_ie_dest VARCHAR(50),
-            valor_produtos DECIMAL(15,2),
-            valor_total_nfe DECIMAL(15,2),
-            valor_total_icms_destacado DECIMAL(15,2),
-            regime_pis_cofins VARCHAR(100),
-            base_calculo_pis_cofins DECIMAL(15,2),
-            aliquota_pis DECIMAL(5,2),
-            aliquota_cofins DECIMAL(5,2),
-            valor_pis_estimado DECIMAL(15,2),
-            valor_cofins_estimado DECIMAL(15,2),
-            observacoes_pis_cofins TEXT,
-            icms_por_item JSONB,
-            potencial_difal BOOLEAN,
-            observacoes_difal TEXT,
-            recuperacao_credito JSONB,
-            dados_completos JSONB,
-            em_processamento BOOLEAN DEFAULT FALSE,
-            data_criacao TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            data_atualizacao TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (chave_acesso) REFERENCES notasfiscais(chave_acesso) ON DELETE CASCADE
-        );
-        
-        CREATE INDEX IF NOT EXISTS idx_analise_fiscal_processamento ON analise_fiscal(em_processamento);
-        
-        -- Alter columns if table already exists with wrong sizes
-        DO $$ 
-        BEGIN
-            -- Increase ind_ie_dest from VARCHAR(1) to VARCHAR(50)
-            ALTER TABLE analise_fiscal ALTER COLUMN ind_ie_dest TYPE VARCHAR(50);
-        EXCEPTION
-            WHEN others THEN NULL;
-        END $$;
-        
-        DO $$ 
-        BEGIN
-            -- Increase numero_nota from VARCHAR(20) to VARCHAR(50)
-            ALTER TABLE analise_fiscal ALTER COLUMN numero_nota TYPE VARCHAR(50);
-        EXCEPTION
-            WHEN others THEN NULL;
-        END $$;
-        
-        DO $$ 
-        BEGIN
-            -- Change razao_social_emitente to TEXT
-            ALTER TABLE analise_fiscal ALTER COLUMN razao_social_emitente TYPE TEXT;
-        EXCEPTION
-            WHEN others THEN NULL;
-        END $$;
-        
-        DO $$ 
-        BEGIN
-            -- Change razao_social_destinatario to TEXT
-            ALTER TABLE analise_fiscal ALTER COLUMN razao_social_destinatario TYPE TEXT;
-        EXCEPTION
-            WHEN others THEN NULL;
-        END $$;
-        
-        DO $$ 
-        BEGIN
-            -- Increase regime_tributario_inferido from VARCHAR(50) to VARCHAR(100)
-            ALTER TABLE analise_fiscal ALTER COLUMN regime_tributario_inferido TYPE VARCHAR(100);
-        EXCEPTION
-            WHEN others THEN NULL;
-        END $$;
-        
-        DO $$ 
-        BEGIN
-            -- Increase regime_pis_cofins from VARCHAR(50) to VARCHAR(100)
-            ALTER TABLE analise_fiscal ALTER COLUMN regime_pis_cofins TYPE VARCHAR(100);
-        EXCEPTION
-            WHEN others THEN NULL;
-        END $$;
-        """
-        
-        await conn.execute(create_table_query)
+        conn = await pool.acquire()
+
+        await conn.execute(CREATE_ANALISE_FISCAL_TABLE_SQL)
+
+        rows = await conn.fetch("""
+            SELECT a.attname AS column_name, format_type(a.atttypid, a.atttypmod) AS column_type
+            FROM pg_attribute a
+            WHERE a.attrelid = 'analise_fiscal'::regclass AND a.attnum > 0 AND NOT a.attisdropped
+              AND a.attname = ANY($1::text[])
+        """, list(ANALISE_FISCAL_COLUMN_TYPES))
+        current = {row["column_name"]: row["column_type"] for row in rows}
+
+        for column, column_type in ANALISE_FISCAL_COLUMN_TYPES.items():
+            if current.get(column, "").lower() == column_type.lower().replace("varchar", "character varying"):
+                continue
+            try:
+                await conn.execute(f"ALTER TABLE analise_fiscal ALTER COLUMN {column} TYPE {column_type}")
+                logger.info(f"Column analise_fiscal.{column} changed to {column_type}")
+            except Exception as e:
+                logger.warning(f"Could not change analise_fiscal.{column} to {column_type}: {e}")
+
         logger.info("Table analise_fiscal created or already exists")
-        
+
     except Exception as e:
         logger.error(f"Error creating analise_fiscal table: {e}")
         raise
     finally:
         if conn:
-            await conn.close()
+            await pool.release(conn)
+
+
+def _to_number(value, default=None, is_int=False):
+    """Safely convert to number (handles both string and numeric inputs)"""
+    if value is None:
+        return default
+    try:
+        if isinstance(value, (int, float, str)):
+            return int(value) if is_int else float(value)
+        return default
+    except (ValueError, TypeError):
+        return default
+
+
+def _to_string(value, default=None):
+    """Safely convert to string (handles both string and numeric inputs)"""
+    if value is None:
+        return default
+    try:
+        return str(value)
+    except Exception:
+        return default
+
 
+def build_analise_fiscal_params(chave_acesso: str, dados_analise: dict, em_processamento: bool = False) -> tuple:
+    """Parameters of UPSERT_ANALISE_FISCAL_SQL extracted from the analysis JSON"""
+    analise = dados_analise.get("analise_fiscal", {})
+    info_nfe = analise.get("info_nfe", {})
+    emitente = info_nfe.get("emitente", {})
+    destinatario = info_nfe.get("destinatario", {})
+    valores_totais = info_nfe.get("valores_totais", {})
+    tributos = analise.get("tributos_calculados", {})
+    pis_cofins = tributos.get("pis_cofins", {})
+    icms_geral = tributos.get("icms_geral", {})
+    icms_por_item = tributos.get("icms_por_item", [])
+    recuperacao = analise.get("recuperacao_credito_expectativa", {})
 
-async def save_analise_fiscal(chave_acesso: str, dados_analise: dict, em_processamento: bool = False):
-    """Save fiscal analysis data to database"""
+    # Convert date string to date object if needed
+    data_emissao = info_nfe.get("data_emissao")
+    if data_emissao and isinstance(data_emissao, str):
+        try:
+            data_emissao = datetime.strptime(data_emissao, "%Y-%m-%d").date()
+        except ValueError:
+            data_emissao = None
+
+    return (
+        chave_acesso,
+        _to_string(info_nfe.get("numero_nota")),
+        data_emissao,
+        _to_string(emitente.get("cnpj")),
+        emitente.get("razao_social"),
+        emitente.get("uf"),
+        _to_number(emitente.get("crt"), is_int=True),
+        emitente.get("regime_tributario_inferido"),
+        _to_string(destinatario.get("cnpj")),
+        destinatario.get("razao_social"),
+        destinatario.get("uf"),
+        _to_string(destinatario.get("ind_ie_dest")),
+        _to_number(valores_totais.get("valor_produtos")),
+        _to_number(valores_totais.get("valor_total_nfe")),
+        _to_number(valores_totais.get("valor_total_icms_destacado")),
+        pis_cofins.get("regime_aplicado"),
+        _to_number(pis_cofins.get("base_calculo_estimada")),
+        _to_number(pis_cofins.get("aliquota_pis")),
+        _to_number(pis_cofins.get("aliquota_cofins")),
+        _to_number(pis_cofins.get("valor_pis_estimado")),
+        _to_number(pis_cofins.get("valor_cofins_estimado")),
+        pis_cofins.get("observacoes"),
+        # JSONB fields as JSON strings
+        json.dumps(icms_por_item) if icms_por_item else None,
+        icms_geral.get("potencial_difal"),
+        icms_geral.get("observacoes_difal"),
+        json.dumps(recuperacao) if recuperacao else None,
+        json.dumps(dados_analise) if dados_analise else None,
+        em_processamento
+    )
+
+
+async def save_analise_fiscal(chave_acesso: str, dados_analise: dict, em_processamento: Optional[bool] = False,
+                              database: DatabasePool = pool):
+    """
+    Save fiscal analysis data to database.
+
+    The tax engine (worker) and the LLM analysis (POST /analise_fiscal) both
+    save here, in any order: tax_engine.merge_analysis keeps the calculated
+    values and the LLM narrative of whichever was stored before. Saves of the
+    same nota are serialized by a transaction-level advisory lock, so neither
+    is lost, and the upsert stays prepared in the connection's statement
+    cache. The table is set up once at startup (ensure_analise_fiscal_table).
+
+    Args:
+        em_processamento: None keeps the stored flag (the n8n analysis may be running)
+        database: Pool of the caller's event loop (the worker thread has its own)
+    """
     conn = None
     try:
-        conn = await asyncpg.connect(DATABASE_URL)
-        
-        # Ensure table exists
-        await ensure_analise_fiscal_table()
-        
-        # Extract data from JSON
-        analise = dados_analise.get("analise_fiscal", {})
-        info_nfe = analise.get("info_nfe", {})
-        emitente = info_nfe.get("emitente", {})
-        destinatario = info_nfe.get("destinatario", {})
-        valores_totais = info_nfe.get("valores_totais", {})
-        tributos = analise.get("tributos_calculados", {})
-        pis_cofins = tributos.get("pis_cofins", {})
-        icms_geral = tributos.get("icms_geral", {})
-        icms_por_item = tributos.get("icms_por_item", [])
-        recuperacao = analise.get("recuperacao_credito_expectativa", {})
-        
-        # Convert date string to date object if needed
-        data_emissao = info_nfe.get("data_emissao")
-        if data_emissao and isinstance(data_emissao, str):
-            try:
-                data_emissao = datetime.strptime(data_emissao, "%Y-%m-%d").date()
-            except ValueError:
-                data_emissao = None
-        
-        # Convert JSONB fields to JSON strings
-        icms_por_item_json = json.dumps(icms_por_item) if icms_por_item else None
-        recuperacao_json = json.dumps(recuperacao) if recuperacao else None
-        dados_completos_json = json.dumps(dados_analise) if dados_analise else None
-        
-        # Helper function to safely convert to number (handles both string and numeric inputs)
-        def to_number(value, default=None, is_int=False):
-            if value is None:
-                return default
-            try:
-                # If already a number, just ensure correct type
-                if isinstance(value, (int, float)):
-                    return int(value) if is_int else float(value)
-                # If string, convert to number
-                elif isinstance(value, str):
-                    return int(value) if is_int else float(value)
-                else:
-                    return default
-            except (ValueError, TypeError):
-                return default
-        
-        # Helper function to safely convert to string (handles both string and numeric inputs)
-        def to_string(value, default=None):
-            if value is None:
-                return default
-            try:
-                return str(value)
-            except:
-                return default
-        
-        # Insert or update
-        query = """
-        INSERT INTO analise_fiscal (
-            chave_acesso,
-            numero_nota,
-            data_emissao,
-            cnpj_emitente,
-            razao_social_emitente,
-            uf_emitente,
-            crt,
-            regime_tributario_inferido,
-            cnpj_destinatario,
-            razao_social_destinatario,
-            uf_destinatario,
-            ind_ie_dest,
-            valor_produtos,
-            valor_total_nfe,
-            valor_total_icms_destacado,
-            regime_pis_cofins,
-            base_calculo_pis_cofins,
-            aliquota_pis,
-            aliquota_cofins,
-            valor_pis_estimado,
-            valor_cofins_estimado,
-            observacoes_pis_cofins,
-            icms_por_item,
-            potencial_difal,
-            observacoes_difal,
-            recuperacao_credito,
-            dados_completos,
-            em_processamento,
-            data_atualizacao
-        ) VALUES (
-            $1, $2, $3, $4, $5, $6, $7, $8, $9, $10, $11, $12, $13, $14, $15,
-            $16, $17, $18, $19, $20, $21, $22, $23, $24, $25, $26, $27, $28,
-            CURRENT_TIMESTAMP
-        )
-        ON CONFLICT (chave_acesso) 
-        DO UPDATE SET
-            numero_nota = EXCLUDED.numero_nota,
-            data_emissao = EXCLUDED.data_emissao,
-            cnpj_emitente = EXCLUDED.cnpj_emitente,
-            razao_social_emitente = EXCLUDED.razao_social_emitente,
-            uf_emitente = EXCLUDED.uf_emitente,
-            crt = EXCLUDED.crt,
-            regime_tributario_inferido = EXCLUDED.regime_tributario_inferido,
-            cnpj_destinatario = EXCLUDED.cnpj_destinatario,
-            razao_social_destinatario = EXCLUDED.razao_social_destinatario,
-            uf_destinatario = EXCLUDED.uf_destinatario,
-            ind_ie_dest = EXCLUDED.ind_ie_dest,
-            valor_produtos = EXCLUDED.valor_produtos,
-            valor_total_nfe = EXCLUDED.valor_total_nfe,
-            valor_total_icms_destacado = EXCLUDED.valor_total_icms_destacado,
-            regime_pis_cofins = EXCLUDED.regime_pis_cofins,
-            base_calculo_pis_cofins = EXCLUDED.base_calculo_pis_cofins,
-            aliquota_pis = EXCLUDED.aliquota_pis,
-            aliquota_cofins = EXCLUDED.aliquota_cofins,
-            valor_pis_estimado = EXCLUDED.valor_pis_estimado,
-            valor_cofins_estimado = EXCLUDED.valor_cofins_estimado,
-            observacoes_pis_cofins = EXCLUDED.observacoes_pis_cofins,
-            icms_por_item = EXCLUDED.icms_por_item,
-            potencial_difal = EXCLUDED.potencial_difal,
-            observacoes_difal = EXCLUDED.observacoes_difal,
-            recuperacao_credito = EXCLUDED.recuperacao_credito,
-            dados_completos = EXCLUDED.dados_completos,
-            em_processamento = EXCLUDED.em_processamento,
-            data_atualizacao = CURRENT_TIMESTAMP
-        RETURNING id;
-        """
-        
-        result = await conn.fetchval(
-            query,
-            chave_acesso,
-            to_string(info_nfe.get("numero_nota")),
-            data_emissao,
-            to_string(emitente.get("cnpj")),
-            emitente.get("razao_social"),
-            emitente.get("uf"),
-            to_number(emitente.get("crt"), is_int=True),
-            emitente.get("regime_tributario_inferido"),
-            to_string(destinatario.get("cnpj")),
-            destinatario.get("razao_social"),
-            destinatario.get("uf"),
-            to_string(destinatario.get("ind_ie_dest")),
-            to_number(valores_totais.get("valor_produtos")),
-            to_number(valores_totais.get("valor_total_nfe")),
-            to_number(valores_totais.get("valor_total_icms_destacado")),
-            pis_cofins.get("regime_aplicado"),
-            to_number(pis_cofins.get("base_calculo_estimada")),
-            to_number(pis_cofins.get("aliquota_pis")),
-            to_number(pis_cofins.get("aliquota_cofins")),
-            to_number(pis_cofins.get("valor_pis_estimado")),
-            to_number(pis_cofins.get("valor_cofins_estimado")),
-            pis_cofins.get("observacoes"),
-            icms_por_item_json,
-            icms_geral.get("potencial_difal"),
-            icms_geral.get("observacoes_difal"),
-            recuperacao_json,
-            dados_completos_json,
-            em_processamento
-        )
-        
-        return result
-        
+        conn = await database.acquire()
+        async with conn.transaction():
+            await conn.execute(LOCK_ANALISE_FISCAL_SQL, chave_acesso)
+            stored = await conn.fetchrow(SELECT_ANALISE_FISCAL_STORED_SQL, chave_acesso)
+            if em_processamento is None:
+                em_processamento = bool(stored and stored["em_processamento"])
+            existing = json.loads(stored["dados"]) if stored and stored["dados"] else None
+            dados_analise = merge_analysis(existing, dados_analise)
+            params = build_analise_fiscal_params(chave_acesso, dados_analise, em_processamento)
+            return await conn.fetchval(UPSERT_ANALISE_FISCAL_SQL, *params)
+
     except Exception as e:
         logger.error(f"Error saving analise fiscal: {e}")
         raise
     finally:
         if conn:
-            await conn.close()
+            await database.release(conn)
 
 
 async def update_analise_fiscal_processamento(chave_acesso: str, em_processamento: bool):
@@ -546,90 +552,42 @@ async def update_analise_fiscal_processamento(chave_acesso: str, em_processament
     """
     conn = None
     try:
-        conn = await asyncpg.connect(DATABASE_URL)
-        
-        # Ensure table exists
-        await ensure_analise_fiscal_table()
-        
-        # Check if analise_fiscal record exists
-        check_analise_query = "SELECT id FROM analise_fiscal WHERE chave_acesso = $1"
-        analise_id = await conn.fetchval(check_analise_query, chave_acesso)
-        
-        if not analise_id:
-            # Analise doesn't exist, check if nota fiscal exists
-            check_nota_query = "SELECT chave_acesso FROM notasfiscais WHERE chave_acesso = $1"
-            nota_exists = await conn.fetchval(check_nota_query, chave_acesso)
-            
-            if not nota_exists:
-                logger.warning(f"Nota fiscal not found for chave_acesso: {chave_acesso}")
-                return {
-                    "error": "nota_fiscal_not_found",
-                    "message": f"Nota fiscal não encontrada para chave_acesso: {chave_acesso}"
-                }
-            
-            # Nota fiscal exists, create analise_fiscal record
-            logger.info(f"Analise fiscal not found for chave_acesso: {chave_acesso}, creating new record")
-            
-            insert_query = """
-            INSERT INTO analise_fiscal (
-                chave_acesso,
-                em_processamento,
-                data_criacao,
-                data_atualizacao
-            ) VALUES (
-                $1, $2, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP
-            )
-            RETURNING id, em_processamento, data_atualizacao
-            """
-            
-            result = await conn.fetchrow(insert_query, chave_acesso, em_processamento)
-            
-            if result:
-                logger.info(f"Created new analise fiscal with em_processamento={em_processamento} for chave_acesso: {chave_acesso}")
-                return {
-                    "id": result["id"],
-                    "chave_acesso": chave_acesso,
-                    "em_processamento": result["em_processamento"],
-                    "data_atualizacao": result["data_atualizacao"].isoformat() if result["data_atualizacao"] else None,
-                    "created": True
-                }
+        conn = await pool.acquire()
+
+        result = await conn.fetchrow(UPSERT_ANALISE_PROCESSAMENTO_SQL, chave_acesso, em_processamento)
+
+        if not result:
+            logger.warning(f"Nota fiscal not found for chave_acesso: {chave_acesso}")
+            return {
+                "error": "nota_fiscal_not_found",
+                "message": f"Nota fiscal não encontrada para chave_acesso: {chave_acesso}"
+            }
+
+        if result["created"]:
+            logger.info(f"Created new analise fiscal with em_processamento={em_processamento} for chave_acesso: {chave_acesso}")
         else:
-            # Analise exists, update it
-            update_query = """
-            UPDATE analise_fiscal 
-            SET em_processamento = $1, 
-                data_atualizacao = CURRENT_TIMESTAMP
-            WHERE chave_acesso = $2
-            RETURNING id, em_processamento, data_atualizacao
-            """
-            
-            result = await conn.fetchrow(update_query, em_processamento, chave_acesso)
-            
-            if result:
-                logger.info(f"Updated em_processamento to {em_processamento} for chave_acesso: {chave_acesso}")
-                return {
-                    "id": result["id"],
-                    "chave_acesso": chave_acesso,
-                    "em_processamento": result["em_processamento"],
-                    "data_atualizacao": result["data_atualizacao"].isoformat() if result["data_atualizacao"] else None,
-                    "created": False
-                }
-        
-        return None
-        
+            logger.info(f"Updated em_processamento to {em_processamento} for chave_acesso: {chave_acesso}")
+        return {
+            "id": result["id"],
+            "chave_acesso": chave_acesso,
+            "em_processamento": result["em_processamento"],
+            "data_atualizacao": result["data_atualizacao"].isoformat() if result["data_atualizacao"] else None,
+            "created": result["created"]
+        }
+
     except Exception as e:
         logger.error(f"Error updating/creating em_processamento: {e}")
         raise
     finally:
         if conn:
-            await conn.close()
+            await pool.release(conn)
 
 
 async def get_analise_fiscal_by_chave(chave_acesso: str):
     """Get fiscal analysis by chave_acesso"""
     conn = None
     try:
-        conn = await asyncpg.connect(DATABASE_URL)
+        conn = await pool.acquire()
         
         query = """
         SELECT 
@@ -732,5 +690,5 @@ async def get_analise_fiscal_by_chave(chave_acesso: str):
         raise
     finally:
         if conn:
-            await conn.close()
+            await pool.release(conn)
 
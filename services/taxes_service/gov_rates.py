@@ -0,0 +1,124 @@
+# gov_rates.py
+"""
+NCM and ICMS rates from gov_service, for the tax engine (tax_engine.py).
+
+One nota needs one POST /ncm/consultar_lote for its NCMs and one POST
+/icms/consultar_lote for its (UF origem, UF destino, NCM) combinations, and
+only for those not already known: gov_service returns the same values for the
+same keys, so they are kept in process for GOV_RATES_CACHE_TTL seconds (at
+most GOV_RATES_CACHE_SIZE keys, oldest dropped first). Calls share one
+keep-alive session. NCMs that are not 8 digits are not looked up; the engine
+falls back to the rates on the nota for them.
+"""
+import logging
+import re
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Iterable, Optional, Tuple
+
+import requests
+
+from config import GOV_SERVICE_URL, GOV_SERVICE_TIMEOUT, GOV_RATES_CACHE_TTL, GOV_RATES_CACHE_SIZE
+
+logger = logging.getLogger(__name__)
+
+_UF = re.compile(r'^[A-Z]{2}$')
+
+
+def normalize_ncm(value) -> Optional[str]:
+    """The 8-digit NCM of an item, or None"""
+    digits = re.sub(r'\D', '', str(value or ''))
+    return digits if len(digits) == 8 else None
+
+
+class GovRates:
+    """
+    Args:
+        base_url: gov_service URL
+        timeout: Seconds per request
+        ttl: Seconds a looked up rate is reused
+        max_entries: Keys kept in process
+    """
+
+    def __init__(self, base_url: str = GOV_SERVICE_URL, timeout: float = GOV_SERVICE_TIMEOUT,
+                 ttl: float = GOV_RATES_CACHE_TTL, max_entries: int = GOV_RATES_CACHE_SIZE):
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._session = requests.Session()
+        self._cache = OrderedDict()  # key -> (expires at, data)
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.lookups = 0
+
+    def _get(self, key):
+        with self._lock:
+            entry = self._cache.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                return None
+            return entry[1]
+
+    def _put(self, key, data):
+        with self._lock:
+            self._cache[key] = (time.monotonic() + self.ttl, data)
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.max_entries:
+                self._cache.popitem(last=False)
+
+    def _post(self, path: str, payload: Dict) -> list:
+        response = self._session.post(f"{self.base_url}{path}", json=payload, timeout=self.timeout)
+        response.raise_for_status()
+        result = response.json()
+        for error in result.get('erros', []):
+            logger.warning(f"gov_service {path}: {error}")
+        return result.get('resultados', [])
+
+    def lookup(self, uf_origem: Optional[str], uf_destino: Optional[str],
+               ncms: Iterable) -> Tuple[Dict[str, Dict], Dict[str, Dict]]:
+        """
+        Rates of the NCMs of a nota
+
+        Returns:
+            (NCM -> /ncm/consultar data, NCM -> /icms/consultar_aliquotas data for
+            uf_origem -> uf_destino); NCMs gov_service could not answer are missing
+
+        Raises:
+            requests.RequestException: gov_service unavailable
+        """
+        ncms = sorted({ncm for ncm in (normalize_ncm(value) for value in ncms) if ncm})
+        uf_origem, uf_destino = (uf_origem or '').strip().upper(), (uf_destino or '').strip().upper()
+        with_icms = bool(_UF.match(uf_origem) and _UF.match(uf_destino))
+
+        ncm_rates, icms_rates = {}, {}
+        missing_ncm, missing_icms = [], []
+        for ncm in ncms:
+            self.lookups += 1
+            data = self._get(('ncm', ncm))
+            if data is None:
+                missing_ncm.append(ncm)
+            else:
+                self.hits += 1
+                ncm_rates[ncm] = data
+            if with_icms:
+                data = self._get(('icms', uf_origem, uf_destino, ncm))
+                if data is None:
+                    missing_icms.append(ncm)
+                else:
+                    icms_rates[ncm] = data
+
+        if missing_ncm:
+            for data in self._post('/ncm/consultar_lote', {'ncms': missing_ncm}):
+                self._put(('ncm', data['ncm']), data)
+                ncm_rates[data['ncm']] = data
+        if missing_icms:
+            consultas = [{'uf_origem': uf_origem, 'uf_destino': uf_destino, 'ncm': ncm} for ncm in missing_icms]
+            for data in self._post('/icms/consultar_lote', {'consultas': consultas}):
+                self._put(('icms', uf_origem, uf_destino, data['ncm']), data)
+                icms_rates[data['ncm']] = data
+        return ncm_rates, icms_rates
+
+    def metrics(self) -> Dict:
+        return {"cached": len(self._cache), "lookups": self.lookups, "hits": self.hits}
@@ -1,17 +1,23 @@
 # main.py
 import uvicorn
-from fastapi import FastAPI, HTTPException, status
+from fastapi import FastAPI, HTTPException, Request, status
 from pydantic import BaseModel
+from datetime import date
+from typing import List, Optional
+import asyncio
 import logging
 import threading
-import requests
 import json
 import re
 
 from config import SERVICE_PORT, TAXES_WEBHOOK_URL
-from db_utils import get_nota_fiscal_by_chave, get_database_statistics, save_analise_fiscal, update_analise_fiscal_processamento, get_analise_fiscal_by_chave
-from rabbitmq_client import publish_to_taxes_queue
+from db_utils import DATABASE_URL, pool, get_nota_fiscal_by_chave, get_database_statistics, ensure_analise_fiscal_table, save_analise_fiscal, update_analise_fiscal_processamento, get_analise_fiscal_by_chave
+from rabbitmq_client import publish_to_taxes_queue, close_publisher
 from rabbitmq_worker import start_consumer
+from nota_cache import NotaCache
+from webhook_dispatcher import WebhookDispatcher
+from batches import BatchRunner
+from dlq_replay import DLQReplayer, ReplayBusy
 
 app = FastAPI(title="Taxes Service", version="1.0.0")
 
@@ -19,11 +25,43 @@ app = FastAPI(title="Taxes Service", version="1.0.0")
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Read-through cache of the analise fiscal responses, invalidated by database notifications
+cache = NotaCache(DATABASE_URL)
+
+# Notas waiting for the n8n taxes webhook, sent a few at a time
+dispatcher = WebhookDispatcher(get_nota_fiscal_by_chave)
+
+# Background batches of notas sent to the taxes queue
+batches = BatchRunner(dispatcher)
+
+# Inspection and throttled replay of the taxes DLQ
+replays = DLQReplayer()
+
 
 class TaxesCalculationRequest(BaseModel):
     chave_acesso: str
 
 
+class TaxesBatchRequest(BaseModel):
+    chaves: Optional[List[str]] = None
+    emitente: Optional[str] = None
+    destinatario: Optional[str] = None
+    uf_emitente: Optional[str] = None
+    uf_destinatario: Optional[str] = None
+    classificacao: Optional[str] = None
+    data_inicio: Optional[date] = None
+    data_fim: Optional[date] = None
+    nao_analisadas: bool = False
+    webhook: bool = False
+
+
+class DLQReplayRequest(BaseModel):
+    groups: Optional[List[str]] = None
+    all: bool = False
+    rate: Optional[float] = None
+    max_messages: Optional[int] = None
+
+
 class AnaliseFiscalRequest(BaseModel):
     texto: str
 
@@ -35,6 +73,18 @@ class UpdateProcessamentoRequest(BaseModel):
 
 @app.on_event("startup")
 async def startup_event():
+    try:
+        await pool.open()
+    except Exception as e:
+        logger.warning(f"Database pool not opened at startup, retrying on first use: {e}")
+    try:
+        # Schema setup runs once here; the save endpoints only run their upserts
+        await ensure_analise_fiscal_table()
+    except Exception as e:
+        logger.warning(f"analise_fiscal table not checked at startup: {e}")
+    await cache.start()
+    await dispatcher.start()
+    await batches.start()
     logger.info("Taxes service started successfully")
     
     # Start RabbitMQ consumer in a separate thread
@@ -43,6 +93,16 @@ async def startup_event():
     logger.info("RabbitMQ consumer worker started in background")
 
 
+@app.on_event("shutdown")
+async def shutdown_event():
+    await asyncio.to_thread(replays.close)
+    await batches.close()
+    close_publisher()
+    await dispatcher.close()
+    await cache.close()
+    await pool.close()
+
+
 @app.get("/health")
 async def health_check():
     """Health check endpoint"""
@@ -58,7 +118,12 @@ async def status_check():
             "status": "online",
             "service": "taxes_service",
             "version": "1.0.0",
-            **db_stats
+            **db_stats,
+            "db_pool": pool.metrics(),
+            "nota_cache": cache.metrics(),
+            "webhook_dispatcher": await dispatcher.metrics(),
+            "batches": batches.metrics(),
+            "dlq_replay": replays.metrics()
         }
     except Exception as e:
         logger.error(f"Error getting status: {e}")
@@ -74,8 +139,11 @@ async def status_check():
 @app.post("/calculate-taxes/")
 async def calculate_taxes(request: TaxesCalculationRequest):
     """
-    Retrieve a nota fiscal from database by chave_acesso and send it to 
-    the taxes calculation queue.
+    Retrieve a nota fiscal from database by chave_acesso, queue it for the
+    N8N taxes webhook and send it to the taxes calculation queue.
+    
+    Answers 429 (Retry-After) while WEBHOOK_BACKLOG_MAX notas wait for the
+    webhook; otherwise webhook_response gives the nota's place in the backlog.
     
     Args:
         request: TaxesCalculationRequest with chave_acesso
@@ -111,47 +179,27 @@ async def calculate_taxes(request: TaxesCalculationRequest):
         logger.info(f"   Emitente: {nota_fiscal.get('razao_social_emitente')}")
         logger.info(f"   Destinatário: {nota_fiscal.get('nome_destinatario')}")
         logger.info(f"   Items: {len(items)}")
-        logger.info(f"   Valor Total: R$ {nota_fiscal.get('valor_nota_fiscal', 0):.2f}")
-        
-        # Step 2: Send to N8N webhook for taxes processing (async - don't wait for response)
-        logger.info(f"🔄 Step 2: Sending to N8N taxes webhook: {TAXES_WEBHOOK_URL}")
-        webhook_url = TAXES_WEBHOOK_URL
-        
-        # Enviar webhook de forma assíncrona (não aguardar resposta)
-        # O processamento pode levar vários minutos, então não esperamos
-        def send_webhook_async():
-            try:
-                logger.info("📡 Enviando webhook para N8N (assíncrono)...")
-                webhook_response = requests.post(
-                    webhook_url,
-                    json=nota_fiscal_data,
-                    headers={'Content-Type': 'application/json'},
-                    timeout=300  # 5 minutos de timeout
-                )
-                webhook_response.raise_for_status()
-                webhook_result = webhook_response.json()
-                
-                # Print webhook response
-                print("=" * 80)
-                print("🎯 RESPOSTA DO WEBHOOK N8N - TAXES:")
-                print("=" * 80)
-                print(json.dumps(webhook_result, indent=2, ensure_ascii=False))
-                print("=" * 80)
-                
-                logger.info(f"✅ Webhook response received: {webhook_response.status_code}")
-                
-            except requests.exceptions.Timeout:
-                logger.warning("⏱️  Timeout calling N8N webhook (5min)")
-            except requests.exceptions.ConnectionError as e:
-                logger.warning(f"🔌 Connection error calling N8N webhook: {e}")
-            except Exception as e:
-                logger.warning(f"⚠️  Error calling N8N webhook: {e}")
-        
-        # Iniciar thread para enviar webhook sem bloquear
-        webhook_thread = threading.Thread(target=send_webhook_async, daemon=True)
-        webhook_thread.start()
-        
-        webhook_result = {"status": "processing", "message": "Webhook enviado para processamento assíncrono"}
+        logger.info(f"   Valor Total: R$ {nota_fiscal.get('valor_nota_fiscal') or 0:.2f}")
+        
+        # Step 2: Queue for the N8N webhook; the dispatcher sends it when a slot is free
+        logger.info(f"🔄 Step 2: Queueing for N8N taxes webhook: {TAXES_WEBHOOK_URL}")
+        try:
+            webhook_result = await dispatcher.enqueue(chave_acesso)
+        except Exception as e:
+            logger.warning(f"⚠️  Webhook backlog unavailable, nota not sent to N8N: {e}")
+            webhook_result = {"status": "unavailable", "message": "Fila do webhook indisponível"}
+        
+        if webhook_result["status"] == "backlog_full":
+            raise HTTPException(
+                status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+                detail={
+                    "message": "Too many notas waiting for the taxes webhook, try again later",
+                    "backlog": webhook_result["backlog"]
+                },
+                headers={"Retry-After": "60"}
+            )
+        logger.info(f"   Webhook: {webhook_result['status']} (position {webhook_result.get('position')}, "
+                    f"backlog {webhook_result.get('backlog')})")
         
         # Step 3: Publish to taxes calculation queue
         logger.info("📤 Step 3: Publishing to taxes calculation queue...")
@@ -188,6 +236,122 @@ async def calculate_taxes(request: TaxesCalculationRequest):
         )
 
 
+@app.post("/calculate-taxes/batch", status_code=status.HTTP_202_ACCEPTED)
+async def calculate_taxes_batch(request: TaxesBatchRequest):
+    """
+    Send many notas fiscais to the taxes calculation queue in the background.
+    
+    Selects the notas by `chaves`, or by filters (emitente, destinatario,
+    UFs, classificacao, data_inicio/data_fim) and/or `nao_analisadas` (no
+    analise fiscal saved yet). With `webhook`, they are also queued for the
+    N8N taxes webhook.
+    
+    Returns:
+        batch_id and progress counters; follow them at GET /calculate-taxes/batch/{batch_id}
+    """
+    try:
+        batch = await batches.create(**request.dict())
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+    except Exception as e:
+        logger.error(f"Error creating taxes batch: {e}", exc_info=True)
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Error creating taxes batch: {str(e)}"
+        )
+    return {**batch, "status_url": f"/calculate-taxes/batch/{batch['batch_id']}"}
+
+
+@app.get("/calculate-taxes/batch/{batch_id}")
+async def get_taxes_batch(batch_id: str):
+    """
+    Progress of a batch: status, notas selected/published/failed, chaves
+    skipped (not found or already analysed), webhook counters
+    """
+    batch = await batches.get(batch_id)
+    if not batch:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Batch {batch_id} not found")
+    return batch
+
+
+@app.get("/dlq")
+async def inspect_dlq(offset: int = 0, limit: int = 20):
+    """
+    Messages of the taxes calculation dead-letter queue, counted per group (x-death-reason
+    without the error message), and the page [offset, offset + limit) of them.
+    Nothing is removed from the queue.
+    """
+    try:
+        return await asyncio.to_thread(replays.inspect, offset, limit)
+    except ReplayBusy as e:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=str(e))
+    except Exception as e:
+        logger.error(f"Error inspecting DLQ: {e}", exc_info=True)
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail=f"Error inspecting DLQ: {str(e)}"
+        )
+
+
+@app.post("/dlq/replay", status_code=status.HTTP_202_ACCEPTED)
+async def replay_dlq(request: DLQReplayRequest):
+    """
+    Move the messages of the selected groups (or `all`) back to their queue,
+    at most `rate` per second, with their retry headers reset.
+    
+    Returns:
+        replay_id and progress counters; follow them at GET /dlq/replay/{replay_id}
+    """
+    try:
+        replay = await asyncio.to_thread(
+            replays.start, request.groups, request.all, request.rate, request.max_messages
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+    except ReplayBusy as e:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=str(e))
+    if replay["status"] == "failed":
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail=f"Error replaying DLQ: {replay['error']}"
+        )
+    return {**replay, "status_url": f"/dlq/replay/{replay['replay_id']}"}
+
+
+@app.get("/dlq/replay/{replay_id}")
+async def get_dlq_replay(replay_id: str):
+    """Progress of a replay: messages visited, replayed (per group) and kept in the DLQ"""
+    replay = replays.get(replay_id)
+    if not replay:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Replay {replay_id} not found")
+    return replay
+
+
+@app.post("/dlq/replay/{replay_id}/stop")
+async def stop_dlq_replay(replay_id: str):
+    """Stop a replay after its current batch; the messages not replayed stay in the DLQ"""
+    replay = replays.stop(replay_id)
+    if not replay:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Replay {replay_id} not found")
+    return replay
+
+
+@app.get("/calculate-taxes/{chave_acesso}/webhook")
+async def get_webhook_status(chave_acesso: str):
+    """
+    Place of a nota in the N8N webhook backlog, or the outcome of its last
+    dispatch (queue wait and webhook latency)
+    """
+    try:
+        return {"chave_acesso": chave_acesso, **await dispatcher.status(chave_acesso)}
+    except Exception as e:
+        logger.error(f"Error getting webhook status: {e}", exc_info=True)
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail=f"Webhook backlog unavailable: {str(e)}"
+        )
+
+
 def clean_json_text(text: str) -> str:
     """Clean markdown code blocks and other formatting from JSON text"""
     # Remove markdown code blocks (```json ... ``` or ``` ... ```)
@@ -317,9 +481,11 @@ async def update_processamento(request: UpdateProcessamentoRequest):
 
 
 @app.get("/analise_fiscal/{chave_acesso}")
-async def get_analise_fiscal(chave_acesso: str):
+async def get_analise_fiscal(chave_acesso: str, request: Request):
     """
-    Get fiscal analysis by chave_acesso
+    Get fiscal analysis by chave_acesso. Cached until the analysis changes
+    (also while it is not found); send the ETag back as If-None-Match to get
+    304 while it has not.
     
     Args:
         chave_acesso: Access key of the nota fiscal
@@ -327,7 +493,7 @@ async def get_analise_fiscal(chave_acesso: str):
     Returns:
         Fiscal analysis data or None if not found
     """
-    try:
+    async def load():
         logger.info(f"Fetching analise fiscal for chave_acesso: {chave_acesso}")
         
         analise = await get_analise_fiscal_by_chave(chave_acesso)
@@ -344,7 +510,9 @@ async def get_analise_fiscal(chave_acesso: str):
             "found": True,
             "analise": analise
         }
-        
+
+    try:
+        return await cache.respond(request, "analise_fiscal", chave_acesso, load)
     except Exception as e:
         logger.error(f"Error getting analise fiscal: {e}", exc_info=True)
         raise HTTPException(
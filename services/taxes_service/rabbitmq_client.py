@@ -2,12 +2,37 @@
 import pika
 import json
 import logging
-from typing import Dict
+import threading
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from typing import Dict, List
 
-from config import RABBITMQ_HOST, RABBITMQ_PORT, RABBITMQ_USER, RABBITMQ_PASS, RABBITMQ_TAXES_QUEUE
+from config import (
+    RABBITMQ_HOST, RABBITMQ_PORT, RABBITMQ_USER, RABBITMQ_PASS, RABBITMQ_TAXES_QUEUE,
+    PUBLISHER_CHANNELS, PUBLISHER_MAX_IN_FLIGHT, PUBLISH_CONFIRM_TIMEOUT
+)
+from rabbitmq_publisher import ConfirmingPublisher
 
 logger = logging.getLogger(__name__)
 
+MESSAGE_PROPERTIES = pika.BasicProperties(
+    delivery_mode=pika.DeliveryMode.Persistent,
+    content_type='application/json'
+)
+
+_publisher = None
+_publisher_lock = threading.Lock()
+
+
+def get_connection_parameters() -> pika.ConnectionParameters:
+    credentials = pika.PlainCredentials(RABBITMQ_USER, RABBITMQ_PASS)
+    return pika.ConnectionParameters(
+        host=RABBITMQ_HOST,
+        port=RABBITMQ_PORT,
+        credentials=credentials,
+        heartbeat=600,
+        blocked_connection_timeout=300
+    )
+
 
 def get_rabbitmq_connection(retries=5, delay=2):
     """Get RabbitMQ connection with retry logic"""
@@ -15,15 +40,7 @@ def get_rabbitmq_connection(retries=5, delay=2):
     
     for attempt in range(retries):
         try:
-            credentials = pika.PlainCredentials(RABBITMQ_USER, RABBITMQ_PASS)
-            parameters = pika.ConnectionParameters(
-                host=RABBITMQ_HOST,
-                port=RABBITMQ_PORT,
-                credentials=credentials,
-                heartbeat=600,
-                blocked_connection_timeout=300
-            )
-            connection = pika.BlockingConnection(parameters)
+            connection = pika.BlockingConnection(get_connection_parameters())
             logger.info("Successfully connected to RabbitMQ")
             return connection
         except Exception as e:
@@ -34,6 +51,29 @@ def get_rabbitmq_connection(retries=5, delay=2):
                 raise
 
 
+def get_publisher() -> ConfirmingPublisher:
+    """Get the process-wide publisher (connects on first use)"""
+    global _publisher
+    with _publisher_lock:
+        if _publisher is None:
+            _publisher = ConfirmingPublisher(
+                get_connection_parameters(),
+                queues=[RABBITMQ_TAXES_QUEUE],
+                channels=PUBLISHER_CHANNELS,
+                max_in_flight=PUBLISHER_MAX_IN_FLIGHT
+            )
+        return _publisher
+
+
+def close_publisher():
+    """Close the publisher connection, if it was opened"""
+    global _publisher
+    with _publisher_lock:
+        if _publisher is not None:
+            _publisher.close()
+            _publisher = None
+
+
 def publish_to_taxes_queue(data: Dict) -> bool:
     """
     Publish nota fiscal to taxes calculation queue
@@ -42,41 +82,51 @@ def publish_to_taxes_queue(data: Dict) -> bool:
         data: Nota fiscal data (dict with 'nota_fiscal' and 'items')
         
     Returns:
-        bool: True if published successfully, False otherwise
+        bool: True if the broker confirmed the message, False otherwise
     """
-    connection = None
     try:
-        # Connect to RabbitMQ
-        connection = get_rabbitmq_connection()
-        channel = connection.channel()
-        
-        # Declare queue (idempotent operation)
-        channel.queue_declare(queue=RABBITMQ_TAXES_QUEUE, durable=True)
-        
         # Convert data to JSON
         message = json.dumps(data, ensure_ascii=False, default=str)
-        
-        # Publish message
-        channel.basic_publish(
-            exchange='',
-            routing_key=RABBITMQ_TAXES_QUEUE,
-            body=message,
-            properties=pika.BasicProperties(
-                delivery_mode=pika.DeliveryMode.Persistent,
-                content_type='application/json'
-            )
-        )
-        
-        logger.info(f"📤 Published nota fiscal to taxes queue: {data['nota_fiscal'].get('chave_acesso')}")
-        logger.info(f"   Queue: {RABBITMQ_TAXES_QUEUE}")
-        logger.info(f"   Items: {len(data['items'])}")
-        
-        return True
-        
+        confirmed = get_publisher().publish(RABBITMQ_TAXES_QUEUE, message, MESSAGE_PROPERTIES).result(PUBLISH_CONFIRM_TIMEOUT)
+    except FutureTimeoutError:
+        confirmed = False
     except Exception as e:
         logger.error(f"Error publishing to taxes queue: {e}", exc_info=True)
         return False
-    finally:
-        if connection and not connection.is_closed:
-            connection.close()
+    
+    if not confirmed:
+        logger.error(f"RabbitMQ did not confirm nota fiscal on taxes queue: {data['nota_fiscal'].get('chave_acesso')}")
+        return False
+    
+    logger.info(f"📤 Published nota fiscal to taxes queue: {data['nota_fiscal'].get('chave_acesso')}")
+    logger.info(f"   Queue: {RABBITMQ_TAXES_QUEUE}")
+    logger.info(f"   Items: {len(data['items'])}")
+    
+    return True
 
+
+def publish_many_to_taxes_queue(datas: List[Dict]) -> List[bool]:
+    """
+    Publish many notas fiscais to the taxes calculation queue, pipelined
+    
+    Args:
+        datas: List of nota fiscal data dicts (with 'nota_fiscal' and 'items')
+        
+    Returns:
+        List[bool]: Per message, True if the broker confirmed it
+    """
+    if not datas:
+        return []
+    
+    try:
+        results = get_publisher().publish_many(
+            ((RABBITMQ_TAXES_QUEUE, json.dumps(data, ensure_ascii=False, default=str)) for data in datas),
+            MESSAGE_PROPERTIES,
+            timeout=PUBLISH_CONFIRM_TIMEOUT
+        )
+    except Exception as e:
+        logger.error(f"Error publishing batch to taxes queue: {e}", exc_info=True)
+        return [False] * len(datas)
+    
+    logger.info(f"📤 Published {sum(results)}/{len(datas)} notas fiscais to taxes queue")
+    return results
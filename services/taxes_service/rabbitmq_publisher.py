@@ -0,0 +1,311 @@
+# rabbitmq_publisher.py
+"""
+Long-lived RabbitMQ publisher with asynchronous publisher confirms.
+
+One SelectConnection runs on a background I/O thread and keeps a small pool of
+confirm-mode channels open; queues are declared once per connection. Callers
+on any thread hand messages to the I/O thread and get a Future that resolves
+to True when the broker acks the message and to False when it nacks it (or
+the connection drops before it is confirmed). Many messages can be in flight
+at once, bounded by max_in_flight, instead of paying a connection handshake
+and a confirm round-trip per message.
+"""
+import itertools
+import logging
+import threading
+import time
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from typing import Iterable, List, Optional, Sequence, Tuple
+
+import pika
+from pika.adapters.select_connection import IOLoop
+
+logger = logging.getLogger(__name__)
+
+
+class _ConfirmChannel:
+    """A confirm-mode channel and the deliveries it is waiting on"""
+
+    def __init__(self, channel):
+        self.channel = channel
+        self.next_tag = 1
+        self.pending = {}  # delivery tag -> Future, in publish order
+
+
+class ConfirmingPublisher:
+    """
+    Thread-safe publisher over a persistent connection.
+
+    Args:
+        parameters: Connection parameters
+        queues: Durable queues to declare once per connection
+        channels: Number of confirm-mode channels messages are spread over
+        max_in_flight: Maximum unconfirmed messages; publish() blocks beyond it
+        connect_timeout: Seconds publish() waits for the connection before failing the message
+        reconnect_delay: Seconds between reconnection attempts
+    """
+
+    def __init__(self, parameters: pika.ConnectionParameters, queues: Sequence[str] = (),
+                 channels: int = 2, max_in_flight: int = 1000,
+                 connect_timeout: float = 30.0, reconnect_delay: float = 2.0):
+        self._parameters = parameters
+        self._queues = list(queues)
+        self._channel_count = max(1, channels)
+        self._connect_timeout = connect_timeout
+        self._reconnect_delay = reconnect_delay
+
+        self._in_flight = threading.BoundedSemaphore(max_in_flight)
+        self._ready = threading.Event()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._closing = False
+        self._ioloop = None
+
+        # Messages handed to the I/O loop but not yet published
+        self._queued = set()
+        self._queued_lock = threading.Lock()
+
+        # Only touched from the I/O thread
+        self._connection = None
+        self._channels: List[_ConfirmChannel] = []
+        self._round_robin = None
+
+    # ------------------------------------------------------------------
+    # Caller side
+    # ------------------------------------------------------------------
+
+    def start(self):
+        """Start the I/O thread (idempotent)"""
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._closing = False
+                # One loop for the publisher's lifetime, so callbacks queued during a reconnect survive it
+                self._ioloop = self._ioloop or IOLoop()
+                self._thread = threading.Thread(target=self._run, name="rabbitmq-publisher", daemon=True)
+                self._thread.start()
+
+    def publish(self, routing_key: str, body, properties: Optional[pika.BasicProperties] = None) -> Future:
+        """
+        Queue a message for publishing on the default exchange.
+
+        Returns:
+            Future resolved with True on broker ack, False on nack or failure
+        """
+        if not self._wait_ready():
+            logger.error(f"Message to '{routing_key}' not published")
+            future = Future()
+            future.set_result(False)
+            return future
+        return self._submit(routing_key, body, properties)
+
+    def publish_many(self, messages: Iterable[Tuple[str, object]],
+                     properties: Optional[pika.BasicProperties] = None,
+                     timeout: Optional[float] = None) -> List[bool]:
+        """
+        Pipeline many messages and wait for their confirms.
+
+        Args:
+            messages: Iterable of (routing_key, body)
+            properties: Properties applied to every message
+            timeout: Overall seconds to wait for the confirms (None waits indefinitely)
+
+        Returns:
+            One bool per message, in order: True if acked, False if nacked, failed or unconfirmed in time
+        """
+        # Wait for the connection once for the whole batch, not once per message
+        if not self._wait_ready():
+            results = [False for _message in messages]
+            logger.error(f"{len(results)} messages not published")
+            return results
+
+        futures = [self._submit(routing_key, body, properties) for routing_key, body in messages]
+        deadline = None if timeout is None else time.monotonic() + timeout
+
+        results = []
+        for future in futures:
+            remaining = None if deadline is None else max(0.0, deadline - time.monotonic())
+            try:
+                results.append(future.result(remaining))
+            except FutureTimeoutError:
+                results.append(False)
+        return results
+
+    def _wait_ready(self) -> bool:
+        self.start()
+        if self._ready.wait(self._connect_timeout):
+            return True
+        logger.error(f"RabbitMQ publisher not connected after {self._connect_timeout}s")
+        return False
+
+    def _submit(self, routing_key: str, body, properties) -> Future:
+        future = Future()
+        self._in_flight.acquire()
+        with self._queued_lock:
+            self._queued.add(future)
+        try:
+            self._ioloop.add_callback_threadsafe(
+                lambda: self._publish(routing_key, body, properties, future)
+            )
+        except Exception as e:
+            logger.error(f"Failed to hand message over to the RabbitMQ publisher: {e}")
+            with self._queued_lock:
+                self._queued.discard(future)
+            self._resolve(future, False)
+        return future
+
+    def close(self, timeout: float = 10.0):
+        """Close the connection and stop the I/O thread"""
+        with self._lock:
+            thread = self._thread
+            if thread is None:
+                return
+            self._closing = True
+            try:
+                self._ioloop.add_callback_threadsafe(self._close_connection)
+            except Exception:
+                pass
+            thread.join(timeout)
+            self._thread = None
+
+    # ------------------------------------------------------------------
+    # I/O thread
+    # ------------------------------------------------------------------
+
+    def _run(self):
+        while not self._closing:
+            try:
+                self._connection = pika.SelectConnection(
+                    self._parameters,
+                    on_open_callback=self._on_connection_open,
+                    on_open_error_callback=self._on_connection_open_error,
+                    on_close_callback=self._on_connection_closed,
+                    custom_ioloop=self._ioloop
+                )
+                self._ioloop.start()
+            except Exception as e:
+                logger.error(f"RabbitMQ publisher I/O loop error: {e}", exc_info=True)
+
+            self._ready.clear()
+            self._fail_pending()
+            if not self._closing:
+                time.sleep(self._reconnect_delay)
+
+        # Messages still queued on the loop will never be published
+        with self._queued_lock:
+            queued, self._queued = self._queued, set()
+        for future in queued:
+            self._resolve(future, False)
+
+    def _on_connection_open(self, connection):
+        logger.info("RabbitMQ publisher connected")
+        self._channels = []
+        connection.channel(on_open_callback=self._on_channel_open)
+
+    def _on_connection_open_error(self, connection, error):
+        logger.warning(f"Failed to connect to RabbitMQ: {error}")
+        self._ioloop.stop()
+
+    def _on_connection_closed(self, connection, reason):
+        if not self._closing:
+            logger.warning(f"RabbitMQ publisher connection closed: {reason}")
+        self._ioloop.stop()
+
+    def _on_channel_open(self, channel):
+        confirm_channel = _ConfirmChannel(channel)
+        channel.add_on_close_callback(self._on_channel_closed)
+        channel.confirm_delivery(
+            ack_nack_callback=lambda frame: self._on_confirm(confirm_channel, frame),
+            callback=lambda _frame: self._on_confirm_mode(confirm_channel)
+        )
+
+    def _on_confirm_mode(self, confirm_channel: _ConfirmChannel):
+        if self._channels:
+            self._add_channel(confirm_channel)
+        else:
+            # The first channel of each connection declares the queues
+            self._declare_queues(confirm_channel, self._queues)
+
+    def _declare_queues(self, confirm_channel: _ConfirmChannel, queues: List[str]):
+        if not queues:
+            self._add_channel(confirm_channel)
+            return
+        confirm_channel.channel.queue_declare(
+            queue=queues[0],
+            durable=True,
+            callback=lambda _frame: self._declare_queues(confirm_channel, queues[1:])
+        )
+
+    def _add_channel(self, confirm_channel: _ConfirmChannel):
+        self._channels.append(confirm_channel)
+        if len(self._channels) < self._channel_count:
+            self._connection.channel(on_open_callback=self._on_channel_open)
+            return
+        self._round_robin = itertools.cycle(self._channels)
+        self._ready.set()
+        logger.info(f"RabbitMQ publisher ready with {len(self._channels)} confirm channels")
+
+    def _on_channel_closed(self, channel, reason):
+        if self._closing:
+            return
+        # Unconfirmed deliveries on this channel are lost; reconnect from scratch
+        logger.warning(f"RabbitMQ publisher channel {channel.channel_number} closed: {reason}")
+        self._ready.clear()
+        if self._connection.is_open:
+            self._connection.close()
+
+    def _publish(self, routing_key: str, body, properties, future: Future):
+        with self._queued_lock:
+            self._queued.discard(future)
+        if not self._ready.is_set():
+            self._resolve(future, False)
+            return
+        confirm_channel = next(self._round_robin)
+        try:
+            confirm_channel.channel.basic_publish(
+                exchange='',
+                routing_key=routing_key,
+                body=body,
+                properties=properties
+            )
+        except Exception as e:
+            logger.error(f"Error publishing to '{routing_key}': {e}")
+            self._resolve(future, False)
+            return
+        confirm_channel.pending[confirm_channel.next_tag] = future
+        confirm_channel.next_tag += 1
+
+    def _on_confirm(self, confirm_channel: _ConfirmChannel, frame):
+        method = frame.method
+        acked = isinstance(method, pika.spec.Basic.Ack)
+        if not method.multiple:
+            future = confirm_channel.pending.pop(method.delivery_tag, None)
+            if future is not None:
+                self._resolve(future, acked)
+            return
+        # multiple=True confirms every delivery up to and including delivery_tag
+        pending = confirm_channel.pending
+        while pending:
+            tag = next(iter(pending))
+            if tag > method.delivery_tag:
+                break
+            self._resolve(pending.pop(tag), acked)
+
+    def _fail_pending(self):
+        for confirm_channel in self._channels:
+            for future in confirm_channel.pending.values():
+                self._resolve(future, False)
+            confirm_channel.pending.clear()
+        self._channels = []
+        self._round_robin = None
+
+    def _resolve(self, future: Future, acked: bool):
+        if not future.done():
+            future.set_result(acked)
+            self._in_flight.release()
+
+    def _close_connection(self):
+        connection = self._connection
+        if connection is not None and not (connection.is_closing or connection.is_closed):
+            connection.close()
+        else:
+            self._ioloop.stop()
@@ -5,12 +5,18 @@ import logging
 import sys
 import os
 import asyncio
+import time
 from typing import Dict
 
+import tax_engine
 from config import (
     RABBITMQ_HOST, RABBITMQ_PORT, RABBITMQ_USER, RABBITMQ_PASS, 
     RABBITMQ_TAXES_QUEUE, RABBITMQ_TAXES_DLQ, RABBITMQ_MAX_RETRIES
 )
+from db_pool import DatabasePool
+from db_utils import DATABASE_URL, save_analise_fiscal
+from gov_rates import GovRates
+from retry_queues import RetryPolicy, retry_count as get_retry_count
 
 # Configure logging
 logging.basicConfig(
@@ -19,6 +25,12 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# The consumer thread runs its own event loop, with its own pool (db_pool.py)
+worker_loop = None
+worker_db = DatabasePool(DATABASE_URL, min_size=1, max_size=1)
+gov_rates = GovRates()
+retries = RetryPolicy(RABBITMQ_TAXES_QUEUE)
+
 
 def get_rabbitmq_connection(retries=5, delay=2):
     """Get RabbitMQ connection with retry logic"""
@@ -57,12 +69,15 @@ def setup_queues(channel):
     channel.queue_declare(queue=RABBITMQ_TAXES_QUEUE, durable=True)
     logger.info(f"📦 Main queue '{RABBITMQ_TAXES_QUEUE}' declared")
     
+    # Declare the delay queues failed messages wait in before coming back
+    retries.declare(channel)
+    
     logger.info(f"🔁 Max retries configured: {RABBITMQ_MAX_RETRIES}")
 
 
-def send_to_dlq(channel, body, reason="Max retries exceeded"):
+def send_to_dlq(channel, body, reason="Max retries exceeded", properties=None, error=None):
     """
-    Send message to Dead Letter Queue
+    Send message to Dead Letter Queue, with its retry headers
     """
     try:
         channel.basic_publish(
@@ -71,7 +86,7 @@ def send_to_dlq(channel, body, reason="Max retries exceeded"):
             body=body,
             properties=pika.BasicProperties(
                 delivery_mode=pika.DeliveryMode.Persistent,
-                headers={'x-death-reason': reason}
+                headers=retries.dlq_headers(properties, reason, error)
             )
         )
         logger.warning(f"💀 Message sent to DLQ. Reason: {reason}")
@@ -101,7 +116,7 @@ def print_json_pretty(data: Dict, title: str = "Received Message"):
     logger.info(f"  Número NF: {nota_fiscal.get('numero_nf', 'N/A')}")
     logger.info(f"  Emitente: {nota_fiscal.get('razao_social_emitente', 'N/A')}")
     logger.info(f"  Destinatário: {nota_fiscal.get('nome_destinatario', 'N/A')}")
-    logger.info(f"  Valor Total: R$ {nota_fiscal.get('valor_nota_fiscal', 0):.2f}")
+    logger.info(f"  Valor Total: R$ {nota_fiscal.get('valor_nota_fiscal') or 0:.2f}")
     logger.info(f"  UF Origem: {nota_fiscal.get('uf_emitente', 'N/A')}")
     logger.info(f"  UF Destino: {nota_fiscal.get('uf_destinatario', 'N/A')}")
     logger.info(f"  Número de Itens: {len(items)}")
@@ -114,7 +129,7 @@ def print_json_pretty(data: Dict, title: str = "Received Message"):
                        f"NCM: {item.get('codigo_ncm_sh', 'N/A')} - "
                        f"CFOP: {item.get('cfop', 'N/A')} - "
                        f"Qtd: {item.get('quantidade', 0)} - "
-                       f"R$ {item.get('valor_total', 0):.2f}")
+                       f"R$ {item.get('valor_total') or 0:.2f}")
     
     logger.info("=" * 80)
 
@@ -123,14 +138,14 @@ def calculate_taxes(data: Dict) -> Dict:
     """
     Calculate taxes for the nota fiscal
     
-    This is a placeholder function that would implement the actual tax calculation logic.
-    For now, it just logs the data and returns a mock result.
+    Looks up the gov_service rates of its NCMs (cached, gov_rates.py) and runs
+    the tax engine over all its items at once (tax_engine.py).
     
     Args:
         data: Nota fiscal data with 'nota_fiscal' and 'items'
         
     Returns:
-        Dict with calculated taxes
+        Analysis in the analise_fiscal format
     """
     nota_fiscal = data.get('nota_fiscal', {})
     items = data.get('items', [])
@@ -141,38 +156,25 @@ def calculate_taxes(data: Dict) -> Dict:
     logger.info(f"   Destination UF: {nota_fiscal.get('uf_destinatario', 'N/A')}")
     logger.info(f"   Operation Type: {nota_fiscal.get('destino_operacao', 'N/A')}")
     
-    # Mock tax calculation - replace with real logic
-    total_value = nota_fiscal.get('valor_nota_fiscal', 0)
-    icms_rate = 0.18  # 18% mock ICMS rate
-    icms_value = total_value * icms_rate
-    
-    # Item-level calculations
-    items_with_taxes = []
-    for item in items:
-        item_total = item.get('valor_total', 0)
-        item_with_tax = {
-            **item,
-            'icms_rate': icms_rate,
-            'icms_value': item_total * icms_rate
-        }
-        items_with_taxes.append(item_with_tax)
-    
-    result = {
-        'nota_fiscal': {
-            **nota_fiscal,
-            'calculated_taxes': {
-                'icms_rate': icms_rate,
-                'icms_value': icms_value,
-                'total_taxes': icms_value
-            }
-        },
-        'items': items_with_taxes
-    }
+    started = time.perf_counter()
+    ncm_rates, icms_rates = gov_rates.lookup(
+        nota_fiscal.get('uf_emitente'), nota_fiscal.get('uf_destinatario'),
+        (item.get('codigo_ncm_sh') for item in items)
+    )
+    looked_up = time.perf_counter()
+    result = tax_engine.calculate(data, ncm_rates, icms_rates)
+    calculated = time.perf_counter()
     
-    logger.info(f"✅ Taxes calculated:")
-    logger.info(f"   ICMS Rate: {icms_rate * 100}%")
-    logger.info(f"   ICMS Value: R$ {icms_value:.2f}")
-    logger.info(f"   Total Taxes: R$ {icms_value:.2f}")
+    calculo = result['analise_fiscal']['calculo']
+    totais = calculo['totais']
+    logger.info(f"✅ Taxes calculated (rates {1000 * (looked_up - started):.1f} ms, "
+                f"engine {1000 * (calculated - looked_up):.1f} ms):")
+    logger.info(f"   ICMS: R$ {totais['valor_icms']:.2f} | ST: R$ {totais['valor_icms_st']:.2f} | "
+                f"FCP: R$ {totais['valor_fcp'] + totais['valor_fcp_st'] + totais['valor_fcp_difal']:.2f}")
+    logger.info(f"   DIFAL: R$ {totais['valor_difal']:.2f} | IPI: R$ {totais['valor_ipi']:.2f}")
+    logger.info(f"   PIS: R$ {totais['valor_pis']:.2f} | COFINS: R$ {totais['valor_cofins']:.2f}")
+    if calculo['itens_sem_taxas_gov_service']:
+        logger.warning(f"   {calculo['itens_sem_taxas_gov_service']} items without gov_service rates")
     
     return result
 
@@ -182,7 +184,7 @@ def process_message(ch, method, properties, body):
     Process a single message from RabbitMQ queue:
     1. Receive nota fiscal from queue
     2. Calculate taxes
-    3. Log results (or save to database/send to another service)
+    3. Save them to analise_fiscal
     
     Implements retry logic with Dead Letter Queue (DLQ)
     
@@ -193,9 +195,7 @@ def process_message(ch, method, properties, body):
         body: Message body
     """
     # Get retry count from message headers
-    retry_count = 0
-    if properties.headers and 'x-retry-count' in properties.headers:
-        retry_count = properties.headers['x-retry-count']
+    retry_count = get_retry_count(properties)
     
     logger.info(f"📋 Processing message (attempt {retry_count + 1}/{RABBITMQ_MAX_RETRIES + 1})")
     
@@ -210,16 +210,16 @@ def process_message(ch, method, properties, body):
         logger.info("🔄 Step 1: Calculating taxes...")
         result = calculate_taxes(message)
         
-        # Print result
-        print_json_pretty(result, "✅ Taxas Calculadas com Sucesso")
-        
-        # Here you could:
-        # - Save results to database
-        # - Send to another queue
-        # - Call an external API
-        # For now, we just log the results
+        # Save the analysis; narrative of the n8n analysis, if any, is kept (tax_engine.merge_analysis)
+        logger.info("🔄 Step 2: Saving analise fiscal...")
+        chave_acesso = message.get('nota_fiscal', {}).get('chave_acesso')
+        if not chave_acesso:
+            raise ValueError("Message without nota_fiscal.chave_acesso")
+        worker_loop.run_until_complete(
+            save_analise_fiscal(chave_acesso, result, em_processamento=None, database=worker_db)
+        )
         
-        logger.info("💾 Tax calculation completed successfully")
+        logger.info(f"💾 Tax calculation of {chave_acesso} saved")
         
         # Acknowledge message only after everything succeeds
         ch.basic_ack(delivery_tag=method.delivery_tag)
@@ -230,45 +230,36 @@ def process_message(ch, method, properties, body):
         logger.error(f"❌ Failed to parse message JSON: {e}")
         logger.error(f"Raw message: {body}")
         # Malformed JSON - send directly to DLQ
-        send_to_dlq(ch, body, reason="Invalid JSON format")
+        send_to_dlq(ch, body, reason="Invalid JSON format", properties=properties, error=e)
         ch.basic_ack(delivery_tag=method.delivery_tag)
         
     except Exception as e:
         logger.error(f"❌ Error processing message: {e}", exc_info=True)
         
-        # Check if we've exceeded max retries
-        if retry_count >= RABBITMQ_MAX_RETRIES:
+        # Wait in a delay queue (exponential backoff), or go to the DLQ when no retries are left
+        if not retries.schedule(ch, body, properties, e):
             logger.warning(f"⚠️  Max retries ({RABBITMQ_MAX_RETRIES}) exceeded")
-            # Send to DLQ
             error_type = type(e).__name__
-            send_to_dlq(ch, body, reason=f"Max retries exceeded - {error_type}: {str(e)}")
-            # Acknowledge the message to remove it from main queue
-            ch.basic_ack(delivery_tag=method.delivery_tag)
-        else:
-            # Increment retry count and requeue
-            new_retry_count = retry_count + 1
-            logger.info(f"🔄 Requeuing message (retry {new_retry_count}/{RABBITMQ_MAX_RETRIES})")
-            
-            # Publish back to queue with incremented retry count
-            new_properties = pika.BasicProperties(
-                delivery_mode=pika.DeliveryMode.Persistent,
-                headers={'x-retry-count': new_retry_count}
-            )
-            
-            ch.basic_publish(
-                exchange='',
-                routing_key=RABBITMQ_TAXES_QUEUE,
-                body=body,
-                properties=new_properties
-            )
-            
-            # Acknowledge the original message
-            ch.basic_ack(delivery_tag=method.delivery_tag)
+            send_to_dlq(ch, body, reason=f"Max retries exceeded - {error_type}: {str(e)}",
+                        properties=properties, error=e)
+        
+        # Acknowledge the original message
+        ch.basic_ack(delivery_tag=method.delivery_tag)
 
 
 def start_consumer():
     """Start consuming messages from RabbitMQ queue with DLQ support"""
+    global worker_loop
     logger.info("🚀 Starting RabbitMQ Consumer Worker for Taxes Calculation...")
+    
+    # Event loop of this thread, for the database pool of the worker
+    worker_loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(worker_loop)
+    try:
+        worker_loop.run_until_complete(worker_db.open())
+    except Exception as e:
+        logger.warning(f"Database not available yet, will retry on the first message: {e}")
+    
     logger.info(f"📡 Connecting to RabbitMQ at {RABBITMQ_HOST}:{RABBITMQ_PORT}")
     
     # Connect to RabbitMQ
@@ -302,6 +293,8 @@ def start_consumer():
         if connection and not connection.is_closed:
             connection.close()
             logger.info("🔌 Connection closed")
+        worker_loop.run_until_complete(worker_db.close())
+        worker_loop.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,165 @@
+# retry_queues.py
+"""
+Delayed retries of failed messages with exponential backoff.
+
+A message whose processing fails is not republished on its queue: it is
+published to a delay queue, <queue>.retry.<delay_ms>.<ttl_ms>, with no consumers.
+The delay is base_delay * 2^(attempt - 1), capped at max_delay. When the
+message expires there, RabbitMQ dead-letters it through the default
+exchange back to the tail of <queue>. Fresh messages therefore keep
+flowing while a failing dependency recovers. Retries do not spin through
+their budget in milliseconds either.
+
+There is one delay queue per distinct delay, so a queue holds messages
+with about the same TTL. Each message's expiration is jittered by
+±jitter, which keeps messages that failed together from coming back
+together. RabbitMQ only expires messages from the head of a queue, so a
+message can wait behind one with a longer jittered TTL. That adds at
+most 2 * jitter * delay. The queue's x-message-ttl caps the wait at
+delay * (1 + jitter). That TTL is part of the queue name: a queue cannot be
+redeclared with other arguments (PRECONDITION_FAILED), so a new jitter
+declares new queues; the old ones can be deleted once they are empty.
+
+The retry state travels in the message headers:
+
+    x-retry-count       retries so far
+    x-first-failure-at  epoch seconds of the first failure
+    x-last-error        last error (type: message, truncated)
+    x-retry-delay-ms    delay applied before this delivery
+
+Once max_retries is reached, schedule() returns False and the caller sends
+the message to its DLQ. The headers go with it (dlq_headers).
+"""
+import logging
+import math
+import random
+import time
+from typing import Dict, List, Optional, Tuple
+
+import pika
+
+from config import RABBITMQ_MAX_RETRIES, RABBITMQ_RETRY_BASE_DELAY, RABBITMQ_RETRY_MAX_DELAY, RABBITMQ_RETRY_JITTER
+
+logger = logging.getLogger(__name__)
+
+RETRY_HEADERS = ('x-retry-count', 'x-first-failure-at', 'x-last-error', 'x-retry-delay-ms')
+MAX_ERROR_LENGTH = 500
+
+
+def retry_count(properties) -> int:
+    """Retries a delivery already had"""
+    headers = getattr(properties, 'headers', None) or {}
+    return int(headers.get('x-retry-count') or 0)
+
+
+def describe_error(error: Exception) -> str:
+    return f"{type(error).__name__}: {error}"[:MAX_ERROR_LENGTH]
+
+
+class RetryPolicy:
+    """
+    Args:
+        queue: Queue the retried messages come back to
+        max_retries: Retries before the message goes to the DLQ
+        base_delay: Seconds before the first retry
+        max_delay: Upper bound of a retry's delay, seconds
+        jitter: Fraction of the delay added or removed at random
+    """
+
+    def __init__(self, queue: str, max_retries: int = RABBITMQ_MAX_RETRIES,
+                 base_delay: float = RABBITMQ_RETRY_BASE_DELAY, max_delay: float = RABBITMQ_RETRY_MAX_DELAY,
+                 jitter: float = RABBITMQ_RETRY_JITTER):
+        self.queue = queue
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max(base_delay, max_delay)
+        self.jitter = min(max(jitter, 0.0), 0.9)
+
+    def delay_ms(self, attempt: int) -> int:
+        """Delay before retry number `attempt` (1-based), without jitter"""
+        return int(1000 * min(self.base_delay * 2 ** (attempt - 1), self.max_delay))
+
+    def ttl_ms(self, attempt: int) -> int:
+        """x-message-ttl of the delay queue of retry number `attempt`: the longest jittered delay"""
+        return int(math.ceil(self.delay_ms(attempt) * (1 + self.jitter)))
+
+    def delay_queue(self, attempt: int) -> str:
+        return f"{self.queue}.retry.{self.delay_ms(attempt)}.{self.ttl_ms(attempt)}"
+
+    def delay_queues(self) -> List[str]:
+        return sorted({self.delay_queue(attempt) for attempt in range(1, self.max_retries + 1)})
+
+    def queue_arguments(self, attempt: int) -> Dict:
+        """Arguments of the delay queue of retry number `attempt`"""
+        return {
+            'x-message-ttl': self.ttl_ms(attempt),
+            'x-dead-letter-exchange': '',
+            'x-dead-letter-routing-key': self.queue,
+        }
+
+    def declare(self, channel):
+        """Declare the delay queues (idempotent)"""
+        for attempt in range(1, self.max_retries + 1):
+            channel.queue_declare(queue=self.delay_queue(attempt), durable=True,
+                                  arguments=self.queue_arguments(attempt))
+        logger.info(f"⏳ Retry delays for '{self.queue}': "
+                    f"{', '.join(f'{self.delay_ms(n) / 1000:g}s' for n in range(1, self.max_retries + 1))}")
+
+    def next_retry(self, properties, error: Exception) -> Optional[Tuple[str, Dict, int]]:
+        """
+        Where and how a failed delivery is retried
+
+        Returns:
+            (delay queue, headers, expiration in ms), or None when it has no
+            retries left (send it to the DLQ)
+        """
+        attempt = retry_count(properties) + 1
+        if attempt > self.max_retries:
+            return None
+        expiration = max(1, int(self.delay_ms(attempt) * random.uniform(1 - self.jitter, 1 + self.jitter)))
+        headers = self.retry_headers(properties, error)
+        headers.update({'x-retry-count': attempt, 'x-retry-delay-ms': expiration})
+        logger.info(f"🔄 Retry {attempt}/{self.max_retries} in {expiration / 1000:.1f}s "
+                    f"(queue '{self.delay_queue(attempt)}')")
+        return self.delay_queue(attempt), headers, expiration
+
+    def schedule(self, channel, body, properties, error: Exception) -> bool:
+        """
+        Publish a failed message to the delay queue of its next retry
+
+        Returns:
+            False when it has no retries left (send it to the DLQ)
+        """
+        retry = self.next_retry(properties, error)
+        if retry is None:
+            return False
+        delay_queue, headers, expiration = retry
+        channel.basic_publish(
+            exchange='',
+            routing_key=delay_queue,
+            body=body,
+            properties=pika.BasicProperties(
+                content_type=getattr(properties, 'content_type', None),
+                delivery_mode=pika.DeliveryMode.Persistent,
+                expiration=str(expiration),
+                headers=headers
+            )
+        )
+        return True
+
+    @staticmethod
+    def retry_headers(properties, error: Optional[Exception] = None) -> Dict:
+        """The delivery's headers with the retry state updated for `error`"""
+        headers = dict(getattr(properties, 'headers', None) or {})
+        headers.setdefault('x-first-failure-at', int(time.time()))
+        if error is not None:
+            headers['x-last-error'] = describe_error(error)
+        return headers
+
+    def dlq_headers(self, properties, reason: str, error: Optional[Exception] = None) -> Dict:
+        """Headers of a message sent to the DLQ: its retry state and the reason"""
+        headers = self.retry_headers(properties, error)
+        headers.setdefault('x-retry-count', retry_count(properties))
+        headers['x-death-reason'] = reason
+        headers['x-original-queue'] = self.queue
+        return headers
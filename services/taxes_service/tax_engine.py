@@ -0,0 +1,472 @@
+# tax_engine.py
+"""
+Deterministic tax calculation of a nota fiscal, run by the taxes worker.
+
+Takes the document published on the taxes queue (db_utils.NOTA_FISCAL_DOCUMENT_SQL:
+`nota_fiscal` and `items` with their `impostos` columns) and the gov_service
+rates of its NCMs (gov_rates.py), and computes per item ICMS, ST, FCP, DIFAL,
+IPI and PIS/COFINS. Every item of the nota is one position of numpy arrays:
+the formulas run once per nota, whatever its number of items.
+
+What the nota states comes first (CSTs, bases and rates of impostos_item);
+gov_service rates fill in what it lacks, as the n8n analysis did:
+
+  IPI     rate of the item, else the NCM's; base vBC, else vProd.
+  ICMS    rate of the item, else interstate / internal rate of origin; base
+          vBC, else vProd plus IPI for final consumers. Computed for the
+          taxed CSTs (00, 10, 20, 70, 90), or when the item has no CST and
+          the NCM is not exempt.
+  ST      CST 10/30/70 and CSOSN 201-203, or no CST and ST for the NCM:
+          base (vProd + IPI) x (1 + MVA), the MVA adjusted for interstate
+          operations; ICMS at the internal rate of destination minus the
+          ICMS of the operation.
+  FCP     rate of destination (of the item, else the NCM's) over the ICMS base (internal operations), the
+          ST base, or the DIFAL base.
+  DIFAL   interstate, to a non-contributor (indIEDest 9 or empty), taxed items:
+          base dupla (LC 190/2022) at the internal rate of destination (of
+          the item, else the NCM's), split by the gov_service partilha.
+  PIS/    rates of the item, else the NCM's; none for CST 04-09 or a
+  COFINS  monofásico / alíquota zero NCM; base vBC, else vProd.
+
+Values are rounded half up to the cent per item, and totals are the sums of
+the rounded items, as on the NF-e. The result has the format of the n8n
+analysis (analise_fiscal.info_nfe / tributos_calculados /
+recuperacao_credito_expectativa), so it is stored the same way, plus the
+per item detail and the differences to the stated values under `calculo`.
+When the LLM analysis of the same nota is saved, only its narrative fields are
+taken (merge_analysis).
+"""
+import copy
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from gov_rates import normalize_ncm
+
+ENGINE = 'taxes_service.tax_engine'
+ENGINE_VERSION = 1
+
+# ICMS CST (after the origin digit) and CSOSN (Simples Nacional) -> situação of the operation's own ICMS
+ICMS_SITUACAO = {
+    '00': 'Tributado', '10': 'Tributado', '20': 'Tributado', '70': 'Tributado', '90': 'Tributado',
+    '30': 'Isento', '40': 'Isento', '41': 'Isento', '50': 'Suspenso',
+    '02': 'Outros', '15': 'Outros', '51': 'Outros', '53': 'Outros', '60': 'Outros', '61': 'Outros',
+    '101': 'Nao Aplicavel', '102': 'Nao Aplicavel', '103': 'Nao Aplicavel', '201': 'Nao Aplicavel',
+    '202': 'Nao Aplicavel', '203': 'Nao Aplicavel', '300': 'Nao Aplicavel', '400': 'Nao Aplicavel',
+    '500': 'Outros', '900': 'Outros',
+}
+ST_CSTS = ('10', '30', '70', '201', '202', '203')
+IPI_TAXED_CSTS = ('00', '49', '50', '99')
+PIS_COFINS_TAXED_CSTS = ('01', '02', '03')
+PIS_COFINS_NOT_LEVIED_CSTS = ('04', '05', '06', '07', '08', '09')
+NCM_NOT_LEVIED_REGIMES = ('Monofasico', 'Aliquota_Zero', 'Substituicao_Tributaria')
+
+# Standard PIS/COFINS rates of each regime, to recognize it from the rates on the nota
+PIS_RATE_REGIMES = {0.0165: 'Nao Cumulativo', 0.0065: 'Cumulativo'}
+
+ADVERTENCIAS = [
+    "Cálculo determinístico a partir dos dados da NF-e e das alíquotas de referência do gov_service. "
+    "A apuração e a recuperação efetivas dependem do regime tributário das empresas e da legislação de cada UF.",
+    "Reduções de base de cálculo e benefícios fiscais não informados na NF-e não são considerados.",
+]
+
+# Fields of an LLM analysis kept over the calculated ones (merge_analysis)
+NARRATIVE_FIELDS = (
+    ('tributos_calculados', 'pis_cofins', 'observacoes'),
+    ('tributos_calculados', 'icms_geral', 'observacoes_difal'),
+    ('recuperacao_credito_expectativa', 'advertencias_limitacoes'),
+)
+
+
+def _code(value) -> str:
+    """Leading code of a described value: '9 - Não Contribuinte' -> '9'"""
+    return str(value or '').strip().split(' ')[0]
+
+
+def _number(value) -> float:
+    return float(value) if value else 0.0
+
+
+def _cents(values: np.ndarray) -> np.ndarray:
+    """Round half up to the cent (the offset absorbs binary representation errors)"""
+    return np.round(values + np.copysign(1e-9, values), 2)
+
+
+def _money(value) -> float:
+    return round(float(value), 2) + 0.0  # no -0.0
+
+
+def _percent(rate) -> float:
+    return round(float(rate) * 100, 4) + 0.0
+
+
+def _columns(items: List[Dict], ncm_rates: Dict, icms_rates: Dict) -> Dict[str, np.ndarray]:
+    """The inputs of every item, one array per field"""
+    rows = []
+    for item in items:
+        impostos = item.get('impostos') or {}
+        icms = impostos.get('icms') or {}
+        ipi = impostos.get('ipi') or {}
+        pis = impostos.get('pis') or {}
+        cofins = impostos.get('cofins') or {}
+        ncm = normalize_ncm(item.get('codigo_ncm_sh'))
+        ncm_rate = ncm_rates.get(ncm) or {}
+        icms_rate = icms_rates.get(ncm) or {}
+        icms_uf_dest = impostos.get('icms_uf_dest') or {}
+        pis_cofins_rate = ncm_rate.get('tributacao_pis_cofins') or {}
+        rows.append((
+            _number(item.get('valor_total')),
+            str(icms.get('cst') or '').strip(), _number(icms.get('v_bc')), _number(icms.get('p_icms')),
+            _number(icms.get('v_icms')),
+            _number(icms_uf_dest.get('p_icms_uf_dest')), _number(icms_uf_dest.get('p_fcp_uf_dest')),
+            str(ipi.get('cst') or '').strip(), _number(ipi.get('v_bc')), _number(ipi.get('p_ipi')),
+            _number(ipi.get('v_ipi')),
+            str(pis.get('cst') or '').strip(), _number(pis.get('v_bc')), _number(pis.get('p_pis')),
+            _number(pis.get('v_pis')),
+            str(cofins.get('cst') or '').strip(), _number(cofins.get('v_bc')), _number(cofins.get('p_cofins')),
+            _number(cofins.get('v_cofins')),
+            bool(ncm_rate), bool(icms_rate),
+            _number(ncm_rate.get('aliquota_ipi_padrao')) / 100,
+            _number(pis_cofins_rate.get('aliquota_pis_padrao')) / 100,
+            _number(pis_cofins_rate.get('aliquota_cofins_padrao')) / 100,
+            pis_cofins_rate.get('regime_especial') in NCM_NOT_LEVIED_REGIMES,
+            _number(icms_rate.get('aliquota_interna_origem')) / 100,
+            _number(icms_rate.get('aliquota_interna_destino')) / 100,
+            _number(icms_rate.get('aliquota_interestadual')) / 100,
+            bool(icms_rate.get('icms_st_aplicavel')),
+            _number(icms_rate.get('mva_original_icms_st')) / 100,
+            _number(icms_rate.get('aliquota_fcp_destino')) / 100,
+            _number(icms_rate.get('partilha_difal_destino', 100)) / 100,
+            icms_rate.get('regime_icms_para_ncm') == 'ISENTO',
+        ))
+    names = (
+        'vprod',
+        'icms_cst', 'icms_v_bc', 'icms_p', 'icms_v',
+        'dest_p_icms', 'dest_p_fcp',
+        'ipi_cst', 'ipi_v_bc', 'ipi_p', 'ipi_v',
+        'pis_cst', 'pis_v_bc', 'pis_p', 'pis_v',
+        'cofins_cst', 'cofins_v_bc', 'cofins_p', 'cofins_v',
+        'has_ncm_rate', 'has_icms_rate',
+        'gov_ipi', 'gov_pis', 'gov_cofins', 'gov_pis_cofins_not_levied',
+        'gov_interna_origem', 'gov_interna_destino', 'gov_interestadual', 'gov_st', 'gov_mva', 'gov_fcp',
+        'gov_partilha_destino', 'gov_icms_isento',
+    )
+    columns = list(zip(*rows)) if rows else [()] * len(names)
+    return {name: np.array(values, dtype=object if name.endswith('_cst') else float)
+            for name, values in zip(names, columns)}
+
+
+def calculate(document: Dict, ncm_rates: Dict[str, Dict], icms_rates: Dict[str, Dict]) -> Dict:
+    """
+    Tax analysis of a nota fiscal
+
+    Args:
+        document: {'nota_fiscal': ..., 'items': [...]} as published on the taxes queue
+        ncm_rates, icms_rates: Rates of its NCMs (gov_rates.GovRates.lookup)
+
+    Returns:
+        Analysis in the n8n format, with the per item calculation under analise_fiscal.calculo
+    """
+    nota = document.get('nota_fiscal') or {}
+    items = document.get('items') or []
+    c = _columns(items, ncm_rates, icms_rates)
+    n = len(items)
+
+    uf_origem = (nota.get('uf_emitente') or '').strip().upper()
+    uf_destino = (nota.get('uf_destinatario') or '').strip().upper()
+    exterior = _code(nota.get('destino_operacao')) == '3'
+    interestadual = bool(uf_origem and uf_destino and uf_origem != uf_destino) and not exterior
+    ind_ie_dest = _code(nota.get('indicador_ie_destinatario'))
+    nao_contribuinte = ind_ie_dest in ('9', '')
+    consumidor_final = _code(nota.get('consumidor_final')) == '1' or nao_contribuinte
+
+    icms_cst = c['icms_cst']
+    has_icms_cst = icms_cst != ''
+    csosn = np.array([len(cst) == 3 for cst in icms_cst], dtype=bool)
+    situacao = np.array([
+        ICMS_SITUACAO.get(cst[-3:] if len(cst) == 3 else cst[-2:], 'Outros') if cst
+        else ('Isento' if isento else 'Tributado')
+        for cst, isento in zip(icms_cst, c['gov_icms_isento'].astype(bool))
+    ], dtype=object)
+    tributado = situacao == 'Tributado'
+
+    # IPI
+    ipi_levied = np.isin(c['ipi_cst'], IPI_TAXED_CSTS) | ((c['ipi_cst'] == '') & (c['gov_ipi'] > 0))
+    ipi_rate = np.where(c['ipi_p'] > 0, c['ipi_p'], c['gov_ipi'])
+    ipi_base = np.where(ipi_levied, np.where(c['ipi_v_bc'] > 0, c['ipi_v_bc'], c['vprod']), 0.0)
+    ipi_value = _cents(ipi_base * ipi_rate)
+
+    # ICMS of the operation
+    operation_rate = c['gov_interestadual'] if interestadual else c['gov_interna_origem']
+    icms_rate = np.where(c['icms_p'] > 0, c['icms_p'], operation_rate)
+    icms_base = np.where(c['icms_v_bc'] > 0, c['icms_v_bc'],
+                         c['vprod'] + (ipi_value if consumidor_final else 0.0))
+    icms_own = _cents(icms_base * icms_rate)
+    icms_value = np.where(tributado, icms_own, 0.0)
+    icms_base = np.where(tributado, icms_base, 0.0)
+    icms_rate = np.where(tributado, icms_rate, 0.0)
+
+    # Substituição tributária
+    st = np.isin(icms_cst, ST_CSTS) | (~has_icms_cst & c['gov_st'].astype(bool))
+    internal_destination = np.where(c['dest_p_icms'] > 0, c['dest_p_icms'],
+                                    np.where(c['gov_interna_destino'] > 0, c['gov_interna_destino'], icms_rate))
+    fcp_rate = np.where(c['dest_p_fcp'] > 0, c['dest_p_fcp'], c['gov_fcp'])
+    mva = c['gov_mva']
+    if interestadual:
+        # MVA ajustada: keeps the tax burden of an internal operation at destination
+        mva = np.where(internal_destination > operation_rate,
+                       (1 + mva) * (1 - operation_rate) / (1 - internal_destination) - 1, mva)
+    st_base = np.where(st, _cents((c['vprod'] + ipi_value) * (1 + mva)), 0.0)
+    st_value = np.where(st, np.maximum(_cents(st_base * internal_destination) - icms_own, 0.0), 0.0)
+    fcp_st = np.where(st, _cents(st_base * fcp_rate), 0.0)
+
+    # DIFAL, to non-contributors in other UFs
+    difal = tributado & interestadual & nao_contribuinte
+    difal_base = np.where(difal, _cents((icms_base - icms_value) / (1 - internal_destination)), 0.0)
+    difal_value = np.where(difal, np.maximum(_cents(difal_base * internal_destination) - icms_value, 0.0), 0.0)
+    difal_destino = _cents(difal_value * c['gov_partilha_destino'])
+    difal_origem = difal_value - difal_destino
+    fcp_difal = np.where(difal, _cents(difal_base * fcp_rate), 0.0)
+    fcp = np.where(tributado & (not interestadual) & (not exterior), _cents(icms_base * fcp_rate), 0.0)
+
+    # PIS/COFINS
+    not_levied = (np.isin(c['pis_cst'], PIS_COFINS_NOT_LEVIED_CSTS)
+                  | ((c['pis_cst'] == '') & c['gov_pis_cofins_not_levied'].astype(bool)))
+    levied = ~not_levied & (np.isin(c['pis_cst'], PIS_COFINS_TAXED_CSTS) | (c['pis_cst'] == '')
+                            | (c['pis_v'] > 0) | (c['cofins_v'] > 0))
+    pis_rate = np.where(levied, np.where(c['pis_p'] > 0, c['pis_p'], c['gov_pis']), 0.0)
+    cofins_rate = np.where(levied, np.where(c['cofins_p'] > 0, c['cofins_p'], c['gov_cofins']), 0.0)
+    pis_base = np.where(levied, np.where(c['pis_v_bc'] > 0, c['pis_v_bc'], c['vprod']), 0.0)
+    cofins_base = np.where(levied, np.where(c['cofins_v_bc'] > 0, c['cofins_v_bc'], c['vprod']), 0.0)
+    pis_value = _cents(pis_base * pis_rate)
+    cofins_value = _cents(cofins_base * cofins_rate)
+    # Tema 69 (STF): ICMS out of the PIS/COFINS base
+    tema_69 = _cents(icms_value * (pis_rate + cofins_rate))
+
+    # Regimes, from what the nota states
+    stated_pis_rates = {round(float(rate), 4) for rate in c['pis_p'][levied & (c['pis_p'] > 0)]}
+    if n and not levied.any():
+        regime_pis_cofins = 'Nao Incidente'
+    elif len(stated_pis_rates) == 1 and next(iter(stated_pis_rates)) in PIS_RATE_REGIMES:
+        regime_pis_cofins = PIS_RATE_REGIMES[next(iter(stated_pis_rates))]
+    else:
+        regime_pis_cofins = 'Nao Determinavel'
+    if csosn.any():
+        regime_tributario, crt = 'Simples Nacional', 1
+    elif regime_pis_cofins == 'Nao Cumulativo':
+        regime_tributario, crt = 'Lucro Real', 3
+    elif regime_pis_cofins == 'Cumulativo':
+        regime_tributario, crt = 'Lucro Presumido', 3
+    else:
+        regime_tributario, crt = 'Nao Determinavel', 3 if has_icms_cst.any() else None
+
+    totals = {
+        'valor_produtos': _money(c['vprod'].sum()),
+        'valor_icms': _money(icms_value.sum()),
+        'valor_icms_st': _money(st_value.sum()),
+        'valor_fcp': _money(fcp.sum()),
+        'valor_fcp_st': _money(fcp_st.sum()),
+        'valor_difal': _money(difal_value.sum()),
+        'valor_difal_uf_destino': _money(difal_destino.sum()),
+        'valor_difal_uf_remetente': _money(difal_origem.sum()),
+        'valor_fcp_difal': _money(fcp_difal.sum()),
+        'valor_ipi': _money(ipi_value.sum()),
+        'valor_pis': _money(pis_value.sum()),
+        'valor_cofins': _money(cofins_value.sum()),
+    }
+    stated = {
+        'icms': _money(c['icms_v'].sum()),
+        'ipi': _money(c['ipi_v'].sum()),
+        'pis': _money(c['pis_v'].sum()),
+        'cofins': _money(c['cofins_v'].sum()),
+    }
+    pis_cofins_base = _money(pis_base.sum())
+
+    icms_por_item = []
+    for i, item in enumerate(items):
+        icms_por_item.append({
+            'numero_item': item.get('numero_produto'),
+            'ncm': item.get('codigo_ncm_sh'),
+            'cst_csosn': icms_cst[i] or None,
+            'base_calculo': _money(icms_base[i]),
+            'aliquota_icms': _percent(icms_rate[i]),
+            'valor_icms': _money(icms_value[i]),
+            'situacao_icms': situacao[i],
+            'valor_icms_destacado': _money(c['icms_v'][i]),
+            'st': {
+                'mva': _percent(mva[i]), 'base_calculo': _money(st_base[i]), 'valor': _money(st_value[i]),
+                'valor_fcp': _money(fcp_st[i])
+            } if st[i] else None,
+            'difal': {
+                'base_calculo': _money(difal_base[i]), 'aliquota_interna_destino': _percent(internal_destination[i]),
+                'valor': _money(difal_value[i]), 'valor_uf_destino': _money(difal_destino[i]),
+                'valor_uf_remetente': _money(difal_origem[i]), 'valor_fcp': _money(fcp_difal[i])
+            } if difal[i] else None,
+            'valor_fcp': _money(fcp[i]),
+            'ipi': {'base_calculo': _money(ipi_base[i]), 'aliquota': _percent(ipi_rate[i] if ipi_levied[i] else 0),
+                    'valor': _money(ipi_value[i])},
+            'pis': {'base_calculo': _money(pis_base[i]), 'aliquota': _percent(pis_rate[i]),
+                    'valor': _money(pis_value[i])},
+            'cofins': {'base_calculo': _money(cofins_base[i]), 'aliquota': _percent(cofins_rate[i]),
+                       'valor': _money(cofins_value[i])},
+            'taxas_gov_service': bool(c['has_ncm_rate'][i] and c['has_icms_rate'][i]),
+        })
+
+    if not interestadual:
+        observacoes_difal = "Operação com o exterior." if exterior else "Operação interna, sem DIFAL."
+    elif not nao_contribuinte:
+        observacoes_difal = (f"Operação interestadual {uf_origem} -> {uf_destino} para contribuinte do ICMS: "
+                             f"DIFAL a cargo do destinatário quando de uso e consumo ou ativo imobilizado.")
+    else:
+        observacoes_difal = (
+            f"Operação interestadual {uf_origem} -> {uf_destino} para não contribuinte: DIFAL de "
+            f"R$ {totals['valor_difal']:.2f} ({totals['valor_difal_uf_destino']:.2f} para {uf_destino}), "
+            f"FCP de R$ {totals['valor_fcp_difal']:.2f}, base dupla (LC 190/2022)."
+        )
+    observacoes_pis_cofins = f"Calculado por item: {int(levied.sum())} de {n} itens com incidência."
+    if stated['pis'] or stated['cofins']:
+        observacoes_pis_cofins += (
+            f" Destacado na NF-e: PIS R$ {stated['pis']:.2f}, COFINS R$ {stated['cofins']:.2f}"
+            f" (diferença do calculado: PIS R$ {totals['valor_pis'] - stated['pis']:.2f},"
+            f" COFINS R$ {totals['valor_cofins'] - stated['cofins']:.2f})."
+        )
+    else:
+        observacoes_pis_cofins += " Sem PIS/COFINS destacados na NF-e: alíquotas de referência do NCM."
+
+    nota_impostos = nota.get('impostos') or {}
+    icms_destacado = _money(nota_impostos.get('v_icms') or stated['icms'])
+    return {
+        'analise_fiscal': {
+            'info_nfe': {
+                'numero_nota': nota.get('numero_nf'),
+                'chave_acesso': nota.get('chave_acesso'),
+                'data_emissao': nota.get('data_emissao'),
+                'emitente': {
+                    'cnpj': nota.get('cpf_cnpj_emitente'),
+                    'razao_social': nota.get('razao_social_emitente'),
+                    'uf': uf_origem or None,
+                    'crt': crt,
+                    'regime_tributario_inferido': regime_tributario,
+                },
+                'destinatario': {
+                    'cnpj': nota.get('cnpj_destinatario'),
+                    'razao_social': nota.get('nome_destinatario'),
+                    'uf': uf_destino or None,
+                    'ind_ie_dest': ind_ie_dest or None,
+                },
+                'valores_totais': {
+                    'valor_produtos': totals['valor_produtos'],
+                    'valor_total_nfe': _money(nota.get('valor_nota_fiscal') or 0),
+                    'valor_total_icms_destacado': icms_destacado,
+                },
+            },
+            'tributos_calculados': {
+                'pis_cofins': {
+                    'regime_aplicado': regime_pis_cofins,
+                    'base_calculo_estimada': pis_cofins_base,
+                    'aliquota_pis': _percent(totals['valor_pis'] / pis_cofins_base) if pis_cofins_base else 0.0,
+                    'aliquota_cofins': _percent(totals['valor_cofins'] / pis_cofins_base) if pis_cofins_base else 0.0,
+                    'valor_pis_estimado': totals['valor_pis'],
+                    'valor_cofins_estimado': totals['valor_cofins'],
+                    'valor_pis_cofins_destacado_nfe': {'pis': stated['pis'], 'cofins': stated['cofins']}
+                    if stated['pis'] or stated['cofins'] else None,
+                    'observacoes': observacoes_pis_cofins,
+                },
+                'icms_por_item': icms_por_item,
+                'icms_geral': {
+                    'potencial_difal': bool(difal.any()),
+                    'observacoes_difal': observacoes_difal,
+                },
+            },
+            'recuperacao_credito_expectativa': {
+                'oportunidades_potenciais': {
+                    'icms': {
+                        'credito_direto_nfe_entrada': {
+                            'valor_potencial': icms_destacado if ind_ie_dest == '1' and icms_destacado else None,
+                            'condicoes': "Crédito do ICMS destacado se o destinatário, contribuinte, utilizar o "
+                                         "produto em sua atividade tributada.",
+                        }
+                    },
+                    'pis_cofins': {
+                        'credito_regime_nao_cumulativo': {
+                            'valor_potencial_indeterminado': True,
+                            'condicoes': "Crédito de PIS/COFINS se o destinatário estiver no regime não cumulativo "
+                                         "e o item for insumo, bem para revenda ou ativo imobilizado.",
+                        }
+                    },
+                    'outras_oportunidades': [
+                        {
+                            'tipo': "Exclusao ICMS Base PIS/COFINS",
+                            'valor_estimado': _money(tema_69.sum()),
+                            'condicoes': "PIS/COFINS sobre o ICMS destacado, excluível da base (Tema 69 STF).",
+                        }
+                    ],
+                },
+                'advertencias_limitacoes': list(ADVERTENCIAS),
+            },
+            'calculo': {
+                'motor': ENGINE,
+                'versao': ENGINE_VERSION,
+                'itens': n,
+                'itens_sem_taxas_gov_service': sum(1 for item in icms_por_item if not item['taxas_gov_service']),
+                'operacao': {
+                    'interestadual': interestadual,
+                    'exterior': exterior,
+                    'consumidor_final': consumidor_final,
+                    'nao_contribuinte': nao_contribuinte,
+                },
+                'totais': totals,
+                'destacado_nfe': stated,
+                'diferencas': {
+                    'icms': _money(totals['valor_icms'] - stated['icms']),
+                    'ipi': _money(totals['valor_ipi'] - stated['ipi']),
+                    'pis': _money(totals['valor_pis'] - stated['pis']),
+                    'cofins': _money(totals['valor_cofins'] - stated['cofins']),
+                },
+            },
+        }
+    }
+
+
+def is_engine_result(analysis: Optional[Dict]) -> bool:
+    calculo = ((analysis or {}).get('analise_fiscal') or {}).get('calculo') or {}
+    return calculo.get('motor') == ENGINE
+
+
+def _merge_narrative(calculated: Dict, narrative: Dict) -> Dict:
+    """The calculated analysis with the narrative fields of another one"""
+    merged = copy.deepcopy(calculated)
+    source = narrative.get('analise_fiscal') or {}
+    target = merged['analise_fiscal']
+    for path in NARRATIVE_FIELDS:
+        value = source
+        for key in path:
+            value = value.get(key) if isinstance(value, dict) else None
+        if value in (None, '', []):
+            continue
+        node = target
+        for key in path[:-1]:
+            node = node.setdefault(key, {})
+        node[path[-1]] = value
+    # The LLM looked the CNPJs up: its regime is better than none
+    emitente = target['info_nfe']['emitente']
+    regime = ((source.get('info_nfe') or {}).get('emitente') or {}).get('regime_tributario_inferido')
+    if emitente.get('regime_tributario_inferido') == 'Nao Determinavel' and regime:
+        emitente['regime_tributario_inferido'] = regime
+    target['calculo']['narrativa'] = True
+    return merged
+
+
+def merge_analysis(existing: Optional[Dict], incoming: Dict) -> Dict:
+    """
+    Analysis to store when `incoming` is saved over `existing`: calculated
+    values always win, narrative (observations, warnings) comes from the LLM
+    analysis whichever of the two is saved first.
+    """
+    if is_engine_result(incoming):
+        if existing and (not is_engine_result(existing) or existing['analise_fiscal']['calculo'].get('narrativa')):
+            return _merge_narrative(incoming, existing)
+        return incoming
+    if is_engine_result(existing):
+        return _merge_narrative(existing, incoming)
+    return incoming
@@ -0,0 +1,298 @@
+# webhook_dispatcher.py
+"""
+Bounded, durable dispatch of notas to the n8n taxes webhook.
+
+POST /calculate-taxes/ used to start a thread per request, each posting the
+nota to n8n with a 5 minute timeout: a burst of requests started as many
+threads and LLM workflows. Requests now only add the chave de acesso to a
+backlog in Redis; one dispatcher task per service instance takes them in
+order and posts them with a shared keep-alive HTTP client, at most
+WEBHOOK_MAX_IN_FLIGHT at a time per instance.
+
+Redis keys (KEY_PREFIX):
+
+    backlog         LIST of chaves waiting, oldest first
+    pending         HASH chave -> enqueue time, of chaves queued or being sent;
+                    a chave is queued once however many times it is requested
+    inflight        ZSET chave -> lease deadline, of chaves being sent
+    result:<chave>  JSON outcome of the last dispatch (WEBHOOK_RESULT_TTL)
+
+The backlog survives restarts. A chave whose instance died while sending it
+goes back to the head of the backlog when its lease (the webhook timeout plus
+LEASE_MARGIN) expires. When the backlog holds WEBHOOK_BACKLOG_MAX chaves new
+ones are refused, and the endpoint answers 429.
+
+The document is read from the database when it is sent, so n8n gets the nota
+as it is then. Queue wait and webhook latency are logged and stored per nota,
+and metrics() reports them over the recent window.
+"""
+import asyncio
+import json
+import logging
+import time
+from collections import deque
+from typing import Awaitable, Callable, Dict, Optional
+
+import httpx
+from redis import asyncio as aioredis
+
+from config import (
+    REDIS_HOST, REDIS_PORT, REDIS_DB, TAXES_WEBHOOK_URL,
+    WEBHOOK_MAX_IN_FLIGHT, WEBHOOK_TIMEOUT, WEBHOOK_BACKLOG_MAX, WEBHOOK_RESULT_TTL
+)
+
+logger = logging.getLogger(__name__)
+
+KEY_PREFIX = 'nfe:webhook'
+POLL_INTERVAL = 1.0  # seconds between backlog checks when idle (other instances may enqueue)
+LEASE_MARGIN = 60  # seconds past the webhook timeout before a chave being sent is given up on
+RECONNECT_DELAY = 5
+
+# Loads the document sent for a chave, None when the nota no longer exists
+Loader = Callable[[str], Awaitable[Optional[Dict]]]
+
+# KEYS: backlog, pending, inflight; ARGV: chave, now, max backlog
+# -> {1, position, size} queued | {0, position (0 while being sent), size} already queued | {-1, 0, size} full
+ENQUEUE_LUA = """
+local size = redis.call('LLEN', KEYS[1])
+if redis.call('HEXISTS', KEYS[2], ARGV[1]) == 1 then
+    local position = redis.call('LPOS', KEYS[1], ARGV[1])
+    return {0, position and position + 1 or 0, size}
+end
+if size >= tonumber(ARGV[3]) then
+    return {-1, 0, size}
+end
+redis.call('HSET', KEYS[2], ARGV[1], ARGV[2])
+size = redis.call('RPUSH', KEYS[1], ARGV[1])
+return {1, size, size}
+"""
+
+# KEYS: backlog, pending, inflight; ARGV: lease deadline -> {chave, enqueue time} | nil
+CLAIM_LUA = """
+local chave = redis.call('LPOP', KEYS[1])
+if not chave then
+    return nil
+end
+redis.call('ZADD', KEYS[3], ARGV[1], chave)
+return {chave, redis.call('HGET', KEYS[2], chave)}
+"""
+
+# KEYS: backlog, inflight; ARGV: now -> chaves given back to the backlog
+REAP_LUA = """
+local expired = redis.call('ZRANGEBYSCORE', KEYS[2], '-inf', ARGV[1])
+for _, chave in ipairs(expired) do
+    redis.call('ZREM', KEYS[2], chave)
+    redis.call('LPUSH', KEYS[1], chave)
+end
+return #expired
+"""
+
+
+def _percentiles(values) -> Dict:
+    values = sorted(values)
+    if not values:
+        return {"avg": 0.0, "p95": 0.0, "max": 0.0}
+    return {
+        "avg": round(1000 * sum(values) / len(values), 2),
+        "p95": round(1000 * values[min(len(values) - 1, int(0.95 * len(values)))], 2),
+        "max": round(1000 * values[-1], 2),
+    }
+
+
+class WebhookDispatcher:
+    """
+    Args:
+        loader: Document of a chave (db_utils.get_nota_fiscal_by_chave)
+        url: n8n webhook URL
+        max_in_flight: Webhook calls running at once in this instance
+        timeout: Seconds a webhook call may take
+        backlog_max: Chaves the backlog holds before refusing new ones
+    """
+
+    def __init__(self, loader: Loader, url: str = TAXES_WEBHOOK_URL, max_in_flight: int = WEBHOOK_MAX_IN_FLIGHT,
+                 timeout: float = WEBHOOK_TIMEOUT, backlog_max: int = WEBHOOK_BACKLOG_MAX,
+                 result_ttl: int = WEBHOOK_RESULT_TTL):
+        self.loader = loader
+        self.url = url
+        self.max_in_flight = max(1, max_in_flight)
+        self.timeout = timeout
+        self.backlog_max = backlog_max
+        self.result_ttl = result_ttl
+        self._keys = [f"{KEY_PREFIX}:backlog", f"{KEY_PREFIX}:pending", f"{KEY_PREFIX}:inflight"]
+        self._redis: Optional[aioredis.Redis] = None
+        self._client: Optional[httpx.AsyncClient] = None
+        self._runner: Optional[asyncio.Task] = None
+        self._tasks = set()
+        self._wakeup = asyncio.Event()
+
+        self.enqueued = 0
+        self.rejected = 0
+        self.delivered = 0
+        self.failed = 0
+        self._queue_waits = deque(maxlen=1000)
+        self._latencies = deque(maxlen=1000)
+
+    async def start(self):
+        """Connect to Redis and start dispatching (startup hook)"""
+        self._redis = aioredis.Redis(host=REDIS_HOST, port=REDIS_PORT, db=REDIS_DB)
+        self._enqueue = self._redis.register_script(ENQUEUE_LUA)
+        self._claim = self._redis.register_script(CLAIM_LUA)
+        self._reap = self._redis.register_script(REAP_LUA)
+        self._client = httpx.AsyncClient(
+            timeout=self.timeout,
+            limits=httpx.Limits(max_connections=self.max_in_flight, max_keepalive_connections=self.max_in_flight)
+        )
+        self._runner = asyncio.create_task(self._run())
+
+    async def close(self):
+        """
+        Stop taking chaves and cancel the calls in flight; their chaves go
+        back to the backlog when their lease expires
+        """
+        if self._runner:
+            self._runner.cancel()
+            await asyncio.gather(self._runner, *self._tasks, return_exceptions=True)
+            self._runner = None
+        if self._client:
+            await self._client.aclose()
+            self._client = None
+        if self._redis:
+            await self._redis.close()
+            self._redis = None
+
+    async def enqueue(self, chave_acesso: str) -> Dict:
+        """
+        Queue a nota for the webhook
+
+        Returns:
+            {"status": "queued" | "already_queued" | "in_flight" | "backlog_full",
+             "position": 1-based place in the backlog (0 when not waiting), "backlog": chaves waiting}
+
+        Raises:
+            redis.RedisError: Redis unavailable
+        """
+        outcome, position, size = await self._enqueue(keys=self._keys,
+                                                      args=[chave_acesso, time.time(), self.backlog_max])
+        if outcome == 1:
+            self.enqueued += 1
+            self._wakeup.set()
+            status = "queued"
+        elif outcome == 0:
+            status = "already_queued" if position else "in_flight"
+        else:
+            self.rejected += 1
+            status = "backlog_full"
+        return {"status": status, "position": position, "backlog": size}
+
+    async def status(self, chave_acesso: str) -> Dict:
+        """Place of a nota in the backlog, or the outcome of its last dispatch"""
+        async with self._redis.pipeline(transaction=False) as pipe:
+            pipe.hget(self._keys[1], chave_acesso)
+            pipe.lpos(self._keys[0], chave_acesso)
+            pipe.zscore(self._keys[2], chave_acesso)
+            pipe.get(f"{KEY_PREFIX}:result:{chave_acesso}")
+            enqueued_at, position, lease, result = await pipe.execute()
+        last = json.loads(result) if result else None
+        if enqueued_at is None:
+            return {"status": last["status"] if last else "unknown", "last_dispatch": last}
+        waiting = round(time.time() - float(enqueued_at), 3)
+        if lease is not None:
+            return {"status": "in_flight", "waiting_s": waiting, "last_dispatch": last}
+        return {"status": "queued", "position": (position or 0) + 1, "waiting_s": waiting, "last_dispatch": last}
+
+    async def _run(self):
+        slots = asyncio.Semaphore(self.max_in_flight)
+        while True:
+            try:
+                await slots.acquire()
+                now = time.time()
+                self._wakeup.clear()
+                await self._reap(keys=[self._keys[0], self._keys[2]], args=[now])
+                claimed = await self._claim(keys=self._keys, args=[now + self.timeout + LEASE_MARGIN])
+                if not claimed:
+                    slots.release()
+                    try:
+                        await asyncio.wait_for(self._wakeup.wait(), POLL_INTERVAL)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                slots.release()
+                logger.warning(f"Webhook backlog unavailable: {e}")
+                await asyncio.sleep(RECONNECT_DELAY)
+                continue
+
+            chave_acesso = claimed[0].decode()
+            enqueued_at = float(claimed[1]) if claimed[1] else now
+            task = asyncio.create_task(self._dispatch(chave_acesso, enqueued_at))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+            task.add_done_callback(lambda _: slots.release())
+
+    async def _dispatch(self, chave_acesso: str, enqueued_at: float):
+        started = time.time()
+        queue_wait = max(0.0, started - enqueued_at)
+        result = {"queue_wait_ms": round(1000 * queue_wait, 2), "started_at": started}
+        try:
+            document = await self.loader(chave_acesso)
+            if document is None:
+                result.update(status="not_found")
+            else:
+                logger.info(f"📡 Enviando webhook para N8N: {chave_acesso} (fila {queue_wait:.1f}s)")
+                sent = time.monotonic()
+                response = await self._client.post(self.url, json=document)
+                latency = time.monotonic() - sent
+                response.raise_for_status()
+                result.update(status="delivered", http_status=response.status_code,
+                              webhook_ms=round(1000 * latency, 2))
+                self._latencies.append(latency)
+                self.delivered += 1
+                logger.info(f"✅ Webhook response for {chave_acesso}: {response.status_code} "
+                            f"(fila {queue_wait:.1f}s, webhook {latency:.1f}s)")
+        except asyncio.CancelledError:
+            raise
+        except httpx.TimeoutException:
+            result.update(status="failed", error=f"Timeout calling N8N webhook ({self.timeout:.0f}s)")
+        except Exception as e:
+            result.update(status="failed", error=f"{type(e).__name__}: {e}")
+        if result["status"] == "failed":
+            self.failed += 1
+            logger.warning(f"⚠️  Error calling N8N webhook for {chave_acesso}: {result['error']}")
+        self._queue_waits.append(queue_wait)
+
+        try:
+            async with self._redis.pipeline(transaction=True) as pipe:
+                pipe.zrem(self._keys[2], chave_acesso)
+                pipe.hdel(self._keys[1], chave_acesso)
+                pipe.set(f"{KEY_PREFIX}:result:{chave_acesso}", json.dumps(result), ex=self.result_ttl)
+                await pipe.execute()
+        except Exception as e:
+            # The lease expires and the chave is sent again
+            logger.warning(f"Could not record the webhook dispatch of {chave_acesso}: {e}")
+
+    async def metrics(self) -> Dict:
+        backlog = in_flight = None
+        if self._redis:
+            try:
+                async with self._redis.pipeline(transaction=False) as pipe:
+                    pipe.llen(self._keys[0])
+                    pipe.zcard(self._keys[2])
+                    backlog, in_flight = await pipe.execute()
+            except Exception:
+                pass
+        return {
+            "running": bool(self._runner and not self._runner.done()),
+            "max_in_flight": self.max_in_flight,
+            "in_flight_here": len(self._tasks),
+            "in_flight": in_flight,
+            "backlog": backlog,
+            "backlog_max": self.backlog_max,
+            "enqueued": self.enqueued,
+            "rejected": self.rejected,
+            "delivered": self.delivered,
+            "failed": self.failed,
+            "queue_wait_ms": _percentiles(self._queue_waits),
+            "webhook_ms": _percentiles(self._latencies),
+        }